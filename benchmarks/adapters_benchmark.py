@@ -0,0 +1,157 @@
+'''Benchmark of raw sqlite3, journal and memory adapters against peewee adapters
+
+Runs the same scenarios of storage tests with adapters from
+sqlite_peewee_adapters, sqlite_adapters, serial_task_adapter and
+memory_adapters on database files and prints time of every scenario
+
+Usage: python benchmarks/adapters_benchmark.py [tasks]
+'''
+
+import glob
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tasktracker_core.storage import sqlite_adapters, sqlite_peewee_adapters, serial_task_adapter, memory_adapters
+from tasktracker_core.model.task import Task, Status
+from tasktracker_core.model.user import User
+from tasktracker_core.model.plan import Plan
+from tasktracker_core.model.project import Project
+from tasktracker_core.logging import LoggerConfig
+
+_DEFAULT_TASKS = 10000
+_REPEAT = 5
+_HOUR = 60 * 60 * 1000
+
+def _create_task(number, parent_tid=None):
+    task = Task()
+    task.pid = 1 + number % 10
+    task.uid = 1 + number % 5
+    task.parent_tid = parent_tid
+    task.title = 'Task {} report'.format(number) if number % 7 == 0 else 'Task {}'.format(number)
+    task.status = Status.PENDING
+    task.supposed_start_time = number * _HOUR
+    task.supposed_end_time = number * _HOUR + 3 * _HOUR
+    return task
+
+class _Scenarios():
+
+    def __init__(self, module, db_file, count):
+        self.module = module
+        self.count = count
+        plan_storage = module.PlanStorageAdapter(db_file)
+        db = plan_storage.db
+        self.plan_storage = plan_storage
+        self.task_storage = module.TaskStorageAdapter(db_file, db)
+        self.user_storage = module.UserStorageAdapter(db_file, db)
+        self.project_storage = module.ProjectStorageAdapter(db_file, db)
+
+        for _ in range(5):
+            self.user_storage.save_user(User())
+        for number in range(10):
+            project = Project()
+            project.creator = 1 + number % 5
+            project.name = 'Project {}'.format(number)
+            pid = self.project_storage.save_project(project)
+            self.project_storage.add_admin_to_project(pid, 1 + (number + 1) % 5)
+            self.project_storage.add_guest_to_project(pid, 1 + (number + 2) % 5)
+
+    def bulk_save(self):
+        self.task_storage.save_tasks(_create_task(number) for number in range(self.count))
+
+    def save_one_by_one(self):
+        with self.task_storage.transaction():
+            for number in range(1000):
+                self.task_storage.save_task(_create_task(number))
+
+    def _filter(self):
+        return self.module.TaskStorageAdapter.Filter()
+
+    def get_all(self):
+        self.task_storage.get_tasks()
+
+    def get_user_pages(self):
+        for uid in range(1, 6):
+            filter = self._filter()
+            filter.uid(uid)
+            self.task_storage.get_tasks(filter, limit=50, newest_first=True)
+
+    def filter_range(self):
+        for number in range(0, self.count, self.count // 50):
+            filter = self._filter()
+            filter.uid(1)
+            filter.filter_range(number * _HOUR, number * _HOUR + 24 * _HOUR)
+            self.task_storage.get_tasks(filter)
+
+    def text_search(self):
+        for _ in range(20):
+            filter = self._filter()
+            filter.text_search('report')
+            self.task_storage.get_tasks(filter, limit=50)
+
+    def get_projects(self):
+        for _ in range(100):
+            for uid in range(1, 6):
+                self.project_storage.get_projects(uid)
+
+    def edit_tasks(self):
+        with self.task_storage.transaction():
+            for tid in range(1, 1001):
+                self.task_storage.edit_task({Task.Field.tid: tid, Task.Field.status: Status.ACTIVE})
+
+    def plans(self):
+        with self.plan_storage.transaction():
+            for tid in range(1, 201):
+                plan = Plan()
+                plan.tid = tid
+                plan.shift = _HOUR
+                plan.exclude = [1, 2, 3]
+                plan_id = self.plan_storage.save_plan(plan)
+                self.plan_storage.get_plans(plan_id=plan_id)
+
+    def remove_subtrees(self):
+        with self.task_storage.transaction():
+            tids = self.task_storage.save_tasks(_create_task(number) for number in range(200))
+            for parent_tid in tids[:100]:
+                self.task_storage.save_tasks([_create_task(0, parent_tid), _create_task(1, parent_tid)])
+            for tid in tids[:100]:
+                self.task_storage.remove_task(tid)
+
+_SCENARIOS = ['bulk_save', 'save_one_by_one', 'get_all', 'get_user_pages', 'filter_range',
+              'text_search', 'get_projects', 'edit_tasks', 'plans', 'remove_subtrees']
+
+def _measure(module, count):
+    descriptor, db_file = tempfile.mkstemp(suffix='.db')
+    os.close(descriptor)
+    os.remove(db_file)
+    try:
+        scenarios = _Scenarios(module, db_file, count)
+        times = {}
+        for name in _SCENARIOS:
+            times[name] = min(timeit.repeat(getattr(scenarios, name), number=1, repeat=_REPEAT)) * 1000
+        return times
+    finally:
+        module.close_databases()
+        for path in glob.glob(db_file + '*'):
+            os.remove(path)
+
+def main(count):
+    # default logger writes log files on every save, measure database only
+    LoggerConfig.custom_logger_enabled = True
+    peewee_times = _measure(sqlite_peewee_adapters, count)
+    raw_times = _measure(sqlite_adapters, count)
+    journal_times = _measure(serial_task_adapter, count)
+    memory_times = _measure(memory_adapters, count)
+    print('{:>16} {:>12} {:>12} {:>8} {:>12} {:>8} {:>12} {:>8}'.format('scenario', 'peewee, ms',
+        'sqlite3, ms', 'speedup', 'journal, ms', 'speedup', 'memory, ms', 'speedup'))
+    for name in _SCENARIOS:
+        print('{:>16} {:>12.2f} {:>12.2f} {:>8.2f} {:>12.2f} {:>8.2f} {:>12.2f} {:>8.2f}'.format(name,
+            peewee_times[name], raw_times[name], peewee_times[name] / raw_times[name],
+            journal_times[name], peewee_times[name] / journal_times[name],
+            memory_times[name], peewee_times[name] / memory_times[name]))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else _DEFAULT_TASKS)
@@ -0,0 +1,119 @@
+'''Benchmark of sqlite engine profiles
+
+For every profile from ENGINE_PROFILES measures single task writes
+each committed on its own, reads of task lists and work of several
+processes sharing one database file like site and console jobs do.
+Failed operations are ones which got "database is locked"
+
+Usage: python benchmarks/engine_profile_benchmark.py [writes [processes]]
+'''
+
+import os
+import sys
+import tempfile
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from peewee import OperationalError
+
+from tasktracker_core.storage.sqlite_peewee_adapters import (TaskStorageAdapter, UserStorageAdapter,
+                                                             ProjectStorageAdapter, ENGINE_PROFILES,
+                                                             set_engine_profile, close_databases)
+from tasktracker_core.model.task import Task
+from tasktracker_core.model.user import User
+from tasktracker_core.model.project import Project
+from tasktracker_core.logging import LoggerConfig
+
+_DEFAULT_WRITES = 500
+_DEFAULT_PROCESSES = 4
+_READS = 200
+
+def _create_task(title):
+    task = Task()
+    task.pid = 1
+    task.uid = 1
+    task.title = title
+    return task
+
+def _prepare(db_file):
+    UserStorageAdapter(db_file).save_user(User())
+    project = Project()
+    project.creator = 1
+    ProjectStorageAdapter(db_file).save_project(project)
+
+def _measure_writes(db_file, writes):
+    task_storage = TaskStorageAdapter(db_file)
+    start = time.perf_counter()
+    for number in range(writes):
+        task_storage.save_task(_create_task('Task {}'.format(number)))
+    return (time.perf_counter() - start) / writes * 1000
+
+def _measure_reads(db_file):
+    task_storage = TaskStorageAdapter(db_file)
+    start = time.perf_counter()
+    for _ in range(_READS):
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(1)
+        task_storage.get_tasks(filter, limit=50, newest_first=True)
+    return (time.perf_counter() - start) / _READS * 1000
+
+def _worker(profile_name, db_file, writes, failures):
+    LoggerConfig.custom_logger_enabled = True
+    set_engine_profile(profile_name)
+    task_storage = TaskStorageAdapter(db_file)
+    failed = 0
+    for number in range(writes):
+        try:
+            task_storage.save_task(_create_task('Worker task {}'.format(number)))
+            filter = TaskStorageAdapter.Filter()
+            filter.uid(1)
+            task_storage.get_tasks(filter, limit=50, newest_first=True)
+        except OperationalError:
+            failed += 1
+    failures.put(failed)
+
+def _measure_processes(profile_name, db_file, writes, processes):
+    failures = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker, args=(profile_name, db_file, writes, failures))
+               for _ in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    failed = sum(failures.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, failed
+
+def _remove_database(db_file):
+    for path in (db_file, db_file + '-wal', db_file + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def main(writes, processes):
+    # default logger writes log files on every save, measure database only
+    LoggerConfig.custom_logger_enabled = True
+    print('{:>12} {:>14} {:>14} {:>20} {:>8}'.format('profile', 'write, ms', 'read, ms',
+        '{} processes, s'.format(processes), 'failed'))
+    for profile_name in ENGINE_PROFILES:
+        descriptor, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+        os.remove(db_file)
+        try:
+            set_engine_profile(profile_name)
+            _prepare(db_file)
+            write_time = _measure_writes(db_file, writes)
+            read_time = _measure_reads(db_file)
+            close_databases()
+
+            processes_time, failed = _measure_processes(profile_name, db_file, writes, processes)
+            print('{:>12} {:>14.3f} {:>14.3f} {:>20.3f} {:>8}'.format(profile_name, write_time,
+                read_time, processes_time, failed))
+        finally:
+            close_databases()
+            _remove_database(db_file)
+
+if __name__ == '__main__':
+    arguments = [int(argument) for argument in sys.argv[1:]]
+    main(*(arguments + [_DEFAULT_WRITES, _DEFAULT_PROCESSES][len(arguments):]))
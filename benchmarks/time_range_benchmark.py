@@ -0,0 +1,91 @@
+'''Benchmark of time range queries of tasks
+
+Fills database files with growing count of tasks and measures
+TaskStorageAdapter.Filter.filter_range with interval index and
+with plain scan of task table. Tasks are spread over time span
+proportional to their count, so every query finds about the same
+count of tasks
+
+Usage: python benchmarks/time_range_benchmark.py [count ...]
+'''
+
+import os
+import sys
+import random
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tasktracker_core.storage.sqlite_peewee_adapters import (TaskStorageAdapter, UserStorageAdapter,
+                                                             ProjectStorageAdapter, close_databases)
+from tasktracker_core.model.task import Task
+from tasktracker_core.model.user import User
+from tasktracker_core.model.project import Project
+
+_DEFAULT_COUNTS = [10000, 100000, 1000000]
+_HOUR = 60 * 60 * 1000
+_DAY = 24 * _HOUR
+_SPAN_PER_TASK = 2 * _HOUR
+_INSERT_BATCH = 10000
+_QUERIES = 50
+
+class _ScanFilter(TaskStorageAdapter.Filter):
+    '''Filter without interval index lookup'''
+
+    def _interval_candidates(self, *conditions):
+        pass
+
+def _random_task(random_generator, span):
+    task = Task()
+    task.pid = 1
+    task.uid = 1
+    task.title = 'Task'
+    task.supposed_start_time = random_generator.randrange(span)
+    task.supposed_end_time = task.supposed_start_time + random_generator.randrange(1, 7 * _DAY)
+    return task
+
+def _fill(db_file, count):
+    task_storage = TaskStorageAdapter(db_file)
+    user = User()
+    UserStorageAdapter(db_file).save_user(user)
+    project = Project()
+    project.creator = 1
+    ProjectStorageAdapter(db_file).save_project(project)
+
+    random_generator = random.Random(count)
+    for offset in range(0, count, _INSERT_BATCH):
+        batch_size = min(_INSERT_BATCH, count - offset)
+        task_storage.save_tasks(_random_task(random_generator, count * _SPAN_PER_TASK)
+                                for _ in range(batch_size))
+    return task_storage
+
+def _measure(task_storage, filter_class, count):
+    random_generator = random.Random(0)
+    windows = [random_generator.randrange(count * _SPAN_PER_TASK) for _ in range(_QUERIES)]
+
+    def run():
+        for start in windows:
+            filter = filter_class()
+            filter.uid(1)
+            filter.filter_range(start, start + _DAY)
+            task_storage.get_tasks(filter)
+
+    return min(timeit.repeat(run, number=1, repeat=3)) / _QUERIES * 1000
+
+def main(counts):
+    print('{:>10} {:>16} {:>16}'.format('tasks', 'index, ms/query', 'scan, ms/query'))
+    for count in counts:
+        descriptor, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+        try:
+            task_storage = _fill(db_file, count)
+            print('{:>10} {:>16.3f} {:>16.3f}'.format(count,
+                _measure(task_storage, TaskStorageAdapter.Filter, count),
+                _measure(task_storage, _ScanFilter, count)))
+        finally:
+            close_databases()
+            os.remove(db_file)
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or _DEFAULT_COUNTS)
@@ -8,7 +8,15 @@ There are three groups: user, database and logger
 In user group there is only one item: name. It is name of primary user.
 All operations will be performed on its behalf
 
-In database group there is only one item: path. It is path to database file
+In database group there is path to database file and optional
+settings of database engine:
+profile - name of engine profile: default, concurrent or read_only
+journal_mode, synchronous, cache_size, mmap_size, temp_store,
+busy_timeout - sqlite pragmas, they override values of profile
+busy_retries, busy_retry_delay - retries of statements failed on
+locked database
+read_only - yes to open existing database only for reading, e.g.
+snapshot for reports
 
 In logger group there are seven items:
 enable_logging - available or not logging
@@ -47,6 +55,7 @@ class ConfigReader():
     def __init__(self):
         self.username = None
         self.db_path = None
+        self.db_engine_options = None
         self.high_log_path = None
         self.low_log_path = None
         self.high_log_level = None
@@ -76,6 +85,8 @@ class ConfigReader():
         if 'database' in config:
             database_config = config['database']
             self.db_path = database_config.get('path')
+            self.db_engine_options = {option: value for option, value in database_config.items()
+                                      if option != 'path'}
 
         if 'logger' in config:
             logger_config = config['logger']
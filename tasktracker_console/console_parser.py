@@ -1,5 +1,6 @@
 import argparse
 import datetime
+import itertools
 import re
 import json
 
@@ -19,6 +20,9 @@ from tasktracker_core.requests.controllers import InvalidProjectIdError
 from tasktracker_core import utils
 from tasktracker_console.config_reader import ConfigReader
 from tasktracker_core.logging import LoggerConfig
+from tasktracker_core.storage.sqlite_peewee_adapters import set_engine_profile
+
+TASKS_PAGE_SIZE = 100
 
 class Parser:
     PREFIX = '--'
@@ -114,7 +118,9 @@ def configure_user(config):
             Controller.authentication(users[0].uid)
 
 def configure_database(config):
-     if config.db_path is not None:
+    if config.db_engine_options:
+        set_engine_profile(config.db_engine_options)
+    if config.db_path is not None:
         Controller.set_database_file(config.db_path)
 
 def configure_logger(config):
@@ -368,9 +374,9 @@ def init_task_parser(root):
     show_task_parser.add_argument(Parser.prefix().TASK_TID,
                                   type=int)
     show_task_parser.add_argument(Parser.prefix().TASK_TITLE,
-                                  type=str)
+                                  type=str, help='Words, prefix* or "phrase" to search in title')
     show_task_parser.add_argument(Parser.prefix().TASK_DESCRIPTION,
-                                  type=str)
+                                  type=str, help='Words, prefix* or "phrase" to search in description')
     show_task_parser.add_argument(Parser.prefix().TASK_START_TIME,
                                   type=get_time_arg(),
                                   nargs='+', action=time_collect_action())
@@ -987,11 +993,15 @@ def proccess_task_edit(parsed):
         console_response.show_invalid_time_range_error(error.start, error.end)
 
 def proccess_overall_task(parsed):
-    tasks = TaskController.fetch_tasks()
-    if tasks is not None:
-        console_response.show_full_tasks_in_console(tasks)
-    else:
+    tasks = TaskController.fetch_tasks(lazy=True)
+    if tasks is None:
         console_response.show_common_error()
+        return
+
+    page = list(itertools.islice(tasks, TASKS_PAGE_SIZE))
+    while len(page) != 0:
+        console_response.show_full_tasks_in_console(page)
+        page = list(itertools.islice(tasks, TASKS_PAGE_SIZE))
 
 def proccess_user(parsed):
     if parsed.user == Parser.ADD:
@@ -0,0 +1,45 @@
+class Change():
+    '''Change of one row of storage
+
+    Changes are numbered by revision which only grows. entity is name
+    of changed table, uid and pid are owner and project of changed row
+    if they are known. fields are names of changed fields, empty
+    for deleted row
+    '''
+
+    def __init__(self):
+        self.revision = None
+        self.entity = None
+        self.entity_id = None
+        self.kind = None
+        self.uid = None
+        self.pid = None
+        self.fields = None
+
+    class Field():
+        revision = 'revision'
+        entity = 'entity'
+        entity_id = 'entity_id'
+        kind = 'kind'
+        uid = 'uid'
+        pid = 'pid'
+        fields = 'fields'
+
+    class Kind():
+        INSERT = 0
+        UPDATE = 1
+        DELETE = 2
+
+    class Entity():
+        task = 'task'
+        plan = 'plan'
+        plan_relations = 'plan_relations'
+        user = 'user'
+        project = 'project'
+        project_relations = 'project_relations'
+
+    def __eq__(self, other):
+        if self.__class__ != other.__class__:
+            return False
+
+        return self.__dict__ == other.__dict__
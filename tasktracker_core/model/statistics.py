@@ -0,0 +1,30 @@
+class TaskStatistics():
+    '''Counts of tasks for dashboards
+
+    by_status, by_priority and by_project are dicts from status, priority
+    and pid to count of tasks. overdue is count of not completed tasks
+    which are overdue by status or by time, overdue_by_project is
+    the same count by pids
+    '''
+
+    def __init__(self):
+        self.total = 0
+        self.overdue = 0
+        self.by_status = {}
+        self.by_priority = {}
+        self.by_project = {}
+        self.overdue_by_project = {}
+
+    def add(self, pid, status, priority, count, overdue_count):
+        '''Adds count of tasks of one group'''
+        self.total += count
+        self.overdue += overdue_count
+        for counts, key, value in ((self.by_status, status, count), (self.by_priority, priority, count),
+                                   (self.by_project, pid, count), (self.overdue_by_project, pid, overdue_count)):
+            counts[key] = counts.get(key, 0) + value
+
+    def __eq__(self, other):
+        if self.__class__ != other.__class__:
+            return False
+
+        return self.__dict__ == other.__dict__
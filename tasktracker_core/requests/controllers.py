@@ -8,19 +8,26 @@ TaskController manage tasks
 PlanController manage plans of tasks
 UserController manage users
 ProjectController manage projects
+ChangeController gives changes of storage for incremental clients
+StatisticsController counts tasks and repeats of plans for dashboards
 '''
 
+import contextlib
 import copy
 import datetime
+import itertools
 
 from tasktracker_core.model.task import Task, Status, Priority
 from tasktracker_core.model.user import User, SuperUser
 from tasktracker_core.model.plan import Plan
 from tasktracker_core.model.project import Project
+from tasktracker_core.model.change import Change
+from tasktracker_core.model.statistics import TaskStatistics
 from tasktracker_core.storage.sqlite_peewee_adapters import TaskStorageAdapter
 from tasktracker_core.storage.sqlite_peewee_adapters import UserStorageAdapter
 from tasktracker_core.storage.sqlite_peewee_adapters import PlanStorageAdapter
 from tasktracker_core.storage.sqlite_peewee_adapters import ProjectStorageAdapter
+from tasktracker_core.storage.sqlite_peewee_adapters import ParentNotAllowedError
 import tasktracker_core.utils as utils
 import tasktracker_core.logging as logging
 
@@ -136,37 +143,51 @@ class Controller():
             self._user_storage = UserStorageAdapter()
             self._project_storage = ProjectStorageAdapter()
     
-    def set_database_file(self, db_file):        
+    def set_database_file(self, db_file):
+        '''Switches all storage adapters to specified database file
+
+        All four adapters share one database engine
+        '''
         self._plan_storage = PlanStorageAdapter(db_file=db_file)
-        self._task_storage = TaskStorageAdapter(db_file=db_file)
-        self._user_storage = UserStorageAdapter(db_file=db_file)
-        self._project_storage = ProjectStorageAdapter(db_file=db_file)
+        db = self._plan_storage.db
+        self._task_storage = TaskStorageAdapter(db_file=db_file, db=db)
+        self._user_storage = UserStorageAdapter(db_file=db_file, db=db)
+        self._project_storage = ProjectStorageAdapter(db_file=db_file, db=db)
 
     def init_storage_adapters(self, plan_storage_adapter=None,
                               task_storage_adapter=None,
                               user_storage_adapter=None,
-                              project_storage_adapter=None):
+                              project_storage_adapter=None,
+                              db_file=None):
         '''Let to install custom storage adapters. 
 
         If an adapter will transmitted with None, default adapter
         will be installed
+        If db_file is specified, adapters are opened on it and share
+        database of plan adapter, like adapters of
+        tasktracker_core.storage.sqlite_adapters do. Adapters of
+        tasktracker_core.storage.sharded_adapters share shard router
         '''
         if plan_storage_adapter is None:
-            self._plan_storage = PlanStorageAdapter()
-        else:
-            self._plan_storage = plan_storage_adapter()
+            plan_storage_adapter = PlanStorageAdapter
         if task_storage_adapter is None:
-            self._task_storage = TaskStorageAdapter()
-        else:
-            self._task_storage = task_storage_adapter()
+            task_storage_adapter = TaskStorageAdapter
         if user_storage_adapter is None:
-            self._user_storage = UserStorageAdapter()
-        else:
-            self._user_storage = user_storage_adapter()
+            user_storage_adapter = UserStorageAdapter
         if project_storage_adapter is None:
-            self._project_storage = ProjectStorageAdapter()
-        else:
+            project_storage_adapter = ProjectStorageAdapter
+
+        if db_file is None:
+            self._plan_storage = plan_storage_adapter()
+            self._task_storage = task_storage_adapter()
+            self._user_storage = user_storage_adapter()
             self._project_storage = project_storage_adapter()
+        else:
+            self._plan_storage = plan_storage_adapter(db_file=db_file)
+            db = self._plan_storage.db
+            self._task_storage = task_storage_adapter(db_file=db_file, db=db)
+            self._user_storage = user_storage_adapter(db_file=db_file, db=db)
+            self._project_storage = project_storage_adapter(db_file=db_file, db=db)
 
     
     def _internal_authentication(self, users, provided_user_id=None, provided_user_login=None):
@@ -233,6 +254,35 @@ class Controller():
             return method(self, *args, **kwargs)
         return check
 
+    def transaction(self):
+        '''Unit of work over all storage adapters of controller
+
+        Returns context manager, all adapter calls inside it share one
+        transaction. Controllers created from this one with
+        Controller(controller) share it too, their transactions become
+        savepoints. Exception inside rolls back the transaction
+        '''
+        transaction = getattr(self._task_storage, 'transaction', None)
+        if transaction is None:
+            return contextlib.nullcontext()
+        return transaction()
+
+    @staticmethod
+    def transactional(method):
+        '''Decorator for methods of controller
+
+        Runs method in transaction of controller. If method raises
+        an error or returns False, all its changes are rolled back
+        '''
+
+        def run_in_transaction(self, *args, **kwargs):
+            with self.transaction() as transaction:
+                result = method(self, *args, **kwargs)
+                if result is False and transaction is not None:
+                    transaction.rollback()
+            return result
+        return run_in_transaction
+
     
     def is_authenticated(self):
         return self._user_login_id != None
@@ -253,6 +303,9 @@ class TaskController(Controller):
 
     _log_tag = 'TaskController'
 
+    # default age of completed tasks moved to archive, in milliseconds
+    ARCHIVE_AGE = 90 * 24 * 60 * 60 * 1000
+
     class TaskValidator(Controller.Validator):
         '''Validate tasks
 
@@ -308,7 +361,7 @@ class TaskController(Controller):
                 logging.get_logger(self.controller._log_tag).error('Wrong parent. Trying to connect task to itself')
                 raise InvalidParentIdError(parent_tid)
 
-            filter = TaskStorageAdapter.Filter()
+            filter = self.controller._task_storage.Filter()
             filter.tid(self.task.parent_tid)
             tasks = self.controller._task_storage.get_tasks(filter)
             if len(tasks) == 0:
@@ -456,6 +509,7 @@ class TaskController(Controller):
         In this case special transforms will occure
 
         If pid is None, default project will be used
+        Returns tid of saved task
         '''
 
         if pid is None:
@@ -518,8 +572,8 @@ class TaskController(Controller):
         validator = self.TaskValidator(task, self)
         validator.run()
 
-        success = self._task_storage.save_task(task)
-        return success
+        tid = self._task_storage.save_task(task)
+        return tid
 
 
     
@@ -593,13 +647,28 @@ class TaskController(Controller):
     def fetch_tasks(self, pid=None, parent_tid=None, tid=None, title=None, description=None,
                         priority=None, status=None, notificate_supposed_start=None, 
                         notificate_supposed_end=None, notificate_deadline=None, 
-                        time_range=None, timeless=None):
+                        time_range=None, timeless=None, limit=None, after_tid=None,
+                        newest_first=False, lazy=False, with_cursor=False, include_archived=False):
         '''Fetches tasks
 
         If pid was specified, tasks will be fetched from projects but not by
-        user id. Otherwise authorised user id will be used
+        user id. Otherwise authorised user id will be used. pid can be list of projects
         If there are plan tasks, their repeats and edits will be fetched
+        title and description are full-text queries, see TaskStorageAdapter.Filter.text_search
+
+        Tasks are ordered by tid (descending if newest_first) and can be paged:
+        limit bounds count of tasks read from storage and after_tid is cursor
+        of previous page. Common tasks of plans are replaced by their repeats,
+        so page can have other tids or less tasks. Plan repeats in time_range
+        are fetched with the first page only
+        If with_cursor is True, pair of tasks and cursor of the next page is returned,
+        cursor is tid of the last task read from storage or None if there are no more tasks
+        If lazy is True, generator is returned, tasks are read from storage by cursor
+        Archived tasks are fetched if include_archived is True or if completed
+        tasks are fetched by status, see archive_tasks
         '''
+        if lazy and with_cursor:
+            raise ValueError('Cursor is known only when all tasks of page are read')
 
         if isinstance(priority, str):
             priority = Priority.from_str(priority)
@@ -608,7 +677,8 @@ class TaskController(Controller):
 
         filter = self._task_storage.Filter()
         if pid is not None:
-            UserController(self).check_project_available(self._user_login_id, pid)
+            for project_pid in (pid if isinstance(pid, list) else [pid]):
+                UserController(self).check_project_available(self._user_login_id, project_pid)
             filter.pid(pid)
         else:
             filter.uid(self._user_login_id)
@@ -617,10 +687,10 @@ class TaskController(Controller):
             filter.tid(tid)
         if parent_tid is not None:
             filter.parent_tid(parent_tid)
-        # if title is not None:
-        #     filter.title(title)
-        # if description is not None:
-        #     filter.description(description)
+        if title is not None:
+            filter.text_search(title, [Task.Field.title])
+        if description is not None:
+            filter.text_search(description, [Task.Field.description])
         if priority is not None:
             filter.priority(priority)
         if status is not None:
@@ -639,50 +709,79 @@ class TaskController(Controller):
         if timeless:
             filter.timeless()
 
-        tasks = self._task_storage.get_tasks(filter)
-
-        reverse_task = tasks[::-1]
-        for i in range(len(reverse_task)):
-            task = reverse_task[i]
-            plans = PlanController(self).get_plan_for_common_task(task.tid)
-            if plans is not None and len(plans) != 0:
-                tasks.remove(task)
-                if time_range is None:
-                    most_valuable_task = self.get_most_valuable_task(plans[0].plan_id)
-                    if most_valuable_task is not None:
-                        logging.get_logger(self._log_tag).info(('Task {} was defined as planned. '
-                            'Most valuable for it is {}').format(task.tid, most_valuable_task.__dict__))
-                        tasks.append(most_valuable_task)
-
-        print('PLANS', time_range)
-        if time_range is not None:
-            plans = PlanController(self).get_plans_by_time_range(time_range)
-            plan_tid_ids = []
-            print('PLANS', plans)
-            for plan in plans:
-                print('PLANS', 'HERE')
-                if plan.tid in plan_tid_ids:
-                    continue
-                plan_tid_ids.append(plan.tid)
-                plan_tasks = self.get_plan_tasks_by_time_range(plan.plan_id, time_range)
-                print('PLANS', plan_tasks)
-                if tasks is None:
-                    tasks = []
-                tasks.extend(plan_tasks)
-
-        print('PLANS 1', tasks)
+        if status == Status.COMPLETED or (isinstance(status, list) and Status.COMPLETED in status):
+            include_archived = True
+
+        stored_tasks = self._iterate_stored_tasks(filter, time_range, after_tid, newest_first,
+                                                  include_archived)
+        if limit is not None:
+            stored_tasks = itertools.islice(stored_tasks, limit)
+        plan_tasks = []
+        if time_range is not None and after_tid is None:
+            plan_tasks = self._iterate_plan_tasks_by_time_range(time_range, title, description)
+
+        if lazy:
+            return itertools.chain((task for _, task in stored_tasks if task is not None), plan_tasks)
+
+        tasks = []
+        cursor = None
+        count = 0
+        for stored_tid, task in stored_tasks:
+            count += 1
+            cursor = stored_tid
+            if task is not None:
+                tasks.append(task)
+        if limit is None or count < limit:
+            cursor = None
+        tasks.extend(plan_tasks)
+
+        if with_cursor:
+            return tasks, cursor
+        return tasks
 
-        if title is not None:
-            for i in range(len(tasks)-1, -1, -1):
-                if title not in tasks[i].title:
-                    del tasks[i]
-        if description is not None:
-            for i in range(len(tasks)-1, -1, -1):
-                if (tasks[i].description is not None and
-                    description not in tasks[i].description):
-                    del tasks[i]
+    def _iterate_stored_tasks(self, filter, time_range, after_tid, newest_first, include_archived):
+        '''Yields pairs of tid of stored task and task to fetch
 
-        return tasks
+        Common tasks of plans are replaced by their most valuable repeat
+        if time_range is not specified, task to fetch is None if common
+        task is skipped
+        '''
+        plan_controller = PlanController(self)
+        for task in self._task_storage.iterate_tasks(filter, after_tid, newest_first,
+                                                     include_archived=include_archived):
+            plans = plan_controller.get_plan_for_common_task(task.tid)
+            if plans is None or len(plans) == 0:
+                yield task.tid, task
+            elif time_range is None:
+                most_valuable_task = self.get_most_valuable_task(plans[0].plan_id)
+                if most_valuable_task is not None:
+                    logging.get_logger(self._log_tag).info(('Task {} was defined as planned. '
+                        'Most valuable for it is {}').format(task.tid, most_valuable_task.__dict__))
+                yield task.tid, most_valuable_task
+            else:
+                yield task.tid, None
+
+    def _iterate_plan_tasks_by_time_range(self, time_range, title=None, description=None):
+        plans = PlanController(self).get_plans_by_time_range(time_range)
+        plan_tasks = []
+        plan_tid_ids = []
+        for plan in plans:
+            if plan.tid in plan_tid_ids:
+                continue
+            plan_tid_ids.append(plan.tid)
+            plan_tasks.extend(self.get_plan_tasks_by_time_range(plan.plan_id, time_range))
+
+        if len(plan_tasks) != 0 and (title is not None or description is not None):
+            filter = self._task_storage.Filter()
+            filter.tid(list({task.tid for task in plan_tasks}))
+            if title is not None:
+                filter.text_search(title, [Task.Field.title])
+            if description is not None:
+                filter.text_search(description, [Task.Field.description])
+            found_tids = {task.tid for task in self._task_storage.get_tasks(filter)}
+            plan_tasks = [task for task in plan_tasks if task.tid in found_tids]
+
+        yield from plan_tasks
 
     
     @Controller.require_authentication
@@ -773,8 +872,27 @@ class TaskController(Controller):
         success = self._task_storage.remove_task(task_id)
         return success
 
+    def archive_tasks(self, age=None):
+        '''Moves completed tasks and plans which ended more than age
+        milliseconds ago to archive
+
+        Archived tasks are fetched only if fetch_tasks is asked for them or
+        for completed tasks. It is maintenance of whole storage, so tasks
+        of all users are archived. Returns dict with counts of moved rows
+        '''
+        if age is None:
+            age = self.ARCHIVE_AGE
+        before_time = utils.datetime_to_milliseconds(utils.now()) - age
+        # storage moves rows by batches, each in its own transaction
+        counts = self._plan_storage.archive_plans(before_time)
+        counts[Change.Entity.task] += self._task_storage.archive_tasks(before_time)
+        logging.get_logger(self._log_tag).info('Tasks and plans which ended before {} were archived: {}'\
+            .format(before_time, counts))
+        return counts
+
     
     @Controller.require_authentication
+    @Controller.transactional
     def edit_task(self, task_id, pid=Controller._not_edit_field_flag,
                   parent_tid=Controller._not_edit_field_flag, 
                   title=Controller._not_edit_field_flag, 
@@ -793,13 +911,17 @@ class TaskController(Controller):
         If edititing task is plan common task and time not shifted
         on plan shift, all excludes will be restored
         If pid is not specified, default pid for user will be used
-        If edititing task is parent task and status and/or priority are changed
-        all childrens will be notified about their parent changes
+        If edititing task is parent task and status and/or priority are changed,
+        they are set to all its subtasks at once. Status of subtasks is checked
+        against their time before any change, common tasks of plans and
+        their subtasks keep their status
+        If storage can not keep task under new parent, InvalidParentIdError
+        will be raised
         '''
 
         UserController(self).check_task_available(self._user_login_id, task_id, True)
 
-        filter = TaskStorageAdapter.Filter()
+        filter = self._task_storage.Filter()
         filter.tid(task_id)
         tasks = self._task_storage.get_tasks(filter)
         if tasks is None or len(tasks) == 0:
@@ -829,10 +951,6 @@ class TaskController(Controller):
         if priority is None:
             priority = Priority.NORMAL
 
-        filter = TaskStorageAdapter.Filter()
-        filter.parent_tid(task_id)
-        childer = self._task_storage.get_tasks(filter)
-
         if pid is not Controller._not_edit_field_flag:
             if pid is None:
                 default_project = ProjectController(self).get_default_project_for_user(self._user_login_id)
@@ -866,13 +984,21 @@ class TaskController(Controller):
         task_validator = self.TaskValidator(task, self, force=force)
         task_validator.run()
 
-        success = self._task_storage.edit_task_from_model(task)
+        if status is not Controller._not_edit_field_flag:
+            for subtask in self._task_storage.get_subtasks(task_id, skip_plan_tasks=True):
+                subtask.status = status
+                self.TaskValidator(subtask, self, force=force).validate_status_time_relations()
+
+        try:
+            success = self._task_storage.edit_task_from_model(task)
+        except ParentNotAllowedError as error:
+            logging.get_logger(self._log_tag).error('Storage can not keep task under parent')
+            raise InvalidParentIdError(error.parent_tid, str(error))
         if success:
-            for child in childer:
-                if status is not Controller._not_edit_field_flag:
-                    self.edit_task(child.tid, status=status)
-                if priority is not Controller._not_edit_field_flag:
-                    self.edit_task(child.tid, priority=priority)
+            if status is not Controller._not_edit_field_flag:
+                self._task_storage.edit_subtasks(task_id, {Task.Field.status: status}, skip_plan_tasks=True)
+            if priority is not Controller._not_edit_field_flag:
+                self._task_storage.edit_subtasks(task_id, {Task.Field.priority: priority})
         return success
 
 class UserController(Controller):
@@ -890,6 +1016,7 @@ class UserController(Controller):
         '''Save user
 
         If user already exists, UserAlreadyExistsError will be raised
+        Returns uid of saved user
         '''
 
         if user_id is None:
@@ -902,14 +1029,16 @@ class UserController(Controller):
 
         exists = self._user_storage.check_user_existence(login)
         if not exists:
-            success = self._user_storage.save_user(user)
+            uid = self._user_storage.save_user(user)
+            if uid is None:
+                return None
 
             project = Project()
-            project.creator = self._user_storage.get_last_saved_user().uid
+            project.creator = uid
             project.name = Project.default_project_name
             self._project_storage.save_project(project)
 
-            return success
+            return uid
         else:
             raise UserAlreadyExistsError(login)
 
@@ -917,7 +1046,7 @@ class UserController(Controller):
     def fetch_user(self, uid=None, login=None, online=None):
         '''Return users by specified params'''
 
-        filter = UserStorageAdapter.Filter()
+        filter = self._user_storage.Filter()
         if uid is not None:
             filter.uid(uid)
         if login is not None:
@@ -929,20 +1058,23 @@ class UserController(Controller):
         return users
 
     
+    @Controller.transactional
     def delete_user(self, user_id):
         '''Delete user and related projects
 
-        User can delete only itself
+        User can delete only itself. Projects created by user are removed
+        with all their tasks, then all tasks of user are removed, everything
+        with a few storage statements in one transaction
         '''
 
         projects = self._project_storage.get_projects(user_id)
-        for project in projects:
-            if project.creator == user_id:
-                ProjectController(self).remove_project_for_user(user_id, project.pid)
+        pids = [project.pid for project in projects if project.creator == user_id]
+        counts = self._project_storage.remove_projects(pids)
+        for entity, count in self._user_storage.remove_user(user_id).items():
+            counts[entity] = counts.get(entity, 0) + count
 
-        ProjectController(self).fetch_projects()
-        success = self._user_storage.delete_user(user_id)
-        return success
+        logging.get_logger(self._log_tag).info('User {} was deleted, removed rows: {}'.format(user_id, counts))
+        return counts[Change.Entity.user] == 1
 
     
     def edit_user(self, user_id, login=-1, online=-1):
@@ -979,7 +1111,7 @@ class UserController(Controller):
         PermissionDenied if it is so. Than checks if user is participiant
         of project and raise PermissionDenied if it is so
         '''
-        filter = TaskStorageAdapter.Filter()
+        filter = self._task_storage.Filter()
         filter.tid(tid)
         tasks = self._task_storage.get_tasks(filter)
         if tasks is not None and len(tasks) != 0:
@@ -1046,6 +1178,8 @@ class PlanController(Controller):
     @Controller.require_authentication
     def attach_plan(self, tid, shift, end=None):
         '''Create and attach new plan with sift and mey be end to task
+
+        Returns plan_id of created plan
         '''
 
         UserController(self).check_task_available(self._user_login_id, tid, True)
@@ -1063,8 +1197,8 @@ class PlanController(Controller):
         plan.tid = tid
         plan.shift = shift
         plan.end = end
-        success = self._plan_storage.save_plan(plan)
-        return success
+        plan_id = self._plan_storage.save_plan(plan)
+        return plan_id
 
     
     @Controller.require_authentication
@@ -1097,6 +1231,7 @@ class PlanController(Controller):
 
     
     @Controller.require_authentication
+    @Controller.transactional
     def edit_repeat_by_number(self, plan_id, number, 
                               status=Controller._not_edit_field_flag, 
                               priority=Controller._not_edit_field_flag, 
@@ -1147,13 +1282,11 @@ class PlanController(Controller):
             if not success:
                 return False
 
-        success = self._task_storage.save_task(task)
-        if not success:
+        edited_tid = self._task_storage.save_task(task)
+        if edited_tid is None:
             return False
 
-        edited_task = self._task_storage.get_last_saved_task()
-
-        success = self._plan_storage.edit_plan_repeat(plan.plan_id, number, edited_task.tid)
+        success = self._plan_storage.edit_plan_repeat(plan.plan_id, number, edited_tid)
         return success
 
     
@@ -1401,7 +1534,7 @@ class PlanController(Controller):
             return None
         plan = plans[0]
 
-        filter = TaskStorageAdapter.Filter()
+        filter = self._task_storage.Filter()
         filter.tid(plan.tid)
         task = self._task_storage.get_tasks(filter)[0]
 
@@ -1428,7 +1561,7 @@ class PlanController(Controller):
             return []
         plan = plans[0]
 
-        filter = TaskStorageAdapter.Filter()
+        filter = self._task_storage.Filter()
         filter.tid(plan.tid)
         task = self._task_storage.get_tasks(filter)[0]
 
@@ -1472,7 +1605,7 @@ class ProjectController(Controller):
     
     @Controller.require_authentication
     def save_project(self, name):
-        '''Saves new project
+        '''Saves new project and returns its pid
         '''
 
         exist_projects = self.fetch_projects(name=name)
@@ -1482,8 +1615,8 @@ class ProjectController(Controller):
         project = Project()
         project.creator = self._user_login_id
         project.name = name
-        success = self._project_storage.save_project(project)
-        return success
+        pid = self._project_storage.save_project(project)
+        return pid
 
     
     @Controller.require_authentication
@@ -1507,6 +1640,7 @@ class ProjectController(Controller):
         return projects
 
     
+    @Controller.transactional
     def remove_project_for_user(self, uid, pid):
         '''Removes a project for specified user
 
@@ -1517,13 +1651,9 @@ class ProjectController(Controller):
         if default_project is not None and default_project.pid == pid:
             return False
 
-        tasks = TaskController(self).fetch_tasks(pid=pid)
-        if tasks is not None:
-            for task in tasks:
-                TaskController(self).remove_task(task.tid)
-        
-        success = self._project_storage.remove_project(pid)
-        return success
+        counts = self._project_storage.remove_projects([pid])
+        logging.get_logger(self._log_tag).info('Project {} was removed, removed rows: {}'.format(pid, counts))
+        return counts[Change.Entity.project] != 0
 
     
     @Controller.require_authentication
@@ -1641,3 +1771,125 @@ class ProjectController(Controller):
         else:
             success = self._project_storage.remove_guest_from_project(pid, uid)
         return success
+
+class ChangeController(Controller):
+    '''Controller for log of changes
+
+    Clients remember revision of the last change they have seen and
+    fetch only changes made after it instead of fetching all data again
+    '''
+
+    _log_tag = 'ChangeController'
+
+    
+    @Controller.require_authentication
+    def get_current_revision(self):
+        '''Returns revision of the last change of storage
+        '''
+
+        return self._task_storage.current_revision()
+
+    
+    @Controller.require_authentication
+    def fetch_changes(self, since_revision=0, limit=None):
+        '''Returns changes made after since_revision which authenticated user can see
+
+        These are changes of rows of user and of projects where user is
+        creator, admin or guest, ordered by revision
+        '''
+
+        return self._task_storage.get_changes(since_revision, self._user_login_id, limit)
+
+class StatisticsController(Controller):
+    '''Controller for statistics of tasks for dashboards
+
+    Statistics are counted by grouping queries of storage, so tasks
+    are not fetched and repeats of plans are not expanded
+    '''
+
+    _log_tag = 'StatisticsController'
+
+    DAY = 24 * 60 * 60 * 1000
+
+    def _get_owners(self, pid):
+        '''Returns uid and pids of counted tasks, like in TaskController.fetch_tasks
+        tasks of user are counted if pid was not specified
+        '''
+        if pid is None:
+            return self._user_login_id, None
+        pids = pid if isinstance(pid, list) else [pid]
+        for project_pid in pids:
+            UserController(self).check_project_available(self._user_login_id, project_pid)
+        return None, pids
+
+    def _get_filter(self, pid):
+        uid, pids = self._get_owners(pid)
+        filter = self._task_storage.Filter()
+        if uid is not None:
+            filter.uid(uid)
+        else:
+            filter.pid(pids)
+        return filter
+
+    @staticmethod
+    def _get_borders(time_range):
+        if len(time_range) == 1:
+            return time_range[0], time_range[0]
+        start_time, end_time = time_range
+        if start_time > end_time:
+            raise InvalidTimeError(start_time, end_time)
+        return start_time, end_time
+
+    
+    @Controller.require_authentication
+    def get_task_statistics(self, pid=None, time=None, include_archived=False):
+        '''Returns TaskStatistics of tasks of user or of projects
+
+        If pid was specified, tasks of projects are counted but not by
+        user id, pid can be list of projects. Not completed tasks are
+        overdue by status or by time, now if time was not specified.
+        Archived tasks are counted if include_archived is True
+        '''
+
+        if time is None:
+            time = utils.datetime_to_milliseconds(utils.now())
+        counts = self._task_storage.count_tasks(self._get_filter(pid), time, include_archived)
+        statistics = TaskStatistics()
+        for (task_pid, status, priority), (count, overdue_count) in counts.items():
+            statistics.add(task_pid, status, priority, count, overdue_count)
+        return statistics
+
+    
+    @Controller.require_authentication
+    def get_completed_histogram(self, time_range, pid=None, bucket_length=DAY):
+        '''Returns list of pairs of start time of bucket and count of
+        tasks completed in it
+
+        time_range is divided into buckets of bucket_length milliseconds,
+        buckets without tasks are in list too. Task is counted by its end
+        or deadline because time of completion is not stored. Archived
+        tasks are counted too, tasks are chosen by pid like in get_task_statistics
+        '''
+
+        if bucket_length <= 0:
+            raise ValueError('Length of bucket should be positive')
+        start_time, end_time = self._get_borders(time_range)
+        histogram = self._task_storage.count_completed_tasks(start_time, end_time + 1, bucket_length,
+                                                             self._get_filter(pid))
+        return [(bucket_start, histogram.get(bucket_start, 0))
+                for bucket_start in range(start_time, end_time + 1, bucket_length)]
+
+    
+    @Controller.require_authentication
+    def get_plan_repeat_counts(self, time_range, pid=None):
+        '''Returns dict from plan_id to count of repeats of plan in time range
+
+        Repeats are counted like in PlanController.get_repeats_by_time_range
+        from times of common task, shift and end of plan, without
+        expanding them. Plans without repeats in time range are skipped,
+        plans are chosen by pid like in get_task_statistics
+        '''
+
+        start_time, end_time = self._get_borders(time_range)
+        uid, pids = self._get_owners(pid)
+        return self._plan_storage.count_repeats(start_time, end_time, uid, pids)
@@ -0,0 +1,1459 @@
+'''Storage adapters over tables kept in memory
+
+Pure python adapters with the same methods as adapters of
+sqlite_peewee_adapters, for tests, simulations and caches. Rows are
+dicts in tables with hash indexes on filtered columns and sorted
+indexes on time borders of tasks. Filters are compiled into
+predicates over rows, conditions on indexed columns also select
+candidate rows by indexes, so other rows are not checked.
+
+Adapters opened with the same db_file share database in process,
+':memory:' included, close_databases forgets them.
+Install adapters with Controller.init_storage_adapters
+'''
+
+import bisect
+import heapq
+import itertools
+import math
+import re
+import threading
+
+from tasktracker_core.model.task import Task, Status
+from tasktracker_core.model.user import User
+from tasktracker_core.model.plan import Plan
+from tasktracker_core.model.project import Project
+from tasktracker_core.model.change import Change
+from tasktracker_core import logging
+
+_DEFAULT_DB_NAME = 'tasktracker'
+
+_EMPTY = frozenset()
+
+# Default count of trees of tasks or plans moved to archive in one transaction
+_ARCHIVE_BATCH_SIZE = 500
+
+class _PlanRelationKind():
+    COMMON = 0
+    EDITED = 1
+    DELETED = 2
+
+class _ProjectRelationKind():
+    ADMIN = 0
+    GUEST = 1
+
+class _SortedIndex():
+    '''Pairs of value and id of row sorted by value, None values are not kept'''
+
+    def __init__(self):
+        self._items = []
+
+    def add(self, value, id):
+        if value is not None:
+            bisect.insort(self._items, (value, id))
+
+    def remove(self, value, id):
+        if value is not None:
+            del self._items[bisect.bisect_left(self._items, (value, id))]
+
+    def bounds(self, low=None, high=None, strict_high=False):
+        '''Returns positions of items with low <= value <= high,
+        strict_high excludes value equal to high
+        '''
+        start = 0 if low is None else bisect.bisect_left(self._items, (low, -math.inf))
+        end = len(self._items)
+        if high is not None:
+            end = bisect.bisect_left(self._items, (high, -math.inf if strict_high else math.inf))
+        return start, max(start, end)
+
+    def ids(self, start, end):
+        return [id for _, id in self._items[start:end]]
+
+    def rebuild(self, items):
+        self._items = sorted(item for item in items if item[0] is not None)
+
+class _Table():
+    '''Rows of table by their ids with hash indexes and sorted indexes on columns
+
+    Rows are dicts, they are never changed in place: edited row
+    is put as new dict
+    '''
+
+    def __init__(self, key, indexed_columns=(), sorted_columns=()):
+        self.key = key
+        self.rows = {}
+        self.last_id = 0
+        self.indexes = {column: {} for column in indexed_columns}
+        self.sorted_indexes = {column: _SortedIndex() for column in sorted_columns}
+
+    def find(self, column, value):
+        '''Returns ids of rows with value in column, set should not be changed'''
+        if column == self.key:
+            return {value} if value in self.rows else _EMPTY
+        return self.indexes[column].get(value, _EMPTY)
+
+    def put(self, row):
+        '''Puts row and returns previous row with the same id'''
+        id = row[self.key]
+        old_row = self.rows.get(id)
+        if old_row is not None:
+            self._unindex(old_row)
+        self.rows[id] = row
+        self.last_id = max(self.last_id, id)
+        for column, index in self.indexes.items():
+            index.setdefault(row[column], set()).add(id)
+        for column, index in self.sorted_indexes.items():
+            index.add(row[column], id)
+        return old_row
+
+    def load(self, rows):
+        '''Puts many rows, sorted indexes are sorted once'''
+        sorted_indexes = self.sorted_indexes
+        self.sorted_indexes = {}
+        try:
+            for row in rows:
+                self.put(row)
+        finally:
+            self.sorted_indexes = sorted_indexes
+            for column, index in sorted_indexes.items():
+                index.rebuild((row[column], id) for id, row in self.rows.items())
+
+    def delete(self, id):
+        '''Deletes row and returns it or None if there was no row'''
+        row = self.rows.pop(id, None)
+        if row is not None:
+            self._unindex(row)
+        return row
+
+    def _unindex(self, row):
+        id = row[self.key]
+        for column, index in self.indexes.items():
+            ids = index[row[column]]
+            ids.discard(id)
+            if len(ids) == 0:
+                del index[row[column]]
+        for column, index in self.sorted_indexes.items():
+            index.remove(row[column], id)
+
+class _Transaction():
+    '''Transaction of Database, nested one works like savepoint
+
+    Changes are applied at once and remembered to be undone.
+    Transaction holds lock of database, so other threads wait for it
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._undo_size = 0
+
+    def __call__(self, method):
+        def run_in_transaction(*args, **kwargs):
+            with _Transaction(self.db):
+                return method(*args, **kwargs)
+        return run_in_transaction
+
+    def __enter__(self):
+        self.db.lock.acquire()
+        self._undo_size = len(self.db._undo)
+        self.db._depth += 1
+        return self
+
+    def rollback(self):
+        '''Rolls back all changes made in transaction, transaction stays open'''
+        self.db._rollback(self._undo_size)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.db._depth -= 1
+            if exc_type is not None:
+                self.rollback()
+            elif self.db._depth == 0:
+                self.db._commit()
+        finally:
+            self.db.lock.release()
+
+class Database():
+    '''Tables of adapters kept in memory'''
+
+    # table name to key column, indexed columns and sorted columns
+    _TABLES = {'task': ('tid', ('uid', 'pid', 'parent_tid', 'status'),
+                        ('left_border', 'interval_left', 'interval_right')),
+               'plan': ('plan_id', (), ()),
+               'plan_relations': ('relation_id', ('plan_id', 'tid'), ()),
+               'user': ('uid', ('login', ), ()),
+               'project': ('pid', ('creator', ), ()),
+               'project_relations': ('relation_id', ('pid', 'uid'), ()),
+               'change_log': ('revision', (), ()),
+               'task_archive': ('tid', ('uid', 'pid', 'parent_tid', 'status'),
+                                ('left_border', 'interval_left', 'interval_right')),
+               'plan_archive': ('plan_id', (), ()),
+               'plan_relations_archive': ('relation_id', ('plan_id', ), ())}
+
+    # logged table to its logged fields, other columns of rows are internal
+    _CHANGE_LOG_FIELDS = {
+        'task': ('pid', 'uid', 'title', 'description', 'supposed_start_time', 'supposed_end_time',
+                 'deadline_time', 'parent_tid', 'priority', 'status', 'notificate_supposed_start',
+                 'notificate_supposed_end', 'notificate_deadline'),
+        'plan': ('end', 'shift'),
+        'plan_relations': ('plan_id', 'tid', 'number', 'kind'),
+        'user': ('login', 'password', 'online'),
+        'project': ('creator', 'name'),
+        'project_relations': ('pid', 'uid', 'kind')}
+
+    def __init__(self, db_file=_DEFAULT_DB_NAME):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.tables = {name: _Table(*columns) for name, columns in self._TABLES.items()}
+        self._depth = 0
+        self._undo = []
+
+    def get(self, name, id):
+        return self.tables[name].rows.get(id)
+
+    def find(self, name, column, value):
+        '''Returns sorted list of ids of rows with value in column'''
+        with self.lock:
+            return sorted(self.tables[name].find(column, value))
+
+    def insert(self, name, row):
+        '''Gives row the next id of table, saves it and returns the id'''
+        with self.lock:
+            table = self.tables[name]
+            row[table.key] = table.last_id + 1
+            self._put(table, name, row)
+            return row[table.key]
+
+    def update(self, table_name, id, **values):
+        '''Saves copy of row with new values, returns False if there is no row'''
+        with self.lock:
+            table = self.tables[table_name]
+            row = table.rows.get(id)
+            if row is None:
+                return False
+            row = dict(row)
+            row.update(values)
+            self._put(table, table_name, row)
+            return True
+
+    def delete(self, name, id):
+        '''Deletes row, returns False if there is no row'''
+        with self.lock:
+            row = self.tables[name].delete(id)
+            if row is None:
+                return False
+            self._log(name, id, row, None)
+            self._log_change(name, id, row, None)
+            return True
+
+    def move(self, name, to_name, id):
+        '''Moves row to other table with the same id, returns False
+        if there is no row. Row is logged as deleted
+        '''
+        with self.lock:
+            row = self.tables[name].delete(id)
+            if row is None:
+                return False
+            self._log(name, id, row, None)
+            self._log_change(name, id, row, None)
+            self._put(self.tables[to_name], to_name, row)
+            return True
+
+    def _put(self, table, name, row):
+        old_row = table.put(row)
+        self._log(name, row[table.key], old_row, row)
+        self._log_change(name, row[table.key], old_row, row)
+
+    def _log_change(self, name, id, old_row, row):
+        '''Writes change of row to change_log like triggers of sqlite adapters do'''
+        fields = self._CHANGE_LOG_FIELDS.get(name)
+        if fields is None:
+            return
+        if row is None:
+            kind = Change.Kind.DELETE
+            fields = None
+        elif old_row is None:
+            kind = Change.Kind.INSERT
+        else:
+            kind = Change.Kind.UPDATE
+            fields = [field for field in fields if old_row[field] != row[field]]
+            if len(fields) == 0:
+                return
+        uid, pid = self._get_owner(name, row if row is not None else old_row)
+        self.insert('change_log', {'entity': name, 'entity_id': id, 'kind': kind, 'uid': uid, 'pid': pid,
+                                   'fields': None if fields is None else ','.join(fields)})
+
+    def _get_owner(self, name, row):
+        '''Returns uid and pid of owner of row, plans and their relations
+        belong to owner of common task while it exists
+        '''
+        if name in ('task', 'project_relations'):
+            return row['uid'], row['pid']
+        if name == 'user':
+            return row['uid'], None
+        if name == 'project':
+            return row['creator'], row['pid']
+
+        tid = row.get('tid')
+        if tid is None:
+            relations = self.tables['plan_relations']
+            plan_id = row['plan_id']
+            for relation_id in sorted(relations.find('plan_id', plan_id)):
+                if relations.rows[relation_id]['kind'] == _PlanRelationKind.COMMON:
+                    tid = relations.rows[relation_id]['tid']
+                    break
+        task = self.tables['task'].rows.get(tid)
+        if task is None:
+            return None, None
+        return task['uid'], task['pid']
+
+    def _log(self, name, id, old_row, row):
+        change = (name, id, old_row, row)
+        if self._depth == 0:
+            self._write([change])
+        else:
+            self._undo.append(change)
+
+    def _rollback(self, undo_size):
+        while len(self._undo) > undo_size:
+            name, id, old_row, _ = self._undo.pop()
+            if old_row is None:
+                self.tables[name].delete(id)
+            else:
+                self.tables[name].put(old_row)
+
+    def _commit(self):
+        changes = self._undo
+        self._undo = []
+        if len(changes) != 0:
+            self._write(changes)
+
+    def _write(self, changes):
+        '''Gets committed changes as tuples of table name, id, old row
+        and new row which is None for deleted row
+        '''
+        pass
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def close(self):
+        pass
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(db_file=_DEFAULT_DB_NAME):
+    '''Returns database for specified name, created once per process'''
+    with _databases_lock:
+        db = _databases.get(db_file)
+        if db is None:
+            db = _databases[db_file] = Database(db_file)
+    return db
+
+def close_databases():
+    '''Forgets all databases'''
+    with _databases_lock:
+        for db in _databases.values():
+            db.close()
+        _databases.clear()
+
+def _get_borders(supposed_start_time, supposed_end_time, deadline_time):
+    times = [time for time in (supposed_start_time, supposed_end_time, deadline_time)
+                if time is not None]
+    if len(times) == 0:
+        return None, None
+    return min(times), max(times)
+
+def _get_interval(supposed_start_time, supposed_end_time, deadline_time):
+    '''Returns borders of task interval like interval index of sqlite adapters
+
+    Missing start or end of task with time is open, timeless task has no interval
+    '''
+    if supposed_start_time is None and supposed_end_time is None and deadline_time is None:
+        return None, None
+    left = -math.inf if supposed_start_time is None else supposed_start_time
+    ends = [time for time in (supposed_end_time, deadline_time) if time is not None]
+    return left, max(ends) if len(ends) != 0 else math.inf
+
+def _to_bool(value):
+    if value is None:
+        return None
+    return bool(value)
+
+def _less(value, other):
+    '''Compares like sql, comparison with None is false'''
+    return value is not None and other is not None and value < other
+
+def _less_or_equal(value, other):
+    return value is not None and other is not None and value <= other
+
+def _overdue_by_time(row, time):
+    '''Times of task were before time, see Filter.overdue_by_time'''
+    return (_less(row['left_border'], time)
+            and (row['supposed_start_time'] is None or row['supposed_start_time'] < time)
+            and (_less(row['supposed_end_time'], time) or _less(row['deadline_time'], time)))
+
+def _tokenize(text):
+    if text is None:
+        return []
+    return re.findall(r'[^\W_]+', text.lower())
+
+def _contains_phrase(tokens, phrase, prefix):
+    last = len(phrase) - 1
+    for start in range(len(tokens) - last):
+        if (tokens[start:start + last] == phrase[:last]
+                and (tokens[start + last].startswith(phrase[last]) if prefix
+                     else tokens[start + last] == phrase[last])):
+            return True
+    return False
+
+class _Filter():
+    '''Filter compiled into predicates over rows
+
+    Conditions on indexed columns also add lookups which select
+    candidate rows by indexes, predicates are checked only for candidates
+    '''
+
+    def __init__(self):
+        self._predicates = []
+        self._lookups = []
+
+    def _append(self, predicate, lookup=None):
+        self._predicates.append(predicate)
+        if lookup is not None:
+            self._lookups.append(lookup)
+
+    def _one_of(self, column, values):
+        if isinstance(values, list):
+            if len(values) == 0:
+                return
+            values = frozenset(value for value in values if value is not None)
+        else:
+            values = frozenset((values, ))
+
+        def lookup(table):
+            if column != table.key and column not in table.indexes:
+                return None
+            ids = set()
+            for value in values:
+                ids.update(table.find(column, value))
+            return ids
+        self._append(lambda row: row[column] in values, lookup)
+
+    def select_ids(self, table):
+        '''Returns ids of candidate rows or None if all rows are candidates'''
+        found = [ids for ids in (lookup(table) for lookup in self._lookups) if ids is not None]
+        if len(found) == 0:
+            return None
+        found.sort(key=len)
+        return found[0].intersection(*found[1:])
+
+    def match(self, row):
+        for predicate in self._predicates:
+            if not predicate(row):
+                return False
+        return True
+
+class StorageAdapter():
+
+    _default_db_file = _DEFAULT_DB_NAME
+
+    def __init__(self, db_file=None, db=None):
+        if db_file is None:
+            db_file = self._default_db_file
+
+        self.db_file = db_file
+        if db is None:
+            self.db = self._get_database(db_file)
+        else:
+            self.db = db
+
+    @staticmethod
+    def _get_database(db_file):
+        return get_database(db_file)
+
+    def transaction(self):
+        '''Returns transaction which is context manager and decorator
+
+        Nested transactions work like savepoints of the outer one
+        '''
+        return self.db.transaction()
+
+    def current_revision(self):
+        '''Returns revision of the last change or 0 if nothing was changed'''
+        with self.db.lock:
+            changes = self.db.tables['change_log'].rows
+            return max(changes) if len(changes) != 0 else 0
+
+    def get_changes(self, since_revision=0, uid=None, limit=None):
+        '''Returns changes made after since_revision ordered by revision
+
+        If uid is specified, only changes of rows of this user and of
+        projects where user is creator, admin or guest are returned
+        '''
+        with self.db.lock:
+            pids = None
+            if uid is not None:
+                pids = set(self.db.tables['project'].find('creator', uid))
+                relations = self.db.tables['project_relations']
+                pids.update(relations.rows[relation_id]['pid'] for relation_id in relations.find('uid', uid))
+
+            changes = []
+            rows = self.db.tables['change_log'].rows
+            for revision in sorted(revision for revision in rows if revision > since_revision):
+                row = rows[revision]
+                if pids is not None and row['uid'] != uid and row['pid'] not in pids:
+                    continue
+                changes.append(self._change_from_row(row))
+                if limit is not None and len(changes) == limit:
+                    break
+        return changes
+
+    @staticmethod
+    def _change_from_row(row):
+        change = Change()
+        for field in ('revision', 'entity', 'entity_id', 'kind', 'uid', 'pid'):
+            setattr(change, field, row[field])
+        change.fields = row['fields'].split(',') if row['fields'] else []
+        return change
+
+    def _select(self, name, filter=None, reverse=False):
+        '''Returns rows of table matched by filter ordered by id'''
+        table = self.db.tables[name]
+        with self.db.lock:
+            ids = None if filter is None else filter.select_ids(table)
+            if ids is None:
+                ids = table.rows.keys()
+            rows = [table.rows[id] for id in sorted(ids, reverse=reverse)]
+        if filter is None:
+            return rows
+        return [row for row in rows if filter.match(row)]
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+class TaskStorageAdapter(StorageAdapter):
+
+    _log_tag = 'TaskStorageAdapter'
+
+    _COLUMNS = ('tid', 'pid', 'uid', 'parent_tid', 'title', 'description',
+                'supposed_start_time', 'supposed_end_time', 'deadline_time',
+                'priority', 'status', 'notificate_supposed_start',
+                'notificate_supposed_end', 'notificate_deadline')
+
+    @classmethod
+    def _task_from_row(cls, row):
+        task = Task()
+        for column in cls._COLUMNS:
+            setattr(task, column, row[column])
+        return task
+
+    @classmethod
+    def _task_to_row(cls, task):
+        row = {column: getattr(task, column) for column in cls._COLUMNS}
+        for column in ('notificate_supposed_start', 'notificate_supposed_end', 'notificate_deadline'):
+            row[column] = _to_bool(row[column])
+        row['left_border'], row['right_border'] = _get_borders(
+            task.supposed_start_time, task.supposed_end_time, task.deadline_time)
+        row['interval_left'], row['interval_right'] = _get_interval(
+            task.supposed_start_time, task.supposed_end_time, task.deadline_time)
+        return row
+
+    def get_tasks(self, filter=None, limit=None, after_tid=None, newest_first=False, include_archived=False):
+        '''Returns list of tasks ordered by tid
+
+        Tasks can be paged by keyset: limit bounds count of tasks and
+        after_tid is tid of the last task of previous page.
+        Tasks found by text search are ordered by tid too. Archived
+        tasks are returned only if include_archived is True
+        '''
+        return list(self.iterate_tasks(filter, after_tid, newest_first, limit, include_archived))
+
+    def iterate_tasks(self, filter=None, after_tid=None, newest_first=False, limit=None, include_archived=False):
+        '''Generator variant of get_tasks
+
+        Tids are selected at once, predicates of filter are checked
+        while tasks are iterated. Archived tasks are merged by tid and
+        are never found by text search, like in sqlite adapters
+        '''
+        names = ['task']
+        if include_archived and (filter is None or not filter._searches_text):
+            names.append('task_archive')
+        tasks = heapq.merge(*[self._iterate_table(name, filter, after_tid, newest_first) for name in names],
+                            key=lambda task: task.tid, reverse=newest_first)
+        yield from itertools.islice(tasks, limit)
+
+    def _iterate_table(self, name, filter, after_tid, newest_first):
+        table = self.db.tables[name]
+        with self.db.lock:
+            tids = None if filter is None else filter.select_ids(table)
+            tids = sorted(table.rows.keys() if tids is None else tids)
+        if after_tid is not None:
+            if newest_first:
+                tids = tids[:bisect.bisect_left(tids, after_tid)]
+            else:
+                tids = tids[bisect.bisect_right(tids, after_tid):]
+        if newest_first:
+            tids.reverse()
+
+        for tid in tids:
+            row = table.rows.get(tid)
+            if row is not None and (filter is None or filter.match(row)):
+                yield self._task_from_row(row)
+
+    def save_task(self, task, auto_tid=True):
+        '''Saves task and returns its generated tid or None if task was not saved
+        '''
+        tid = self.db.insert('task', self._task_to_row(task))
+        logging.get_logger(self._log_tag).info('Task was saved: {}'.format(tid))
+        return tid
+
+    def save_tasks(self, tasks):
+        '''Saves tasks inside one transaction
+
+        Returns list of generated tids in order of passed tasks
+        '''
+        with self.transaction():
+            tids = [self.db.insert('task', self._task_to_row(task)) for task in tasks]
+        logging.get_logger(self._log_tag).info('{} tasks were saved'.format(len(tids)))
+        return tids
+
+    def _select_with_archived(self, filter, include_archived):
+        '''Rows of task table and archive, archived tasks are never
+        found by text search
+        '''
+        rows = self._select('task', filter)
+        if include_archived and (filter is None or not filter._searches_text):
+            rows.extend(self._select('task_archive', filter))
+        return rows
+
+    def count_tasks(self, filter=None, overdue_time=None, include_archived=False):
+        '''Returns counts of tasks matched by filter grouped by project,
+        status and priority like in sqlite_peewee_adapters
+
+        Result is dict from (pid, status, priority) to pair of count of
+        tasks and count of overdue tasks
+        '''
+        counts = {}
+        for row in self._select_with_archived(filter, include_archived):
+            key = (row['pid'], row['status'], row['priority'])
+            overdue = (row['status'] == Status.OVERDUE
+                       or (row['status'] in (Status.ACTIVE, Status.PENDING) and _overdue_by_time(row, overdue_time)))
+            count, overdue_count = counts.get(key, (0, 0))
+            counts[key] = (count + 1, overdue_count + int(overdue))
+        return counts
+
+    def count_completed_tasks(self, start_time, end_time, bucket_length, filter=None):
+        '''Returns histogram of completed tasks matched by filter like in
+        sqlite_peewee_adapters
+
+        Result is dict from start time of bucket to count of tasks
+        '''
+        histogram = {}
+        for row in self._select_with_archived(filter, True):
+            right_border = row['right_border']
+            if (row['status'] == Status.COMPLETED and _less_or_equal(start_time, right_border)
+                    and right_border < end_time):
+                bucket_start = start_time + (right_border - start_time) // bucket_length * bucket_length
+                histogram[bucket_start] = histogram.get(bucket_start, 0) + 1
+        return histogram
+
+    def get_last_saved_task(self):
+        rows = self.db.tables['task'].rows
+        with self.db.lock:
+            if len(rows) == 0:
+                return None
+            return self._task_from_row(rows[max(rows)])
+
+    def remove_task(self, tid):
+        '''Removes task with all its subtasks in one transaction
+
+        Plans which common task is removed are removed with their edited
+        repeats, edited repeats of other plans are restored.
+        Returns count of removed tasks
+        '''
+        counts = self._remove_subtrees([tid])
+        logging.get_logger(self._log_tag).info('Task {} was removed, removed rows: {}'.format(tid, counts))
+        return counts[Change.Entity.task]
+
+    def remove_tasks(self, uid=None, pids=None):
+        '''Removes all tasks of user and all tasks of projects with pids
+
+        Tasks are removed with subtasks and plans like in remove_task
+        in one transaction. Archived tasks of user and projects are
+        removed too. Returns dict with counts of removed rows by table names
+        '''
+        with self.transaction():
+            counts = self._remove_subtrees(self._find_roots('task', uid, pids))
+            archived_tids = self._select_subtree_tids(self._find_roots('task_archive', uid, pids), 'task_archive')
+            counts[Change.Entity.task] += sum(self.db.delete('task_archive', archived_tid)
+                                              for archived_tid in archived_tids)
+        logging.get_logger(self._log_tag).info('Tasks of user {} and projects {} were removed, removed rows: {}'\
+            .format(uid, pids, counts))
+        return counts
+
+    def _find_roots(self, name, uid, pids):
+        root_tids = set()
+        if uid is not None:
+            root_tids.update(self.db.find(name, 'uid', uid))
+        for pid in pids if pids is not None else []:
+            root_tids.update(self.db.find(name, 'pid', pid))
+        return sorted(root_tids)
+
+    def _remove_subtrees(self, root_tids):
+        relations = self.db.tables['plan_relations']
+        with self.transaction():
+            plan_ids = sorted({relations.rows[relation_id]['plan_id']
+                               for subtree_tid in self._select_subtree_tids(root_tids)
+                               for relation_id in relations.find('tid', subtree_tid)
+                               if relations.rows[relation_id]['kind'] == _PlanRelationKind.COMMON})
+
+            root_tids = list(root_tids)
+            relation_ids = set()
+            for plan_id in plan_ids:
+                for relation_id in relations.find('plan_id', plan_id):
+                    relation_ids.add(relation_id)
+                    if relations.rows[relation_id]['kind'] == _PlanRelationKind.EDITED:
+                        root_tids.append(relations.rows[relation_id]['tid'])
+            tids_to_remove = self._select_subtree_tids(root_tids)
+            for removed_tid in tids_to_remove:
+                relation_ids.update(relations.find('tid', removed_tid))
+
+            relations_deleted = sum(self.db.delete('plan_relations', relation_id)
+                                    for relation_id in sorted(relation_ids))
+            plans_deleted = sum(self.db.delete('plan', plan_id) for plan_id in plan_ids)
+            tasks_deleted = sum(self.db.delete('task', removed_tid) for removed_tid in tids_to_remove)
+
+        return {Change.Entity.task: tasks_deleted, Change.Entity.plan: plans_deleted,
+                Change.Entity.plan_relations: relations_deleted}
+
+    def _select_subtree_tids(self, root_tids, name='task', is_excluded=None):
+        table = self.db.tables[name]
+        subtree = [tid for tid in dict.fromkeys(root_tids) if tid in table.rows]
+        found = set(subtree)
+        for tid in subtree:
+            for child_tid in sorted(table.find('parent_tid', tid)):
+                if child_tid not in found and (is_excluded is None or not is_excluded(child_tid)):
+                    found.add(child_tid)
+                    subtree.append(child_tid)
+        return subtree
+
+    def archive_tasks(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Moves completed tasks which ended before before_time to archive
+
+        Only tasks without parent are moved, each with all its subtasks,
+        and only if all subtasks are completed too and ended before
+        before_time or have no time. Tasks of plans are archived with
+        their plans only. Every batch of tasks is moved in its own
+        transaction. Returns count of moved tasks
+        '''
+        table = self.db.tables['task']
+        moved_count = 0
+        last_root = 0
+        while True:
+            with self.transaction():
+                roots = sorted(tid for tid in table.find('parent_tid', None)
+                               if tid > last_root and _less(table.rows[tid]['right_border'], before_time)
+                               and self._is_archivable(table.rows[tid], before_time))[:batch_size]
+                if len(roots) == 0:
+                    break
+                last_root = roots[-1]
+                for root in roots:
+                    subtree = self._select_subtree_tids([root])
+                    if all(self._is_archivable(table.rows[tid], before_time) for tid in subtree):
+                        moved_count += sum(self.db.move('task', 'task_archive', tid) for tid in subtree)
+
+        logging.get_logger(self._log_tag).info('{} tasks which ended before {} were archived'\
+            .format(moved_count, before_time))
+        return moved_count
+
+    def _is_archivable(self, row, before_time):
+        '''Task is completed, ended before before_time or has no time
+        and is not a task of plan
+        '''
+        return (row['status'] == Status.COMPLETED
+                and (row['right_border'] is None or row['right_border'] < before_time)
+                and len(self.db.tables['plan_relations'].find('tid', row['tid'])) == 0)
+
+    def _is_common_task(self, tid):
+        relations = self.db.tables['plan_relations']
+        return any(relations.rows[relation_id]['kind'] == _PlanRelationKind.COMMON
+                   for relation_id in relations.find('tid', tid))
+
+    def _select_subtasks(self, tid, skip_plan_tasks):
+        is_excluded = self._is_common_task if skip_plan_tasks else None
+        tids = self._select_subtree_tids([tid], is_excluded=is_excluded)[1:]
+        table = self.db.tables['task']
+        return [self._task_from_row(table.rows[subtask_tid]) for subtask_tid in sorted(tids)]
+
+    def get_subtasks(self, tid, skip_plan_tasks=False):
+        '''Returns all subtasks of task at any depth ordered by tid
+
+        If skip_plan_tasks is True, common tasks of plans are not returned
+        together with their own subtasks
+        '''
+        with self.db.lock:
+            return self._select_subtasks(tid, skip_plan_tasks)
+
+    def edit_subtasks(self, tid, task_field_dict, skip_plan_tasks=False):
+        '''Sets fields of all subtasks of task at any depth in one transaction
+
+        Subtasks are selected like get_subtasks does. Returns count of edited tasks
+        '''
+        with self.transaction():
+            subtasks = self._select_subtasks(tid, skip_plan_tasks)
+            for task in subtasks:
+                for field, value in task_field_dict.items():
+                    setattr(task, field, value)
+                row = self._task_to_row(task)
+                del row['tid']
+                self.db.update('task', task.tid, **row)
+        logging.get_logger(self._log_tag).info('{} subtasks of task {} were edited: {}'\
+            .format(len(subtasks), tid, task_field_dict))
+        return len(subtasks)
+
+    def edit_task_from_model(self, task):
+        row = self._task_to_row(task)
+        del row['tid']
+        success = self.db.update('task', task.tid, **row)
+        if success:
+            logging.get_logger(self._log_tag).info('Task was edited: %s', task.tid)
+        return success
+
+    def edit_task(self, task_field_dict):
+        tid = task_field_dict[Task.Field.tid]
+        filter = self.Filter()
+        filter.tid(tid)
+        tasks = self.get_tasks(filter)
+        if len(tasks) == 0:
+            return False
+        task = tasks[0]
+        for field, value in task_field_dict.items():
+            if field != Task.Field.tid and hasattr(task, field):
+                setattr(task, field, value)
+        return self.edit_task_from_model(task)
+
+    class Filter(_Filter):
+
+        _searches_text = False
+
+        def tid(self, tid):
+            self._one_of('tid', tid)
+
+        def pid(self, pid):
+            self._one_of('pid', pid)
+
+        def parent_tid(self, parent_tid):
+            self._one_of('parent_tid', parent_tid)
+
+        def uid(self, uid):
+            self._one_of('uid', uid)
+
+        def title(self, title):
+            self._one_of('title', title)
+
+        def description(self, description):
+            self._one_of('description', description)
+
+        def priority(self, priority):
+            self._one_of('priority', priority)
+
+        def status(self, status):
+            self._one_of('status', status)
+
+        def notificate_supposed_start(self, notificate_supposed_start):
+            self._one_of('notificate_supposed_start', notificate_supposed_start)
+
+        def notificate_supposed_end(self, notificate_supposed_end):
+            self._one_of('notificate_supposed_end', notificate_supposed_end)
+
+        def notificate_deadline(self, notificate_deadline):
+            self._one_of('notificate_deadline', notificate_deadline)
+
+        def one_of_notificate(self):
+            self._append(lambda row: (row['notificate_supposed_start'] or row['notificate_supposed_end']
+                                      or row['notificate_deadline']) is True)
+
+        def to_time(self, time):
+            self._append(lambda row: _less(row['left_border'], time),
+                         self._border_lookup('left_border', high=time, strict_high=True))
+
+        def not_completed(self):
+            self._one_of('status', [Status.ACTIVE, Status.PENDING, Status.OVERDUE])
+
+        def overdue_by_time(self, time):
+            self._append(lambda row: _overdue_by_time(row, time),
+                self._border_lookup('left_border', high=time, strict_high=True))
+
+        def filter_range(self, start_time, end_time):
+            def in_range(row):
+                if row['supposed_end_time'] is None and row['deadline_time'] is None:
+                    return _less_or_equal(row['supposed_start_time'], end_time)
+                return ((row['supposed_start_time'] is None or row['supposed_start_time'] <= end_time)
+                        and (_less_or_equal(start_time, row['supposed_end_time'])
+                             or _less_or_equal(start_time, row['deadline_time'])))
+
+            def lookup(table):
+                # the shorter of two ranges of interval borders, other border is checked by predicate
+                left_index = table.sorted_indexes['interval_left']
+                right_index = table.sorted_indexes['interval_right']
+                left_bounds = left_index.bounds(high=end_time)
+                right_bounds = right_index.bounds(low=start_time)
+                if left_bounds[1] - left_bounds[0] <= right_bounds[1] - right_bounds[0]:
+                    return set(left_index.ids(*left_bounds))
+                return set(right_index.ids(*right_bounds))
+            self._append(in_range, lookup)
+
+        @staticmethod
+        def _border_lookup(column, **bounds):
+            def lookup(table):
+                index = table.sorted_indexes[column]
+                return set(index.ids(*index.bounds(**bounds)))
+            return lookup
+
+        def timeless(self):
+            self._append(lambda row: row['supposed_end_time'] is None and row['supposed_start_time'] is None
+                                     and row['deadline_time'] is None)
+
+        def text_search(self, query, fields=None):
+            '''Search by words of title and description
+
+            Query consists of words, 'prefix*' and '"exact phrase"' terms,
+            all of them should be found. fields restricts search
+            to Task.Field.title or Task.Field.description
+            '''
+            terms = []
+            for phrase, prefix, word in re.findall(r'"([^"]*)"(\*?)|(\S+)', query):
+                if phrase == '':
+                    phrase = word.replace('"', '')
+                    prefix = '*' if phrase.endswith('*') else ''
+                    phrase = phrase.rstrip('*')
+                tokens = _tokenize(phrase)
+                if len(tokens) != 0:
+                    terms.append((tokens, prefix == '*'))
+            self._searches_text = True
+            if len(terms) == 0:
+                # query without words matches nothing
+                self._append(lambda row: False)
+                return
+
+            if fields is None:
+                fields = (Task.Field.title, Task.Field.description)
+            def match(row):
+                tokens = [_tokenize(row[field]) for field in fields]
+                return all(any(_contains_phrase(field_tokens, phrase, prefix) for field_tokens in tokens)
+                           for phrase, prefix in terms)
+            self._append(match)
+
+class PlanStorageAdapter(StorageAdapter):
+
+    _log_tag = 'PlanStorageAdapter'
+
+    @staticmethod
+    def _plan_from_row(row):
+        plan = Plan()
+        plan.plan_id = row['plan_id']
+        plan.end = row['end']
+        plan.shift = row['shift']
+        return plan
+
+    def get_plans(self, plan_id=None, common_tid=None, edit_repeat_tid=None):
+        if plan_id is not None:
+            plan = self._get_plan_by_id(plan_id)
+            if plan is None:
+                return []
+            return [plan]
+
+        if common_tid is not None:
+            return self._get_plans_by_relation(common_tid, _PlanRelationKind.COMMON)
+
+        if edit_repeat_tid is not None:
+            return self._get_plans_by_relation(edit_repeat_tid, _PlanRelationKind.EDITED)
+
+        return [self._plan_from_row(row) for row in self._select('plan')]
+
+    def _get_plans_by_relation(self, tid, kind):
+        plans = []
+        for relation_id in self.db.find('plan_relations', 'tid', tid):
+            relation = self.db.get('plan_relations', relation_id)
+            if relation['kind'] == kind:
+                plan = self._get_plan_by_id(relation['plan_id'])
+                if plan is not None:
+                    plans.append(plan)
+        return plans
+
+    def _get_plan_by_id(self, plan_id):
+        row = self.db.get('plan', plan_id)
+        if row is None:
+            return None
+        plan = self._plan_from_row(row)
+        plan.exclude = []
+        for relation in self._get_relations(plan_id):
+            if relation['kind'] == _PlanRelationKind.COMMON:
+                plan.tid = relation['tid']
+            else:
+                plan.exclude.append(relation['number'])
+        return plan
+
+    def _get_relations(self, plan_id, number=None):
+        relations = self.db.tables['plan_relations'].rows
+        return [relations[relation_id] for relation_id in self.db.find('plan_relations', 'plan_id', plan_id)
+                if number is None or relations[relation_id]['number'] == number]
+
+    def get_exclude_type(self, plan_id, number):
+        relations = self._get_relations(plan_id, number)
+        if len(relations) != 1:
+            return None
+
+        kind = relations[0]['kind']
+        if kind == _PlanRelationKind.DELETED:
+            return Plan.PlanExcludeKind.DELETED
+        if kind == _PlanRelationKind.EDITED:
+            return Plan.PlanExcludeKind.EDITED
+        return None
+
+    def get_number_for_edit_repeat_by_tid(self, plan_id, edit_tid):
+        for relation in self._get_relations(plan_id):
+            if relation['tid'] == edit_tid and relation['kind'] == _PlanRelationKind.EDITED:
+                return relation['number']
+        return None
+
+    def get_tid_for_edit_repeat(self, plan_id, number):
+        relations = self._get_relations(plan_id, number)
+        if len(relations) != 1 or relations[0]['kind'] != _PlanRelationKind.EDITED:
+            return None
+        return relations[0]['tid']
+
+    def recalculate_exclude_when_start_time_shifted(self, plan_id, start_time_shift):
+        row = self.db.get('plan', plan_id)
+        if row is None:
+            return False
+        shift = row['shift']
+        if start_time_shift % shift != 0:
+            return self.restore_all_repeats(plan_id)
+
+        logging.get_logger(self._log_tag).info(('For {} excludes were recalculated '
+            'due start time shift changed').format(plan_id))
+        with self.transaction():
+            for relation in self._get_relations(plan_id):
+                if relation['kind'] == _PlanRelationKind.COMMON:
+                    continue
+                number = relation['number'] - start_time_shift // shift
+                if number < 0:
+                    self.db.delete('plan_relations', relation['relation_id'])
+                else:
+                    self.db.update('plan_relations', relation['relation_id'], number=number)
+        return True
+
+    def _insert_relation(self, plan_id, tid, number, kind):
+        return self.db.insert('plan_relations', {'plan_id': plan_id, 'tid': tid,
+                                                 'number': number, 'kind': kind})
+
+    def save_plans(self, plans):
+        '''Saves plans with their common relations and excludes inside one transaction
+
+        Returns list of generated plan ids in order of passed plans
+        '''
+        plan_ids = []
+        with self.transaction():
+            for plan in plans:
+                plan_id = self.db.insert('plan', {'end': plan.end, 'shift': plan.shift})
+                self._insert_relation(plan_id, plan.tid, None, _PlanRelationKind.COMMON)
+                if plan.exclude is not None:
+                    for number in plan.exclude:
+                        self._insert_relation(plan_id, None, number, _PlanRelationKind.DELETED)
+                plan_ids.append(plan_id)
+
+        logging.get_logger(self._log_tag).info('{} plans were saved'.format(len(plan_ids)))
+        return plan_ids
+
+    def add_plan_excludes(self, plan_id, numbers):
+        '''Deletes repeats of plan by numbers
+
+        Returns list of generated relation ids in order of passed numbers
+        '''
+        numbers = list(numbers)
+        with self.transaction():
+            relation_ids = [self._insert_relation(plan_id, None, number, _PlanRelationKind.DELETED)
+                            for number in numbers]
+        logging.get_logger(self._log_tag).info('Repeats {} were deleted in plan {}'.format(numbers, plan_id))
+        return relation_ids
+
+    def save_plan(self, plan):
+        '''Saves plan and returns its generated plan_id or None if plan was not saved
+        '''
+        return self.save_plans([plan])[0]
+
+    def delete_plan_repeat(self, plan_id, number):
+        self._insert_relation(plan_id, None, number, _PlanRelationKind.DELETED)
+        logging.get_logger(self._log_tag).info('Repeat {} was deleted in plan {}'.format(number, plan_id))
+        return True
+
+    def edit_plan_repeat(self, plan_id, number, tid):
+        type = self.get_exclude_type(plan_id, number)
+        if type != None:
+            self.restore_plan_repeat(plan_id, number)
+        self._insert_relation(plan_id, tid, number, _PlanRelationKind.EDITED)
+        logging.get_logger(self._log_tag).info('Repeat {} in plan {} was edited: {}'\
+            .format(number, plan_id, tid))
+        return True
+
+    def chagne_edit_plan_repeat_to_delete(self, plan_id, number):
+        success = self.restore_plan_repeat(plan_id, number)
+        if not success:
+            return False
+        return self.delete_plan_repeat(plan_id, number)
+
+    def restore_plan_repeat(self, plan_id, number):
+        with self.transaction():
+            for relation in self._get_relations(plan_id, number):
+                self.db.delete('plan_relations', relation['relation_id'])
+        logging.get_logger(self._log_tag).info('Repeat {} in plan {} was restored'.format(number, plan_id))
+        return True
+
+    def restore_all_repeats(self, plan_id):
+        rows_deleted = 0
+        with self.transaction():
+            for relation in self._get_relations(plan_id):
+                if relation['kind'] != _PlanRelationKind.COMMON:
+                    rows_deleted += self.db.delete('plan_relations', relation['relation_id'])
+        success = rows_deleted != 0
+        if success:
+            logging.get_logger(self._log_tag).info('All repeats in plan {} were restore'.format(plan_id))
+        return success
+
+    def remove_plan(self, plan_id):
+        with self.transaction():
+            success = self.db.delete('plan', plan_id)
+            for relation in self._get_relations(plan_id):
+                if relation['tid'] is not None:
+                    self.db.delete('task', relation['tid'])
+                self.db.delete('plan_relations', relation['relation_id'])
+        if success:
+            logging.get_logger(self._log_tag).info('Plan {} was deleted'.format(plan_id))
+        return success
+
+    def count_repeats(self, start_time, end_time, uid=None, pids=None):
+        '''Returns counts of repeats of plans in time range like in
+        sqlite_peewee_adapters, numbers of the first and the last repeats
+        in range are calculated from borders of common task
+
+        Result is dict from plan_id to count, plans without repeats
+        in range are skipped
+        '''
+        pids = set(pids) if pids is not None else None
+        counts = {}
+        for plan_row in self._select('plan'):
+            relations = self._get_relations(plan_row['plan_id'])
+            common_tids = [relation['tid'] for relation in relations
+                           if relation['kind'] == _PlanRelationKind.COMMON]
+            task_row = self.db.get('task', common_tids[0]) if len(common_tids) != 0 else None
+            if task_row is None or task_row['left_border'] is None or not plan_row['shift'] > 0:
+                continue
+            if ((uid is not None or pids is not None) and task_row['uid'] != uid
+                    and (pids is None or task_row['pid'] not in pids)):
+                continue
+
+            shift = plan_row['shift']
+            last_time = end_time if plan_row['end'] is None else min(end_time, plan_row['end'])
+            # the first repeat which ends after start_time and the last one which starts before last_time
+            first_number = max(0, -((task_row['right_border'] - start_time) // shift))
+            last_number = (last_time - task_row['left_border']) // shift
+            count = last_number - first_number + 1 - sum(
+                1 for relation in relations if relation['kind'] != _PlanRelationKind.COMMON
+                and first_number <= relation['number'] <= last_number)
+            if count > 0:
+                counts[plan_row['plan_id']] = count
+        return counts
+
+    def archive_plans(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Moves plans which ended before before_time to archive
+
+        Plans are moved with their relations, common tasks and edited
+        repeats with all subtasks. Every batch of plans is moved in its
+        own transaction. Returns dict with counts of moved rows by table names
+        '''
+        task_storage = TaskStorageAdapter(self.db_file, self.db)
+        plans = self.db.tables['plan']
+        relations = self.db.tables['plan_relations']
+        counts = {Change.Entity.task: 0, Change.Entity.plan: 0, Change.Entity.plan_relations: 0}
+        last_plan_id = 0
+        while True:
+            with self.transaction():
+                plan_ids = sorted(plan_id for plan_id, row in plans.rows.items()
+                                  if plan_id > last_plan_id and _less(row['end'], before_time))[:batch_size]
+                if len(plan_ids) == 0:
+                    break
+                last_plan_id = plan_ids[-1]
+
+                relation_ids = sorted(relation_id for plan_id in plan_ids
+                                      for relation_id in relations.find('plan_id', plan_id))
+                plan_tids = [relations.rows[relation_id]['tid'] for relation_id in relation_ids
+                             if relations.rows[relation_id]['tid'] is not None]
+                counts[Change.Entity.task] += sum(self.db.move('task', 'task_archive', tid)
+                                                  for tid in task_storage._select_subtree_tids(plan_tids))
+                counts[Change.Entity.plan_relations] += sum(
+                    self.db.move('plan_relations', 'plan_relations_archive', relation_id)
+                    for relation_id in relation_ids)
+                counts[Change.Entity.plan] += sum(self.db.move('plan', 'plan_archive', plan_id)
+                                                  for plan_id in plan_ids)
+
+        logging.get_logger(self._log_tag).info('Plans which ended before {} were archived, moved rows: {}'\
+            .format(before_time, counts))
+        return counts
+
+    def edit_plan(self, plan_field_dict):
+        plan_id = plan_field_dict[Plan.Field.plan_id]
+        row = self.db.get('plan', plan_id)
+        if row is None:
+            return True
+
+        if Plan.Field.end in plan_field_dict:
+            end = plan_field_dict[Plan.Field.end]
+            if not self.db.update('plan', plan_id, end=end):
+                return False
+            logging.get_logger(self._log_tag).info('End of plan {} was changed to {}'.format(plan_id, end))
+
+        if Plan.Field.shift in plan_field_dict:
+            shift = plan_field_dict[Plan.Field.shift]
+            old_shift = row['shift']
+            with self.transaction():
+                self.db.update('plan', plan_id, shift=shift)
+                # repeat stays only if it starts at the same time with new shift
+                for relation in self._get_relations(plan_id):
+                    if relation['kind'] == _PlanRelationKind.COMMON:
+                        continue
+                    if (relation['number'] * old_shift) % shift != 0:
+                        self.db.delete('plan_relations', relation['relation_id'])
+                    else:
+                        self.db.update('plan_relations', relation['relation_id'],
+                                       number=relation['number'] * old_shift // shift)
+            logging.get_logger(self._log_tag).info('Shift of plan {} was changed to {}'.format(plan_id, shift))
+
+        return True
+
+class UserStorageAdapter(StorageAdapter):
+
+    _log_tag = 'UserStorageAdapter'
+
+    @staticmethod
+    def _user_from_row(row):
+        user = User()
+        user.uid = row['uid']
+        user.login = row['login']
+        user.password = row['password']
+        user.online = row['online']
+        return user
+
+    def check_user_existence(self, login):
+        return len(self.db.find('user', 'login', login)) != 0
+
+    def get_users(self, filter=None):
+        return [self._user_from_row(row) for row in self._select('user', filter)]
+
+    def save_user(self, user):
+        '''Saves user and returns its generated uid or None if user was not saved
+        '''
+        uid = self.db.insert('user', {'login': user.login, 'password': user.password,
+                                      'online': _to_bool(user.online)})
+        logging.get_logger(self._log_tag).info('User {} was saved'.format(uid))
+        return uid
+
+    def get_last_saved_user(self):
+        rows = self._select('user', reverse=True)
+        if len(rows) != 0:
+            return self._user_from_row(rows[0])
+
+    def delete_user(self, uid):
+        return self.remove_user(uid)[Change.Entity.user] == 1
+
+    def remove_user(self, uid):
+        '''Removes user with all its tasks and its relations to projects in one transaction
+
+        Returns dict with counts of removed rows by table names
+        '''
+        with self.transaction():
+            counts = TaskStorageAdapter(self.db_file, self.db).remove_tasks(uid=uid)
+            counts[Change.Entity.project_relations] = sum(self.db.delete('project_relations', relation_id)
+                for relation_id in self.db.find('project_relations', 'uid', uid))
+            counts[Change.Entity.user] = int(self.db.delete('user', uid))
+        if counts[Change.Entity.user] == 1:
+            logging.get_logger(self._log_tag).info('User {} was deleted, removed rows: {}'.format(uid, counts))
+        return counts
+
+    def edit_user(self, user_field_dict):
+        uid = user_field_dict[User.Field.uid]
+        values = {field: user_field_dict[field] for field in (User.Field.login, User.Field.password, User.Field.online)
+                  if field in user_field_dict}
+        if User.Field.online in values:
+            values[User.Field.online] = _to_bool(values[User.Field.online])
+        if len(values) == 0:
+            return self.db.get('user', uid) is not None
+
+        success = self.db.update('user', uid, **values)
+        if success:
+            logging.get_logger(self._log_tag).info('User {} was edited'.format(uid))
+        return success
+
+    class Filter(_Filter):
+
+        def uid(self, uid):
+            self._one_of('uid', uid)
+
+        def login(self, login):
+            self._one_of('login', login)
+
+        def online(self, online):
+            self._one_of('online', online)
+
+class ProjectStorageAdapter(StorageAdapter):
+
+    _log_tag = 'ProjectStorageAdapter'
+
+    def save_project(self, project):
+        '''Saves project and returns its generated pid or None if project was not saved
+        '''
+        return self.db.insert('project', {'creator': project.creator, 'name': project.name})
+
+    def get_projects(self, uid, name=None, pid=None):
+        '''Returns projects which user created or participates in as admin or guest
+
+        Own projects go first, then admin and guest ones
+        '''
+        relations = self.db.tables['project_relations'].rows
+        with self.db.lock:
+            kinds = {pid: -1 for pid in self.db.find('project', 'creator', uid)}
+            for relation_id in self.db.find('project_relations', 'uid', uid):
+                relation = relations[relation_id]
+                kinds[relation['pid']] = min(kinds.get(relation['pid'], relation['kind']), relation['kind'])
+
+            projects = []
+            for project_pid in sorted(kinds, key=lambda project_pid: (kinds[project_pid], project_pid)):
+                project = self._get_project_by_id(project_pid)
+                if (project is not None and (name is None or project.name == name)
+                        and (pid is None or project.pid == pid)):
+                    projects.append(project)
+        return projects
+
+    def get_all_admin_third_party_projects(self, uid):
+        return self._get_third_party_projects(uid, _ProjectRelationKind.ADMIN)
+
+    def get_all_guest_third_party_projects(self, uid):
+        return self._get_third_party_projects(uid, _ProjectRelationKind.GUEST)
+
+    def _get_third_party_projects(self, uid, kind):
+        relations = self.db.tables['project_relations'].rows
+        with self.db.lock:
+            pids = {relations[relation_id]['pid'] for relation_id in self.db.find('project_relations', 'uid', uid)
+                    if relations[relation_id]['kind'] == kind}
+            projects = [self._get_project_by_id(pid) for pid in sorted(pids)]
+        return [project for project in projects if project is not None]
+
+    def _get_project_by_id(self, pid):
+        row = self.db.get('project', pid)
+        if row is None:
+            return None
+        project = Project()
+        project.pid = pid
+        project.creator = row['creator']
+        project.name = row['name']
+        for relation_id in self.db.find('project_relations', 'pid', pid):
+            relation = self.db.get('project_relations', relation_id)
+            attribute = 'admins' if relation['kind'] == _ProjectRelationKind.ADMIN else 'guests'
+            if getattr(project, attribute) is None:
+                setattr(project, attribute, [])
+            getattr(project, attribute).append(relation['uid'])
+        return project
+
+    def remove_project(self, pid):
+        with self.transaction():
+            for relation_id in self.db.find('project_relations', 'pid', pid):
+                self.db.delete('project_relations', relation_id)
+            success = self.db.delete('project', pid)
+        if success:
+            logging.get_logger(self._log_tag).info('Project {} was removed'.format(pid))
+        return success
+
+    def remove_projects(self, pids):
+        '''Removes projects with all their tasks and relations to users in one transaction
+
+        Returns dict with counts of removed rows by table names
+        '''
+        pids = list(pids)
+        with self.transaction():
+            counts = TaskStorageAdapter(self.db_file, self.db).remove_tasks(pids=pids)
+            relation_ids = set()
+            for pid in pids:
+                relation_ids.update(self.db.find('project_relations', 'pid', pid))
+            counts[Change.Entity.project_relations] = sum(self.db.delete('project_relations', relation_id)
+                                                          for relation_id in sorted(relation_ids))
+            counts[Change.Entity.project] = sum(self.db.delete('project', pid) for pid in pids)
+        logging.get_logger(self._log_tag).info('Projects {} were removed, removed rows: {}'.format(pids, counts))
+        return counts
+
+    def edit_project(self, project_fields_dict):
+        pid = project_fields_dict[Project.Field.pid]
+        if Project.Field.name not in project_fields_dict:
+            return self.db.get('project', pid) is not None
+
+        success = self.db.update('project', pid, name=project_fields_dict[Project.Field.name])
+        if success:
+            logging.get_logger(self._log_tag).info('Project {} was edited'.format(pid))
+        return success
+
+    def get_user_kind(self, pid, uid):
+        projects = self.get_projects(uid, pid=pid)
+        if len(projects) == 0:
+            return None
+        return projects[0].get_user_kind(uid)
+
+    def _add_user(self, pid, uid, kind):
+        self.db.insert('project_relations', {'pid': pid, 'uid': uid, 'kind': kind})
+        return True
+
+    def _remove_user(self, pid, uid, kind):
+        # rows of condition built by sqlite_peewee_adapters,
+        # operator precedence makes it (uid AND kind) = kind
+        rows_deleted = 0
+        with self.transaction():
+            for relation in self._select('project_relations'):
+                if int(bool(uid) and bool(relation['kind'])) == kind:
+                    rows_deleted += self.db.delete('project_relations', relation['relation_id'])
+        return rows_deleted == 1
+
+    def add_admin_to_project(self, pid, uid):
+        success = self._add_user(pid, uid, _ProjectRelationKind.ADMIN)
+        if success:
+            logging.get_logger(self._log_tag).info('Admin {} was invited in project {}'.format(uid, pid))
+        return success
+
+    def remove_admin_from_project(self, pid, uid):
+        '''Removes admin from project, tasks of admin are passed to project creator'''
+        with self.transaction():
+            tids = [tid for tid in self.db.find('task', 'pid', pid) if self.db.get('task', tid)['uid'] == uid]
+            if len(tids) != 0:
+                creator = self.get_projects(uid=uid, pid=pid)[0].creator
+                for tid in tids:
+                    self.db.update('task', tid, uid=creator)
+            success = self._remove_user(pid, uid, _ProjectRelationKind.ADMIN)
+        if success:
+            logging.get_logger(self._log_tag).info('Admin {} was removed from project {}'.format(uid, pid))
+        return success
+
+    def add_guest_to_project(self, pid, uid):
+        success = self._add_user(pid, uid, _ProjectRelationKind.GUEST)
+        if success:
+            logging.get_logger(self._log_tag).info('Guest {} was invited in project {}'.format(uid, pid))
+        return success
+
+    def remove_guest_from_project(self, pid, uid):
+        success = self._remove_user(pid, uid, _ProjectRelationKind.GUEST)
+        if success:
+            logging.get_logger(self._log_tag).info('Guest {} was removed from project {}'.format(uid, pid))
+        return success
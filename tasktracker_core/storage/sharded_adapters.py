@@ -0,0 +1,907 @@
+'''Storage adapters which keep tasks and plans in shard databases by users
+
+Writes to one database file wait for its lock, so all users of one file
+write one by one. Adapters of this module keep users, projects and
+relations of projects in catalogue database and tasks and plans in shard
+databases, so writes of users of different shards go in parallel, also
+from several processes. ShardRouter maps uid to shard by pluggable
+mapping, see HashShardMapping and TableShardMapping
+
+Task is stored in shard of its owner, subtask is stored with its parent
+and plan is stored with its common task, so subtrees and plans never
+cross shards. Shards where users have subtasks of other users are kept
+in catalogue, so tasks of user are still found by uid
+
+Ids of tasks and plans are unique in all shards: id given by shard is
+multiplied by _MAX_SHARDS and number of shard is added, so shard of id
+is known without catalogue. Tasks of several shards are merged by tid
+
+Databases are opened by sqlite_adapters. Every shard has its own change
+log, new rows of them are copied to change log of catalogue before it is
+read, so revisions of catalogue order changes of all shards and clients
+keep one revision like with one database. Transaction of adapters covers
+catalogue and all shards used inside it, but databases are committed one
+by one, not atomically
+
+Install adapters with Controller.init_storage_adapters
+'''
+
+import collections
+import contextlib
+import copy
+import heapq
+import itertools
+import os
+import threading
+
+from tasktracker_core.model.task import Task
+from tasktracker_core.model.plan import Plan
+from tasktracker_core.model.change import Change
+from tasktracker_core.storage import sqlite_adapters
+from tasktracker_core.storage.sqlite_peewee_adapters import (ParentNotAllowedError, _DEFAULT_DB_FILE_PATH,
+                                                             _ARCHIVE_BATCH_SIZE)
+from tasktracker_core import logging
+
+_MEMORY_DB_FILE = ':memory:'
+
+# Ids of tasks and plans keep number of shard in remainder of division by it
+_MAX_SHARDS = 1024
+
+_DEFAULT_SHARD_COUNT = 4
+
+# Default count of open shard connections of every thread
+_SHARD_POOL_SIZE = 8
+
+class HashShardMapping():
+    '''Maps uid to one of shard_count shards by remainder of division'''
+
+    def __init__(self, shard_count=_DEFAULT_SHARD_COUNT):
+        if not 0 < shard_count <= _MAX_SHARDS:
+            raise ValueError('Count of shards must be from 1 to {}'.format(_MAX_SHARDS))
+        self.shard_count = shard_count
+
+    def __call__(self, uid):
+        # tasks without owner are kept in the first shard
+        if uid is None:
+            return 0
+        return uid % self.shard_count
+
+    def shards(self):
+        return list(range(self.shard_count))
+
+class TableShardMapping():
+    '''Maps uid to shard by lookup table, users missing in table are
+    mapped by default mapping
+
+    Shard of user must not be changed after user saved tasks, tasks
+    are not moved to new shard
+    '''
+
+    def __init__(self, table, default=None):
+        self.table = dict(table)
+        self.default = default if default is not None else HashShardMapping(1)
+
+    def __call__(self, uid):
+        shard_number = self.table.get(uid)
+        if shard_number is None:
+            return self.default(uid)
+        return shard_number
+
+    def shards(self):
+        return sorted(set(self.table.values()).union(self.default.shards()))
+
+def _split(global_id):
+    '''Returns pair of shard number and id in shard'''
+    local_id, shard_number = divmod(global_id, _MAX_SHARDS)
+    return shard_number, local_id
+
+def _to_global(shard_number, local_id):
+    if local_id is None:
+        return None
+    return local_id * _MAX_SHARDS + shard_number
+
+def _local_cursor(shard_number, after_tid, newest_first):
+    '''Returns tid in shard which bounds tasks of shard like after_tid bounds all tasks'''
+    if after_tid is None:
+        return None
+    if newest_first:
+        return -((shard_number - after_tid) // _MAX_SHARDS)
+    return (after_tid - shard_number) // _MAX_SHARDS
+
+def _tid(task):
+    return task.tid
+
+# entities of change log which are stored in shards
+_SHARD_ENTITIES = (Change.Entity.task, Change.Entity.plan, Change.Entity.plan_relations)
+
+class _Shard():
+    '''Database of shard with adapters of sqlite_adapters over it'''
+
+    def __init__(self, number, db_file, db):
+        self.number = number
+        self.db = db
+        self.task = sqlite_adapters.TaskStorageAdapter(db_file, db)
+        self.plan = sqlite_adapters.PlanStorageAdapter(db_file, db)
+
+class _Transaction():
+    '''Transaction of catalogue and of shards used inside it
+
+    Shard joins transaction when it is used first. Nested transaction is
+    savepoint of all databases of outer ones. Databases are committed in
+    reverse order of joining, catalogue is the last one
+    '''
+
+    def __init__(self, router):
+        self.router = router
+        self._transactions = []
+
+    def __call__(self, method):
+        def run_in_transaction(*args, **kwargs):
+            with _Transaction(self.router):
+                return method(*args, **kwargs)
+        return run_in_transaction
+
+    def _join(self, db):
+        if any(joined_db is db for joined_db, _ in self._transactions):
+            return
+        transaction = db.transaction()
+        transaction.__enter__()
+        self._transactions.append((db, transaction))
+
+    def databases(self):
+        return [db for db, _ in self._transactions]
+
+    def __enter__(self):
+        stack = self.router._transaction_stack()
+        databases = stack[-1].databases() if len(stack) != 0 else [self.router.catalogue]
+        stack.append(self)
+        for db in databases:
+            self._join(db)
+        return self
+
+    def rollback(self):
+        '''Rolls back all changes made in transaction, transaction stays open'''
+        for _, transaction in self._transactions:
+            transaction.rollback()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.router._transaction_stack().pop()
+        error = None
+        for _, transaction in reversed(self._transactions):
+            try:
+                transaction.__exit__(exc_type, exc_val, exc_tb)
+            except Exception as exit_error:
+                # databases which are not committed yet are rolled back
+                if exc_val is None:
+                    exc_type, exc_val, exc_tb = type(exit_error), exit_error, exit_error.__traceback__
+                    error = exit_error
+        if error is not None:
+            raise error
+
+class ShardRouter():
+    '''Opens catalogue and shard databases and finds shards of users and ids
+
+    Shard databases are files next to catalogue file with number of shard
+    in name, they are opened when they are used first. In-memory catalogue
+    has in-memory shards. Every thread keeps at most pool_size connections
+    to shards open, the least recently used one is closed when another
+    shard is used. Connections of shards used by open transaction or by
+    unfinished iteration are never closed
+    '''
+
+    def __init__(self, db_file, mapping=None, pool_size=_SHARD_POOL_SIZE):
+        self.db_file = db_file
+        self.mapping = mapping if mapping is not None else HashShardMapping()
+        self.pool_size = pool_size
+        for shard_number in self.mapping.shards():
+            self._check_number(shard_number)
+
+        self.catalogue = sqlite_adapters.get_database(db_file)
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def _check_number(shard_number):
+        if not 0 <= shard_number < _MAX_SHARDS:
+            raise ValueError('Number of shard must be from 0 to {}'.format(_MAX_SHARDS - 1))
+        return shard_number
+
+    def shard_file(self, shard_number):
+        if self.db_file == _MEMORY_DB_FILE:
+            return _MEMORY_DB_FILE
+        root, extension = os.path.splitext(self.db_file)
+        return '{}.shard{}{}'.format(root, shard_number, extension)
+
+    def shard_numbers(self):
+        return self.mapping.shards()
+
+    def shard_of_user(self, uid):
+        return self._check_number(self.mapping(uid))
+
+    def shards_of_user(self, uid):
+        '''Returns set of shard of user and shards where user has subtasks of other users'''
+        shard_numbers = {self.shard_of_user(uid)}
+        shard_numbers.update(row[0] for row in self.catalogue.execute(
+            'SELECT shard FROM shard_guest WHERE uid = ?', (uid, )))
+        return shard_numbers
+
+    def add_guest(self, uid, shard_number):
+        '''Remembers that user has subtasks of other users in shard'''
+        if uid is not None and shard_number != self.shard_of_user(uid):
+            self.catalogue.execute('INSERT OR IGNORE INTO shard_guest (uid, shard) VALUES (?, ?)',
+                                   (uid, shard_number))
+
+    def remove_guest(self, uid):
+        self.catalogue.execute('DELETE FROM shard_guest WHERE uid = ?', (uid, ))
+
+    def collect_changes(self):
+        '''Copies new rows of change logs of shards to change log of catalogue
+
+        Copied rows get next revisions of catalogue and global ids, so
+        change made after any read revision always gets greater one.
+        Read-only catalogue is not changed
+        '''
+        if self.catalogue.profile.read_only:
+            return
+        with self.transaction():
+            # write goes first, so concurrent collectors wait for lock of catalogue
+            self.catalogue.executemany('INSERT OR IGNORE INTO shard_change_cursor (shard, revision) VALUES (?, 0)',
+                                       [(shard_number, ) for shard_number in self.shard_numbers()])
+            for shard_number in self.shard_numbers():
+                copied_revision = self.catalogue.execute(
+                    'SELECT revision FROM shard_change_cursor WHERE shard = ?', (shard_number, )).fetchone()[0]
+                rows = self.shard(shard_number).db.execute(
+                    'SELECT revision, entity, entity_id, kind, uid, pid, fields FROM change_log'
+                    ' WHERE revision > ? ORDER BY revision', (copied_revision, )).fetchall()
+                if len(rows) == 0:
+                    continue
+                self.catalogue.executemany(
+                    'INSERT INTO change_log (entity, entity_id, kind, uid, pid, fields) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(entity, _to_global(shard_number, entity_id) if entity in _SHARD_ENTITIES else entity_id,
+                      kind, uid, pid, fields) for _, entity, entity_id, kind, uid, pid, fields in rows])
+                self.catalogue.execute('UPDATE shard_change_cursor SET revision = ? WHERE shard = ?',
+                                       (rows[-1][0], shard_number))
+
+    def locate(self, global_id):
+        '''Returns pair of shard number and id in shard or None if id
+        belongs to none of shards of mapping
+        '''
+        shard_number, local_id = _split(global_id)
+        if shard_number not in self.shard_numbers():
+            return None
+        return shard_number, local_id
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def _transaction_stack(self):
+        stack = getattr(self._local, 'transactions', None)
+        if stack is None:
+            stack = self._local.transactions = []
+        return stack
+
+    def _pool(self):
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = collections.OrderedDict()
+            self._local.pinned = collections.Counter()
+        return pool
+
+    def shard(self, shard_number):
+        '''Returns shard with adapters, opens its database when it is used first
+
+        Shard joins open transactions of current thread
+        '''
+        with self._shards_lock:
+            shard = self._shards.get(shard_number)
+            if shard is None:
+                db_file = self.shard_file(shard_number)
+                shard = _Shard(shard_number, db_file, sqlite_adapters.get_database(db_file))
+                self._shards[shard_number] = shard
+                logging.get_logger('ShardRouter').info('Shard {} was opened: {}'.format(shard_number, db_file))
+
+        pool = self._pool()
+        pool[shard_number] = shard
+        pool.move_to_end(shard_number)
+        for transaction in self._transaction_stack():
+            transaction._join(shard.db)
+        self._shrink_pool(pool)
+        return shard
+
+    def _shrink_pool(self, pool):
+        stack = self._transaction_stack()
+        busy_databases = stack[0].databases() if len(stack) != 0 else []
+        for shard_number, shard in list(pool.items()):
+            if len(pool) <= self.pool_size:
+                return
+            if self._local.pinned[shard_number] == 0 and all(db is not shard.db for db in busy_databases):
+                del pool[shard_number]
+                shard.db.close()
+
+    @contextlib.contextmanager
+    def pinned(self, shard_number):
+        '''Returns context with shard which connection is not closed by pool'''
+        self._pool()
+        self._local.pinned[shard_number] += 1
+        try:
+            yield self.shard(shard_number)
+        finally:
+            self._local.pinned[shard_number] -= 1
+
+    def close(self):
+        '''Closes connections of current thread to shards'''
+        pool = self._pool()
+        for shard in pool.values():
+            shard.db.close()
+        pool.clear()
+
+_shard_mapping = HashShardMapping()
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+def set_shard_mapping(mapping):
+    '''Sets mapping of routers opened by get_router after this call'''
+    global _shard_mapping
+    _shard_mapping = mapping
+
+def get_router(db_file):
+    '''Returns router for catalogue file, opened once per process
+
+    In-memory catalogue is never shared, every call creates new router
+    New routers use mapping set by set_shard_mapping
+    '''
+    if db_file == _MEMORY_DB_FILE:
+        return ShardRouter(db_file, _shard_mapping)
+
+    db_file = os.path.abspath(db_file)
+    with _routers_lock:
+        router = _routers.get(db_file)
+        if router is None:
+            router = _routers[db_file] = ShardRouter(db_file, _shard_mapping)
+    return router
+
+def close_routers():
+    '''Closes connections of current thread to shards and forgets all routers'''
+    with _routers_lock:
+        for router in _routers.values():
+            router.close()
+        _routers.clear()
+
+class StorageAdapter():
+    '''Base of adapters of tasks and plans, db is ShardRouter'''
+
+    def __init__(self, db_file=_DEFAULT_DB_FILE_PATH, db=None):
+        if db_file is None:
+            db_file = _DEFAULT_DB_FILE_PATH
+
+        self.db_file = db_file
+        if db is None:
+            self.db = get_router(db_file)
+        else:
+            self.db = db
+
+    def transaction(self):
+        '''Returns transaction which is context manager and decorator
+
+        Nested transactions become savepoints of the outer one
+        '''
+        return self.db.transaction()
+
+    def _shard_of(self, global_id):
+        '''Returns shard of id and id in shard'''
+        location = self.db.locate(global_id)
+        if location is None:
+            raise ValueError('Id {} belongs to none of shards'.format(global_id))
+        shard_number, local_id = location
+        return self.db.shard(shard_number), local_id
+
+    def _change_log(self):
+        '''Returns adapter of catalogue with changes of all shards'''
+        self.db.collect_changes()
+        return sqlite_adapters.StorageAdapter(self.db_file, self.db.catalogue)
+
+    def current_revision(self):
+        '''Returns revision of the last change of catalogue and all shards'''
+        return self._change_log().current_revision()
+
+    def get_changes(self, since_revision=0, uid=None, limit=None):
+        '''Returns changes of catalogue and all shards like sqlite_adapters,
+        ids of tasks and plans are global
+        '''
+        return self._change_log().get_changes(since_revision, uid, limit)
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def _raise_if_disconnected(self):
+        pass
+
+_NOT_IN_SHARD = object()
+
+def _local_ids(shard_number, ids):
+    '''Translates tid or list of tids to tids of shard
+
+    Returns _NOT_IN_SHARD if shard has none of them. None and empty list
+    match the same tasks in every shard
+    '''
+    if ids is None:
+        return None
+    if isinstance(ids, list):
+        if len(ids) == 0:
+            return ids
+        local_ids = [local_id for id_shard, local_id in map(_split, ids) if id_shard == shard_number]
+        return local_ids if len(local_ids) != 0 else _NOT_IN_SHARD
+    id_shard, local_id = _split(ids)
+    return local_id if id_shard == shard_number else _NOT_IN_SHARD
+
+class TaskStorageAdapter(StorageAdapter):
+
+    _log_tag = 'TaskStorageAdapter'
+
+    def _route(self, filter):
+        '''Returns pairs of shard number and filter of shard for shards
+        which can have tasks matching filter
+        '''
+        shard_numbers = set(self.db.shard_numbers())
+        if filter is None:
+            return [(shard_number, None) for shard_number in sorted(shard_numbers)]
+
+        for uids in filter._uids:
+            if uids is None or uids == []:
+                continue
+            user_shards = set()
+            for uid in (uids if isinstance(uids, list) else [uids]):
+                user_shards.update(self.db.shards_of_user(uid))
+            shard_numbers &= user_shards
+
+        routes = []
+        for shard_number in sorted(shard_numbers):
+            shard_filter = filter.to_shard_filter(shard_number)
+            if shard_filter is not None:
+                routes.append((shard_number, shard_filter))
+        return routes
+
+    @staticmethod
+    def _merge(streams, filter, newest_first):
+        if len(streams) == 1:
+            return iter(streams[0])
+        # tasks found by text search are ordered by relevance in shard
+        if filter is not None and filter._searches_text:
+            return iter(sorted(itertools.chain(*streams), key=_tid, reverse=newest_first))
+        return heapq.merge(*streams, key=_tid, reverse=newest_first)
+
+    @staticmethod
+    def _to_global_task(shard_number, task):
+        task.tid = _to_global(shard_number, task.tid)
+        task.parent_tid = _to_global(shard_number, task.parent_tid)
+        return task
+
+    @staticmethod
+    def _local_parent_tid(shard_number, parent_tid):
+        if parent_tid is None:
+            return None
+        parent_shard, local_parent_tid = _split(parent_tid)
+        if parent_shard != shard_number:
+            raise ParentNotAllowedError(parent_tid, 'Parent task {} is stored in another shard'.format(parent_tid))
+        return local_parent_tid
+
+    def _to_shard_task(self, shard_number, task):
+        shard_task = copy.copy(task)
+        if task.tid:
+            shard_task.tid = _split(task.tid)[1]
+        shard_task.parent_tid = self._local_parent_tid(shard_number, task.parent_tid)
+        return shard_task
+
+    def _to_shard_fields(self, shard_number, task_field_dict):
+        fields = dict(task_field_dict)
+        if Task.Field.tid in fields:
+            fields[Task.Field.tid] = _split(fields[Task.Field.tid])[1]
+        if Task.Field.parent_tid in fields:
+            fields[Task.Field.parent_tid] = self._local_parent_tid(shard_number, fields[Task.Field.parent_tid])
+        return fields
+
+    def _shard_of_new_task(self, task):
+        '''Subtask is stored with its parent, other task in shard of its owner'''
+        if task.parent_tid is None:
+            return self.db.shard_of_user(task.uid)
+        return self._shard_of(task.parent_tid)[0].number
+
+    def get_tasks(self, filter=None, limit=None, after_tid=None, newest_first=False, include_archived=False):
+        '''Returns list of tasks ordered by tid
+
+        Every shard reads at most limit tasks after its cursor, tasks of
+        shards are merged by tid. Tasks found by text search in several
+        shards are ordered by tid, not by relevance
+        '''
+        streams = []
+        for shard_number, shard_filter in self._route(filter):
+            tasks = self.db.shard(shard_number).task.get_tasks(
+                shard_filter, limit, _local_cursor(shard_number, after_tid, newest_first),
+                newest_first, include_archived)
+            streams.append([self._to_global_task(shard_number, task) for task in tasks])
+        return list(itertools.islice(self._merge(streams, filter, newest_first), limit))
+
+    def iterate_tasks(self, filter=None, after_tid=None, newest_first=False, include_archived=False):
+        '''Generator variant of get_tasks
+
+        Tasks are read from cursors of all shards at once
+        '''
+        streams = [self._iterate_shard(shard_number, shard_filter,
+                                       _local_cursor(shard_number, after_tid, newest_first),
+                                       newest_first, include_archived)
+                   for shard_number, shard_filter in self._route(filter)]
+        yield from self._merge(streams, filter, newest_first)
+
+    def _iterate_shard(self, shard_number, filter, after_tid, newest_first, include_archived):
+        with self.db.pinned(shard_number) as shard:
+            for task in shard.task.iterate_tasks(filter, after_tid, newest_first, include_archived):
+                yield self._to_global_task(shard_number, task)
+
+    def count_tasks(self, filter=None, overdue_time=None, include_archived=False):
+        '''Returns counts of tasks grouped by project, status and priority
+        like sqlite_adapters, counts of shards are summed
+        '''
+        counts = {}
+        for shard_number, shard_filter in self._route(filter):
+            shard_counts = self.db.shard(shard_number).task.count_tasks(shard_filter, overdue_time, include_archived)
+            for key, (count, overdue_count) in shard_counts.items():
+                total_count, total_overdue_count = counts.get(key, (0, 0))
+                counts[key] = (total_count + count, total_overdue_count + overdue_count)
+        return counts
+
+    def count_completed_tasks(self, start_time, end_time, bucket_length, filter=None):
+        '''Returns histogram of completed tasks like sqlite_adapters,
+        histograms of shards are summed
+        '''
+        histogram = {}
+        for shard_number, shard_filter in self._route(filter):
+            shard_histogram = self.db.shard(shard_number).task.count_completed_tasks(
+                start_time, end_time, bucket_length, shard_filter)
+            for bucket_start, count in shard_histogram.items():
+                histogram[bucket_start] = histogram.get(bucket_start, 0) + count
+        return histogram
+
+    def save_task(self, task, auto_tid=True):
+        '''Saves task and returns its generated tid or None if task was not saved
+        '''
+        shard_number = self._shard_of_new_task(task)
+        with self.transaction():
+            self.db.add_guest(task.uid, shard_number)
+            tid = self.db.shard(shard_number).task.save_task(self._to_shard_task(shard_number, task), auto_tid)
+        return _to_global(shard_number, tid)
+
+    def save_tasks(self, tasks):
+        '''Saves tasks with one insert per shard inside one transaction
+
+        Returns list of generated tids in order of passed tasks
+        '''
+        tasks = list(tasks)
+        shard_indexes = collections.defaultdict(list)
+        for index, task in enumerate(tasks):
+            shard_indexes[self._shard_of_new_task(task)].append(index)
+
+        tids = [None] * len(tasks)
+        with self.transaction():
+            for shard_number, indexes in sorted(shard_indexes.items()):
+                for uid in {tasks[index].uid for index in indexes}:
+                    self.db.add_guest(uid, shard_number)
+                shard_tids = self.db.shard(shard_number).task.save_tasks(
+                    [self._to_shard_task(shard_number, tasks[index]) for index in indexes])
+                for index, tid in zip(indexes, shard_tids):
+                    tids[index] = _to_global(shard_number, tid)
+        return tids
+
+    def get_last_saved_task(self):
+        '''Returns task with the greatest tid of all shards'''
+        last_task = None
+        for shard_number in self.db.shard_numbers():
+            task = self.db.shard(shard_number).task.get_last_saved_task()
+            if task is not None:
+                task = self._to_global_task(shard_number, task)
+                if last_task is None or task.tid > last_task.tid:
+                    last_task = task
+        return last_task
+
+    def remove_task(self, tid):
+        '''Removes task with all its subtasks in its shard, returns count of removed tasks'''
+        location = self.db.locate(tid)
+        if location is None:
+            return 0
+        shard_number, local_tid = location
+        return self.db.shard(shard_number).task.remove_task(local_tid)
+
+    def remove_tasks(self, uid=None, pids=None):
+        '''Removes all tasks of user and all tasks of projects with pids
+
+        Tasks of user are removed from shards of user, tasks of projects
+        from all shards. Returns dict with counts of removed rows by table names
+        '''
+        pids = list(pids) if pids is not None else []
+        shard_numbers = set(self.db.shard_numbers()) if len(pids) != 0 else set()
+        if uid is not None:
+            shard_numbers.update(self.db.shards_of_user(uid))
+
+        counts = {Change.Entity.task: 0, Change.Entity.plan: 0, Change.Entity.plan_relations: 0}
+        with self.transaction():
+            for shard_number in sorted(shard_numbers):
+                for entity, count in self.db.shard(shard_number).task.remove_tasks(uid, pids).items():
+                    counts[entity] = counts.get(entity, 0) + count
+            if uid is not None:
+                self.db.remove_guest(uid)
+        return counts
+
+    def archive_tasks(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Archives tasks in every shard like sqlite_adapters, returns count of moved tasks'''
+        return sum(self.db.shard(shard_number).task.archive_tasks(before_time, batch_size)
+                   for shard_number in self.db.shard_numbers())
+
+    def get_subtasks(self, tid, skip_plan_tasks=False):
+        location = self.db.locate(tid)
+        if location is None:
+            return []
+        shard_number, local_tid = location
+        return [self._to_global_task(shard_number, task)
+                for task in self.db.shard(shard_number).task.get_subtasks(local_tid, skip_plan_tasks)]
+
+    def edit_subtasks(self, tid, task_field_dict, skip_plan_tasks=False):
+        location = self.db.locate(tid)
+        if location is None:
+            return 0
+        shard_number, local_tid = location
+        with self.transaction():
+            if Task.Field.uid in task_field_dict:
+                self.db.add_guest(task_field_dict[Task.Field.uid], shard_number)
+            return self.db.shard(shard_number).task.edit_subtasks(
+                local_tid, self._to_shard_fields(shard_number, task_field_dict), skip_plan_tasks)
+
+    def edit_task_from_model(self, task):
+        '''Edits task in its shard, new owner of task becomes guest of shard'''
+        location = self.db.locate(task.tid)
+        if location is None:
+            return False
+        shard_number = location[0]
+        with self.transaction():
+            self.db.add_guest(task.uid, shard_number)
+            return self.db.shard(shard_number).task.edit_task_from_model(self._to_shard_task(shard_number, task))
+
+    def edit_task(self, task_field_dict):
+        '''Edits fields of task in its shard, new owner of task becomes guest of shard'''
+        location = self.db.locate(task_field_dict[Task.Field.tid])
+        if location is None:
+            return False
+        shard_number = location[0]
+        with self.transaction():
+            if Task.Field.uid in task_field_dict:
+                self.db.add_guest(task_field_dict[Task.Field.uid], shard_number)
+            return self.db.shard(shard_number).task.edit_task(self._to_shard_fields(shard_number, task_field_dict))
+
+    class Filter():
+        '''Keeps conditions of filter of sqlite_adapters to repeat them
+        in every shard
+
+        Tids and parent tids are translated to tids of shard, shards which
+        can not have matching tasks are skipped
+        '''
+
+        def __init__(self):
+            self._calls = []
+            self._uids = []
+            self._searches_text = False
+
+        def __getattr__(self, name):
+            if name.startswith('_') or not hasattr(sqlite_adapters.TaskStorageAdapter.Filter, name):
+                raise AttributeError(name)
+
+            def append_call(*args):
+                self._calls.append((name, args))
+            return append_call
+
+        def uid(self, uid):
+            self._uids.append(uid)
+            self._calls.append(('uid', (uid, )))
+
+        def text_search(self, query, fields=None):
+            self._searches_text = True
+            self._calls.append(('text_search', (query, fields)))
+
+        def to_shard_filter(self, shard_number):
+            '''Returns filter of sqlite_adapters for shard or None if shard
+            can not have matching tasks
+            '''
+            shard_filter = sqlite_adapters.TaskStorageAdapter.Filter()
+            for name, args in self._calls:
+                if name in ('tid', 'parent_tid'):
+                    ids = _local_ids(shard_number, args[0])
+                    if ids is _NOT_IN_SHARD:
+                        return None
+                    args = (ids, )
+                getattr(shard_filter, name)(*args)
+            return shard_filter
+
+class PlanStorageAdapter(StorageAdapter):
+    '''Plan is stored in shard of its common task'''
+
+    _log_tag = 'PlanStorageAdapter'
+
+    @staticmethod
+    def _to_global_plan(shard_number, plan):
+        plan.plan_id = _to_global(shard_number, plan.plan_id)
+        plan.tid = _to_global(shard_number, plan.tid)
+        return plan
+
+    def _local_tid(self, shard, tid):
+        tid_shard, local_tid = _split(tid)
+        if tid_shard != shard.number:
+            raise ValueError('Task {} is stored in another shard than plan'.format(tid))
+        return local_tid
+
+    def get_plans(self, plan_id=None, common_tid=None, edit_repeat_tid=None):
+        '''Returns plans by id or by task in shard of id, all plans are
+        read from every shard and ordered by plan_id
+        '''
+        for name, global_id in (('plan_id', plan_id), ('common_tid', common_tid),
+                                ('edit_repeat_tid', edit_repeat_tid)):
+            if global_id is None:
+                continue
+            location = self.db.locate(global_id)
+            if location is None:
+                return []
+            shard_number, local_id = location
+            return [self._to_global_plan(shard_number, plan)
+                    for plan in self.db.shard(shard_number).plan.get_plans(**{name: local_id})]
+
+        plans = [self._to_global_plan(shard_number, plan) for shard_number in self.db.shard_numbers()
+                 for plan in self.db.shard(shard_number).plan.get_plans()]
+        return sorted(plans, key=lambda plan: plan.plan_id)
+
+    def get_exclude_type(self, plan_id, number):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return shard.plan.get_exclude_type(local_plan_id, number)
+
+    def get_number_for_edit_repeat_by_tid(self, plan_id, edit_tid):
+        shard, local_plan_id = self._shard_of(plan_id)
+        tid_shard, local_tid = _split(edit_tid)
+        if tid_shard != shard.number:
+            return None
+        return shard.plan.get_number_for_edit_repeat_by_tid(local_plan_id, local_tid)
+
+    def get_tid_for_edit_repeat(self, plan_id, number):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return _to_global(shard.number, shard.plan.get_tid_for_edit_repeat(local_plan_id, number))
+
+    def recalculate_exclude_when_start_time_shifted(self, plan_id, start_time_shift):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return shard.plan.recalculate_exclude_when_start_time_shifted(local_plan_id, start_time_shift)
+
+    def save_plans(self, plans):
+        '''Saves plans to shards of their common tasks inside one transaction
+
+        Returns list of generated plan ids in order of passed plans
+        '''
+        plans = list(plans)
+        shard_indexes = collections.defaultdict(list)
+        for index, plan in enumerate(plans):
+            shard_indexes[self._shard_of(plan.tid)[0].number].append(index)
+
+        plan_ids = [None] * len(plans)
+        with self.transaction():
+            for shard_number, indexes in sorted(shard_indexes.items()):
+                shard = self.db.shard(shard_number)
+                shard_plans = []
+                for index in indexes:
+                    shard_plan = copy.copy(plans[index])
+                    shard_plan.tid = self._local_tid(shard, shard_plan.tid)
+                    shard_plans.append(shard_plan)
+                for index, plan_id in zip(indexes, shard.plan.save_plans(shard_plans)):
+                    plan_ids[index] = _to_global(shard_number, plan_id)
+        return plan_ids
+
+    def add_plan_excludes(self, plan_id, numbers):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return [_to_global(shard.number, relation_id)
+                for relation_id in shard.plan.add_plan_excludes(local_plan_id, numbers)]
+
+    def save_plan(self, plan):
+        '''Saves plan and returns its generated plan_id or None if plan was not saved
+        '''
+        return self.save_plans([plan])[0]
+
+    def delete_plan_repeat(self, plan_id, number):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return shard.plan.delete_plan_repeat(local_plan_id, number)
+
+    def edit_plan_repeat(self, plan_id, number, tid):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return shard.plan.edit_plan_repeat(local_plan_id, number, self._local_tid(shard, tid))
+
+    def chagne_edit_plan_repeat_to_delete(self, plan_id, number):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return shard.plan.chagne_edit_plan_repeat_to_delete(local_plan_id, number)
+
+    def restore_plan_repeat(self, plan_id, number):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return shard.plan.restore_plan_repeat(local_plan_id, number)
+
+    def restore_all_repeats(self, plan_id):
+        shard, local_plan_id = self._shard_of(plan_id)
+        return shard.plan.restore_all_repeats(local_plan_id)
+
+    def remove_plan(self, plan_id):
+        location = self.db.locate(plan_id)
+        if location is None:
+            return False
+        shard_number, local_plan_id = location
+        return self.db.shard(shard_number).plan.remove_plan(local_plan_id)
+
+    def count_repeats(self, start_time, end_time, uid=None, pids=None):
+        '''Returns counts of repeats of plans in time range like sqlite_adapters
+
+        Plans of user are counted in shards of user, plans of projects
+        and all plans in every shard
+        '''
+        if uid is not None and pids is None:
+            shard_numbers = sorted(self.db.shards_of_user(uid))
+        else:
+            shard_numbers = self.db.shard_numbers()
+        counts = {}
+        for shard_number in shard_numbers:
+            for plan_id, count in self.db.shard(shard_number).plan.count_repeats(
+                    start_time, end_time, uid, pids).items():
+                counts[_to_global(shard_number, plan_id)] = count
+        return counts
+
+    def archive_plans(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Archives plans in every shard like sqlite_adapters
+
+        Returns dict with counts of moved rows by table names
+        '''
+        counts = {Change.Entity.task: 0, Change.Entity.plan: 0, Change.Entity.plan_relations: 0}
+        for shard_number in self.db.shard_numbers():
+            for entity, count in self.db.shard(shard_number).plan.archive_plans(before_time, batch_size).items():
+                counts[entity] += count
+        return counts
+
+    def edit_plan(self, plan_field_dict):
+        shard, local_plan_id = self._shard_of(plan_field_dict[Plan.Field.plan_id])
+        fields = dict(plan_field_dict)
+        fields[Plan.Field.plan_id] = local_plan_id
+        return shard.plan.edit_plan(fields)
+
+class _CatalogueAdapter():
+    '''Adapter of sqlite_adapters over catalogue database, tasks of
+    users and projects are removed from shards
+    '''
+
+    def __init__(self, db_file=_DEFAULT_DB_FILE_PATH, db=None):
+        if db_file is None:
+            db_file = _DEFAULT_DB_FILE_PATH
+        self.router = db if db is not None else get_router(db_file)
+        super().__init__(db_file, self.router.catalogue)
+
+    def transaction(self):
+        return self.router.transaction()
+
+    def _task_storage(self):
+        return TaskStorageAdapter(self.db_file, self.router)
+
+    def current_revision(self):
+        self.router.collect_changes()
+        return super().current_revision()
+
+    def get_changes(self, since_revision=0, uid=None, limit=None):
+        self.router.collect_changes()
+        return super().get_changes(since_revision, uid, limit)
+
+class UserStorageAdapter(_CatalogueAdapter, sqlite_adapters.UserStorageAdapter):
+    pass
+
+class ProjectStorageAdapter(_CatalogueAdapter, sqlite_adapters.ProjectStorageAdapter):
+    pass
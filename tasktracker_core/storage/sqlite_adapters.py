@@ -1,304 +1,1383 @@
-# from ..model.task import Task
-# import sqlite3
-# import os
-# from itertools import filterfalse
-
-# class TidAlreadyExistsError(Exception):
-
-#     def __init__(self, tid):
-#         message = 'Tid {} already exists'.format(tid)
-#         super().__init__(message)
-
-# class TidNotExistsError(Exception):
-
-#     def __init__(self, tid):
-#         message = 'Tid {} not exists'.format(tid)
-#         super().__init__(message)
-
-# class DatabaseTaskTable:
-
-#     NAME = 'task'
-
-#     TID = ('tid', 'integer primary key')
-#     UID = ('uid', 'integer')
-#     RESPONSIBLE_UID = ('responsible_uid', 'integer')
-#     PID = ('pid', 'integer')
-#     PARENT_TID = ('parent_tid', 'integer')
-#     TITLE = ('title', 'text')
-#     DESCRIPTION = ('description', 'text')
-#     PRIORITY = ('priority', 'integer')
-#     STATUS = ('status', 'integer')
-#     SUPPOSED_START_TIME = ('supposed_start_time', 'integer')
-#     SUPPOSED_END_TIME = ('supposed_end_time', 'integer')
-#     DEADLINE_TIME = ('deadline_time', 'integer')
-#     ACTUAL_START_TIME = ('actual_start_time', 'integer')
-#     ACTUAL_END_TIME = ('actual_end_time', 'integer')
-#     NOTIFICATE_SUPPOSED_START = ('notificate_supposed_start', 'integer')
-#     NOTIFICATE_SUPPOSED_END = ('notificate_supposed_end', 'integer')
-#     NOTIFICATE_DEADLINE = ('notificate_deadline', 'integer')
-
-#     ACTIVE_COLUMNS = [TID, UID, RESPONSIBLE_UID, PID, 
-#                     PARENT_TID, TITLE, DESCRIPTION, 
-#                     PRIORITY, STATUS, SUPPOSED_START_TIME, 
-#                     SUPPOSED_END_TIME, DEADLINE_TIME, 
-#                     ACTUAL_START_TIME, ACTUAL_END_TIME,
-#                     NOTIFICATE_SUPPOSED_START, 
-#                     NOTIFICATE_SUPPOSED_END,
-#                     NOTIFICATE_DEADLINE]
-
-#     @classmethod
-#     def prepare_task_members(cls, task, auto_tid):
-#         notificate_supposed_start = int(task.notificate_supposed_start)
-#         notificate_supposed_end = int(task.notificate_supposed_end)
-#         notificate_deadline = int(task.notificate_deadline)
-
-#         data =  {cls.map_task_attr(task.uid): task.uid, 
-#                 cls.map_task_attr(task.responsible_uid): task.responsible_uid, 
-#                 cls.map_task_attr(task.pid): task.pid, 
-#                 cls.map_task_attr(task.parent_tid): task.parent_tid, 
-#                 cls.map_task_attr(task.title): task.title, 
-#                 cls.map_task_attr(task.description): task.description, 
-#                 cls.map_task_attr(task.priority): task.priority, 
-#                 cls.map_task_attr(task.status): task.status, 
-#                 cls.map_task_attr(task.supposed_start_time): task.supposed_start_time, 
-#                 cls.map_task_attr(task.supposed_end_time): task.supposed_end_time, 
-#                 cls.map_task_attr(task.deadline_time): task.deadline_time, 
-#                 cls.map_task_attr(task.actual_start_time): task.actual_start_time, 
-#                 cls.map_task_attr(task.actual_end_time): task.actual_end_time,
-#                 cls.map_task_attr(task.notificate_supposed_start): notificate_supposed_start, 
-#                 cls.map_task_attr(task.notificate_supposed_end): notificate_supposed_end,
-#                 cls.map_task_attr(task.notificate_deadline): notificate_deadline}
-#         if not auto_tid:
-#             data[map_task_attr(task.tid)] = task.tid
-#         return data
-
-#     @classmethod
-#     def map_task_attr(cls, task_attr):
-#         if task_attr == task.tid:
-#             return cls.TID[0]
-#         if task_attr == task.uid:
-#             return cls.UID[0]
-#         if task_attr == task.responsible_uid:
-#             return cls.RESPONSIBLE_UID[0]
-#         if task_attr == task.pid:
-#             return cls.PID[0]
-#         if task_attr == task.parent_tid:
-#             return cls.PARENT_TID[0]
-#         if task_attr == task.title:
-#             return cls.title[0]
-#         if task_attr == task.description:
-#             return cls.DESCRIPTION[0]
-#         if task_attr == task.priority:
-#             return cls.PRIORITY[0]
-#         if task_attr == task.status:
-#             return cls.STATUS[0]
-#         if task_attr == task.supposed_start_time:
-#             return cls.SUPPOSED_START_TIME[0]
-#         if task_attr == task.supposed_end_time:
-#             return cls.SUPPOSED_END_TIME[0]
-#         if task_attr == task.deadline_time:
-#             return cls.DEADLINE_TIME[0]
-#         if task_attr == task.actual_start_time:
-#             return cls.ACTUAL_START_TIME[0]
-#         if task_attr == task.actual_end_time:
-#             return cls.ACTUAL_END_TIME[0]
-#         if task_attr == task.notificate_supposed_start:
-#             return cls.NOTIFICATE_SUPPOSED_START[0]
-#         if task_attr == task.notificate_supposed_end:
-#             return cls.NOTIFICATE_SUPPOSED_END[0]
-#         if task_attr == task.notificate_deadline:
-#             return cls.NOTIFICATE_DEADLINE[0]
-
-#     @classmethod
-#     def create_task_from_sqlite_row(cls, row):
-#         notificate_supposed_start = bool(row[cls.map_task_attr(task.notificate_supposed_start)])
-#         notificate_supposed_end = bool(row[cls.map_task_attr(task.notificate_supposed_end)])
-#         notificate_deadline = bool(row[cls.map_task_attr(task.notificate_deadline)])
-
-#         task = Task()
-#         task.tid = row[cls.map_task_attr(task.tid)]
-#         task.uid = row[cls.map_task_attr(task.uid)]
-#         task.responsible_uid = row[cls.map_task_attr(task.responsible_uid)]
-#         task.pid = row[cls.map_task_attr(task.pid)]
-#         task.parent_tid = row[cls.map_task_attr(task.parent_tid)]
-#         task.title = row[cls.map_task_attr(task.title)]
-#         task.description = row[cls.map_task_attr(task.description)]
-#         task.priority = row[cls.map_task_attr(task.priority)]
-#         task.status = row[cls.map_task_attr(task.status)]
-#         task.supposed_start_time = row[cls.map_task_attr(task.supposed_start_time)]
-#         task.supposed_end_time = row[cls.map_task_attr(task.supposed_end_time)]
-#         task.deadline_time = row[cls.map_task_attr(task.deadline_time)]
-#         task.actual_start_time = row[cls.map_task_attr(task.actual_start_time)]
-#         task.actual_end_time = row[cls.map_task_attr(task.actual_end_time)]
-#         task.notificate_supposed_start = notificate_supposed_start
-#         task.notificate_supposed_end = notificate_supposed_end
-#         task.notificate_deadline = notificate_deadline
-#         return task
-
-# class DatabaseHelper():
-
-#     def __init__(self, db_name):
-#         self.db_name = db_name
-
-#     def create(self):
-#         with sqlite3.connect(self.db_name) as connection:
-#             self._create_task_table(connection)            
-
-#     def _create_task_table(self, connection):
-#         def zip_column_in_str(column):
-#             c_name = column[0]
-#             c_type = column[1]
-#             return '{} {}'.format(c_name, c_type)
-
-#         sqlite_task_table_columns = ','.join(map(zip_column_in_str, 
-#             DatabaseTaskTable.ACTIVE_COLUMNS))
-#         connection.execute('create table task({})'.format(sqlite_task_table_columns))
-
-#     def is_database_exists(self):
-#         try:
-#             open(self.db_name, 'r').close()
-#         except FileNotFoundError:
-#             return False
-#         return True
-
-#     def update(self, db_version, expected_version):
-#         pass
-
-# class StorageAdapter():
-
-#     _first_calling = True
-
-#     _DEFAULT_DB_NAME = 'tasktracker.db'
-
-#     _DATABASE_VERSION = 0
-
-#     def __init__(self, db_name, db_helper_class):
-#         self.db_name = db_name
-
-#         db_helper = db_helper_class(db_name)
-#         self.db_helper = db_helper
-
-#         if not db_helper.is_database_exists():
-#             db_helper.create()
-#             self._set_db_version(self._DATABASE_VERSION)
-
-#         db_version = self._get_db_version()
-#         if db_version != self._DATABASE_VERSION:
-#             db_helper.update(db_version, _DATABASE_VERSION)
-
-#     def _get_db_version(self):
-#         with sqlite3.connect(self.db_name) as connection:
-#             cursor = connection.execute("pragma user_version")
-#             db_version = cursor.fetchall()[0][0]
-
-#         connection.close()
-#         return db_version
-
-#     def _set_db_version(self, db_version):
-#         with sqlite3.connect(self.db_name) as connection:
-#             connection.execute("pragma user_version = {}".format(db_version))
-#         connection.close()
-
-# class TaskStorageAdapter(StorageAdapter):
-
-#     def __init__(self, db_name=StorageAdapter._DEFAULT_DB_NAME, 
-#         db_helper_class=DatabaseHelper):
-#         super().__init__(db_name, db_helper_class)
-
-#     def connect(self):
-#         self.connection = sqlite3.connect(self.db_name)
-#         self.connection.row_factory = sqlite3.Row
-
-#     def disconnect(self):
-#         self._raise_if_disconnect()
-#         self.connection.close()
-#         del self.connection
-
-#     def is_connected(self):
-#         try:
-#             self._raise_if_disconnect()
-#         except ValueError:
-#             return False
-
-#         return True
-
-#     def _raise_if_disconnect(self):
-#         try:
-#             self.connection
-#         except AttributeError:
-#             raise ValueError("There isn't a connection")
-
-#     def get_tasks(self, filter=None):
-#         self._raise_if_disconnect()
-
-#         query = 'select * from task'
-#         if filter is not None:
-#             data = ','.join(['{}=(?)'.format(key) for key in filter.keys()])
-#             query += ' where {}'.format(data)
-#         with self.connection:
-#             if filter is None:
-#                 cursor = self.connection.execute(query)
-#             else:
-#                 cursor = self.connection.execute(query, list(filter.values()))
-#             cursor_content = cursor.fetchall()
-#             tasks = []
-#             for raw_task in cursor_content:
-#                 task = DatabaseTaskTable.create_task_from_sqlite_row(raw_task)
-#                 tasks.append(task)
-
-#         return tasks
-        
-#     def save_task(self, task, auto_tid=True):
-#         self._raise_if_disconnect()
-
-#         prepared_dict = DatabaseTaskTable.prepare_task_members(task, auto_tid)
-#         data_placeholder = ('?,' * len(prepared_dict))[0:-1]
-#         columns = ','.join(list(prepared_dict.keys()))
-#         query = 'insert into task({}) values ({})'.format(columns, data_placeholder)
-#         with self.connection:
-#             self.connection.execute(query, list(prepared_dict.values()))
-    
-#     def remove_task(self, task_id):
-#         self._raise_if_disconnect()
-
-#         query = 'delete from task where {}=(?)'.format(DatabaseTaskTable.TID[0])
-#         with self.connection:
-#             self.connection.execute(query, [task_id])
-
-#     def edit_task(self, edit_task):
-#         self._raise_if_disconnect()
-
-#         prepared_dict = DatabaseTaskTable.prepare_task_members(edit_task, True)
-#         data = ','.join(['{}=(?)'.format(key) for key in prepared_dict.keys()])
-#         query = 'update task set {} where {}=(?)'.format(data, DatabaseTaskTable.TID[0])
-#         with self.connection:
-#             self.connection.execute(query, list(prepared_dict.values()) + [edit_task.tid])
-
-#     def is_task_id_present(self, task_id):
-#         tasks = self.get_tasks()
-
-#         present = False
-#         for task in tasks:
-#             if task.tid == task_id:
-#                 present = True
-#                 break
-
-#         return present
-
-#     def _create_next_task_id(self):
-#         with open(self.id_db_name, 'a+') as id_db_file:
-#             id_db_file.seek(0)
-#             json_id_db_file_content = id_db_file.read()
-#             if len(json_id_db_file_content) == 0:
-#                 id_db_file_content = {}
-#             else:
-#                 id_db_file_content = json.loads(json_id_db_file_content)
-
-#             task_id = int(id_db_file_content.get('task', '0'))
-#             id_db_file_content['task'] = task_id + 1
-
-#             json_id_db_file_content = json.dumps(id_db_file_content)
-#             id_db_file.truncate(0)
-#             id_db_file.write(json_id_db_file_content)
-
-#         return task_id
\ No newline at end of file
+'''Storage adapters over plain sqlite3 module
+
+Drop-in replacement of adapters from sqlite_peewee_adapters: the same
+four adapter classes with the same methods work with the same database
+schema, so both kinds of adapters can open one database file. Schema is
+created and migrated by sqlite_peewee_adapters.migrate_schema, all other
+queries are plain sql
+
+Rows are read as tuples and mapped to model objects directly. Every
+query has constant sql text, lists of values are passed as one json
+parameter, so sqlite3 statement cache of connection prepares every
+query only once. Bulk writes use executemany
+
+Install adapters with Controller.init_storage_adapters
+'''
+
+import heapq
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from peewee import SqliteDatabase
+
+from tasktracker_core.model.task import Task, Status
+from tasktracker_core.model.user import User
+from tasktracker_core.model.plan import Plan
+from tasktracker_core.model.project import Project
+from tasktracker_core.model.change import Change
+from tasktracker_core.storage.sqlite_peewee_adapters import (migrate_schema, get_engine_profile,
+                                                             _DEFAULT_DB_FILE_PATH, _ARCHIVE_BATCH_SIZE,
+                                                             _SNAPSHOT_PAGES, _SNAPSHOT_PAUSE, _backup,
+                                                             _read_only_uri, _check_schema_version)
+from tasktracker_core import logging
+
+_MEMORY_DB_FILE = ':memory:'
+
+# Prepared statements kept by every connection
+_CACHED_STATEMENTS = 256
+
+class _PlanRelationKind():
+    COMMON = 0
+    EDITED = 1
+    DELETED = 2
+
+class _ProjectRelationKind():
+    ADMIN = 0
+    GUEST = 1
+
+class _Transaction():
+    '''Transaction of Database, nested one is savepoint
+
+    Works as context manager and as decorator like peewee atomic
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._savepoint = None
+
+    def __call__(self, method):
+        def run_in_transaction(*args, **kwargs):
+            with _Transaction(self.db):
+                return method(*args, **kwargs)
+        return run_in_transaction
+
+    def __enter__(self):
+        depth = self.db.transaction_depth()
+        if depth == 0:
+            self.db.execute('BEGIN')
+        else:
+            self._savepoint = 's{}'.format(depth)
+            self.db.execute('SAVEPOINT {}'.format(self._savepoint))
+        self.db._local.depth = depth + 1
+        return self
+
+    def rollback(self):
+        '''Rolls back all changes made in transaction, transaction stays open'''
+        if self._savepoint is None:
+            self.db.execute('ROLLBACK')
+            self.db.execute('BEGIN')
+        else:
+            self.db.execute('ROLLBACK TO SAVEPOINT {}'.format(self._savepoint))
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.db._local.depth -= 1
+        if self._savepoint is None:
+            if exc_type is None:
+                try:
+                    self.db.execute('COMMIT')
+                    return
+                except:
+                    self.db.execute('ROLLBACK')
+                    raise
+            self.db.execute('ROLLBACK')
+        else:
+            if exc_type is not None:
+                self.db.execute('ROLLBACK TO SAVEPOINT {}'.format(self._savepoint))
+            self.db.execute('RELEASE SAVEPOINT {}'.format(self._savepoint))
+
+class Database():
+    '''Sqlite database file with one connection for every thread
+
+    Connections use engine profile of sqlite_peewee_adapters which was
+    set when database was opened. In-memory database is opened in shared
+    cache, so connections of all threads see the same data. Read-only
+    profile opens existing file by mode=ro uri without migration
+    '''
+
+    _memory_ids = itertools.count(1)
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.profile = get_engine_profile()
+        self._local = threading.local()
+        if self.profile.read_only:
+            self.database = _read_only_uri(db_file)
+            self._uri = True
+            schema_db = SqliteDatabase(self.database, uri=True)
+            _check_schema_version(schema_db, db_file)
+            schema_db.close()
+            return
+
+        self._uri = db_file == _MEMORY_DB_FILE
+        if self._uri:
+            self.database = 'file:tasktracker_memory_{}?mode=memory&cache=shared'.format(
+                next(self._memory_ids))
+            # in-memory database lives while it has at least one connection
+            self._keeper = self._connect()
+        else:
+            self.database = db_file
+
+        schema_db = SqliteDatabase(self.database, uri=self._uri)
+        migrate_schema(schema_db)
+        schema_db.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database, uri=self._uri, isolation_level=None,
+                                     check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
+        for name, value in self.profile.get_pragmas():
+            connection.execute('PRAGMA {} = {}'.format(name, value))
+        return connection
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def close(self):
+        '''Closes connection of current thread'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def transaction_depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def _run(self, method, sql, params):
+        attempt = 0
+        while True:
+            try:
+                return method(sql, params)
+            except sqlite3.OperationalError as error:
+                message = str(error)
+                if (attempt >= self.profile.busy_retries or self.transaction_depth() != 0
+                        or not ('database is locked' in message or 'database table is locked' in message)):
+                    raise
+            time.sleep(self.profile.busy_retry_delay * 2 ** attempt)
+            attempt += 1
+
+    def execute(self, sql, params=()):
+        return self._run(self.connection().execute, sql, params)
+
+    def executemany(self, sql, params):
+        return self._run(self.connection().executemany, sql, params)
+
+    def insert_many(self, sql, rows):
+        '''Inserts rows in one transaction and returns their generated ids
+
+        Sqlite assigns sequential rowids to rows inserted in one transaction
+        '''
+        rows = list(rows)
+        if len(rows) == 0:
+            return []
+        with self.transaction():
+            self.executemany(sql, rows)
+            last_id = self.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(db_file):
+    '''Returns database for specified file, opened once per process
+
+    In-memory database is never shared, every call creates new one
+    '''
+    if db_file == _MEMORY_DB_FILE:
+        return Database(db_file)
+
+    db_file = os.path.abspath(db_file)
+    with _databases_lock:
+        db = _databases.get(db_file)
+        if db is None:
+            db = _databases[db_file] = Database(db_file)
+    return db
+
+def close_databases():
+    '''Closes connections of current thread and forgets all databases'''
+    with _databases_lock:
+        for db in _databases.values():
+            db.close()
+        _databases.clear()
+
+def _json_list(values):
+    return json.dumps(list(values))
+
+_IN_LIST = 'IN (SELECT value FROM json_each(?))'
+
+def _floor_div(dividend, divisor):
+    '''Returns sql of division of integers rounded down, sqlite rounds it towards zero'''
+    return '(({0}) - ((({0}) % ({1})) + ({1})) % ({1})) / ({1})'.format(dividend, divisor)
+
+def _to_bool(value):
+    if value is None:
+        return None
+    return bool(value)
+
+class StorageAdapter():
+
+    def __init__(self, db_file=_DEFAULT_DB_FILE_PATH, db=None):
+        if db_file is None:
+            db_file = _DEFAULT_DB_FILE_PATH
+
+        self.db_file = db_file
+        if db is None:
+            self.db = get_database(db_file)
+        else:
+            self.db = db
+
+    def transaction(self):
+        '''Returns transaction which is context manager and decorator
+
+        Nested transactions become savepoints of the outer one
+        '''
+        return self.db.transaction()
+
+    def _task_storage(self):
+        '''Task adapter of the same database for cascades of users and projects'''
+        return TaskStorageAdapter(self.db_file, self.db)
+
+    def snapshot(self, dest_path, pages=_SNAPSHOT_PAGES, pause=_SNAPSHOT_PAUSE, progress=None):
+        '''Writes consistent copy of database to dest_path while it is used
+
+        Same as snapshot of sqlite_peewee_adapters
+        '''
+        total_pages = _backup(self.db.connection(), dest_path, pages, pause, progress)
+        logging.get_logger('StorageAdapter').info('Snapshot of {} pages was written to {}'.format(
+            total_pages, dest_path))
+        return total_pages
+
+    _SELECT_CHANGES = ('SELECT revision, entity, entity_id, kind, uid, pid, fields FROM change_log'
+                       ' WHERE revision > ?')
+
+    # changes of user and of projects where user is creator, admin or guest
+    _SELECT_USER_CHANGES = (_SELECT_CHANGES + ' AND (uid = ?'
+                            ' OR pid IN (SELECT pid_id FROM project_relations WHERE uid_id = ?)'
+                            ' OR pid IN (SELECT pid FROM project WHERE creator_id = ?))')
+
+    @staticmethod
+    def _change_from_row(row):
+        change = Change()
+        (change.revision, change.entity, change.entity_id, change.kind,
+            change.uid, change.pid, fields) = row
+        change.fields = fields.split(',') if fields else []
+        return change
+
+    def current_revision(self):
+        '''Returns revision of the last change or 0 if nothing was changed'''
+        return self.db.execute('SELECT COALESCE(MAX(revision), 0) FROM change_log').fetchone()[0]
+
+    def get_changes(self, since_revision=0, uid=None, limit=None):
+        '''Returns changes made after since_revision ordered by revision
+
+        If uid is specified, only changes of rows of this user and of
+        projects where user is creator, admin or guest are returned
+        '''
+        # negative limit means no limit
+        limit = -1 if limit is None else limit
+        if uid is None:
+            rows = self.db.execute(self._SELECT_CHANGES + ' ORDER BY revision LIMIT ?', (since_revision, limit))
+        else:
+            rows = self.db.execute(self._SELECT_USER_CHANGES + ' ORDER BY revision LIMIT ?',
+                                   (since_revision, uid, uid, uid, limit))
+        return [self._change_from_row(row) for row in rows]
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+class TaskStorageAdapter(StorageAdapter):
+
+    _log_tag = 'TaskStorageAdapter'
+
+    # columns in order of Task attributes set by _task_from_row
+    _COLUMNS = ('tid', 'pid_id', 'uid_id', 'parent_tid', 'title', 'description',
+                'supposed_start_time', 'supposed_end_time', 'deadline_time',
+                'priority', 'status', 'notificate_supposed_start',
+                'notificate_supposed_end', 'notificate_deadline')
+
+    _SELECT = 'SELECT {} FROM task'.format(', '.join('task.' + column for column in _COLUMNS))
+
+    # conditions of filter refer to task, so archive is aliased
+    _SELECT_ARCHIVED = _SELECT + '_archive AS task'
+
+    # borders of task are set by triggers of schema
+    _DATA_COLUMNS = _COLUMNS[1:]
+
+    _INSERT = 'INSERT INTO task ({}) VALUES ({})'.format(', '.join(_DATA_COLUMNS),
+                                                         ', '.join('?' * len(_DATA_COLUMNS)))
+
+    _INSERT_WITH_TID = 'INSERT INTO task ({}) VALUES ({})'.format(', '.join(_COLUMNS),
+                                                                  ', '.join('?' * len(_COLUMNS)))
+
+    # greatest archived tid if sqlite would give it to new task again
+    _LAST_ARCHIVED_TID = ('SELECT MAX(tid) FROM task_archive'
+                          ' WHERE tid >= (SELECT COALESCE(MAX(tid), 0) FROM task)')
+
+    _ARCHIVE_COLUMNS = _COLUMNS + ('is_plan', 'left_border', 'right_border')
+
+    _MOVE_TO_ARCHIVE = 'INSERT INTO task_archive ({0}) SELECT {0} FROM task WHERE tid '.format(
+        ', '.join(_ARCHIVE_COLUMNS)) + _IN_LIST
+
+    # roots whose trees can be archived, tasks of plans, not completed tasks
+    # and tasks which ended after time block their trees
+    _ARCHIVED_ROOTS = ('WITH RECURSIVE tree(root, tid) AS (SELECT tid, tid FROM task WHERE tid ' + _IN_LIST +
+                       ' UNION ALL SELECT tree.root, task.tid FROM task JOIN tree ON task.parent_tid = tree.tid)'
+                       ' SELECT tid FROM task WHERE tid ' + _IN_LIST + ' AND tid NOT IN (SELECT tree.root'
+                       ' FROM tree JOIN task ON task.tid = tree.tid WHERE COALESCE(task.status, -1) != ?'
+                       ' OR task.right_border >= ? OR task.tid IN (SELECT tid_id FROM plan_relations))')
+
+    _UPDATE = 'UPDATE task SET {} WHERE tid = ?'.format(', '.join('{} = ?'.format(column)
+                                                                  for column in _DATA_COLUMNS))
+
+    # Task.Field to column
+    _FIELD_COLUMNS = {Task.Field.pid: 'pid_id', Task.Field.uid: 'uid_id'}
+
+    # not completed task is overdue by its status or by time like in Filter.overdue_by_time
+    _OVERDUE = ('task.status = {} OR (task.status IN ({}, {}) AND task.left_border < ?'
+                ' AND (task.supposed_start_time IS NULL OR task.supposed_start_time < ?)'
+                ' AND (task.supposed_end_time < ? OR task.deadline_time < ?))').format(
+        Status.OVERDUE, Status.ACTIVE, Status.PENDING)
+
+    _SUBTREE = ('WITH RECURSIVE subtree(tid) AS (SELECT tid FROM task WHERE tid ' + _IN_LIST +
+                ' UNION SELECT task.tid FROM task JOIN subtree ON task.parent_tid = subtree.tid)'
+                ' SELECT tid FROM subtree')
+
+    @staticmethod
+    def _task_from_row(row):
+        task = Task()
+        (task.tid, task.pid, task.uid, task.parent_tid, task.title, task.description,
+            task.supposed_start_time, task.supposed_end_time, task.deadline_time,
+            task.priority, task.status, notificate_supposed_start,
+            notificate_supposed_end, notificate_deadline) = row
+        task.notificate_supposed_start = _to_bool(notificate_supposed_start)
+        task.notificate_supposed_end = _to_bool(notificate_supposed_end)
+        task.notificate_deadline = _to_bool(notificate_deadline)
+        return task
+
+    @staticmethod
+    def _task_to_row(task):
+        return (task.pid, task.uid, task.parent_tid, task.title, task.description,
+                task.supposed_start_time, task.supposed_end_time, task.deadline_time,
+                task.priority, task.status, task.notificate_supposed_start,
+                task.notificate_supposed_end, task.notificate_deadline)
+
+    def get_tasks(self, filter=None, limit=None, after_tid=None, newest_first=False, include_archived=False):
+        '''Returns list of tasks ordered by tid
+
+        Tasks can be paged by keyset: limit bounds count of tasks and
+        after_tid is tid of the last task of previous page. Archived
+        tasks are returned only if include_archived is True
+        '''
+        if include_archived:
+            return list(itertools.islice(self._iterate_with_archived(filter, limit, after_tid, newest_first),
+                                         limit))
+        return [self._task_from_row(row) for row in self._select_tasks(filter, limit,
+                                                                     after_tid, newest_first)]
+
+    def iterate_tasks(self, filter=None, after_tid=None, newest_first=False, include_archived=False):
+        '''Generator variant of get_tasks
+
+        Rows are read from database cursor one by one and are not cached,
+        so memory usage does not depend on count of tasks
+        '''
+        if include_archived:
+            yield from self._iterate_with_archived(filter, None, after_tid, newest_first)
+            return
+        for row in self._select_tasks(filter, None, after_tid, newest_first):
+            yield self._task_from_row(row)
+
+    def _iterate_with_archived(self, filter, limit, after_tid, newest_first):
+        '''Merges tasks of task table and archive by tid, relevance
+        of text search is not used for order here
+        '''
+        streams = [(self._task_from_row(row) for row in self._select_tasks(filter, limit, after_tid, newest_first,
+                                                                          archived, by_relevance=False))
+                   for archived in (False, True)]
+        return heapq.merge(*streams, key=lambda task: task.tid, reverse=newest_first)
+
+    def _select_tasks(self, filter, limit, after_tid, newest_first, archived=False, by_relevance=True):
+        '''Tasks are ordered by tid. Tasks found by text search are ordered
+        by relevance unless they are paged with after_tid or newest_first.
+        Archived tasks are never found by text search
+        '''
+        join, conditions, params = self._filter_tasks(filter, archived)
+        if after_tid is not None:
+            conditions.append('task.tid < ?' if newest_first else 'task.tid > ?')
+            params.append(after_tid)
+
+        sql = (self._SELECT_ARCHIVED if archived else self._SELECT) + join
+        order = []
+        if join != '' and by_relevance and after_tid is None and not newest_first:
+            order.append('bm25(task_search)')
+        if len(conditions) != 0:
+            sql += ' WHERE ' + ' AND '.join('({})'.format(condition) for condition in conditions)
+        order.append('task.tid DESC' if newest_first else 'task.tid')
+        sql += ' ORDER BY ' + ', '.join(order)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self.db.execute(sql, params)
+
+    @staticmethod
+    def _filter_tasks(filter, archived):
+        '''Returns join of text search, list of conditions and list of
+        their parameters for filter
+        '''
+        join = ''
+        conditions = []
+        params = []
+        if filter is None:
+            return join, conditions, params
+
+        for condition, condition_params in filter.to_sql_conditions(with_interval_index=not archived):
+            conditions.append(condition)
+            params.extend(condition_params)
+        text_search_query = filter.to_text_search_query()
+        if text_search_query is not None and archived:
+            conditions.append('0')
+        elif text_search_query is not None:
+            join = ' JOIN task_search ON task_search.rowid = task.tid'
+            conditions.append('task_search MATCH ?')
+            params.append(text_search_query)
+        return join, conditions, params
+
+    def _aggregate_tasks(self, groups, aggregates, column_params, filter, archived,
+                         conditions=(), condition_params=()):
+        '''Selects aggregates of tasks matched by filter and conditions
+        grouped by groups, parameters of both are column_params
+        '''
+        join, filter_conditions, filter_params = self._filter_tasks(filter, archived)
+        conditions = list(conditions) + filter_conditions
+        sql = 'SELECT {} FROM {}{}'.format(', '.join(groups + aggregates),
+                                           'task_archive AS task' if archived else 'task', join)
+        if len(conditions) != 0:
+            sql += ' WHERE ' + ' AND '.join('({})'.format(condition) for condition in conditions)
+        # groups are referred by numbers of columns, so their parameters are passed once
+        sql += ' GROUP BY ' + ', '.join(str(number) for number in range(1, len(groups) + 1))
+        return self.db.execute(sql, list(column_params) + list(condition_params) + filter_params)
+
+    def count_tasks(self, filter=None, overdue_time=None, include_archived=False):
+        '''Returns counts of tasks matched by filter grouped by project,
+        status and priority
+
+        Result is dict from (pid, status, priority) to pair of count of
+        tasks and count of overdue tasks. Not completed task is overdue if
+        its status is overdue or if it is overdue by overdue_time like in
+        Filter.overdue_by_time. Tasks are counted by one query for task
+        table and one for archive if include_archived is True
+        '''
+        aggregates = ('COUNT(*)', 'SUM(CASE WHEN {} THEN 1 ELSE 0 END)'.format(self._OVERDUE))
+        counts = {}
+        for archived in ((False, True) if include_archived else (False, )):
+            rows = self._aggregate_tasks(('task.pid_id', 'task.status', 'task.priority'), aggregates,
+                                         [overdue_time] * 4, filter, archived)
+            for pid, status, priority, count, overdue_count in rows:
+                total_count, total_overdue_count = counts.get((pid, status, priority), (0, 0))
+                counts[(pid, status, priority)] = (total_count + count, total_overdue_count + overdue_count)
+        return counts
+
+    def count_completed_tasks(self, start_time, end_time, bucket_length, filter=None):
+        '''Returns histogram of completed tasks matched by filter
+
+        Time from start_time to end_time is divided into buckets of
+        bucket_length, task is counted in bucket of its right border
+        because time of completion is not stored. Result is dict from
+        start time of bucket to count of tasks, buckets without tasks
+        are skipped. Archived tasks are counted too, one query per table
+        '''
+        histogram = {}
+        for archived in (False, True):
+            rows = self._aggregate_tasks(('(task.right_border - ?) / ?', ), ('COUNT(*)', ),
+                                         (start_time, bucket_length), filter, archived,
+                                         ('task.status = ? AND task.right_border >= ? AND task.right_border < ?', ),
+                                         (Status.COMPLETED, start_time, end_time))
+            for number, count in rows:
+                bucket_start = start_time + number * bucket_length
+                histogram[bucket_start] = histogram.get(bucket_start, 0) + count
+        return histogram
+
+    def _next_free_tid(self):
+        '''Returns tid for new task if sqlite would give it tid of archived
+        task, otherwise None
+        '''
+        last_archived_tid = self.db.execute(self._LAST_ARCHIVED_TID).fetchone()[0]
+        if last_archived_tid is None:
+            return None
+        return last_archived_tid + 1
+
+    def save_task(self, task, auto_tid=True):
+        '''Saves task and returns its generated tid or None if task was not saved
+        '''
+        with self.transaction():
+            tid = self._next_free_tid()
+            if tid is None:
+                cursor = self.db.execute(self._INSERT, self._task_to_row(task))
+            else:
+                cursor = self.db.execute(self._INSERT_WITH_TID, (tid, ) + self._task_to_row(task))
+        if cursor.rowcount != 1:
+            return None
+        logging.get_logger(self._log_tag).info('Task was saved: {}'.format(cursor.lastrowid))
+        return cursor.lastrowid
+
+    def save_tasks(self, tasks):
+        '''Saves tasks with executemany inside one transaction
+
+        Returns list of generated tids in order of passed tasks
+        '''
+        rows = (self._task_to_row(task) for task in tasks)
+        with self.transaction():
+            first_tid = self._next_free_tid()
+            if first_tid is None:
+                tids = self.db.insert_many(self._INSERT, rows)
+            else:
+                tids = self.db.insert_many(self._INSERT_WITH_TID,
+                                           ((tid, ) + row for tid, row in enumerate(rows, first_tid)))
+        logging.get_logger(self._log_tag).info('{} tasks were saved'.format(len(tids)))
+        return tids
+
+    def get_last_saved_task(self):
+        row = self.db.execute(self._SELECT + ' ORDER BY task.tid DESC LIMIT 1').fetchone()
+        if row is not None:
+            return self._task_from_row(row)
+
+    def remove_task(self, tid):
+        '''Removes task with all its subtasks in one transaction
+
+        Plans which common task is removed are removed with their edited
+        repeats, edited repeats of other plans are restored.
+        Returns count of removed tasks
+        '''
+        counts = self._remove_subtrees([tid])
+        logging.get_logger(self._log_tag).info('Task {} was removed, removed rows: {}'.format(tid, counts))
+        return counts[Change.Entity.task]
+
+    def remove_tasks(self, uid=None, pids=None):
+        '''Removes all tasks of user and all tasks of projects with pids
+
+        Tasks are removed with subtasks and plans like in remove_task, with
+        a few statements in one transaction. Archived tasks of user and
+        projects are removed too. Returns dict with counts of removed
+        rows by table names
+        '''
+        params = (uid, _json_list(pids if pids is not None else []))
+        with self.transaction():
+            root_tids = [row[0] for row in self.db.execute(
+                'SELECT tid FROM task WHERE uid_id = ? OR pid_id ' + _IN_LIST, params)]
+            counts = self._remove_subtrees(root_tids)
+            counts[Change.Entity.task] += self.db.execute(
+                'DELETE FROM task_archive WHERE tid IN ({})'.format(self._ARCHIVED_SUBTREE), params).rowcount
+        logging.get_logger(self._log_tag).info('Tasks of user {} and projects {} were removed, removed rows: {}'\
+            .format(uid, pids, counts))
+        return counts
+
+    def _remove_subtrees(self, root_tids):
+        with self.transaction():
+            subtree = self._select_subtree_tids(root_tids)
+            plan_ids = [row[0] for row in self.db.execute(
+                'SELECT plan_id FROM plan_relations WHERE kind = ? AND tid_id ' + _IN_LIST,
+                (_PlanRelationKind.COMMON, _json_list(subtree)))]
+
+            root_tids = list(root_tids)
+            if len(plan_ids) != 0:
+                root_tids.extend(row[0] for row in self.db.execute(
+                    'SELECT tid_id FROM plan_relations WHERE kind = ? AND plan_id ' + _IN_LIST,
+                    (_PlanRelationKind.EDITED, _json_list(plan_ids))))
+            tids_to_remove = _json_list(self._select_subtree_tids(root_tids))
+            plan_ids_json = _json_list(plan_ids)
+
+            relations_deleted = self.db.execute(
+                'DELETE FROM plan_relations WHERE plan_id {0} OR tid_id {0}'.format(_IN_LIST),
+                (plan_ids_json, tids_to_remove)).rowcount
+            plans_deleted = self.db.execute('DELETE FROM plan WHERE plan_id ' + _IN_LIST,
+                                            (plan_ids_json, )).rowcount
+            tasks_deleted = self.db.execute('DELETE FROM task WHERE tid ' + _IN_LIST,
+                                            (tids_to_remove, )).rowcount
+
+        return {Change.Entity.task: tasks_deleted, Change.Entity.plan: plans_deleted,
+                Change.Entity.plan_relations: relations_deleted}
+
+    def _select_subtree_tids(self, root_tids):
+        return [row[0] for row in self.db.execute(self._SUBTREE, (_json_list(root_tids), ))]
+
+    # archived tasks of user or projects with their subtasks
+    _ARCHIVED_SUBTREE = ('WITH RECURSIVE subtree(tid) AS (SELECT tid FROM task_archive'
+                         ' WHERE uid_id = ? OR pid_id ' + _IN_LIST + ' UNION SELECT task_archive.tid'
+                         ' FROM task_archive JOIN subtree ON task_archive.parent_tid = subtree.tid)'
+                         ' SELECT tid FROM subtree')
+
+    def archive_tasks(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Moves completed tasks which ended before before_time to archive
+
+        Only tasks without parent are moved, each with all its subtasks,
+        and only if all subtasks are completed too and ended before
+        before_time or have no time. Tasks of plans are archived with
+        their plans only. Every batch of tasks is moved in its own
+        transaction. Returns count of moved tasks
+        '''
+        moved_count = 0
+        last_root = 0
+        while True:
+            with self.transaction():
+                roots = [row[0] for row in self.db.execute(
+                    'SELECT tid FROM task WHERE parent_tid IS NULL AND status = ? AND right_border < ?'
+                    ' AND tid > ? AND tid NOT IN (SELECT tid_id FROM plan_relations WHERE tid_id IS NOT NULL)'
+                    ' ORDER BY tid LIMIT ?', (Status.COMPLETED, before_time, last_root, batch_size))]
+                if len(roots) == 0:
+                    break
+                last_root = roots[-1]
+                roots = _json_list(roots)
+                archived_roots = [row[0] for row in self.db.execute(
+                    self._ARCHIVED_ROOTS, (roots, roots, Status.COMPLETED, before_time))]
+                moved_count += self._move_to_archive(self._select_subtree_tids(archived_roots))
+
+        logging.get_logger(self._log_tag).info('{} tasks which ended before {} were archived'\
+            .format(moved_count, before_time))
+        return moved_count
+
+    def _move_to_archive(self, tids):
+        '''Copies tasks with tids to archive and removes them from task table,
+        returns count of moved tasks
+        '''
+        tids = _json_list(tids)
+        self.db.execute(self._MOVE_TO_ARCHIVE, (tids, ))
+        return self.db.execute('DELETE FROM task WHERE tid ' + _IN_LIST, (tids, )).rowcount
+
+    _SUBTASKS = 'tid IN ({}) AND tid != ?'.format(_SUBTREE.replace(_IN_LIST, '= ?'))
+
+    # subtasks which are not common tasks of plans or subtasks of them
+    _SUBTASKS_WITHOUT_PLAN_TASKS = ('tid IN (WITH RECURSIVE subtree(tid) AS (SELECT tid FROM task WHERE tid = ?'
+                                    ' UNION SELECT task.tid FROM task JOIN subtree ON task.parent_tid = subtree.tid'
+                                    ' WHERE task.tid NOT IN (SELECT tid_id FROM plan_relations'
+                                    ' WHERE kind = {} AND tid_id IS NOT NULL)) SELECT tid FROM subtree)'
+                                    ' AND tid != ?').format(_PlanRelationKind.COMMON)
+
+    def get_subtasks(self, tid, skip_plan_tasks=False):
+        '''Returns all subtasks of task at any depth ordered by tid
+
+        If skip_plan_tasks is True, common tasks of plans are not returned
+        together with their own subtasks
+        '''
+        condition = self._SUBTASKS_WITHOUT_PLAN_TASKS if skip_plan_tasks else self._SUBTASKS
+        rows = self.db.execute(self._SELECT + ' WHERE ' + condition + ' ORDER BY tid', (tid, tid))
+        return [self._task_from_row(row) for row in rows]
+
+    def edit_subtasks(self, tid, task_field_dict, skip_plan_tasks=False):
+        '''Sets fields of all subtasks of task at any depth with one update
+
+        Subtasks are selected like get_subtasks does. Returns count of edited tasks
+        '''
+        fields = sorted(task_field_dict)
+        condition = self._SUBTASKS_WITHOUT_PLAN_TASKS if skip_plan_tasks else self._SUBTASKS
+        sql = 'UPDATE task SET {} WHERE {}'.format(
+            ', '.join('{} = ?'.format(self._FIELD_COLUMNS.get(field, field)) for field in fields), condition)
+        rows_modified = self.db.execute(sql, tuple(task_field_dict[field] for field in fields) + (tid, tid)).rowcount
+        logging.get_logger(self._log_tag).info('{} subtasks of task {} were edited: {}'\
+            .format(rows_modified, tid, task_field_dict))
+        return rows_modified
+
+    def edit_task_from_model(self, task):
+        rows_modified = self.db.execute(self._UPDATE, self._task_to_row(task) + (task.tid, )).rowcount
+        success = rows_modified == 1
+        if success:
+            logging.get_logger(self._log_tag).info('Task was edited: %s', task.tid)
+        return success
+
+    def edit_task(self, task_field_dict):
+        tid = task_field_dict[Task.Field.tid]
+        filter = self.Filter()
+        filter.tid(tid)
+        tasks = self.get_tasks(filter)
+        if len(tasks) == 0:
+            return False
+        task = tasks[0]
+        for field, value in task_field_dict.items():
+            if field != Task.Field.tid and hasattr(task, field):
+                setattr(task, field, value)
+        return self.edit_task_from_model(task)
+
+    class Filter():
+
+        def __init__(self):
+            self._filter = []
+            # lookups in interval index, archive has no such index
+            self._interval_candidates = []
+            self._text_search = []
+
+        def _append(self, condition, *params):
+            self._filter.append((condition, params))
+
+        def _one_of(self, column, values):
+            if isinstance(values, list):
+                if len(values) != 0:
+                    self._append('task.{} {}'.format(column, _IN_LIST), _json_list(values))
+            elif values is None:
+                self._append('task.{} IS NULL'.format(column))
+            else:
+                self._append('task.{} = ?'.format(column), values)
+
+        def tid(self, tid):
+            self._one_of('tid', tid)
+
+        def pid(self, pid):
+            self._one_of('pid_id', pid)
+
+        def parent_tid(self, parent_tid):
+            self._one_of('parent_tid', parent_tid)
+
+        def uid(self, uid):
+            self._one_of('uid_id', uid)
+
+        def title(self, title):
+            self._one_of('title', title)
+
+        def description(self, description):
+            self._one_of('description', description)
+
+        def priority(self, priority):
+            self._one_of('priority', priority)
+
+        def status(self, status):
+            self._one_of('status', status)
+
+        def notificate_supposed_start(self, notificate_supposed_start):
+            self._one_of('notificate_supposed_start', notificate_supposed_start)
+
+        def notificate_supposed_end(self, notificate_supposed_end):
+            self._one_of('notificate_supposed_end', notificate_supposed_end)
+
+        def notificate_deadline(self, notificate_deadline):
+            self._one_of('notificate_deadline', notificate_deadline)
+
+        def one_of_notificate(self):
+            self._append('task.notificate_supposed_start = 1 OR task.notificate_supposed_end = 1 '
+                         'OR task.notificate_deadline = 1')
+
+        def to_time(self, time):
+            self._append('task.left_border < ?', time)
+
+        def not_completed(self):
+            self._one_of('status', [Status.ACTIVE, Status.PENDING, Status.OVERDUE])
+
+        def overdue_by_time(self, time):
+            self._interval_candidates.append(('task.tid IN (SELECT tid FROM task_interval '
+                                              'WHERE left_border < ? AND due_border_min < ?)', (time, time)))
+            self._append('task.left_border < ?', time)
+            self._append('(task.supposed_start_time IS NULL OR task.supposed_start_time < ?) '
+                         'AND (task.supposed_end_time < ? OR task.deadline_time < ?)',
+                         time, time, time)
+
+        def filter_range(self, start_time, end_time):
+            self._interval_candidates.append(('task.tid IN (SELECT tid FROM task_interval '
+                                              'WHERE left_border <= ? AND right_border >= ?)',
+                                              (end_time, start_time)))
+            self._append('(task.supposed_end_time IS NULL AND task.deadline_time IS NULL '
+                            'AND task.supposed_start_time <= ?) '
+                         'OR ((task.supposed_start_time IS NULL OR task.supposed_start_time <= ?) '
+                            'AND (task.supposed_end_time >= ? OR task.deadline_time >= ?))',
+                         end_time, end_time, start_time, start_time)
+
+        def timeless(self):
+            self._append('task.supposed_end_time IS NULL AND task.supposed_start_time IS NULL '
+                         'AND task.deadline_time IS NULL')
+
+        def text_search(self, query, fields=None):
+            '''Full-text search by title and description
+
+            Query consists of words, 'prefix*' and '"exact phrase"' terms,
+            all of them should be found. fields restricts search
+            to Task.Field.title or Task.Field.description.
+            Found tasks are ordered by relevance
+            '''
+            terms = []
+            for phrase, prefix, word in re.findall(r'"([^"]*)"(\*?)|(\S+)', query):
+                if phrase == '':
+                    phrase = word.replace('"', '')
+                    prefix = '*' if phrase.endswith('*') else ''
+                    phrase = phrase.rstrip('*')
+                if phrase.strip() != '':
+                    terms.append('"{}"{}'.format(phrase, prefix))
+            if len(terms) == 0:
+                # query without words matches nothing
+                self._filter.append(('0', ()))
+                return
+
+            expression = '({})'.format(' '.join(terms))
+            if fields is not None:
+                expression = '{{{}}} : {}'.format(' '.join(fields), expression)
+            self._text_search.append(expression)
+
+        def to_text_search_query(self):
+            if len(self._text_search) == 0:
+                return None
+            return ' AND '.join(self._text_search)
+
+        def to_sql_conditions(self, with_interval_index=True):
+            '''Returns list of pairs of sql condition and its parameters'''
+            if with_interval_index:
+                return self._interval_candidates + self._filter
+            return self._filter
+
+class PlanStorageAdapter(StorageAdapter):
+
+    _log_tag = 'PlanStorageAdapter'
+
+    _INSERT_PLAN = 'INSERT INTO plan ("end", shift) VALUES (?, ?)'
+
+    _INSERT_RELATION = 'INSERT INTO plan_relations (plan_id, tid_id, number, kind) VALUES (?, ?, ?, ?)'
+
+    _DELETE_EXCLUDES = 'DELETE FROM plan_relations WHERE plan_id = ? AND kind != ?'
+
+    # numbers of the first repeat which ends after start_time and of the last one
+    # which starts before end_time and end of plan, excluded repeats between them
+    # are subtracted. Plans of all owners are counted if uid and pids are null
+    _COUNT_REPEATS = ('WITH time_range(start_time, end_time) AS (VALUES (?, ?)),'
+                      ' bounds(plan_id, first_number, last_number) AS (SELECT plan.plan_id,'
+                      ' CASE WHEN task.right_border >= start_time THEN 0 ELSE {} END, {}'
+                      ' FROM plan JOIN plan_relations ON plan_relations.plan_id = plan.plan_id'
+                      ' JOIN task ON task.tid = plan_relations.tid_id, time_range'
+                      ' WHERE plan_relations.kind = {} AND plan.shift > 0 AND ((? IS NULL AND ? IS NULL)'
+                      ' OR task.uid_id = ? OR task.pid_id ' + _IN_LIST + '))'
+                      ' SELECT plan_id, last_number - first_number + 1 - (SELECT COUNT(*) FROM plan_relations'
+                      ' WHERE plan_relations.plan_id = bounds.plan_id AND kind != {}'
+                      ' AND number BETWEEN first_number AND last_number)'
+                      ' FROM bounds WHERE last_number >= first_number').format(
+        _floor_div('start_time - task.right_border + plan.shift - 1', 'plan.shift'),
+        _floor_div('MIN(end_time, COALESCE(plan."end", end_time)) - task.left_border', 'plan.shift'),
+        _PlanRelationKind.COMMON, _PlanRelationKind.COMMON)
+
+    @staticmethod
+    def _plan_from_row(row):
+        plan = Plan()
+        plan.plan_id, plan.end, plan.shift = row
+        return plan
+
+    def get_plans(self, plan_id=None, common_tid=None, edit_repeat_tid=None):
+        if plan_id is not None:
+            plan = self._get_plan_by_id(plan_id)
+            if plan is None:
+                return []
+            return [plan]
+
+        if common_tid is not None:
+            return self._get_plans_by_relation(common_tid, _PlanRelationKind.COMMON)
+
+        if edit_repeat_tid is not None:
+            return self._get_plans_by_relation(edit_repeat_tid, _PlanRelationKind.EDITED)
+
+        return [self._plan_from_row(row) for row in self.db.execute(
+                'SELECT plan_id, "end", shift FROM plan')]
+
+    def _get_plans_by_relation(self, tid, kind):
+        plans = []
+        for row in self.db.execute('SELECT plan_id FROM plan_relations WHERE tid_id = ? AND kind = ?',
+                                   (tid, kind)).fetchall():
+            plan = self._get_plan_by_id(row[0])
+            if plan is not None:
+                plans.append(plan)
+        return plans
+
+    def _get_plan_by_id(self, plan_id):
+        row = self.db.execute('SELECT plan_id, "end", shift FROM plan WHERE plan_id = ?',
+                              (plan_id, )).fetchone()
+        if row is None:
+            return None
+        plan = self._plan_from_row(row)
+        plan.exclude = []
+        for tid, number, kind in self.db.execute('SELECT tid_id, number, kind FROM plan_relations '
+                                                 'WHERE plan_id = ? ORDER BY relation_id', (plan_id, )):
+            if kind == _PlanRelationKind.COMMON:
+                plan.tid = tid
+            else:
+                plan.exclude.append(number)
+        return plan
+
+    def _get_relations(self, plan_id, number):
+        return self.db.execute('SELECT tid_id, kind FROM plan_relations WHERE plan_id = ? AND number = ?',
+                               (plan_id, number)).fetchall()
+
+    def get_exclude_type(self, plan_id, number):
+        relations = self._get_relations(plan_id, number)
+        if len(relations) != 1:
+            return None
+
+        kind = relations[0][1]
+        if kind == _PlanRelationKind.DELETED:
+            return Plan.PlanExcludeKind.DELETED
+        if kind == _PlanRelationKind.EDITED:
+            return Plan.PlanExcludeKind.EDITED
+        return None
+
+    def get_number_for_edit_repeat_by_tid(self, plan_id, edit_tid):
+        row = self.db.execute('SELECT number FROM plan_relations WHERE plan_id = ? AND tid_id = ? AND kind = ?',
+                              (plan_id, edit_tid, _PlanRelationKind.EDITED)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_tid_for_edit_repeat(self, plan_id, number):
+        relations = self._get_relations(plan_id, number)
+        if len(relations) != 1:
+            return None
+        tid, kind = relations[0]
+        if kind != _PlanRelationKind.EDITED:
+            return None
+        return tid
+
+    def recalculate_exclude_when_start_time_shifted(self, plan_id, start_time_shift):
+        row = self.db.execute('SELECT shift FROM plan WHERE plan_id = ?', (plan_id, )).fetchone()
+        if row is None:
+            return False
+        shift = row[0]
+        if start_time_shift % shift != 0:
+            return self.restore_all_repeats(plan_id)
+
+        logging.get_logger(self._log_tag).info(('For {} excludes were recalculated '
+            'due start time shift changed').format(plan_id))
+        number_shift = start_time_shift // shift
+        with self.transaction():
+            self.db.execute(self._DELETE_EXCLUDES + ' AND number < ?',
+                            (plan_id, _PlanRelationKind.COMMON, number_shift))
+            self.db.execute('UPDATE plan_relations SET number = number - ? WHERE plan_id = ? AND kind != ?',
+                            (number_shift, plan_id, _PlanRelationKind.COMMON))
+        return True
+
+    def save_plans(self, plans):
+        '''Saves plans with their common relations and excludes
+
+        All rows are written with executemany inside one transaction.
+        Returns list of generated plan ids in order of passed plans
+        '''
+        plans = list(plans)
+        with self.transaction():
+            plan_ids = self.db.insert_many(self._INSERT_PLAN, ((plan.end, plan.shift) for plan in plans))
+
+            relation_rows = []
+            for plan_id, plan in zip(plan_ids, plans):
+                relation_rows.append((plan_id, plan.tid, None, _PlanRelationKind.COMMON))
+                if plan.exclude is not None:
+                    relation_rows.extend((plan_id, None, number, _PlanRelationKind.DELETED)
+                                         for number in plan.exclude)
+            self.db.insert_many(self._INSERT_RELATION, relation_rows)
+
+        logging.get_logger(self._log_tag).info('{} plans were saved'.format(len(plan_ids)))
+        return plan_ids
+
+    def add_plan_excludes(self, plan_id, numbers):
+        '''Deletes repeats of plan by numbers with executemany
+
+        Returns list of generated relation ids in order of passed numbers
+        '''
+        numbers = list(numbers)
+        relation_ids = self.db.insert_many(self._INSERT_RELATION,
+            ((plan_id, None, number, _PlanRelationKind.DELETED) for number in numbers))
+        logging.get_logger(self._log_tag).info('Repeats {} were deleted in plan {}'.format(numbers, plan_id))
+        return relation_ids
+
+    def save_plan(self, plan):
+        '''Saves plan and returns its generated plan_id or None if plan was not saved
+        '''
+        return self.save_plans([plan])[0]
+
+    def _add_relation(self, plan_id, tid, number, kind):
+        return self.db.execute(self._INSERT_RELATION, (plan_id, tid, number, kind)).rowcount == 1
+
+    def delete_plan_repeat(self, plan_id, number):
+        success = self._add_relation(plan_id, None, number, _PlanRelationKind.DELETED)
+        if success:
+            logging.get_logger(self._log_tag).info('Repeat {} was deleted in plan {}'.format(number, plan_id))
+        return success
+
+    def edit_plan_repeat(self, plan_id, number, tid):
+        type = self.get_exclude_type(plan_id, number)
+        if type != None:
+            self.restore_plan_repeat(plan_id, number)
+        success = self._add_relation(plan_id, tid, number, _PlanRelationKind.EDITED)
+        if success:
+            logging.get_logger(self._log_tag).info('Repeat {} in plan {} was edited: {}'\
+                .format(number, plan_id, tid))
+        return success
+
+    def chagne_edit_plan_repeat_to_delete(self, plan_id, number):
+        success = self.restore_plan_repeat(plan_id, number)
+        if not success:
+            return False
+        return self.delete_plan_repeat(plan_id, number)
+
+    def restore_plan_repeat(self, plan_id, number):
+        self.db.execute('DELETE FROM plan_relations WHERE plan_id = ? AND number = ?', (plan_id, number))
+        logging.get_logger(self._log_tag).info('Repeat {} in plan {} was restored'.format(number, plan_id))
+        return True
+
+    def restore_all_repeats(self, plan_id):
+        rows_deleted = self.db.execute(self._DELETE_EXCLUDES, (plan_id, _PlanRelationKind.COMMON)).rowcount
+        success = rows_deleted != 0
+        if success:
+            logging.get_logger(self._log_tag).info('All repeats in plan {} were restore'.format(plan_id))
+        return success
+
+    def remove_plan(self, plan_id):
+        with self.transaction():
+            rows_deleted = self.db.execute('DELETE FROM plan WHERE plan_id = ?', (plan_id, )).rowcount
+            self.db.execute('DELETE FROM task WHERE tid IN (SELECT tid_id FROM plan_relations '
+                            'WHERE plan_id = ? AND tid_id IS NOT NULL)', (plan_id, ))
+            self.db.execute('DELETE FROM plan_relations WHERE plan_id = ?', (plan_id, ))
+        success = rows_deleted == 1
+        if success:
+            logging.get_logger(self._log_tag).info('Plan {} was deleted'.format(plan_id))
+        return success
+
+    def count_repeats(self, start_time, end_time, uid=None, pids=None):
+        '''Returns counts of repeats of plans in time range by one query
+
+        Plans are selected by common tasks of user with uid or of projects
+        with pids, all plans are counted if both are None. Repeats are
+        counted like in PlanController.get_repeats_by_time_range, see
+        sqlite_peewee_adapters. Result is dict from plan_id to count,
+        plans without repeats in range are skipped
+        '''
+        pids = _json_list(pids) if pids is not None else None
+        rows = self.db.execute(self._COUNT_REPEATS, (start_time, end_time, uid, pids, uid, pids))
+        return {plan_id: count for plan_id, count in rows if count > 0}
+
+    def archive_plans(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Moves plans which ended before before_time to archive
+
+        Plans are moved with their relations, common tasks and edited
+        repeats with all subtasks. Every batch of plans is moved in its
+        own transaction. Returns dict with counts of moved rows by table names
+        '''
+        task_storage = TaskStorageAdapter(self.db_file, self.db)
+        counts = {Change.Entity.task: 0, Change.Entity.plan: 0, Change.Entity.plan_relations: 0}
+        last_plan_id = 0
+        while True:
+            with self.transaction():
+                plan_ids = [row[0] for row in self.db.execute(
+                    'SELECT plan_id FROM plan WHERE "end" < ? AND plan_id > ? ORDER BY plan_id LIMIT ?',
+                    (before_time, last_plan_id, batch_size))]
+                if len(plan_ids) == 0:
+                    break
+                last_plan_id = plan_ids[-1]
+                plan_ids = _json_list(plan_ids)
+
+                plan_tids = [row[0] for row in self.db.execute(
+                    'SELECT tid_id FROM plan_relations WHERE tid_id IS NOT NULL AND plan_id ' + _IN_LIST,
+                    (plan_ids, ))]
+                counts[Change.Entity.task] += task_storage._move_to_archive(
+                    task_storage._select_subtree_tids(plan_tids))
+
+                self.db.execute('INSERT INTO plan_relations_archive (relation_id, plan_id, tid_id, number, kind)'
+                                ' SELECT relation_id, plan_id, tid_id, number, kind FROM plan_relations'
+                                ' WHERE plan_id ' + _IN_LIST, (plan_ids, ))
+                counts[Change.Entity.plan_relations] += self.db.execute(
+                    'DELETE FROM plan_relations WHERE plan_id ' + _IN_LIST, (plan_ids, )).rowcount
+                self.db.execute('INSERT INTO plan_archive (plan_id, "end", shift)'
+                                ' SELECT plan_id, "end", shift FROM plan WHERE plan_id ' + _IN_LIST, (plan_ids, ))
+                counts[Change.Entity.plan] += self.db.execute(
+                    'DELETE FROM plan WHERE plan_id ' + _IN_LIST, (plan_ids, )).rowcount
+
+        logging.get_logger(self._log_tag).info('Plans which ended before {} were archived, moved rows: {}'\
+            .format(before_time, counts))
+        return counts
+
+    def edit_plan(self, plan_field_dict):
+        plan_id = plan_field_dict[Plan.Field.plan_id]
+        row = self.db.execute('SELECT shift FROM plan WHERE plan_id = ?', (plan_id, )).fetchone()
+        if row is None:
+            return True
+
+        if Plan.Field.end in plan_field_dict:
+            end = plan_field_dict[Plan.Field.end]
+            if self.db.execute('UPDATE plan SET "end" = ? WHERE plan_id = ?', (end, plan_id)).rowcount != 1:
+                return False
+            logging.get_logger(self._log_tag).info('End of plan {} was changed to {}'.format(plan_id, end))
+
+        if Plan.Field.shift in plan_field_dict:
+            shift = plan_field_dict[Plan.Field.shift]
+            old_shift = row[0]
+            # repeat stays only if it starts at the same time with new shift
+            with self.transaction():
+                if self.db.execute('UPDATE plan SET shift = ? WHERE plan_id = ?', (shift, plan_id)).rowcount != 1:
+                    return False
+                rows_deleted = self.db.execute(self._DELETE_EXCLUDES + ' AND (number * ?) % ? != 0',
+                                               (plan_id, _PlanRelationKind.COMMON, old_shift, shift)).rowcount
+                rows_shifted = self.db.execute(('UPDATE plan_relations SET number = (number * ?) / ? '
+                                                'WHERE plan_id = ? AND kind != ?'),
+                                               (old_shift, shift, plan_id, _PlanRelationKind.COMMON)).rowcount
+            logging.get_logger(self._log_tag).info('Shift of plan {} was changed to {}'.format(plan_id, shift))
+            logging.get_logger(self._log_tag).info('{} repeats were shifted, {} repeats were removed'
+                .format(rows_shifted, rows_deleted))
+
+        return True
+
+class UserStorageAdapter(StorageAdapter):
+
+    _log_tag = 'UserStorageAdapter'
+
+    _SELECT = 'SELECT uid, login, password, online FROM "user"'
+
+    @staticmethod
+    def _user_from_row(row):
+        user = User()
+        user.uid, user.login, user.password, online = row
+        user.online = _to_bool(online)
+        return user
+
+    def check_user_existence(self, login):
+        row = self.db.execute('SELECT 1 FROM "user" WHERE login = ? LIMIT 1', (login, )).fetchone()
+        return row is not None
+
+    def get_users(self, filter=None):
+        sql = self._SELECT
+        params = []
+        if filter is not None and len(filter.to_sql_conditions()) != 0:
+            conditions = filter.to_sql_conditions()
+            sql += ' WHERE ' + ' AND '.join(condition for condition, _ in conditions)
+            params = [param for _, condition_params in conditions for param in condition_params]
+        return [self._user_from_row(row) for row in self.db.execute(sql, params)]
+
+    def save_user(self, user):
+        '''Saves user and returns its generated uid or None if user was not saved
+        '''
+        cursor = self.db.execute('INSERT INTO "user" (login, password, online) VALUES (?, ?, ?)',
+                                 (user.login, user.password, user.online))
+        if cursor.rowcount != 1:
+            return None
+        logging.get_logger(self._log_tag).info('User {} was saved'.format(cursor.lastrowid))
+        return cursor.lastrowid
+
+    def get_last_saved_user(self):
+        row = self.db.execute(self._SELECT + ' ORDER BY uid DESC LIMIT 1').fetchone()
+        if row is not None:
+            return self._user_from_row(row)
+
+    def delete_user(self, uid):
+        return self.remove_user(uid)[Change.Entity.user] == 1
+
+    def remove_user(self, uid):
+        '''Removes user with all its tasks and its relations to projects
+
+        Rows are removed with a few statements in one transaction.
+        Returns dict with counts of removed rows by table names
+        '''
+        with self.transaction():
+            counts = self._task_storage().remove_tasks(uid=uid)
+            counts[Change.Entity.project_relations] = self.db.execute(
+                'DELETE FROM project_relations WHERE uid_id = ?', (uid, )).rowcount
+            counts[Change.Entity.user] = self.db.execute('DELETE FROM "user" WHERE uid = ?', (uid, )).rowcount
+        if counts[Change.Entity.user] == 1:
+            logging.get_logger(self._log_tag).info('User {} was deleted, removed rows: {}'.format(uid, counts))
+        return counts
+
+    def edit_user(self, user_field_dict):
+        uid = user_field_dict[User.Field.uid]
+        fields = [field for field in (User.Field.login, User.Field.password, User.Field.online)
+                    if field in user_field_dict]
+        if len(fields) == 0:
+            return self.db.execute('SELECT 1 FROM "user" WHERE uid = ?', (uid, )).fetchone() is not None
+
+        sql = 'UPDATE "user" SET {} WHERE uid = ?'.format(', '.join('{} = ?'.format(field) for field in fields))
+        rows_modified = self.db.execute(sql, [user_field_dict[field] for field in fields] + [uid]).rowcount
+        success = rows_modified == 1
+        if success:
+            logging.get_logger(self._log_tag).info('User {} was edited'.format(uid))
+        return success
+
+    class Filter():
+
+        def __init__(self):
+            self._filter = []
+
+        def uid(self, uid):
+            self._filter.append(('uid = ?', (uid, )))
+
+        def login(self, login):
+            self._filter.append(('login = ?', (login, )))
+
+        def online(self, online):
+            self._filter.append(('online = ?', (online, )))
+
+        def to_sql_conditions(self):
+            '''Returns list of pairs of sql condition and its parameters'''
+            return self._filter
+
+class ProjectStorageAdapter(StorageAdapter):
+
+    _log_tag = 'ProjectStorageAdapter'
+
+    _SELECT = ('SELECT project.pid, project.creator_id, project.name, '
+               'GROUP_CONCAT(CASE WHEN relation.kind = {0} THEN relation.uid_id END), '
+               'GROUP_CONCAT(CASE WHEN relation.kind = {1} THEN relation.uid_id END) '
+               'FROM project LEFT OUTER JOIN project_relations AS relation '
+               'ON relation.pid_id = project.pid').format(_ProjectRelationKind.ADMIN,
+                                                          _ProjectRelationKind.GUEST)
+
+    def save_project(self, project):
+        '''Saves project and returns its generated pid or None if project was not saved
+        '''
+        cursor = self.db.execute('INSERT INTO project (creator_id, name) VALUES (?, ?)',
+                                 (project.creator, project.name))
+        if cursor.rowcount != 1:
+            return None
+        return cursor.lastrowid
+
+    def get_projects(self, uid, name=None, pid=None):
+        '''Returns projects which user created or participates in as admin or guest
+
+        Own projects go first, then admin and guest ones.
+        Projects are loaded with one query
+        '''
+        conditions = ['project.creator_id = ? OR project.pid IN '
+                      '(SELECT pid_id FROM project_relations WHERE uid_id = ?)']
+        params = [uid, uid]
+        if name is not None:
+            conditions.append('project.name = ?')
+            params.append(name)
+        if pid is not None:
+            conditions.append('project.pid = ?')
+            params.append(pid)
+
+        order = 'CASE WHEN project.creator_id = ? THEN -1 ELSE MIN(CASE WHEN relation.uid_id = ? THEN relation.kind END) END'
+        return self._select_projects(conditions, params, order, [uid, uid])
+
+    def get_all_admin_third_party_projects(self, uid):
+        return self._get_third_party_projects(uid, _ProjectRelationKind.ADMIN)
+
+    def get_all_guest_third_party_projects(self, uid):
+        return self._get_third_party_projects(uid, _ProjectRelationKind.GUEST)
+
+    def _get_third_party_projects(self, uid, kind):
+        return self._select_projects(['project.pid IN (SELECT pid_id FROM project_relations '
+                                      'WHERE uid_id = ? AND kind = ?)'], [uid, kind])
+
+    def _get_project_by_id(self, pid):
+        projects = self._select_projects(['project.pid = ?'], [pid])
+        if len(projects) == 0:
+            return None
+        return projects[0]
+
+    def _select_projects(self, conditions, params, order=None, order_params=()):
+        '''Selects projects with their admins and guests by one grouped join
+        '''
+        sql = '{} WHERE {} GROUP BY project.pid ORDER BY {}project.pid'.format(self._SELECT,
+                ' AND '.join('({})'.format(condition) for condition in conditions),
+                '' if order is None else order + ', ')
+
+        projects = []
+        for pid, creator, name, admin_uids, guest_uids in self.db.execute(sql, list(params) + list(order_params)):
+            project = Project()
+            project.pid = pid
+            project.creator = creator
+            project.name = name
+            if admin_uids is not None:
+                project.admins = [int(uid) for uid in admin_uids.split(',')]
+            if guest_uids is not None:
+                project.guests = [int(uid) for uid in guest_uids.split(',')]
+            projects.append(project)
+        return projects
+
+    def remove_project(self, pid):
+        with self.transaction():
+            self.db.execute('DELETE FROM project_relations WHERE pid_id = ?', (pid, ))
+            rows_deleted = self.db.execute('DELETE FROM project WHERE pid = ?', (pid, )).rowcount
+        success = rows_deleted != 0
+        if success:
+            logging.get_logger(self._log_tag).info('Project {} was removed'.format(pid))
+        return success
+
+    def remove_projects(self, pids):
+        '''Removes projects with all their tasks and relations to users
+
+        Rows are removed with a few statements in one transaction.
+        Returns dict with counts of removed rows by table names
+        '''
+        pids = list(pids)
+        with self.transaction():
+            counts = self._task_storage().remove_tasks(pids=pids)
+            counts[Change.Entity.project_relations] = self.db.execute(
+                'DELETE FROM project_relations WHERE pid_id ' + _IN_LIST, (_json_list(pids), )).rowcount
+            counts[Change.Entity.project] = self.db.execute(
+                'DELETE FROM project WHERE pid ' + _IN_LIST, (_json_list(pids), )).rowcount
+        logging.get_logger(self._log_tag).info('Projects {} were removed, removed rows: {}'.format(pids, counts))
+        return counts
+
+    def edit_project(self, project_fields_dict):
+        pid = project_fields_dict[Project.Field.pid]
+        if Project.Field.name not in project_fields_dict:
+            return self.db.execute('SELECT 1 FROM project WHERE pid = ?', (pid, )).fetchone() is not None
+
+        rows_modified = self.db.execute('UPDATE project SET name = ? WHERE pid = ?',
+                                        (project_fields_dict[Project.Field.name], pid)).rowcount
+        success = rows_modified == 1
+        if success:
+            logging.get_logger(self._log_tag).info('Project {} was edited'.format(pid))
+        return success
+
+    def get_user_kind(self, pid, uid):
+        projects = self.get_projects(uid, pid=pid)
+        if len(projects) == 0:
+            return None
+        return projects[0].get_user_kind(uid)
+
+    def _add_user(self, pid, uid, kind):
+        return self.db.execute('INSERT INTO project_relations (pid_id, uid_id, kind) VALUES (?, ?, ?)',
+                               (pid, uid, kind)).rowcount == 1
+
+    def _remove_user(self, pid, uid, kind):
+        # condition built by sqlite_peewee_adapters, operator precedence makes it (uid AND kind) = kind
+        return self.db.execute('DELETE FROM project_relations WHERE (? AND kind) = ?',
+                               (uid, kind)).rowcount == 1
+
+    def add_admin_to_project(self, pid, uid):
+        success = self._add_user(pid, uid, _ProjectRelationKind.ADMIN)
+        if success:
+            logging.get_logger(self._log_tag).info('Admin {} was invited in project {}'.format(uid, pid))
+        return success
+
+    def remove_admin_from_project(self, pid, uid):
+        '''Removes admin from project, tasks of admin are passed to project creator'''
+        with self.transaction():
+            if self.db.execute('SELECT 1 FROM task WHERE pid_id = ? AND uid_id = ? LIMIT 1',
+                               (pid, uid)).fetchone() is not None:
+                creator = self.get_projects(uid=uid, pid=pid)[0].creator
+                self.db.execute('UPDATE task SET uid_id = ? WHERE pid_id = ? AND uid_id = ?', (creator, pid, uid))
+            success = self._remove_user(pid, uid, _ProjectRelationKind.ADMIN)
+        if success:
+            logging.get_logger(self._log_tag).info('Admin {} was removed from project {}'.format(uid, pid))
+        return success
+
+    def add_guest_to_project(self, pid, uid):
+        success = self._add_user(pid, uid, _ProjectRelationKind.GUEST)
+        if success:
+            logging.get_logger(self._log_tag).info('Guest {} was invited in project {}'.format(uid, pid))
+        return success
+
+    def remove_guest_from_project(self, pid, uid):
+        success = self._remove_user(pid, uid, _ProjectRelationKind.GUEST)
+        if success:
+            logging.get_logger(self._log_tag).info('Guest {} was removed from project {}'.format(uid, pid))
+        return success
@@ -1,12 +1,24 @@
+import heapq
+import operator
 import os
-from itertools import filterfalse
+import re
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+from functools import reduce
+from itertools import filterfalse, islice
 
 from peewee import *
+from peewee import Expression
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField, VirtualModel, AutoIncrementField
+from playhouse.migrate import SqliteMigrator, migrate
 
 from tasktracker_core.model.task import Task, Status
 from tasktracker_core.model.user import User
 from tasktracker_core.model.plan import Plan
 from tasktracker_core.model.project import Project
+from tasktracker_core.model.change import Change
 from tasktracker_core import logging
 from tasktracker_core import utils
 
@@ -22,7 +34,48 @@ class TidNotExistsError(Exception):
         message = 'Tid {} not exists'.format(tid)
         super().__init__(message)
 
-_db_proxy = Proxy()
+class ParentNotAllowedError(ValueError):
+    '''Storage can not keep task under parent, for example sharded_adapters
+    when parent is stored in another shard
+    '''
+
+    def __init__(self, parent_tid, explanation):
+        super().__init__(explanation)
+        self.parent_tid = parent_tid
+
+class _ThreadDatabaseProxy(Proxy):
+    '''Proxy to database engine which is bound separately in every thread
+
+    Threads serving different databases do not swap engine of each other.
+    Thread which has not bound an engine uses the one bound last
+    '''
+
+    __slots__ = ('_local', '_default')
+
+    def __init__(self):
+        object.__setattr__(self, '_local', threading.local())
+        object.__setattr__(self, '_default', None)
+        super().__init__()
+
+    @property
+    def obj(self):
+        obj = getattr(self._local, 'obj', None)
+        if obj is None:
+            return self._default
+        return obj
+
+    @obj.setter
+    def obj(self, obj):
+        self._local.obj = obj
+        if obj is not None:
+            object.__setattr__(self, '_default', obj)
+
+    def __setattr__(self, attr, value):
+        if attr not in ('obj', '_callbacks'):
+            raise AttributeError('Cannot set attribute on proxy.')
+        object.__setattr__(self, attr, value)
+
+_db_proxy = _ThreadDatabaseProxy()
 
 class BaseTableModel(Model):
 
@@ -64,9 +117,8 @@ class ProjectTableModel(BaseTableModel):
     def to_project(self):
         project = Project()
         project.pid = self.pid
-        user_table_model = self.creator
-        if user_table_model is not None:
-            project.creator = user_table_model.uid
+        # raw column value, reading self.creator would query user table
+        project.creator = self.creator_id
         project.name = self.name
         return project
 
@@ -85,6 +137,10 @@ class ProjectRelationsTableModel(BaseTableModel):
 
     class Meta:
         table_name = 'project_relations'
+        indexes = (
+            (('uid', 'kind'), False),
+            (('pid', 'kind'), False),
+        )
 
 _DEFAULT_DB_FILE_PATH = utils.get_file_in_home_folder('tasktracker.db')
 
@@ -104,6 +160,9 @@ class TaskTableModel(BaseTableModel):
     notificate_supposed_end = BooleanField()
     notificate_deadline = BooleanField()
     is_plan = IntegerField(null=True)
+    # the earliest and the latest of task times, set by triggers
+    left_border = IntegerField(null=True)
+    right_border = IntegerField(null=True)
 
     def map_task_attr(self, task_field, value):
         if task_field == Task.Field.tid:
@@ -135,16 +194,30 @@ class TaskTableModel(BaseTableModel):
         if task_field == Task.Field.notificate_deadline:
             self.notificate_deadline = value
 
+    @staticmethod
+    def task_to_data(task):
+        return {'uid': task.uid,
+                'pid': task.pid,
+                'parent_tid': task.parent_tid,
+                'title': task.title,
+                'description': task.description,
+                'supposed_start_time': task.supposed_start_time,
+                'supposed_end_time': task.supposed_end_time,
+                'deadline_time': task.deadline_time,
+                'priority': task.priority,
+                'status': task.status,
+                'notificate_supposed_start': task.notificate_supposed_start,
+                'notificate_supposed_end': task.notificate_supposed_end,
+                'notificate_deadline': task.notificate_deadline}
+
     def to_task(self):
         task = Task()
         task.tid = self.tid
-        project_table_model = self.pid
-        if project_table_model is not None:
-            task.pid = project_table_model.pid
+        # raw column values, reading self.pid or self.uid would query
+        # project and user tables for every row
+        task.pid = self.pid_id
         task.parent_tid = self.parent_tid
-        user_table_model = self.uid
-        if user_table_model is not None:
-            task.uid = user_table_model.uid
+        task.uid = self.uid_id
         task.title = self.title
         task.description = self.description
         task.supposed_start_time = self.supposed_start_time
@@ -159,6 +232,12 @@ class TaskTableModel(BaseTableModel):
 
     class Meta:
         table_name = 'task'
+        indexes = (
+            (('uid', 'status'), False),
+            (('pid', 'status'), False),
+            (('parent_tid', ), False),
+            (('pid', 'left_border'), False),
+        )
 
 class PlanTableModel(BaseTableModel):
     plan_id = AutoField(primary_key=True)
@@ -197,6 +276,704 @@ class PlanRelationsTableModel(BaseTableModel):
 
     class Meta:
         table_name = 'plan_relations'
+        indexes = (
+            (('plan_id', 'kind'), False),
+            (('tid', 'kind'), False),
+            (('plan_id', 'number'), False),
+        )
+
+class TaskArchiveTableModel(BaseTableModel):
+    '''Completed tasks moved out of task table by TaskStorageAdapter.archive_tasks
+
+    Columns are the same as columns of task table, archived tasks keep
+    their tids. Archive is not indexed for text search and time ranges
+    '''
+    tid = IntegerField(primary_key=True)
+    pid = IntegerField(column_name='pid_id')
+    uid = IntegerField(column_name='uid_id', null=True)
+    title = TextField(null=True)
+    description = TextField(null=True)
+    supposed_start_time = IntegerField(null=True)
+    supposed_end_time = IntegerField(null=True)
+    deadline_time = IntegerField(null=True)
+    parent_tid = IntegerField(null=True)
+    priority = IntegerField(null=True)
+    status = IntegerField(null=True)
+    notificate_supposed_start = BooleanField()
+    notificate_supposed_end = BooleanField()
+    notificate_deadline = BooleanField()
+    is_plan = IntegerField(null=True)
+    left_border = IntegerField(null=True)
+    right_border = IntegerField(null=True)
+
+    def to_task(self):
+        return TaskTableModel(**self.__data__).to_task()
+
+    class Meta:
+        table_name = 'task_archive'
+        indexes = (
+            (('uid', 'status'), False),
+            (('pid', 'status'), False),
+            (('parent_tid', ), False),
+        )
+
+class PlanArchiveTableModel(BaseTableModel):
+    '''Expired plans moved out of plan table by PlanStorageAdapter.archive_plans
+
+    Ids of plans are not unique here, plan table can give ids
+    of archived plans to new plans
+    '''
+    plan_id = IntegerField(index=True)
+    end = IntegerField(null=True)
+    shift = IntegerField(null=False)
+
+    class Meta:
+        table_name = 'plan_archive'
+        primary_key = False
+
+class PlanRelationsArchiveTableModel(BaseTableModel):
+    '''Relations of archived plans'''
+    relation_id = IntegerField()
+    plan_id = IntegerField(index=True)
+    tid = IntegerField(column_name='tid_id', null=True)
+    number = IntegerField(null=True)
+    kind = IntegerField(null=True)
+
+    class Meta:
+        table_name = 'plan_relations_archive'
+        primary_key = False
+
+class ShardGuestTableModel(BaseTableModel):
+    '''Shards where user has subtasks of tasks of other users
+
+    Used only in catalogue database of sharded_adapters
+    '''
+    uid = IntegerField()
+    shard = IntegerField()
+
+    class Meta:
+        table_name = 'shard_guest'
+        primary_key = CompositeKey('uid', 'shard')
+
+class ShardChangeCursorTableModel(BaseTableModel):
+    '''Revision of change log of shard which is copied to change log
+    of catalogue
+
+    Used only in catalogue database of sharded_adapters
+    '''
+    shard = IntegerField(primary_key=True)
+    revision = IntegerField()
+
+    class Meta:
+        table_name = 'shard_change_cursor'
+
+class SchemaVersionTableModel(BaseTableModel):
+    '''Keeps numbers of applied schema migrations'''
+    version = IntegerField(primary_key=True)
+
+    class Meta:
+        table_name = 'schema_version'
+
+class ChangeLogTableModel(BaseTableModel):
+    '''Changes of rows of other tables, written by triggers
+
+    Revision is autoincremented, so it is never reused. fields keeps
+    names of changed fields separated by commas
+    '''
+    revision = AutoIncrementField()
+    entity = TextField()
+    entity_id = IntegerField()
+    kind = IntegerField()
+    uid = IntegerField(null=True)
+    pid = IntegerField(null=True)
+    fields = TextField(null=True)
+
+    def to_change(self):
+        change = Change()
+        change.revision = self.revision
+        change.entity = self.entity
+        change.entity_id = self.entity_id
+        change.kind = self.kind
+        change.uid = self.uid
+        change.pid = self.pid
+        change.fields = self.fields.split(',') if self.fields else []
+        return change
+
+    class Meta:
+        table_name = 'change_log'
+
+class TaskSearchTableModel(FTS5Model):
+    '''Full-text index of title and description of tasks
+
+    External content table over task, kept in sync by triggers
+    '''
+    rowid = RowIDField()
+    title = SearchField()
+    description = SearchField()
+
+    class Meta:
+        database = _db_proxy
+        table_name = 'task_search'
+        options = {'content': TaskTableModel._meta.table_name, 'content_rowid': 'tid'}
+
+_TASK_SEARCH_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS task_search_insert AFTER INSERT ON task BEGIN
+        INSERT INTO task_search(rowid, title, description) VALUES (new.tid, new.title, new.description);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS task_search_delete AFTER DELETE ON task BEGIN
+        INSERT INTO task_search(task_search, rowid, title, description)
+            VALUES ('delete', old.tid, old.title, old.description);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS task_search_update AFTER UPDATE OF title, description ON task BEGIN
+        INSERT INTO task_search(task_search, rowid, title, description)
+            VALUES ('delete', old.tid, old.title, old.description);
+        INSERT INTO task_search(rowid, title, description) VALUES (new.tid, new.title, new.description);
+    END''',
+]
+
+class TaskIntervalTableModel(VirtualModel):
+    '''R*Tree index of time intervals of tasks
+
+    First dimension is [left_border, right_border] of task, second one is
+    the point of its first due time (supposed end or deadline). Missing
+    borders are open and stored as _TIME_MIN and _TIME_MAX. Timeless
+    tasks are not indexed. R*Tree keeps borders as 32-bit floats rounded
+    outward, so lookups return a superset of tasks to check exactly
+    '''
+    tid = IntegerField(primary_key=True)
+    left_border = FloatField()
+    right_border = FloatField()
+    due_border_min = FloatField()
+    due_border_max = FloatField()
+
+    class Meta:
+        database = _db_proxy
+        table_name = 'task_interval'
+        extension_module = 'rtree'
+
+_TIME_MIN = -2**62
+_TIME_MAX = 2**62
+
+def _task_interval_values(row):
+    end_or_deadline = 'COALESCE({0}.supposed_end_time, {0}.deadline_time)'.format(row)
+    deadline_or_end = 'COALESCE({0}.deadline_time, {0}.supposed_end_time)'.format(row)
+    left_border = 'COALESCE({}.supposed_start_time, {})'.format(row, _TIME_MIN)
+    right_border = 'COALESCE(MAX({}, {}), {})'.format(end_or_deadline, deadline_or_end, _TIME_MAX)
+    due_border = 'COALESCE(MIN({}, {}), {})'.format(end_or_deadline, deadline_or_end, _TIME_MAX)
+    return '{}.tid, {}, {}, {}, {}'.format(row, left_border, right_border, due_border, due_border)
+
+def _task_has_time(row):
+    return ('({0}.supposed_start_time IS NOT NULL OR {0}.supposed_end_time IS NOT NULL '
+            'OR {0}.deadline_time IS NOT NULL)').format(row)
+
+_TASK_INTERVAL_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS task_interval_insert AFTER INSERT ON task WHEN {} BEGIN
+        INSERT INTO task_interval VALUES ({});
+    END'''.format(_task_has_time('new'), _task_interval_values('new')),
+    '''CREATE TRIGGER IF NOT EXISTS task_interval_delete AFTER DELETE ON task BEGIN
+        DELETE FROM task_interval WHERE tid = old.tid;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS task_interval_update
+            AFTER UPDATE OF supposed_start_time, supposed_end_time, deadline_time ON task BEGIN
+        DELETE FROM task_interval WHERE tid = old.tid;
+        INSERT INTO task_interval SELECT {} WHERE {};
+    END'''.format(_task_interval_values('new'), _task_has_time('new')),
+]
+
+_COMMON_TID = ('(SELECT tid_id FROM plan_relations WHERE plan_id = {{row}}.plan_id AND kind = {})'
+               .format(PlanRelationsTableModel.Kind.COMMON))
+_PLAN_RELATION_TID = 'COALESCE({{row}}.tid_id, {})'.format(_COMMON_TID)
+
+def _task_column(column, tid):
+    return '(SELECT {} FROM task WHERE tid = {})'.format(column, tid)
+
+# Logged table to its key column, sql of owner uid and pid of row and
+# columns with names of fields they keep. Plans and their relations
+# belong to owner of common task while it exists
+_CHANGE_LOG_TABLES = [
+    ('task', 'tid', '{row}.uid_id', '{row}.pid_id',
+     [('pid_id', Task.Field.pid), ('uid_id', Task.Field.uid), ('title', Task.Field.title),
+      ('description', Task.Field.description), ('supposed_start_time', Task.Field.supposed_start_time),
+      ('supposed_end_time', Task.Field.supposed_end_time), ('deadline_time', Task.Field.deadline_time),
+      ('parent_tid', Task.Field.parent_tid), ('priority', Task.Field.priority),
+      ('status', Task.Field.status), ('notificate_supposed_start', Task.Field.notificate_supposed_start),
+      ('notificate_supposed_end', Task.Field.notificate_supposed_end),
+      ('notificate_deadline', Task.Field.notificate_deadline)]),
+    ('plan', 'plan_id', _task_column('uid_id', _COMMON_TID), _task_column('pid_id', _COMMON_TID),
+     [('end', Plan.Field.end), ('shift', Plan.Field.shift)]),
+    ('plan_relations', 'relation_id', _task_column('uid_id', _PLAN_RELATION_TID),
+     _task_column('pid_id', _PLAN_RELATION_TID),
+     [('plan_id', 'plan_id'), ('tid_id', 'tid'), ('number', 'number'), ('kind', 'kind')]),
+    ('user', 'uid', '{row}.uid', 'NULL',
+     [('login', User.Field.login), ('password', User.Field.password), ('online', User.Field.online)]),
+    ('project', 'pid', '{row}.creator_id', '{row}.pid',
+     [('creator_id', Project.Field.creator), ('name', Project.Field.name)]),
+    ('project_relations', 'relation_id', '{row}.uid_id', '{row}.pid_id',
+     [('pid_id', 'pid'), ('uid_id', 'uid'), ('kind', 'kind')]),
+]
+
+def _change_log_triggers(table, key, uid, pid, columns):
+    insert_change = ('INSERT INTO change_log(entity, entity_id, kind, uid, pid, fields) '
+                     "VALUES ('{}', {{row}}.{}, {{kind}}, {}, {}, {{fields}});").format(table, key, uid, pid)
+    changed_fields = "RTRIM({}, ',')".format(' || '.join(
+        "CASE WHEN old.{0} IS NOT new.{0} THEN '{1},' ELSE '' END".format(column, field)
+        for column, field in columns))
+    all_fields = "'{}'".format(','.join(field for _, field in columns))
+    return [
+        '''CREATE TRIGGER IF NOT EXISTS {0}_change_log_insert AFTER INSERT ON "{0}" BEGIN
+            {1}
+        END'''.format(table, insert_change.format(row='new', kind=Change.Kind.INSERT, fields=all_fields)),
+        '''CREATE TRIGGER IF NOT EXISTS {0}_change_log_update AFTER UPDATE ON "{0}" WHEN {1} != '' BEGIN
+            {2}
+        END'''.format(table, changed_fields,
+                       insert_change.format(row='new', kind=Change.Kind.UPDATE, fields=changed_fields)),
+        '''CREATE TRIGGER IF NOT EXISTS {0}_change_log_delete AFTER DELETE ON "{0}" BEGIN
+            {1}
+        END'''.format(table, insert_change.format(row='old', kind=Change.Kind.DELETE, fields='NULL')),
+    ]
+
+_TABLES = [TaskTableModel, UserTableModel, 
+        PlanTableModel, PlanRelationsTableModel, 
+        ProjectTableModel, ProjectRelationsTableModel,
+        SchemaVersionTableModel, ChangeLogTableModel,
+        TaskArchiveTableModel, PlanArchiveTableModel, PlanRelationsArchiveTableModel,
+        ShardGuestTableModel, ShardChangeCursorTableModel]
+
+def _add_index(db, model, *fields):
+    db.execute(ModelIndex(model, fields, safe=True))
+
+def _migration_add_secondary_indexes(db):
+    '''Version 1. Composite indexes for filters of tasks, plans and projects'''
+    _add_index(db, TaskTableModel, TaskTableModel.uid, TaskTableModel.status)
+    _add_index(db, TaskTableModel, TaskTableModel.pid, TaskTableModel.status)
+    _add_index(db, TaskTableModel, TaskTableModel.parent_tid)
+    _add_index(db, PlanRelationsTableModel, PlanRelationsTableModel.plan_id, PlanRelationsTableModel.kind)
+    _add_index(db, PlanRelationsTableModel, PlanRelationsTableModel.tid, PlanRelationsTableModel.kind)
+    _add_index(db, PlanRelationsTableModel, PlanRelationsTableModel.plan_id, PlanRelationsTableModel.number)
+    _add_index(db, ProjectRelationsTableModel, ProjectRelationsTableModel.uid, ProjectRelationsTableModel.kind)
+    _add_index(db, ProjectRelationsTableModel, ProjectRelationsTableModel.pid, ProjectRelationsTableModel.kind)
+
+def _create_task_search(db):
+    with db.bind_ctx([TaskSearchTableModel]):
+        TaskSearchTableModel.create_table()
+    for trigger in _TASK_SEARCH_TRIGGERS:
+        db.execute_sql(trigger)
+
+def _migration_add_task_search(db):
+    '''Version 2. Full-text index of tasks'''
+    _create_task_search(db)
+    with db.bind_ctx([TaskSearchTableModel]):
+        TaskSearchTableModel.rebuild()
+
+def _create_task_interval(db):
+    with db.bind_ctx([TaskIntervalTableModel]):
+        TaskIntervalTableModel.create_table()
+    for trigger in _TASK_INTERVAL_TRIGGERS:
+        db.execute_sql(trigger)
+
+def _migration_add_task_interval(db):
+    '''Version 3. Interval index of task time ranges'''
+    _create_task_interval(db)
+    db.execute_sql('INSERT INTO task_interval SELECT {} FROM task WHERE {}'.format(
+        _task_interval_values('task'), _task_has_time('task')))
+
+def _borders_sql(aggregate):
+    # every argument is one of non null times or null if there are no times
+    return '{}(COALESCE(supposed_start_time, supposed_end_time, deadline_time), ' \
+            'COALESCE(supposed_end_time, deadline_time, supposed_start_time), ' \
+            'COALESCE(deadline_time, supposed_start_time, supposed_end_time))'.format(aggregate)
+
+_TASK_BORDERS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS task_borders_insert AFTER INSERT ON task BEGIN
+        UPDATE task SET left_border = {}, right_border = {} WHERE tid = new.tid;
+    END'''.format(_borders_sql('MIN'), _borders_sql('MAX')),
+    '''CREATE TRIGGER IF NOT EXISTS task_borders_update
+            AFTER UPDATE OF supposed_start_time, supposed_end_time, deadline_time ON task BEGIN
+        UPDATE task SET left_border = {}, right_border = {} WHERE tid = new.tid;
+    END'''.format(_borders_sql('MIN'), _borders_sql('MAX')),
+]
+
+def _create_task_borders(db):
+    for trigger in _TASK_BORDERS_TRIGGERS:
+        db.execute_sql(trigger)
+
+def _migration_add_task_borders(db):
+    '''Version 4. Persisted left and right borders of tasks'''
+    migrator = SqliteMigrator(db)
+    migrate(migrator.add_column(TaskTableModel._meta.table_name, 'left_border', TaskTableModel.left_border),
+            migrator.add_column(TaskTableModel._meta.table_name, 'right_border', TaskTableModel.right_border))
+    db.execute_sql('UPDATE task SET left_border = {}, right_border = {}'.format(
+        _borders_sql('MIN'), _borders_sql('MAX')))
+    _add_index(db, TaskTableModel, TaskTableModel.uid, TaskTableModel.right_border)
+    _add_index(db, TaskTableModel, TaskTableModel.pid, TaskTableModel.left_border)
+
+def _migration_set_task_borders_by_triggers(db):
+    '''Version 5. Borders of tasks are set by triggers, unused index of right border is dropped'''
+    db.execute_sql('DROP INDEX IF EXISTS tasktablemodel_uid_id_right_border')
+    _create_task_borders(db)
+
+def _create_change_log(db):
+    for table_triggers in _CHANGE_LOG_TABLES:
+        for trigger in _change_log_triggers(*table_triggers):
+            db.execute_sql(trigger)
+
+def _migration_add_change_log(db):
+    '''Version 6. Log of changes of all tables, existing rows are not logged'''
+    with db.bind_ctx([ChangeLogTableModel]):
+        ChangeLogTableModel.create_table()
+    _create_change_log(db)
+
+def _migration_add_archive(db):
+    '''Version 7. Archive tables for completed tasks and expired plans'''
+    db.create_tables([TaskArchiveTableModel, PlanArchiveTableModel, PlanRelationsArchiveTableModel])
+
+def _migration_add_shard_guest(db):
+    '''Version 8. Shards of sharded_adapters where users have subtasks of other users'''
+    db.create_tables([ShardGuestTableModel])
+
+def _migration_add_shard_change_cursor(db):
+    '''Version 9. Revisions of change logs of shards copied to catalogue of sharded_adapters'''
+    db.create_tables([ShardChangeCursorTableModel])
+
+# Forward migrations of database schema. Migration with index i upgrades
+# schema to version i + 1. Never change or reorder existing migrations,
+# only append new ones
+_MIGRATIONS = [_migration_add_secondary_indexes, _migration_add_task_search,
+               _migration_add_task_interval, _migration_add_task_borders,
+               _migration_set_task_borders_by_triggers, _migration_add_change_log,
+               _migration_add_archive, _migration_add_shard_guest, _migration_add_shard_change_cursor]
+
+def _create_schema_objects(db):
+    '''Creates objects of new database which table models do not declare'''
+    _create_task_search(db)
+    _create_task_interval(db)
+    _create_task_borders(db)
+    _create_change_log(db)
+
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+def get_schema_version(db):
+    '''Returns version of database schema or 0 if it was never versioned'''
+    if not db.table_exists(SchemaVersionTableModel._meta.table_name):
+        return 0
+    with db.bind_ctx([SchemaVersionTableModel]):
+        version = SchemaVersionTableModel.select(fn.MAX(SchemaVersionTableModel.version)).scalar()
+    return version if version is not None else 0
+
+def migrate_schema(db):
+    '''Creates tables or upgrades existing database to SCHEMA_VERSION
+
+    New database gets all tables and indexes at once and is marked with
+    the last version. Existing database gets all missing migrations
+    applied one by one, each in its own savepoint. Schema is checked and
+    migrated in one immediate transaction, so processes opening the same
+    file at once wait for each other instead of migrating it twice
+    '''
+    with db.bind_ctx(_TABLES), db.atomic('IMMEDIATE'):
+        if not db.table_exists(TaskTableModel._meta.table_name):
+            db.create_tables(_TABLES)
+            _create_schema_objects(db)
+            SchemaVersionTableModel.insert_many(
+                [(version, ) for version in range(1, SCHEMA_VERSION + 1)],
+                fields=[SchemaVersionTableModel.version]).execute()
+            return
+
+        db.create_tables([SchemaVersionTableModel])
+        current_version = get_schema_version(db)
+        for version in range(current_version + 1, SCHEMA_VERSION + 1):
+            with db.atomic():
+                _MIGRATIONS[version - 1](db)
+                SchemaVersionTableModel.create(version=version)
+            logging.get_logger('StorageAdapter').info('Database schema was migrated to version {}'.format(version))
+        db.create_tables(_TABLES)
+
+# Default limit of host parameters in one sqlite statement
+_MAX_SQL_VARIABLES = 999
+
+def _insert_many(db, model, rows):
+    '''Inserts rows by batches in one transaction
+
+    Returns generated primary keys in order of rows. Sqlite assigns
+    sequential rowids to rows of one insert, so ids of a batch
+    are calculated from the last inserted rowid
+    '''
+    if len(rows) == 0:
+        return []
+
+    batch_size = max(1, _MAX_SQL_VARIABLES // len(rows[0]))
+    ids = []
+    with db.atomic():
+        for batch in chunked(rows, batch_size):
+            last_id = model.insert_many(batch).execute()
+            ids.extend(range(last_id - len(batch) + 1, last_id + 1))
+    return ids
+
+def _floor_div(dividend, divisor):
+    '''Division of integers rounded down, sqlite rounds it towards zero.
+    Operator % of peewee means GLOB, so remainder is built as expression
+    '''
+    def remainder(value):
+        return Expression(value, '%', divisor)
+    return (dividend - remainder(remainder(dividend) + divisor)) / divisor
+
+def _overdue_by_time(model, time):
+    '''Times of task were before time, see Filter.overdue_by_time'''
+    start_before = (~(model.supposed_start_time >> None)
+                        & (model.supposed_start_time < time))
+    end_before = (~(model.supposed_end_time >> None)
+                        & (model.supposed_end_time < time))
+    deadline_before = (~(model.deadline_time >> None)
+                        & (model.deadline_time < time))
+    only_end = (model.supposed_start_time >> None)
+    return ((only_end & (end_before | deadline_before))
+            | (start_before & (end_before | deadline_before)))
+
+_MEMORY_DB_FILE = ':memory:'
+
+# Default count of trees of tasks or plans moved to archive in one transaction
+_ARCHIVE_BATCH_SIZE = 500
+
+# Default count of pages copied by one step of snapshot and pause
+# in seconds between steps, while writers can take the lock
+_SNAPSHOT_PAGES = 256
+_SNAPSHOT_PAUSE = 0.005
+
+class EngineProfile():
+    '''Settings of sqlite engine
+
+    Pragmas are applied to every connection opened by engine, None
+    keeps sqlite default. If statement outside of transaction fails
+    because database is locked by another process, it is retried
+    busy_retries times with exponentially growing delay starting
+    from busy_retry_delay seconds. Read-only engine opens existing
+    database file with mode=ro and query_only pragma, never migrates
+    its schema and fails on every write
+    '''
+
+    # busy_timeout goes first, switching journal mode may wait for lock
+    PRAGMAS = ('busy_timeout', 'journal_mode', 'synchronous',
+               'cache_size', 'mmap_size', 'temp_store')
+
+    _INTEGER_OPTIONS = ('busy_timeout', 'cache_size', 'mmap_size', 'busy_retries')
+
+    _BOOLEAN_VALUES = {'1': True, 'true': True, 'yes': True, 'on': True,
+                       '0': False, 'false': False, 'no': False, 'off': False}
+
+    def __init__(self, journal_mode=None, synchronous=None, cache_size=None,
+                 mmap_size=None, temp_store=None, busy_timeout=None,
+                 busy_retries=0, busy_retry_delay=0.05, read_only=False):
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.temp_store = temp_store
+        self.busy_timeout = busy_timeout
+        self.busy_retries = busy_retries
+        self.busy_retry_delay = busy_retry_delay
+        self.read_only = read_only
+
+    def get_pragmas(self):
+        pragmas = [(name, getattr(self, name)) for name in self.PRAGMAS
+                   if getattr(self, name) is not None]
+        if self.read_only:
+            # journal mode of read-only connection can not be switched
+            pragmas = [(name, value) for name, value in pragmas if name != 'journal_mode']
+            pragmas.append(('query_only', 1))
+        return pragmas
+
+    def copy(self, **options):
+        attrs = dict(vars(self))
+        attrs.update(options)
+        return EngineProfile(**attrs)
+
+    @staticmethod
+    def from_options(options):
+        '''Creates profile from dict of options like in config files
+
+        Option profile selects one of ENGINE_PROFILES as base, other
+        options override its attributes. Values can be strings
+        '''
+        options = dict(options)
+        name = options.pop('profile', None)
+        base = ENGINE_PROFILES.get(name or 'default')
+        if base is None:
+            raise ValueError('Unknown engine profile {}'.format(name))
+
+        for option, value in options.items():
+            if (option not in EngineProfile.PRAGMAS
+                    and option not in ('busy_retries', 'busy_retry_delay', 'read_only')):
+                raise ValueError('Unknown engine option {}'.format(option))
+            if isinstance(value, str):
+                if option in EngineProfile._INTEGER_OPTIONS:
+                    options[option] = int(value)
+                elif option == 'busy_retry_delay':
+                    options[option] = float(value)
+                elif option == 'read_only':
+                    if value.lower() not in EngineProfile._BOOLEAN_VALUES:
+                        raise ValueError('Invalid value {} of engine option read_only'.format(value))
+                    options[option] = EngineProfile._BOOLEAN_VALUES[value.lower()]
+        return base.copy(**options)
+
+ENGINE_PROFILES = {
+    # sqlite defaults: rollback journal, synchronous=FULL, small page cache
+    'default': EngineProfile(),
+    # several processes share database file: readers do not block writer,
+    # writer waits for lock instead of failing at once
+    'concurrent': EngineProfile(journal_mode='wal', synchronous='normal',
+                                cache_size=-16000, mmap_size=64 * 1024 * 1024,
+                                temp_store='memory', busy_timeout=5000,
+                                busy_retries=5),
+    # reporting and export jobs which read snapshot or live database
+    # and must never change it
+    'read_only': EngineProfile(cache_size=-16000, mmap_size=64 * 1024 * 1024,
+                               temp_store='memory', busy_timeout=5000,
+                               busy_retries=5, read_only=True)
+}
+
+_engine_profile = ENGINE_PROFILES['default']
+
+def set_engine_profile(profile):
+    '''Sets profile of engines opened by get_database after this call
+
+    Profile may be EngineProfile, name from ENGINE_PROFILES or dict
+    for EngineProfile.from_options
+    '''
+    global _engine_profile
+    if isinstance(profile, str):
+        profile = EngineProfile.from_options({'profile': profile})
+    elif isinstance(profile, dict):
+        profile = EngineProfile.from_options(profile)
+    _engine_profile = profile
+
+def get_engine_profile():
+    return _engine_profile
+
+def _is_busy_error(error):
+    message = str(error)
+    return 'database is locked' in message or 'database table is locked' in message
+
+class _SqliteDatabase(SqliteDatabase):
+    '''Sqlite engine which retries statements failed on busy database
+
+    Statement inside transaction is never retried, whole transaction
+    should be repeated instead
+    '''
+
+    def __init__(self, database, profile, **kwargs):
+        super().__init__(database, pragmas=profile.get_pragmas(), **kwargs)
+        self.profile = profile
+
+    def execute_sql(self, sql, params=None, commit=None):
+        attempt = 0
+        while True:
+            try:
+                return super().execute_sql(sql, params)
+            except OperationalError as error:
+                if (attempt >= self.profile.busy_retries or self.in_transaction()
+                        or not _is_busy_error(error)):
+                    raise
+            time.sleep(self.profile.busy_retry_delay * 2 ** attempt)
+            attempt += 1
+
+def _read_only_uri(db_file):
+    '''Returns uri which opens existing database file for reading only'''
+    if db_file == _MEMORY_DB_FILE:
+        raise ValueError('In-memory database can not be opened read-only')
+    return 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_file)))
+
+def _check_schema_version(db, db_file):
+    '''Read-only database is never migrated, so its schema must be up to date'''
+    version = get_schema_version(db)
+    if version != SCHEMA_VERSION:
+        raise ValueError('Database {} has schema version {}, expected {}'.format(
+            db_file, version, SCHEMA_VERSION))
+
+def _open_database(db_file):
+    if _engine_profile.read_only:
+        db = _SqliteDatabase(_read_only_uri(db_file), _engine_profile, uri=True)
+        _check_schema_version(db, db_file)
+        return db
+
+    db = _SqliteDatabase(db_file, _engine_profile)
+    migrate_schema(db)
+    return db
+
+def _backup(connection, dest_path, pages=_SNAPSHOT_PAGES, pause=_SNAPSHOT_PAUSE, progress=None):
+    '''Copies database of sqlite3 connection to dest_path by online backup
+
+    Database is copied to temporary file next to dest_path which then
+    replaces it, so readers of the previous snapshot never see a half
+    written one. Returns count of copied pages
+    '''
+    temp_path = '{}.tmp'.format(dest_path)
+    total_pages = 0
+
+    def after_step(status, remaining, total):
+        nonlocal total_pages
+        total_pages = total
+        if progress is not None:
+            progress(status, remaining, total)
+        if remaining > 0 and pause:
+            time.sleep(pause)
+
+    target = sqlite3.connect(temp_path)
+    try:
+        connection.backup(target, pages=pages, progress=after_step)
+    finally:
+        target.close()
+    os.replace(temp_path, dest_path)
+    return total_pages
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(db_file):
+    '''Returns database engine for specified file
+
+    Engine is opened and its schema is checked only once per process,
+    all next calls with the same path return the same engine.
+    In-memory database is never shared: every call creates new one
+    like sqlite does for every connection to ':memory:'
+    New engines use profile set by set_engine_profile
+    '''
+    if db_file == _MEMORY_DB_FILE:
+        return _open_database(db_file)
+
+    db_file = os.path.abspath(db_file)
+    with _databases_lock:
+        db = _databases.get(db_file)
+        if db is None:
+            db = _open_database(db_file)
+            _databases[db_file] = db
+    return db
+
+def open_connection():
+    '''Opens connection of current thread to its database engine
+
+    Engines keep separate connection for every thread. Server which
+    runs requests in threads should call it when request is started
+    and close_connections when request is finished
+    '''
+    db = _db_proxy.obj
+    if db is not None:
+        db.connect(reuse_if_open=True)
+
+def close_connections():
+    '''Closes connections of current thread to all database engines'''
+    with _databases_lock:
+        databases = list(_databases.values())
+    if _db_proxy.obj is not None and _db_proxy.obj not in databases:
+        databases.append(_db_proxy.obj)
+    for db in databases:
+        if not db.is_closed():
+            db.close()
+
+def close_databases():
+    '''Closes and forgets all engines opened by get_database'''
+    with _databases_lock:
+        for db in _databases.values():
+            db.close()
+        _databases.clear()
 
 class StorageAdapter():
 
@@ -206,42 +983,62 @@ class StorageAdapter():
 
         self.db_file = db_file
 
-        # print(self._is_database_exists())
-
-        # if not self._is_database_exists():
-        #     self._create_db()
-
         if db is None:
-            self.db = SqliteDatabase(db_file)
-            _db_proxy.initialize(self.db)
-
-            tables = [TaskTableModel, UserTableModel, 
-                    PlanTableModel, PlanRelationsTableModel, 
-                    ProjectTableModel, ProjectRelationsTableModel]
-            self.db.create_tables(tables)
+            self.db = get_database(db_file)
+            # proxy is re-pointed only for current thread and only when
+            # another engine is opened, adapters of the same database
+            # never swap it
+            if _db_proxy.obj is not self.db:
+                _db_proxy.initialize(self.db)
         else:
             self.db = db
 
-    def _is_database_exists(self):
-        if self.db_file == ':memory:':
-            # if db is in memory, we should init it always, so return False
-            # to say that database need to be initialized
-            return False
-
-        try:
-            open(self.db_file, 'r').close()
-        except FileNotFoundError:
-            return False
-        return True
-
-    def _create_db(self):
-        if self.db_file != ':memory:':
-            utils.create_file_if_not_exists(self.db_file)
-
-        tables = [TaskTableModel, UserTableModel, 
-            PlanTableModel, PlanRelationsTableModel, 
-            ProjectTableModel, ProjectRelationsTableModel]
-        self.db.create_tables(tables)
+    def transaction(self):
+        '''Returns transaction which is context manager and decorator
+
+        Transaction is opened on the engine models are bound to, so
+        adapters of one database share it. Nested transactions become
+        savepoints of the outer one
+        '''
+        return _db_proxy.atomic()
+
+    def snapshot(self, dest_path, pages=_SNAPSHOT_PAGES, pause=_SNAPSHOT_PAUSE, progress=None):
+        '''Writes consistent copy of database to dest_path while it is used
+
+        Sqlite online backup copies database by steps of pages, the lock
+        is held during one step only and writers get it between steps.
+        If database is changed by another connection, backup restarts.
+        progress is called after every step with status, remaining and
+        total count of pages. Returns count of copied pages
+        '''
+        total_pages = _backup(self.db.connection(), dest_path, pages, pause, progress)
+        logging.get_logger('StorageAdapter').info('Snapshot of {} pages was written to {}'.format(
+            total_pages, dest_path))
+        return total_pages
+
+    def current_revision(self):
+        '''Returns revision of the last change or 0 if nothing was changed'''
+        revision = ChangeLogTableModel.select(fn.MAX(ChangeLogTableModel.revision)).scalar()
+        return revision if revision is not None else 0
+
+    def get_changes(self, since_revision=0, uid=None, limit=None):
+        '''Returns changes made after since_revision ordered by revision
+
+        If uid is specified, only changes of rows of this user and of
+        projects where user is creator, admin or guest are returned
+        '''
+        changes = ChangeLogTableModel.select().where(ChangeLogTableModel.revision > since_revision)
+        if uid is not None:
+            related_pids = (ProjectRelationsTableModel.select(ProjectRelationsTableModel.pid)
+                            .where(ProjectRelationsTableModel.uid == uid))
+            created_pids = ProjectTableModel.select(ProjectTableModel.pid).where(ProjectTableModel.creator == uid)
+            changes = changes.where((ChangeLogTableModel.uid == uid)
+                                    | ChangeLogTableModel.pid.in_(related_pids)
+                                    | ChangeLogTableModel.pid.in_(created_pids))
+        changes = changes.order_by(ChangeLogTableModel.revision)
+        if limit is not None:
+            changes = changes.limit(limit)
+        return [change.to_change() for change in changes]
 
     def connect(self):
         pass
@@ -259,38 +1056,175 @@ class TaskStorageAdapter(StorageAdapter):
 
     _log_tag = 'TaskStorageAdapter'
 
-    def get_tasks(self, filter=None):
-        if filter is None:
-            task_table_models = TaskTableModel.select()
-        else:
-            conditions = filter.to_peewee_conditions()
-            if conditions is None or len(conditions) == 0:
-                task_table_models = TaskTableModel.select()
-            else:
-                task_table_models = TaskTableModel.select().where(*conditions)
+    def get_tasks(self, filter=None, limit=None, after_tid=None, newest_first=False, include_archived=False):
+        '''Returns list of tasks ordered by tid
+
+        Tasks can be paged by keyset: limit bounds count of tasks and
+        after_tid is tid of the last task of previous page. Archived
+        tasks are returned only if include_archived is True
+        '''
+        if include_archived:
+            return list(islice(self._iterate_with_archived(filter, limit, after_tid, newest_first), limit))
+
+        task_table_models = self._select_tasks(filter, after_tid, newest_first)
+        if limit is not None:
+            task_table_models = task_table_models.limit(limit)
 
         tasks = [task_model.to_task() for task_model in task_table_models]
         return tasks
-        
+
+    def iterate_tasks(self, filter=None, after_tid=None, newest_first=False, include_archived=False):
+        '''Generator variant of get_tasks
+
+        Rows are read from database cursor one by one and are not cached,
+        so memory usage does not depend on count of tasks
+        '''
+        if include_archived:
+            yield from self._iterate_with_archived(filter, None, after_tid, newest_first)
+            return
+
+        task_table_models = self._select_tasks(filter, after_tid, newest_first)
+        for task_model in task_table_models.iterator():
+            yield task_model.to_task()
+
+    def _iterate_with_archived(self, filter, limit, after_tid, newest_first):
+        '''Merges tasks of task table and archive by tid, relevance
+        of text search is not used for order here
+        '''
+        streams = []
+        for model in (TaskTableModel, TaskArchiveTableModel):
+            task_table_models = self._select_tasks(filter, after_tid, newest_first, model, by_relevance=False)
+            if limit is not None:
+                task_table_models = task_table_models.limit(limit)
+            streams.append(task_model.to_task() for task_model in task_table_models.iterator())
+        return heapq.merge(*streams, key=lambda task: task.tid, reverse=newest_first)
+
+    def _select_tasks(self, filter, after_tid, newest_first, model=TaskTableModel, by_relevance=True):
+        '''Tasks are ordered by tid. Tasks found by text search are ordered
+        by relevance unless they are paged with after_tid or newest_first
+        '''
+        conditions = []
+        text_search_query = None
+        if filter is not None:
+            conditions.extend(filter.to_peewee_conditions(model))
+            text_search_query = filter.to_text_search_query()
+        if after_tid is not None:
+            if newest_first:
+                conditions.append(model.tid < after_tid)
+            else:
+                conditions.append(model.tid > after_tid)
+
+        order = []
+        task_table_models = model.select()
+        if text_search_query is not None:
+            if model is not TaskTableModel:
+                conditions.append(SQL('0'))
+            else:
+                task_table_models = task_table_models.join(TaskSearchTableModel,
+                    on=(TaskSearchTableModel.rowid == TaskTableModel.tid))
+                conditions.append(TaskSearchTableModel.match(text_search_query))
+                if by_relevance and after_tid is None and not newest_first:
+                    order.append(TaskSearchTableModel.bm25())
+        if len(conditions) != 0:
+            task_table_models = task_table_models.where(*conditions)
+        if newest_first:
+            order.append(model.tid.desc())
+        else:
+            order.append(model.tid)
+        return task_table_models.order_by(*order)
+
+    def count_tasks(self, filter=None, overdue_time=None, include_archived=False):
+        '''Returns counts of tasks matched by filter grouped by project,
+        status and priority
+
+        Result is dict from (pid, status, priority) to pair of count of
+        tasks and count of overdue tasks. Not completed task is overdue if
+        its status is overdue or if it is overdue by overdue_time like in
+        Filter.overdue_by_time. Tasks are counted by one query for task
+        table and one for archive if include_archived is True
+        '''
+        models = [TaskTableModel, TaskArchiveTableModel] if include_archived else [TaskTableModel]
+        counts = {}
+        for model in models:
+            overdue = model.status == Status.OVERDUE
+            if overdue_time is not None:
+                overdue |= (model.status.in_([Status.ACTIVE, Status.PENDING])
+                            & (model.left_border < overdue_time)
+                            & _overdue_by_time(model, overdue_time))
+            rows = self._select_tasks(filter, None, False, model, by_relevance=False)\
+                .select(model.pid, model.status, model.priority,
+                        fn.COUNT(model.tid), fn.SUM(Case(None, [(overdue, 1)], 0)))\
+                .group_by(model.pid, model.status, model.priority)\
+                .order_by()
+            for pid, status, priority, count, overdue_count in rows.tuples():
+                total_count, total_overdue_count = counts.get((pid, status, priority), (0, 0))
+                counts[(pid, status, priority)] = (total_count + count, total_overdue_count + overdue_count)
+        return counts
+
+    def count_completed_tasks(self, start_time, end_time, bucket_length, filter=None):
+        '''Returns histogram of completed tasks matched by filter
+
+        Time from start_time to end_time is divided into buckets of
+        bucket_length, task is counted in bucket of its right border
+        because time of completion is not stored. Result is dict from
+        start time of bucket to count of tasks, buckets without tasks
+        are skipped. Archived tasks are counted too, one query per table
+        '''
+        histogram = {}
+        for model in (TaskTableModel, TaskArchiveTableModel):
+            bucket = (model.right_border - start_time) / bucket_length
+            rows = self._select_tasks(filter, None, False, model, by_relevance=False)\
+                .select(bucket, fn.COUNT(model.tid))\
+                .where((model.status == Status.COMPLETED)
+                    & (model.right_border >= start_time)
+                    & (model.right_border < end_time))\
+                .group_by(bucket)\
+                .order_by()
+            for number, count in rows.tuples():
+                bucket_start = start_time + number * bucket_length
+                histogram[bucket_start] = histogram.get(bucket_start, 0) + count
+        return histogram
+
+    def _next_free_tid(self):
+        '''Returns tid for new task if sqlite would give it tid of archived
+        task, otherwise None
+
+        Sqlite gives new row the greatest tid of task table plus one,
+        so tids of the latest archived tasks can be given again
+        '''
+        last_tid = TaskTableModel.select(fn.COALESCE(fn.MAX(TaskTableModel.tid), 0))
+        last_archived_tid = TaskArchiveTableModel.select(fn.MAX(TaskArchiveTableModel.tid))\
+            .where(TaskArchiveTableModel.tid >= last_tid).scalar()
+        if last_archived_tid is None:
+            return None
+        return last_archived_tid + 1
+
     def save_task(self, task, auto_tid=True):
-        task_to_save = TaskTableModel(uid=task.uid,
-                            pid=task.pid,
-                            parent_tid=task.parent_tid,
-                            title=task.title, 
-                            description=task.description,
-                            supposed_start_time=task.supposed_start_time,
-                            supposed_end_time=task.supposed_end_time,
-                            deadline_time=task.deadline_time,
-                            priority=task.priority,
-                            status=task.status,
-                            notificate_supposed_start=task.notificate_supposed_start,
-                            notificate_supposed_end=task.notificate_supposed_end,
-                            notificate_deadline=task.notificate_deadline)
-        rows_modified = task_to_save.save()
-        success = rows_modified == 1
-        if success:
-            logging.get_logger(self._log_tag).info('Task was saved: {}'.format(task_to_save.__data__))
-        return success
+        '''Saves task and returns its generated tid or None if task was not saved
+        '''
+        task_to_save = TaskTableModel(**TaskTableModel.task_to_data(task))
+        with self.transaction():
+            task_to_save.tid = self._next_free_tid()
+            rows_modified = task_to_save.save(force_insert=True)
+        if rows_modified != 1:
+            return None
+        logging.get_logger(self._log_tag).info('Task was saved: {}'.format(task_to_save.__data__))
+        return task_to_save.tid
+
+    def save_tasks(self, tasks):
+        '''Saves tasks with multi-row inserts inside one transaction
+
+        Returns list of generated tids in order of passed tasks
+        '''
+        rows = [TaskTableModel.task_to_data(task) for task in tasks]
+        with self.transaction():
+            first_tid = self._next_free_tid()
+            if first_tid is not None:
+                for tid, row in enumerate(rows, first_tid):
+                    row['tid'] = tid
+            tids = _insert_many(self.db, TaskTableModel, rows)
+        logging.get_logger(self._log_tag).info('{} tasks were saved'.format(len(tids)))
+        return tids
 
     def get_last_saved_task(self):
         task_model = TaskTableModel.select().order_by(TaskTableModel.tid.desc()).get()
@@ -298,38 +1232,189 @@ class TaskStorageAdapter(StorageAdapter):
             return task_model.to_task()
 
     def remove_task(self, tid):
-        plan_storage = PlanStorageAdapter(self.db_file, self.db)
-        plans = plan_storage.get_plans(common_tid=tid)
-        if plans is not None and len(plans) != 0:
-            for plan in plans:
-                success = plan_storage.remove_plan(plan.plan_id)
-                print(success)
-                if not success:
-                    return success
-
-        plans = plan_storage.get_plans(edit_repeat_tid=tid)
-        if plans is not None and len(plans) != 0:
-            for plan in plans:
-                number = plan_storage.get_number_for_edit_repeat_by_tid(plan.plan_id, tid)
-                success = plan_storage.restore_plan_repeat(plan.plan_id, number)
-                print(success)
-                if not success:
-                    return False
-
-        tasks_to_delete = [tid]
-        while len(tasks_to_delete) != 0:
-            tid_to_delete = tasks_to_delete.pop(0)
-            rows_deleted = TaskTableModel.delete().where(TaskTableModel.tid == tid_to_delete).execute()
-            if rows_deleted == 0:
-                return False
-            else:
-                logging.get_logger(self._log_tag).info('Task was removed: {}'.format(tid_to_delete))
-
-            child_tasks = TaskTableModel.select().where(TaskTableModel.parent_tid == tid_to_delete)
-            for child_task in child_tasks:
-                tasks_to_delete.append(child_task.tid)
-
-        return True
+        '''Removes task with all its subtasks in one transaction
+
+        Plans which common task is removed are removed with their edited
+        repeats, edited repeats of other plans are restored.
+        Returns count of removed tasks
+        '''
+        counts = self._remove_subtrees([tid])
+        logging.get_logger(self._log_tag).info('Task {} was removed, removed rows: {}'.format(tid, counts))
+        return counts[Change.Entity.task]
+
+    def remove_tasks(self, uid=None, pids=None):
+        '''Removes all tasks of user and all tasks of projects with pids
+
+        Tasks are removed with subtasks and plans like in remove_task, with
+        a few statements in one transaction. Archived tasks of user and
+        projects are removed too. Returns dict with counts of removed
+        rows by table names
+        '''
+        conditions = []
+        if uid is not None:
+            conditions.append(lambda model: model.uid == uid)
+        if pids is not None:
+            pids = list(pids)
+            conditions.append(lambda model: model.pid.in_(pids))
+        if len(conditions) == 0:
+            return self._remove_subtrees([])
+
+        roots = TaskTableModel.select(TaskTableModel.tid)\
+            .where(reduce(operator.or_, [condition(TaskTableModel) for condition in conditions]))
+        archived_roots = TaskArchiveTableModel.select(TaskArchiveTableModel.tid)\
+            .where(reduce(operator.or_, [condition(TaskArchiveTableModel) for condition in conditions]))
+        counts = self._remove_subtrees(roots, archived_roots)
+        logging.get_logger(self._log_tag).info('Tasks of user {} and projects {} were removed, removed rows: {}'\
+            .format(uid, pids, counts))
+        return counts
+
+    def _remove_subtrees(self, roots, archived_roots=None):
+        '''Removes tasks with tids selected by roots with their subtrees and plans
+
+        roots is list of tids or query which selects them, archived_roots
+        is query which selects archived tasks removed with their subtrees
+        '''
+        with self.transaction():
+            subtree = self._select_subtree_tids(roots)
+            plan_ids = [relation.plan_id_id for relation in PlanRelationsTableModel
+                .select(PlanRelationsTableModel.plan_id)
+                .where((PlanRelationsTableModel.kind == PlanRelationsTableModel.Kind.COMMON)
+                    & (PlanRelationsTableModel.tid.in_(subtree)))]
+
+            edited_tids = []
+            if len(plan_ids) != 0:
+                edited_tids = [relation.tid_id for relation in PlanRelationsTableModel
+                    .select(PlanRelationsTableModel.tid)
+                    .where((PlanRelationsTableModel.kind == PlanRelationsTableModel.Kind.EDITED)
+                        & (PlanRelationsTableModel.plan_id.in_(plan_ids)))]
+            if len(edited_tids) != 0:
+                roots = TaskTableModel.select(TaskTableModel.tid)\
+                            .where(TaskTableModel.tid.in_(roots) | TaskTableModel.tid.in_(edited_tids))
+            tids_to_remove = self._select_subtree_tids(roots)
+
+            relations_deleted = PlanRelationsTableModel.delete()\
+                .where(PlanRelationsTableModel.plan_id.in_(plan_ids)
+                    | PlanRelationsTableModel.tid.in_(tids_to_remove))\
+                .execute()
+            plans_deleted = PlanTableModel.delete().where(PlanTableModel.plan_id.in_(plan_ids)).execute()
+            tasks_deleted = TaskTableModel.delete().where(TaskTableModel.tid.in_(tids_to_remove)).execute()
+            if archived_roots is not None:
+                tasks_deleted += TaskArchiveTableModel.delete()\
+                    .where(TaskArchiveTableModel.tid.in_(
+                        self._select_subtree_tids(archived_roots, TaskArchiveTableModel)))\
+                    .execute()
+
+        return {Change.Entity.task: tasks_deleted, Change.Entity.plan: plans_deleted,
+                Change.Entity.plan_relations: relations_deleted}
+
+    def _select_subtree_tids(self, root_tids, model=TaskTableModel, excluded_tids=None):
+        '''Returns query for tids of tasks with root_tids and all their subtasks
+
+        Subtasks with excluded_tids (list or query) are not returned
+        together with their own subtasks
+        '''
+        base = model.select(model.tid)\
+                    .where(model.tid.in_(root_tids))\
+                    .cte('subtree', recursive=True, columns=('tid',))
+        children = model.select(model.tid)\
+                    .join(base, on=(model.parent_tid == base.c.tid))
+        if excluded_tids is not None:
+            children = children.where(model.tid.not_in(excluded_tids))
+        subtree = base.union(children)
+        return subtree.select_from(subtree.c.tid)
+
+    def archive_tasks(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Moves completed tasks which ended before before_time to archive
+
+        Only tasks without parent are moved, each with all its subtasks,
+        and only if all subtasks are completed too and ended before
+        before_time or have no time. Tasks of plans are archived with
+        their plans only. Every batch of tasks is moved in its own
+        transaction. Returns count of moved tasks
+        '''
+        plan_tids = PlanRelationsTableModel.select(PlanRelationsTableModel.tid)\
+            .where(PlanRelationsTableModel.tid.is_null(False))
+        # status is compared with coalesce, so task without status blocks its tree
+        blocking = ((fn.COALESCE(TaskTableModel.status, -1) != Status.COMPLETED)
+            | (TaskTableModel.right_border >= before_time)
+            | TaskTableModel.tid.in_(plan_tids))
+
+        moved_count = 0
+        last_root = 0
+        while True:
+            with self.transaction():
+                roots = [task_model.tid for task_model in TaskTableModel.select(TaskTableModel.tid)
+                    .where(TaskTableModel.parent_tid.is_null()
+                        & (TaskTableModel.status == Status.COMPLETED)
+                        & (TaskTableModel.right_border < before_time)
+                        & (TaskTableModel.tid > last_root)
+                        & TaskTableModel.tid.not_in(plan_tids))
+                    .order_by(TaskTableModel.tid)
+                    .limit(batch_size)]
+                if len(roots) == 0:
+                    break
+                last_root = roots[-1]
+
+                base = TaskTableModel.select(TaskTableModel.tid, TaskTableModel.tid)\
+                    .where(TaskTableModel.tid.in_(roots))\
+                    .cte('tree', recursive=True, columns=('root', 'tid'))
+                children = TaskTableModel.select(base.c.root, TaskTableModel.tid)\
+                    .join(base, on=(TaskTableModel.parent_tid == base.c.tid))
+                tree = base.union_all(children)
+                blocked_roots = tree.select_from(tree.c.root)\
+                    .join(TaskTableModel, on=(TaskTableModel.tid == tree.c.tid))\
+                    .where(blocking)
+                archived_roots = TaskTableModel.select(TaskTableModel.tid)\
+                    .where(TaskTableModel.tid.in_(roots) & TaskTableModel.tid.not_in(blocked_roots))
+                moved_count += self._move_to_archive(self._select_subtree_tids(archived_roots))
+
+        logging.get_logger(self._log_tag).info('{} tasks which ended before {} were archived'\
+            .format(moved_count, before_time))
+        return moved_count
+
+    def _move_to_archive(self, tids):
+        '''Copies tasks with tids to archive and removes them from task table,
+        tids is list or query. Returns count of moved tasks
+        '''
+        fields = TaskArchiveTableModel._meta.sorted_fields
+        TaskArchiveTableModel.insert_from(
+            TaskTableModel.select(*[TaskTableModel._meta.fields[field.name] for field in fields])
+                .where(TaskTableModel.tid.in_(tids)),
+            fields).execute()
+        return TaskTableModel.delete().where(TaskTableModel.tid.in_(tids)).execute()
+
+    def _subtasks_condition(self, tid, skip_plan_tasks):
+        common_tids = None
+        if skip_plan_tasks:
+            common_tids = PlanRelationsTableModel.select(PlanRelationsTableModel.tid)\
+                .where((PlanRelationsTableModel.kind == PlanRelationsTableModel.Kind.COMMON)
+                    & PlanRelationsTableModel.tid.is_null(False))
+        return (TaskTableModel.tid.in_(self._select_subtree_tids([tid], excluded_tids=common_tids))
+                & (TaskTableModel.tid != tid))
+
+    def get_subtasks(self, tid, skip_plan_tasks=False):
+        '''Returns all subtasks of task at any depth ordered by tid
+
+        If skip_plan_tasks is True, common tasks of plans are not returned
+        together with their own subtasks
+        '''
+        task_models = TaskTableModel.select()\
+            .where(self._subtasks_condition(tid, skip_plan_tasks))\
+            .order_by(TaskTableModel.tid)
+        return [task_model.to_task() for task_model in task_models]
+
+    def edit_subtasks(self, tid, task_field_dict, skip_plan_tasks=False):
+        '''Sets fields of all subtasks of task at any depth with one update
+
+        Subtasks are selected like get_subtasks does. Returns count of edited tasks
+        '''
+        values = {getattr(TaskTableModel, field): value for field, value in task_field_dict.items()}
+        rows_modified = TaskTableModel.update(values)\
+            .where(self._subtasks_condition(tid, skip_plan_tasks))\
+            .execute()
+        logging.get_logger(self._log_tag).info('{} subtasks of task {} were edited: {}'\
+            .format(rows_modified, tid, task_field_dict))
+        return rows_modified
 
     def edit_task_from_model(self, task):
         task_to_edit = TaskTableModel.select().where(TaskTableModel.tid == task.tid)[0]
@@ -368,111 +1453,149 @@ class TaskStorageAdapter(StorageAdapter):
         return rows_modified == 1
 
     class Filter():
+        '''Conditions are kept as functions of table model, so the same
+        filter selects tasks from task table and from archive
+        '''
 
         def __init__(self):
             self._filter = []
+            self._text_search = []
 
         def tid(self, tid):
-            self._filter.append(TaskTableModel.tid == tid)
+            if isinstance(tid, list):
+                self._filter.append(lambda model: model.tid.in_(tid))
+            else:
+                self._filter.append(lambda model: model.tid == tid)
 
         def pid(self, pid):
-            self._filter.append(TaskTableModel.pid == pid)
+            if isinstance(pid, list):
+                self._filter.append(lambda model: model.pid.in_(pid))
+            else:
+                self._filter.append(lambda model: model.pid == pid)
 
         def parent_tid(self, parent_tid):
-            self._filter.append(TaskTableModel.parent_tid == parent_tid)
+            self._filter.append(lambda model: model.parent_tid == parent_tid)
 
         def uid(self, uid):
-            self._filter.append(TaskTableModel.uid == uid)
+            self._filter.append(lambda model: model.uid == uid)
 
         def title(self, title):
-            self._filter.append(TaskTableModel.title == title)
+            self._filter.append(lambda model: model.title == title)
 
         def description(self, description):
-            self._filter.append(TaskTableModel.description == description)
+            self._filter.append(lambda model: model.description == description)
 
-        def priority(self, priority):
-            if isinstance(priority, list):
-                if len(priority) == 0:
+        def _one_of(self, field, values):
+            if isinstance(values, list):
+                if len(values) == 0:
                     return
-                priority_iter = iter(priority)
-                condition = TaskTableModel.priority == next(priority_iter)
-                for p in priority_iter:
-                    condition = (condition) | (TaskTableModel.priority == p)
-                self._filter.append(condition)
+                self._filter.append(lambda model: reduce(operator.or_,
+                    [getattr(model, field) == value for value in values]))
             else:
-                self._filter.append(TaskTableModel.priority == priority)
+                self._filter.append(lambda model: getattr(model, field) == values)
+
+        def priority(self, priority):
+            self._one_of('priority', priority)
 
         def status(self, status):
-            if isinstance(status, list):
-                if len(status) == 0:
-                    return
-                status_iter = iter(status)
-                condition = TaskTableModel.status == next(status_iter)
-                for s in status_iter:
-                    condition = (condition) | (TaskTableModel.status == s)
-                self._filter.append(condition)
-            else:
-                self._filter.append(TaskTableModel.status == status)
+            self._one_of('status', status)
 
         def notificate_supposed_start(self, notificate_supposed_start):
-            self._filter.append(TaskTableModel.notificate_supposed_start == notificate_supposed_start)
+            self._filter.append(lambda model: model.notificate_supposed_start == notificate_supposed_start)
 
         def notificate_supposed_end(self, notificate_supposed_end):
-            self._filter.append(TaskTableModel.notificate_supposed_end == notificate_supposed_end)
+            self._filter.append(lambda model: model.notificate_supposed_end == notificate_supposed_end)
 
         def notificate_deadline(self, notificate_deadline):
-            self._filter.append(TaskTableModel.notificate_deadline == notificate_deadline)
+            self._filter.append(lambda model: model.notificate_deadline == notificate_deadline)
 
         def one_of_notificate(self):
-            self._filter.append((TaskTableModel.notificate_supposed_start == True)
-                                | (TaskTableModel.notificate_supposed_end == True)
-                                | (TaskTableModel.notificate_deadline == True))
+            self._filter.append(lambda model: (model.notificate_supposed_start == True)
+                                              | (model.notificate_supposed_end == True)
+                                              | (model.notificate_deadline == True))
 
         def to_time(self, time):
-            self._filter.append((TaskTableModel.supposed_end_time < time)
-                                | (TaskTableModel.supposed_start_time < time)
-                                | (TaskTableModel.deadline_time < time))
+            self._filter.append(lambda model: model.left_border < time)
 
         def not_completed(self):
-            self._filter.append((TaskTableModel.status == Status.ACTIVE)
-                                | (TaskTableModel.status == Status.PENDING)
-                                | (TaskTableModel.status == Status.OVERDUE))
+            self._one_of('status', [Status.ACTIVE, Status.PENDING, Status.OVERDUE])
 
         def plan_tid(self, plan_tid):
-            self._filter.append(TaskTableModel.plan_tid == plan_tid)
+            self._filter.append(lambda model: model.plan_tid == plan_tid)
+
+        def _interval_candidates(self, *conditions):
+            '''Narrows filter by lookup in interval index, exact conditions
+            should be added separately. Archive has no interval index,
+            so there only exact conditions are checked
+            '''
+            candidates = TaskIntervalTableModel.select(TaskIntervalTableModel.tid).where(*conditions)
+            self._filter.append(lambda model: model.tid.in_(candidates) if model is TaskTableModel else None)
 
         def overdue_by_time(self, time):
-            start_before = (~(TaskTableModel.supposed_start_time >> None)
-                                & (TaskTableModel.supposed_start_time < time))
-            end_before = (~(TaskTableModel.supposed_end_time >> None)
-                                & (TaskTableModel.supposed_end_time < time))
-            deadline_before = (~(TaskTableModel.deadline_time >> None)
-                                & (TaskTableModel.deadline_time < time))
-            only_end = (TaskTableModel.supposed_start_time >> None)
-            self._filter.append((only_end & (end_before | deadline_before))
-                                | (start_before & (end_before | deadline_before)))
+            self._interval_candidates(TaskIntervalTableModel.left_border < time,
+                                      TaskIntervalTableModel.due_border_min < time)
+            self._filter.append(lambda model: model.left_border < time)
+            self._filter.append(lambda model: _overdue_by_time(model, time))
 
         def filter_range(self, start_time, end_time):
-            start_before_end = (~(TaskTableModel.supposed_start_time >> None)
-                                & (TaskTableModel.supposed_start_time <= end_time))
-            end_after_start = (~(TaskTableModel.supposed_end_time >> None)
-                                & (TaskTableModel.supposed_end_time >= start_time))
-            deadline_after_start = (~(TaskTableModel.deadline_time >> None)
-                                & (TaskTableModel.deadline_time >= start_time))
-            only_start = ((TaskTableModel.supposed_end_time >> None) 
-                            & (TaskTableModel.deadline_time >> None))
-            only_end = (TaskTableModel.supposed_start_time >> None)
-            self._filter.append((only_start & start_before_end)
-                                | (only_end & (end_after_start | deadline_after_start))
-                                | (start_before_end & (end_after_start | deadline_after_start)))
+            self._interval_candidates(TaskIntervalTableModel.left_border <= end_time,
+                                      TaskIntervalTableModel.right_border >= start_time)
+
+            def in_range(model):
+                start_before_end = (~(model.supposed_start_time >> None)
+                                    & (model.supposed_start_time <= end_time))
+                end_after_start = (~(model.supposed_end_time >> None)
+                                    & (model.supposed_end_time >= start_time))
+                deadline_after_start = (~(model.deadline_time >> None)
+                                    & (model.deadline_time >= start_time))
+                only_start = ((model.supposed_end_time >> None)
+                                & (model.deadline_time >> None))
+                only_end = (model.supposed_start_time >> None)
+                return ((only_start & start_before_end)
+                        | (only_end & (end_after_start | deadline_after_start))
+                        | (start_before_end & (end_after_start | deadline_after_start)))
+            self._filter.append(in_range)
 
         def timeless(self):
-            self._filter.append((TaskTableModel.supposed_end_time == None)
-                                & (TaskTableModel.supposed_start_time == None)
-                                & (TaskTableModel.deadline_time == None))
-
-        def to_peewee_conditions(self):
-            return self._filter
+            self._filter.append(lambda model: (model.supposed_end_time == None)
+                                              & (model.supposed_start_time == None)
+                                              & (model.deadline_time == None))
+
+        def text_search(self, query, fields=None):
+            '''Full-text search by title and description
+
+            Query consists of words, 'prefix*' and '"exact phrase"' terms,
+            all of them should be found. fields restricts search
+            to Task.Field.title or Task.Field.description.
+            Found tasks are ordered by relevance. Archived tasks
+            are never found by text search
+            '''
+            terms = []
+            for phrase, prefix, word in re.findall(r'"([^"]*)"(\*?)|(\S+)', query):
+                if phrase == '':
+                    phrase = word.replace('"', '')
+                    prefix = '*' if phrase.endswith('*') else ''
+                    phrase = phrase.rstrip('*')
+                if phrase.strip() != '':
+                    terms.append('"{}"{}'.format(phrase, prefix))
+            if len(terms) == 0:
+                # query without words matches nothing
+                self._filter.append(lambda model: SQL('0'))
+                return
+
+            expression = '({})'.format(' '.join(terms))
+            if fields is not None:
+                expression = '{{{}}} : {}'.format(' '.join(fields), expression)
+            self._text_search.append(expression)
+
+        def to_text_search_query(self):
+            if len(self._text_search) == 0:
+                return None
+            return ' AND '.join(self._text_search)
+
+        def to_peewee_conditions(self, model=TaskTableModel):
+            conditions = [condition(model) for condition in self._filter]
+            return [condition for condition in conditions if condition is not None]
 
 class PlanStorageAdapter(StorageAdapter):
 
@@ -518,11 +1641,13 @@ class PlanStorageAdapter(StorageAdapter):
         if len(plan_models) == 0:
             return None
         plan = plan_models[0].to_plan()        
-        relations = PlanRelationsTableModel.select().where(PlanRelationsTableModel.plan_id == plan_id)
+        relations = PlanRelationsTableModel.select()\
+                        .where(PlanRelationsTableModel.plan_id == plan_id)\
+                        .order_by(PlanRelationsTableModel.relation_id)
         plan.exclude = []
         for relation in relations:
             if relation.kind == PlanRelationsTableModel.Kind.COMMON:
-                plan.tid = relation.tid.tid
+                plan.tid = relation.tid_id
             else:
                 plan.exclude.append(relation.number)
         return plan
@@ -558,54 +1683,72 @@ class PlanStorageAdapter(StorageAdapter):
         if relations[0].kind != PlanRelationsTableModel.Kind.EDITED:
             return None
 
-        return relations[0].tid
+        return relations[0].tid_id
 
     def recalculate_exclude_when_start_time_shifted(self, plan_id, start_time_shift):
-        plan_models = PlanTableModel.select().where(PlanTableModel.plan_id == plan_id)
-        shift = plan_models[0].shift
-        if start_time_shift % shift == 0:
-            logging.get_logger(self._log_tag).info(('For {} excludes were recalculated '
-                'due start time shift changed').format(plan_id))
-            conditions = ((PlanRelationsTableModel.plan_id == plan_id) 
-                & (PlanRelationsTableModel.kind != PlanRelationsTableModel.Kind.COMMON))
-            relations = PlanRelationsTableModel.select().where(conditions)
-            for relation in relations:
-                relation.number -= start_time_shift / shift
-                if relation.number < 0:
-                    relation.delete_instance()
-                else:
-                    rows_modified = relation.save()
-                    if rows_modified != 1:
-                        return False
-        else:
+        '''Renumbers excludes of plan after its start was moved
+
+        Excludes which are before new start are deleted, all others are
+        renumbered with one UPDATE
+        '''
+        plan_model = PlanTableModel.get_or_none(PlanTableModel.plan_id == plan_id)
+        if plan_model is None:
+            return False
+        shift = plan_model.shift
+        if start_time_shift % shift != 0:
             return self.restore_all_repeats(plan_id)
 
+        logging.get_logger(self._log_tag).info(('For {} excludes were recalculated '
+            'due start time shift changed').format(plan_id))
+        number_shift = start_time_shift // shift
+        conditions = ((PlanRelationsTableModel.plan_id == plan_id)
+            & (PlanRelationsTableModel.kind != PlanRelationsTableModel.Kind.COMMON))
+        with self.transaction():
+            PlanRelationsTableModel.delete().where(
+                conditions & (PlanRelationsTableModel.number < number_shift)).execute()
+            PlanRelationsTableModel.update(number=PlanRelationsTableModel.number - number_shift).where(
+                conditions).execute()
         return True
 
-    def save_plan(self, plan):
-        plan_to_save = PlanTableModel(end=plan.end,
-                                shift=plan.shift)
-        rows_modified = plan_to_save.save()
-        if rows_modified != 1:
-            return False
-        logging.get_logger(self._log_tag).info('Plan was saved: {}'.format(plan_to_save.__data__))
-
-        plan_common_relation = PlanRelationsTableModel(plan_id=plan_to_save.plan_id,
-                                                    tid=plan.tid,
-                                                    number=None,
-                                                    kind=PlanRelationsTableModel.Kind.COMMON)
-        rows_modified = plan_common_relation.save()
-        if rows_modified != 1:
-            return False
-        logging.get_logger(self._log_tag).info('Plan common relation was added: {}'.format(plan_common_relation.__data__))
+    def save_plans(self, plans):
+        '''Saves plans with their common relations and excludes
+
+        All rows are written with multi-row inserts inside one transaction.
+        Returns list of generated plan ids in order of passed plans
+        '''
+        plans = list(plans)
+        with self.transaction():
+            plan_rows = [{'end': plan.end, 'shift': plan.shift} for plan in plans]
+            plan_ids = _insert_many(self.db, PlanTableModel, plan_rows)
+
+            relation_rows = []
+            for plan_id, plan in zip(plan_ids, plans):
+                relation_rows.append({'plan_id': plan_id, 'tid': plan.tid, 'number': None,
+                                      'kind': PlanRelationsTableModel.Kind.COMMON})
+                if plan.exclude is not None:
+                    for exclude_number in plan.exclude:
+                        relation_rows.append({'plan_id': plan_id, 'tid': None, 'number': exclude_number,
+                                              'kind': PlanRelationsTableModel.Kind.DELETED})
+            _insert_many(self.db, PlanRelationsTableModel, relation_rows)
+
+        logging.get_logger(self._log_tag).info('{} plans were saved'.format(len(plan_ids)))
+        return plan_ids
+
+    def add_plan_excludes(self, plan_id, numbers):
+        '''Deletes repeats of plan by numbers with one multi-row insert
+
+        Returns list of generated relation ids in order of passed numbers
+        '''
+        rows = [{'plan_id': plan_id, 'tid': None, 'number': number,
+                 'kind': PlanRelationsTableModel.Kind.DELETED} for number in numbers]
+        relation_ids = _insert_many(self.db, PlanRelationsTableModel, rows)
+        logging.get_logger(self._log_tag).info('Repeats {} were deleted in plan {}'.format(list(numbers), plan_id))
+        return relation_ids
 
-        if plan.exclude is not None and len(plan.exclude) != 0:
-            for exclude_number in plan.exclude:
-                success = self.delete_plan_repeat(plan_to_save.plan_id, exclude_number)
-                if not success:
-                    return False
-        
-        return True
+    def save_plan(self, plan):
+        '''Saves plan and returns its generated plan_id or None if plan was not saved
+        '''
+        return self.save_plans([plan])[0]
 
     def delete_plan_repeat(self, plan_id, number):
         plan_deleted_relations = PlanRelationsTableModel(plan_id=plan_id,
@@ -663,8 +1806,8 @@ class PlanStorageAdapter(StorageAdapter):
         if len(relations) != 0:
             task_storage = TaskStorageAdapter(self.db_file, self.db)
             for relation in relations:
-                if relation.tid is not None:
-                    TaskTableModel.delete().where(TaskTableModel.tid == relation.tid).execute()
+                if relation.tid_id is not None:
+                    TaskTableModel.delete().where(TaskTableModel.tid == relation.tid_id).execute()
 
         PlanRelationsTableModel.delete().where(PlanRelationsTableModel.plan_id == plan_id).execute()
         success = rows_deleted == 1
@@ -672,6 +1815,97 @@ class PlanStorageAdapter(StorageAdapter):
             logging.get_logger(self._log_tag).info('Plan {} was deleted'.format(plan_id))
         return success
 
+    def count_repeats(self, start_time, end_time, uid=None, pids=None):
+        '''Returns counts of repeats of plans in time range by one query
+
+        Plans are selected by common tasks of user with uid or of projects
+        with pids, all plans are counted if both are None. Repeats are
+        counted like in PlanController.get_repeats_by_time_range: numbers
+        of the first and the last repeats in range are calculated from
+        borders of common task, shift and end of plan, excluded repeats
+        between them are subtracted. Result is dict from plan_id to count,
+        plans without repeats in range are skipped
+        '''
+        Common = PlanRelationsTableModel.alias()
+        Exclude = PlanRelationsTableModel.alias()
+        shift = PlanTableModel.shift
+        last_time = fn.MIN(end_time, fn.COALESCE(PlanTableModel.end, end_time))
+        # the first repeat which ends after start_time and the last one which starts before last_time
+        first = Case(None, [(TaskTableModel.right_border >= start_time, 0)],
+                     _floor_div(start_time - TaskTableModel.right_border + shift - 1, shift))
+        last = _floor_div(last_time - TaskTableModel.left_border, shift)
+
+        conditions = [(Common.kind == PlanRelationsTableModel.Kind.COMMON) & (shift > 0)]
+        owners = []
+        if uid is not None:
+            owners.append(TaskTableModel.uid == uid)
+        if pids is not None:
+            owners.append(TaskTableModel.pid.in_(list(pids)))
+        if len(owners) != 0:
+            conditions.append(reduce(operator.or_, owners))
+
+        bounds = PlanTableModel.select(PlanTableModel.plan_id, first, last)\
+            .join(Common, on=(Common.plan_id == PlanTableModel.plan_id))\
+            .join(TaskTableModel, on=(TaskTableModel.tid == Common.tid))\
+            .where(*conditions)\
+            .cte('bounds', columns=('plan_id', 'first_number', 'last_number'))
+        excluded = Exclude.select(fn.COUNT(Exclude.relation_id))\
+            .where((Exclude.plan_id == bounds.c.plan_id)
+                & (Exclude.kind != PlanRelationsTableModel.Kind.COMMON)
+                & (Exclude.number >= bounds.c.first_number)
+                & (Exclude.number <= bounds.c.last_number))
+        rows = bounds.select_from(bounds.c.plan_id, bounds.c.last_number - bounds.c.first_number + 1 - excluded)\
+            .where(bounds.c.last_number >= bounds.c.first_number)
+        return {plan_id: count for plan_id, count in rows.tuples() if count > 0}
+
+    def archive_plans(self, before_time, batch_size=_ARCHIVE_BATCH_SIZE):
+        '''Moves plans which ended before before_time to archive
+
+        Plans are moved with their relations, common tasks and edited
+        repeats with all subtasks. Every batch of plans is moved in its
+        own transaction. Returns dict with counts of moved rows by table names
+        '''
+        task_storage = TaskStorageAdapter(self.db_file, self.db)
+        counts = {Change.Entity.task: 0, Change.Entity.plan: 0, Change.Entity.plan_relations: 0}
+        last_plan_id = 0
+        while True:
+            with self.transaction():
+                plan_ids = [plan_model.plan_id for plan_model in PlanTableModel.select(PlanTableModel.plan_id)
+                    .where((PlanTableModel.end < before_time) & (PlanTableModel.plan_id > last_plan_id))
+                    .order_by(PlanTableModel.plan_id)
+                    .limit(batch_size)]
+                if len(plan_ids) == 0:
+                    break
+                last_plan_id = plan_ids[-1]
+
+                # tasks are selected by relations, so they are moved first
+                plan_tids = PlanRelationsTableModel.select(PlanRelationsTableModel.tid)\
+                    .where(PlanRelationsTableModel.plan_id.in_(plan_ids)
+                        & PlanRelationsTableModel.tid.is_null(False))
+                counts[Change.Entity.task] += task_storage._move_to_archive(
+                    task_storage._select_subtree_tids(plan_tids))
+
+                relation_fields = PlanRelationsArchiveTableModel._meta.sorted_fields
+                PlanRelationsArchiveTableModel.insert_from(
+                    PlanRelationsTableModel.select(*[PlanRelationsTableModel._meta.fields[field.name]
+                                                     for field in relation_fields])
+                        .where(PlanRelationsTableModel.plan_id.in_(plan_ids)),
+                    relation_fields).execute()
+                counts[Change.Entity.plan_relations] += PlanRelationsTableModel.delete()\
+                    .where(PlanRelationsTableModel.plan_id.in_(plan_ids)).execute()
+
+                plan_fields = PlanArchiveTableModel._meta.sorted_fields
+                PlanArchiveTableModel.insert_from(
+                    PlanTableModel.select(*[PlanTableModel._meta.fields[field.name] for field in plan_fields])
+                        .where(PlanTableModel.plan_id.in_(plan_ids)),
+                    plan_fields).execute()
+                counts[Change.Entity.plan] += PlanTableModel.delete()\
+                    .where(PlanTableModel.plan_id.in_(plan_ids)).execute()
+
+        logging.get_logger(self._log_tag).info('Plans which ended before {} were archived, moved rows: {}'\
+            .format(before_time, counts))
+        return counts
+
     def edit_plan(self, plan_field_dict):
         plan_id = plan_field_dict[Plan.Field.plan_id]
 
@@ -687,29 +1921,25 @@ class PlanStorageAdapter(StorageAdapter):
 
         if Plan.Field.shift in plan_field_dict:
             shift = plan_field_dict[Plan.Field.shift]
-            plan_models = PlanTableModel.select().where(PlanTableModel.plan_id == plan_id)
-            for plan_model in plan_models:
-                old_shift = plan_model.shift
-                plan_model.shift = shift
-                rows_modified = plan_model.save()
-                if rows_modified != 1:
-                    return False
-                logging.get_logger(self._log_tag).info('Shift of plan {} was changed to {}'.format(plan_id, shift))
-            
+            plan_model = PlanTableModel.get_or_none(PlanTableModel.plan_id == plan_id)
+            if plan_model is None:
+                return True
+            old_shift = plan_model.shift
+
+            # repeat stays only if it starts at the same time with new shift
             conditions = ((PlanRelationsTableModel.plan_id == plan_id)
                 & (PlanRelationsTableModel.kind != PlanRelationsTableModel.Kind.COMMON))
-            relations = PlanRelationsTableModel.select().where(conditions)
-            for relation in relations:
-                number = relation.number
-                if (number * old_shift) % shift == 0:
-                    relation.number = (number * old_shift) / shift
-                    rows_modified = relation.save()
-                    if rows_modified != 1:
-                        return False
-                    logging.get_logger(self._log_tag).info('Repeat {} was shifted'.format(number))
-                else:
-                    relation.delete_instance()
-                    logging.get_logger(self._log_tag).info('Repeat {} was removed'.format(number))
+            start_offset = PlanRelationsTableModel.number * old_shift
+            with self.transaction():
+                PlanTableModel.update(shift=shift).where(PlanTableModel.plan_id == plan_id).execute()
+                # number is integer, so division in sqlite is integer too
+                rows_deleted = PlanRelationsTableModel.delete().where(
+                    conditions & (start_offset - start_offset / shift * shift != 0)).execute()
+                rows_shifted = PlanRelationsTableModel.update(number=start_offset / shift).where(
+                    conditions).execute()
+            logging.get_logger(self._log_tag).info('Shift of plan {} was changed to {}'.format(plan_id, shift))
+            logging.get_logger(self._log_tag).info('{} repeats were shifted, {} repeats were removed'
+                .format(rows_shifted, rows_deleted))
 
         return True
 
@@ -736,14 +1966,16 @@ class UserStorageAdapter(StorageAdapter):
         return users
 
     def save_user(self, user):
+        '''Saves user and returns its generated uid or None if user was not saved
+        '''
         user_to_save = UserTableModel(login=user.login,
                             password=user.password,
                             online=user.online)
         rows_modified = user_to_save.save()
-        success = rows_modified == 1
-        if success:
-            logging.get_logger(self._log_tag).info('User {} was saved'.format(user_to_save.__data__))
-        return success
+        if rows_modified != 1:
+            return None
+        logging.get_logger(self._log_tag).info('User {} was saved'.format(user_to_save.__data__))
+        return user_to_save.uid
 
     def get_last_saved_user(self):
         user_model = UserTableModel.select().order_by(UserTableModel.uid.desc()).get()
@@ -751,18 +1983,22 @@ class UserStorageAdapter(StorageAdapter):
             return user_model.to_user()
 
     def delete_user(self, uid):
-        task_adapter = TaskStorageAdapter(self.db_file, self.db)
-        filter = TaskStorageAdapter.Filter()
-        filter.uid(uid)
-        tasks = task_adapter.get_tasks(filter)
-        for task in tasks:
-            task_adapter.remove_task(task.tid)
-
-        rows_deleted = UserTableModel.delete().where(UserTableModel.uid == uid).execute()
-        success = rows_deleted == 1
-        if success:
-            logging.get_logger(self._log_tag).info('User {} was deleted'.format(uid))
-        return success
+        return self.remove_user(uid)[Change.Entity.user] == 1
+
+    def remove_user(self, uid):
+        '''Removes user with all its tasks and its relations to projects
+
+        Rows are removed with a few statements in one transaction.
+        Returns dict with counts of removed rows by table names
+        '''
+        with self.transaction():
+            counts = TaskStorageAdapter(self.db_file, self.db).remove_tasks(uid=uid)
+            counts[Change.Entity.project_relations] = ProjectRelationsTableModel.delete()\
+                .where(ProjectRelationsTableModel.uid == uid).execute()
+            counts[Change.Entity.user] = UserTableModel.delete().where(UserTableModel.uid == uid).execute()
+        if counts[Change.Entity.user] == 1:
+            logging.get_logger(self._log_tag).info('User {} was deleted, removed rows: {}'.format(uid, counts))
+        return counts
 
     def edit_user(self, user_field_dict):
         uid = user_field_dict[User.Field.uid]
@@ -803,91 +2039,79 @@ class ProjectStorageAdapter(StorageAdapter):
     _log_tag = 'ProjectStorageAdapter'
 
     def save_project(self, project):
+        '''Saves project and returns its generated pid or None if project was not saved
+        '''
         project_model = ProjectTableModel(creator=project.creator, name=project.name)
         rows_modified = project_model.save()
-        return rows_modified == 1
+        if rows_modified != 1:
+            return None
+        return project_model.pid
 
     def _get_all_relations(self):
         return ProjectRelationsTableModel.select()
 
     def get_projects(self, uid, name=None, pid=None):
-        projects = []
-        
-        project_table_models = ProjectTableModel.select().where(ProjectTableModel.creator == uid)
-        for project_model in project_table_models:
-            project = self._get_project_by_id(project_model.pid)
-            if project is not None:
-                projects.append(project)
-
-        admin_projects = self.get_all_admin_third_party_projects(uid)
-        guest_projects = self.get_all_guest_third_party_projects(uid)
-
-        projects.extend(admin_projects)
-        projects.extend(guest_projects)
-
-        result = []
-        for project in projects:
-            include = True
-            if name is not None:
-                if project.name != name:
-                    include = False
-            if pid is not None and include:
-                if project.pid != pid:
-                    include = False
-            if include:
-                result.append(project)
-
-        return result
+        '''Returns projects which user created or participates in as admin or guest
+
+        Own projects go first, then admin and guest ones.
+        Projects are loaded with one query
+        '''
+        user_relations = ProjectRelationsTableModel.select(ProjectRelationsTableModel.pid)\
+                            .where(ProjectRelationsTableModel.uid == uid)
+        conditions = [(ProjectTableModel.creator == uid) | (ProjectTableModel.pid.in_(user_relations))]
+        if name is not None:
+            conditions.append(ProjectTableModel.name == name)
+        if pid is not None:
+            conditions.append(ProjectTableModel.pid == pid)
+
+        user_kind = fn.MIN(Case(None, [(ProjectRelationsTableModel.uid == uid, ProjectRelationsTableModel.kind)]))
+        order = Case(None, [(ProjectTableModel.creator == uid, -1)], user_kind)
+        return self._select_projects(conditions, order)
 
     def get_all_admin_third_party_projects(self, uid):
-        admin_project_models = ProjectRelationsTableModel.select().where((ProjectRelationsTableModel.uid == uid)
-                            & (ProjectRelationsTableModel.kind == ProjectRelationsTableModel.Kind.ADMIN))
-
-        projects = []
-        if len(admin_project_models) != 0:
-            for admin_project_model in admin_project_models:
-                project = self._get_project_by_id(admin_project_model.pid)
-                projects.append(project)
-        return projects
+        return self._get_third_party_projects(uid, ProjectRelationsTableModel.Kind.ADMIN)
 
     def get_all_guest_third_party_projects(self, uid):
-        guest_project_models = ProjectRelationsTableModel.select().where((ProjectRelationsTableModel.uid == uid)
-                            & (ProjectRelationsTableModel.kind == ProjectRelationsTableModel.Kind.GUEST))
+        return self._get_third_party_projects(uid, ProjectRelationsTableModel.Kind.GUEST)
 
-        projects = []
-        if len(guest_project_models) != 0:
-            for guest_project_model in guest_project_models:
-                project = self._get_project_by_id(guest_project_model.pid)
-                projects.append(project)
-        return projects
+    def _get_third_party_projects(self, uid, kind):
+        user_relations = ProjectRelationsTableModel.select(ProjectRelationsTableModel.pid)\
+                            .where((ProjectRelationsTableModel.uid == uid)
+                            & (ProjectRelationsTableModel.kind == kind))
+        return self._select_projects([ProjectTableModel.pid.in_(user_relations)])
 
     def _get_project_by_id(self, pid):
-        project_models = ProjectTableModel.select().where(ProjectTableModel.pid == pid)
-        if len(project_models) == 0:
+        projects = self._select_projects([ProjectTableModel.pid == pid])
+        if len(projects) == 0:
             return None
-        project_model = project_models[0]
+        return projects[0]
+
+    def _select_projects(self, conditions, *order):
+        '''Selects projects with their admins and guests by one grouped join
+        '''
+        def uids_of_kind(kind):
+            return fn.GROUP_CONCAT(Case(None, [(ProjectRelationsTableModel.kind == kind,
+                                                ProjectRelationsTableModel.uid)]))
+
+        project_models = ProjectTableModel.select(ProjectTableModel,
+                    uids_of_kind(ProjectRelationsTableModel.Kind.ADMIN).alias('admin_uids'),
+                    uids_of_kind(ProjectRelationsTableModel.Kind.GUEST).alias('guest_uids'))\
+                .join(ProjectRelationsTableModel, JOIN.LEFT_OUTER,
+                    on=(ProjectRelationsTableModel.pid == ProjectTableModel.pid))\
+                .where(*conditions)\
+                .group_by(ProjectTableModel.pid)\
+                .order_by(*order, ProjectTableModel.pid)\
+                .objects()
 
-        project = project_model.to_project()
-
-        admin_project_models = ProjectRelationsTableModel.select()\
-                            .where(((ProjectRelationsTableModel.pid == pid)
-                            & (ProjectRelationsTableModel.kind == ProjectRelationsTableModel.Kind.ADMIN)))
-        if len(admin_project_models) != 0:
-            admin_uids = []
-            for admin_project_model in admin_project_models:
-                admin_uids.append(admin_project_model.uid.uid)
-            project.admins = admin_uids
-
-        guest_project_models = ProjectRelationsTableModel.select()\
-                            .where(((ProjectRelationsTableModel.pid == pid)
-                            & (ProjectRelationsTableModel.kind == ProjectRelationsTableModel.Kind.GUEST)))
-        if len(guest_project_models) != 0:
-            guest_uids = []
-            for guest_project_model in guest_project_models:
-                guest_uids.append(guest_project_model.uid.uid)
-            project.guests = guest_uids
-
-        return project
+        projects = []
+        for project_model in project_models:
+            project = project_model.to_project()
+            if project_model.admin_uids is not None:
+                project.admins = [int(uid) for uid in project_model.admin_uids.split(',')]
+            if project_model.guest_uids is not None:
+                project.guests = [int(uid) for uid in project_model.guest_uids.split(',')]
+            projects.append(project)
+        return projects
 
     def remove_project(self, pid):
         ProjectRelationsTableModel.delete().where(ProjectRelationsTableModel.pid == pid).execute()
@@ -897,6 +2121,22 @@ class ProjectStorageAdapter(StorageAdapter):
             logging.get_logger(self._log_tag).info('Project {} was removed'.format(pid))
         return success
 
+    def remove_projects(self, pids):
+        '''Removes projects with all their tasks and relations to users
+
+        Rows are removed with a few statements in one transaction.
+        Returns dict with counts of removed rows by table names
+        '''
+        pids = list(pids)
+        with self.transaction():
+            counts = TaskStorageAdapter(self.db_file, self.db).remove_tasks(pids=pids)
+            counts[Change.Entity.project_relations] = ProjectRelationsTableModel.delete()\
+                .where(ProjectRelationsTableModel.pid.in_(pids)).execute()
+            counts[Change.Entity.project] = ProjectTableModel.delete()\
+                .where(ProjectTableModel.pid.in_(pids)).execute()
+        logging.get_logger(self._log_tag).info('Projects {} were removed, removed rows: {}'.format(pids, counts))
+        return counts
+
     def edit_project(self, project_fields_dict):
         pid = project_fields_dict[Project.Field.pid]
         project_models = ProjectTableModel.select().where(ProjectTableModel.pid == pid)
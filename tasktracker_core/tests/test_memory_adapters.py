@@ -0,0 +1,110 @@
+import unittest
+from unittest import mock
+
+from tasktracker_core.storage import memory_adapters
+from tasktracker_core.storage.memory_adapters import (TaskStorageAdapter, UserStorageAdapter,
+                                                      PlanStorageAdapter, ProjectStorageAdapter,
+                                                      get_database, close_databases)
+from tasktracker_core.model.task import Task, Status
+from tasktracker_core.tests import test_sqlite_peewee_adapters
+from tasktracker_core.tests import test_storage_project_adapter
+from tasktracker_core.tests import test_sqlite_adapters
+
+_ADAPTERS = {'TaskStorageAdapter': TaskStorageAdapter, 'UserStorageAdapter': UserStorageAdapter,
+             'PlanStorageAdapter': PlanStorageAdapter, 'ProjectStorageAdapter': ProjectStorageAdapter}
+
+def _with_memory_adapters(test_class, skipped_tests=(), **names):
+    '''Returns subclass of test case which runs it over memory adapters
+
+    Adapters imported by module of test case are replaced while test runs,
+    every test starts with empty database
+    '''
+    module = __import__(test_class.__module__, fromlist=['*'])
+    patched_names = {name: adapter for name, adapter in _ADAPTERS.items() if hasattr(module, name)}
+    patched_names.update(names)
+
+    def setUp(self):
+        close_databases()
+        patcher = mock.patch.multiple(module, **patched_names)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        test_class.setUp(self)
+
+    attributes = {'setUp': setUp}
+    for test_name in skipped_tests:
+        attributes[test_name] = unittest.skip('checks internals of sqlite_peewee_adapters')(
+            getattr(test_class, test_name))
+    return type('TestMemory' + test_class.__name__[len('Test'):], (test_class, ), attributes)
+
+TestMemoryTask = _with_memory_adapters(test_sqlite_peewee_adapters.TestTask)
+TestMemoryTaskParentTid = _with_memory_adapters(test_sqlite_peewee_adapters.TestTaskParentTid)
+TestMemoryUser = _with_memory_adapters(test_sqlite_peewee_adapters.TestUser)
+TestMemoryTaskUser = _with_memory_adapters(test_sqlite_peewee_adapters.TestTaskUser)
+TestMemoryPlan = _with_memory_adapters(test_sqlite_peewee_adapters.TestPlan)
+TestMemoryBulkInsert = _with_memory_adapters(test_sqlite_peewee_adapters.TestBulkInsert,
+                                              ['test_save_plan_is_atomic'])
+TestMemoryRemoveSubtree = _with_memory_adapters(test_sqlite_peewee_adapters.TestRemoveSubtree)
+TestMemoryEditSubtasks = _with_memory_adapters(test_sqlite_peewee_adapters.TestEditSubtasks)
+TestMemoryPlanExcludeRenumbering = _with_memory_adapters(
+    test_sqlite_peewee_adapters.TestPlanExcludeRenumbering)
+TestMemoryBulkRemove = _with_memory_adapters(test_sqlite_peewee_adapters.TestBulkRemove)
+TestMemoryArchive = _with_memory_adapters(test_sqlite_peewee_adapters.TestArchive)
+TestMemoryStatistics = _with_memory_adapters(test_sqlite_peewee_adapters.TestStatistics)
+TestMemoryTaskPagination = _with_memory_adapters(test_sqlite_peewee_adapters.TestTaskPagination)
+TestMemoryTaskTextSearch = _with_memory_adapters(test_sqlite_peewee_adapters.TestTaskTextSearch)
+TestMemoryTaskIntervalIndex = _with_memory_adapters(test_sqlite_peewee_adapters.TestTaskIntervalIndex,
+                                                    ['test_borders_follow_task_changes'])
+TestMemoryProject = _with_memory_adapters(test_storage_project_adapter.TestProject)
+TestMemoryAdapters = _with_memory_adapters(test_sqlite_adapters.TestAdapters,
+                                           ['test_snapshot_and_read_only_database'],
+                                           sqlite_adapters=memory_adapters)
+TestControllerWithMemoryAdapters = _with_memory_adapters(test_sqlite_adapters.TestControllerWithAdapters)
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        close_databases()
+        self.storage_task = TaskStorageAdapter(':memory:')
+
+    def _create_task(self, uid=1, start=None, end=None, deadline=None):
+        task = Task()
+        task.pid = 1
+        task.uid = uid
+        task.supposed_start_time = start
+        task.supposed_end_time = end
+        task.deadline_time = deadline
+        task.status = Status.PENDING
+        return task
+
+    def test_memory_database_is_shared(self):
+        self.assertIs(UserStorageAdapter(':memory:').db, self.storage_task.db)
+        close_databases()
+        self.assertIsNot(get_database(':memory:'), self.storage_task.db)
+
+    def test_filter_selects_candidates_by_indexes(self):
+        self.storage_task.save_tasks([self._create_task(uid=1, start=0, end=10),
+                                      self._create_task(uid=2, start=20, end=30),
+                                      self._create_task(uid=2, end=50),
+                                      self._create_task(uid=2)])
+        table = self.storage_task.db.tables['task']
+
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(2)
+        filter.filter_range(40, 60)
+        self.assertEqual(filter.select_ids(table), {3})
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter)], [3])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.to_time(15)
+        self.assertEqual(filter.select_ids(table), {1})
+
+    def test_rollback_restores_indexes(self):
+        self.storage_task.save_task(self._create_task(uid=1))
+        with self.assertRaises(ValueError):
+            with self.storage_task.transaction():
+                self.storage_task.edit_task({Task.Field.tid: 1, Task.Field.uid: 2})
+                raise ValueError()
+
+        table = self.storage_task.db.tables['task']
+        self.assertEqual(table.find('uid', 1), {1})
+        self.assertEqual(table.find('uid', 2), set())
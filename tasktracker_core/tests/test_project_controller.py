@@ -1,7 +1,8 @@
 import unittest
 import datetime
 
-from tasktracker_core.requests.controllers import ProjectController, UserController, Controller
+from tasktracker_core.requests.controllers import (ProjectController, UserController, Controller,
+                                                   TaskController, PlanController)
 from tasktracker_core.model.task import Task, Status, Priority
 from tasktracker_core.model.project import Project
 from tasktracker_core.model.user import User
@@ -51,3 +52,36 @@ class TestProject(unittest.TestCase):
         project.name = Project.default_project_name
         self.assertEqual(project, ProjectStorageAdapterMock._saved_project)
 
+class TestRemoveProjectAndUser(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.controller.init_storage_adapters(db_file=':memory:')
+        self.uid = UserController(self.controller).save_user('owner')
+        self.other_uid = UserController(self.controller).save_user('other')
+        self.controller.authentication(self.uid)
+
+        self.pid = ProjectController(self.controller).save_project('Work')
+        ProjectController(self.controller).invite_user_to_project(self.pid, self.other_uid, guest=True)
+        task_controller = TaskController(self.controller)
+        self.root_tid = task_controller.save_task(pid=self.pid, title='Root')
+        task_controller.save_task(pid=self.pid, parent_tid=self.root_tid, title='Child')
+        self.own_tid = task_controller.save_task(title='Own', supposed_start=4102444800000,
+                                                 supposed_end=4102444800010)
+        PlanController(self.controller).attach_plan(self.own_tid, 1000)
+
+    def _titles(self):
+        return sorted(task.title for task in self.controller._task_storage.get_tasks())
+
+    def test_remove_project_removes_its_tasks(self):
+        self.assertTrue(ProjectController(self.controller).remove_project(self.pid))
+        self.assertEqual(self._titles(), ['Own'])
+        self.assertEqual([project.pid for project in ProjectController(self.controller).fetch_projects()
+                          if project.pid == self.pid], [])
+
+    def test_delete_user_removes_projects_tasks_and_plans(self):
+        self.assertTrue(UserController(self.controller).delete_user(self.uid))
+        self.assertEqual(self._titles(), [])
+        self.assertEqual(self.controller._plan_storage.get_plans(), [])
+        self.assertEqual(self.controller._project_storage.get_projects(self.uid), [])
+        self.assertEqual([user.uid for user in self.controller._user_storage.get_users()], [self.other_uid])
@@ -1,229 +1,292 @@
-# from tasktracker_server.storage.serial_task_adapter import TaskStorageAdapter
-# from tasktracker_server.model.task import Task
-# import os
-# import json
-# import pprint
-
-
-# _TEST_ID_DB = 'test_id.db'
-# _TEST_DB = 'test_task.db'
-
-# class TestTaskNewId(unittest.TestCase):
-
-#     def setUp(self):
-#         self.storage = TaskStorageAdapter(id_db_name=_TEST_ID_DB)
-
-#     def test_create_next_task_id(self):
-#         id_zero = self.storage._create_next_task_id()
-#         self.assertEqual(id_zero, 0)
-
-#         id_one = self.storage._create_next_task_id()
-#         self.assertEqual(id_one, 1)
-
-#         id_two = self.storage._create_next_task_id()
-#         self.assertEqual(id_two, 2)
-
-#         id_three = self.storage._create_next_task_id()
-#         self.assertEqual(id_three, 3)
-
-#         with open(_TEST_ID_DB, 'r') as id_db:
-#             id_db_content = json.loads(id_db.read())
-#             if 'task' not in id_db_content:
-#                 raise ValueError('There is no task field inside db')
-
-#             task_count = 0
-#             for key, val in id_db_content.items():
-#                 if key == 'task':
-#                     if val != 4:
-#                         raise ValueError('Wrong id number for task: {}'.format(val))
-#                     task_count += 1
-#             if task_count != 1:
-#                 raise ValueError('Wrong task field count inside db: {}'.format(task_count))        
-
-#     def tearDown(self):
-#         os.remove(_TEST_ID_DB)
-
-# class TestEmptyTaskDb(unittest.TestCase):
-
-#     def setUp(self):
-#         self.storage = TaskStorageAdapter(_TEST_DB)
-
-#     def test_get_tasks_empty_list(self):
-#         tasks = self.storage.get_tasks()
-#         self.assertListEqual(tasks, [])
-
-#     def tearDown(self):
-#         os.remove(_TEST_DB)
-
-# class TestGetFromTaskDb(unittest.TestCase):
-
-#     def setUp(self):
-#         self.storage = TaskStorageAdapter(_TEST_DB)
-#         self._db_content = [{'tid': 0, 'title': 'zero', 'supposed_start_time': 2343434334434, 'deadline_time': 34980483508450},
-#                     {'tid': 1, 'title': 'first', 'supposed_start_time': 66556566565, 'deadline_time': 5345454545454},
-#                     {'tid': 2, 'title': 'second', 'supposed_start_time': 34334554, 'deadline_time': 34980483508450},
-#                     {'tid': 3, 'title': 'third', 'supposed_start_time': 344545353453, 'deadline_time': 34980483508450}]
-#         with open(_TEST_DB, 'w') as test_db:
-#             test_db.write(json.dumps(self._db_content))
-
-#     def test_get_all_tasks(self):
-#         tasks = self.storage.get_tasks()
-
-#         test_tasks = []
-#         for raw_test_task in self._db_content:
-#             task = Task()
-#             task.__dict__ = raw_test_task
-#             test_tasks.append(task)
-
-#         self.assertListEqual(tasks, test_tasks)
-
-#     def test_get_tasks_by_id(self):
-#         filter = {'tid': 0}
-#         tasks = self.storage.get_tasks(filter)
-
-#         test_task = Task()
-#         test_task.__dict__ = self._db_content[0]
-
-#         self.assertEqual(len(tasks), 1)
-#         self.assertEqual(tasks[0], test_task)
-
-#     def test_get_tasks_by_title(self):
-#         filter = {'title': 'first'}
-#         tasks = self.storage.get_tasks(filter)
-
-#         test_task = Task()
-#         test_task.__dict__ = self._db_content[1]
-
-#         self.assertEqual(len(tasks), 1)
-#         self.assertEqual(tasks[0], test_task)
-
-#     def test_get_tasks_by_deadline_time(self):
-#         filter = {'deadline_time': 34980483508450}
-#         tasks = self.storage.get_tasks(filter)
-
-#         task_zero = Task()
-#         task_zero.__dict__ = self._db_content[0]
-#         task_second = Task()
-#         task_second.__dict__ = self._db_content[2]
-#         task_third = Task()
-#         task_third.__dict__ = self._db_content[3]
-#         test_tasks = [task_zero, task_second, task_third]
-
-#         self.assertEqual(len(tasks), 3)
-#         self.assertListEqual(tasks, test_tasks)
-
-#     def tearDown(self):
-#         os.remove(_TEST_DB)
-
-# class TestAddToTaskDb(unittest.TestCase):
-
-#     def setUp(self):
-#         self.storage = TaskStorageAdapter(_TEST_DB)
-
-#     def test_add_task(self):
-#         task = Task()
-#         task.title = 'title'
-#         task.description = 'description'
-#         task.supposed_start_time = 40390934804
-#         task.supposed_end_time = 439039409009
-#         task.deadline_time = 49890438034980
-
-#         self.storage.save_task(task)
-
-#         test_task = Task()
-#         with open(_TEST_DB, 'r') as db:
-#             db_content = json.loads(db.read())
-#             self.assertEqual(len(db_content), 1)
-            
-#             test_task.__dict__ = db_content[0]
-
-#         self.assertEqual(task, test_task)
-        
-
-#     def tearDown(self):
-#         os.remove(_TEST_DB)
-
-# class TestEditInTaskDb(unittest.TestCase):
-
-#     def setUp(self):
-#         self.storage = TaskStorageAdapter(_TEST_DB)
-#         self._db_content = [{'tid': 0, 'title': 'zero', 'supposed_start_time': 2343434334434, 'deadline_time': 34980483508450},
-#                     {'tid': 1, 'title': 'first', 'supposed_start_time': 66556566565, 'deadline_time': 5345454545454},
-#                     {'tid': 2, 'title': 'second', 'supposed_start_time': 34334554, 'deadline_time': 34980483508450},
-#                     {'tid': 3, 'title': 'third', 'supposed_start_time': 344545353453, 'deadline_time': 34980483508450}]
-#         with open(_TEST_DB, 'w') as test_db:
-#             test_db.write(json.dumps(self._db_content))
-
-#     def test_edit_task(self):
-#         task = Task()
-#         task.tid = 1
-#         task.title = 'title'
-#         task.description = 'description'
-#         task.supposed_start_time = 40390934804
-#         task.supposed_end_time = 439039409009
-#         task.deadline_time = 49890438034980
-
-#         self.storage.edit_task(task)
-
-#         task_zero = Task()
-#         task_zero.__dict__ = self._db_content[0]
-#         task_second = Task()
-#         task_second.__dict__ = self._db_content[2]
-#         task_third = Task()
-#         task_third.__dict__ = self._db_content[3]
-#         supposed_db_content = [task_zero, task_second, task_third, task]
-
-#         with open(_TEST_DB, 'r') as db:
-#             db_content = json.loads(db.read())
-#             self.assertEqual(len(db_content), 4)
-           
-#             real_db_content = []
-#             for task_in_db in db_content:
-#                 test_task = Task()
-#                 test_task.__dict__ = task_in_db
-#                 real_db_content.append(test_task)
-
-#         self.assertListEqual(supposed_db_content, real_db_content)
-        
-
-#     def tearDown(self):
-#         os.remove(_TEST_DB)
-
-
-# class TestRemoveFromTaskDb(unittest.TestCase):
-
-#     def setUp(self):
-#         self.storage = TaskStorageAdapter(_TEST_DB)
-#         self._db_content = [{'tid': 0, 'title': 'zero', 'supposed_start_time': 2343434334434, 'deadline_time': 34980483508450},
-#                     {'tid': 1, 'title': 'first', 'supposed_start_time': 66556566565, 'deadline_time': 5345454545454},
-#                     {'tid': 2, 'title': 'second', 'supposed_start_time': 34334554, 'deadline_time': 34980483508450},
-#                     {'tid': 3, 'title': 'third', 'supposed_start_time': 344545353453, 'deadline_time': 34980483508450}]
-#         with open(_TEST_DB, 'w') as test_db:
-#             test_db.write(json.dumps(self._db_content))
-
-#     def test_remove_task(self):
-#         self.storage.remove_task(1)
-
-#         task_zero = Task()
-#         task_zero.__dict__ = self._db_content[0]
-#         task_second = Task()
-#         task_second.__dict__ = self._db_content[2]
-#         task_third = Task()
-#         task_third.__dict__ = self._db_content[3]
-#         supposed_db_content = [task_zero, task_second, task_third]
-
-#         with open(_TEST_DB, 'r') as db:
-#             db_content = json.loads(db.read())
-#             self.assertEqual(len(db_content), 3)
-           
-#             real_db_content = []
-#             for task_in_db in db_content:
-#                 test_task = Task()
-#                 test_task.__dict__ = task_in_db
-#                 real_db_content.append(test_task)
-
-#         self.assertListEqual(supposed_db_content, real_db_content)
-        
-
-#     def tearDown(self):
-#         os.remove(_TEST_DB)
\ No newline at end of file
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from tasktracker_core.storage.serial_task_adapter import (TaskStorageAdapter, UserStorageAdapter,
+                                                          PlanStorageAdapter, ProjectStorageAdapter,
+                                                          Database, get_database, close_databases)
+from tasktracker_core.storage import serial_task_adapter
+from tasktracker_core.storage import sqlite_adapters
+from tasktracker_core.tests import test_sqlite_adapters
+from tasktracker_core.requests.controllers import Controller
+from tasktracker_core.model.task import Task, Status
+from tasktracker_core.model.user import User
+from tasktracker_core.model.plan import Plan
+from tasktracker_core.model.project import Project
+
+def _create_task(title='Title', parent_tid=None, uid=1, start=None, end=None, deadline=None):
+    task = Task()
+    task.pid = 1
+    task.uid = uid
+    task.title = title
+    task.parent_tid = parent_tid
+    task.supposed_start_time = start
+    task.supposed_end_time = end
+    task.deadline_time = deadline
+    task.status = Status.PENDING
+    return task
+
+def _create_adapters(module, db_file):
+    plan_storage = module.PlanStorageAdapter(db_file)
+    db = plan_storage.db
+    return (module.TaskStorageAdapter(db_file, db), module.UserStorageAdapter(db_file, db),
+            plan_storage, module.ProjectStorageAdapter(db_file, db))
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.folder, 'tasktracker.jsonl')
+
+    def tearDown(self):
+        close_databases()
+        shutil.rmtree(self.folder)
+
+    def _reopen(self):
+        close_databases()
+        return TaskStorageAdapter(self.journal_file)
+
+    def _journal_records(self):
+        with open(self.journal_file) as journal:
+            return [json.loads(line) for line in journal]
+
+    def test_replay_after_reopen(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_tasks([_create_task('First'), _create_task('Second', parent_tid=1),
+                                 _create_task('Third')])
+        storage_task.edit_task({Task.Field.tid: 3, Task.Field.title: 'Edited'})
+        storage_task.remove_task(1)
+        plan = Plan()
+        plan.tid = 3
+        plan.shift = 10
+        plan.exclude = [1]
+        PlanStorageAdapter(self.journal_file).save_plan(plan)
+
+        storage_task = self._reopen()
+        self.assertEqual([(task.tid, task.title) for task in storage_task.get_tasks()], [(3, 'Edited')])
+        self.assertEqual(storage_task.save_task(_create_task()), 4)
+        self.assertEqual(PlanStorageAdapter(self.journal_file).get_plans(common_tid=3)[0].exclude, [1])
+
+    def test_indexes_after_replay(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_tasks([_create_task(uid=1), _create_task(uid=2, parent_tid=1),
+                                 _create_task(uid=2)])
+        storage_task.edit_task({Task.Field.tid: 3, Task.Field.uid: 1})
+
+        storage_task = self._reopen()
+        table = storage_task.db.tables['task']
+        self.assertEqual(table.find('uid', 1), {1, 3})
+        self.assertEqual(table.find('parent_tid', 1), {2})
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(2)
+        self.assertEqual([task.tid for task in storage_task.get_tasks(filter)], [2])
+
+    def test_rolled_back_changes_are_not_written(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_task(_create_task('Saved'))
+        with self.assertRaises(ValueError):
+            with storage_task.transaction():
+                storage_task.save_task(_create_task('Rolled back'))
+                storage_task.remove_task(1)
+                raise ValueError()
+
+        self.assertEqual([record['r']['title'] for record in self._journal_records()], ['Saved'])
+        storage_task = self._reopen()
+        self.assertEqual([task.title for task in storage_task.get_tasks()], ['Saved'])
+
+    def test_compaction(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_tasks([_create_task('Task {}'.format(number)) for number in range(10)])
+        storage_task.remove_task(2)
+        storage_task.db.compact()
+
+        self.assertEqual(self._journal_records(), [])
+        self.assertFalse(os.path.exists(self.journal_file + '.compacting'))
+        storage_task.save_task(_create_task('After compaction'))
+        self.assertEqual(len(self._journal_records()), 1)
+
+        storage_task = self._reopen()
+        tasks = storage_task.get_tasks()
+        self.assertEqual(len(tasks), 10)
+        self.assertEqual((tasks[-1].tid, tasks[-1].title), (11, 'After compaction'))
+
+    def test_background_compaction_by_journal_size(self):
+        db = Database(self.journal_file, compact_records=5)
+        storage_task = TaskStorageAdapter(self.journal_file, db)
+        for number in range(12):
+            storage_task.save_task(_create_task('Task {}'.format(number)))
+        db.close()
+
+        self.assertTrue(os.path.exists(self.journal_file + '.snapshot'))
+        self.assertLess(len(self._journal_records()), 12)
+        db = Database(self.journal_file)
+        self.assertEqual(len(TaskStorageAdapter(self.journal_file, db).get_tasks()), 12)
+        db.close()
+
+    def test_interrupted_compaction_is_finished_on_open(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_tasks([_create_task(), _create_task()])
+        storage_task.db.compact()
+        storage_task.save_task(_create_task('Moved aside'))
+        close_databases()
+        os.replace(self.journal_file, self.journal_file + '.compacting')
+
+        storage_task = TaskStorageAdapter(self.journal_file)
+        self.assertEqual([task.title for task in storage_task.get_tasks()], ['Title', 'Title', 'Moved aside'])
+        self.assertFalse(os.path.exists(self.journal_file + '.compacting'))
+
+    def test_torn_record_is_cut_off(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_task(_create_task('Written'))
+        close_databases()
+        with open(self.journal_file, 'a') as journal:
+            journal.write('{"t":"task","r":{"tid"')
+
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_task(_create_task('After crash'))
+        storage_task = self._reopen()
+        self.assertEqual([task.title for task in storage_task.get_tasks()], ['Written', 'After crash'])
+
+    def test_record_without_line_end_is_cut_off(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_task(_create_task('Written'))
+        close_databases()
+        with open(self.journal_file, 'a') as journal:
+            journal.write('{"t":"task","d":1}')
+
+        storage_task = TaskStorageAdapter(self.journal_file)
+        self.assertEqual([task.title for task in storage_task.get_tasks()], ['Written'])
+        storage_task.save_task(_create_task('After crash'))
+        storage_task.save_task(_create_task('Next'))
+        storage_task = self._reopen()
+        self.assertEqual([task.title for task in storage_task.get_tasks()], ['Written', 'After crash', 'Next'])
+
+    def test_fsync_is_batched(self):
+        db = Database(self.journal_file, sync_records=3, sync_interval=60)
+        storage_task = TaskStorageAdapter(self.journal_file, db)
+        storage_task.save_task(_create_task())
+        storage_task.save_task(_create_task())
+        self.assertEqual(db.journal._unsynced, 2)
+        storage_task.save_task(_create_task())
+        self.assertEqual(db.journal._unsynced, 0)
+        db.close()
+
+class TestAdaptersMatchSqliteAdapters(unittest.TestCase):
+
+    def _run_scenario(self, module):
+        storage_task, storage_user, storage_plan, storage_project = _create_adapters(module, ':memory:')
+        storage_user.save_user(User())
+        storage_user.save_user(User())
+        project = Project()
+        project.creator = 1
+        storage_project.save_project(project)
+        storage_project.add_admin_to_project(1, 2)
+
+        storage_task.save_tasks([_create_task('Task {} report'.format(number), parent_tid=number // 4 or None,
+                                              uid=1 + number % 2, start=number * 10, end=number * 10 + 25)
+                                 for number in range(30)])
+        storage_task.save_tasks([_create_task('Only end', end=300), _create_task('Only start', start=600),
+                                 _create_task('Only deadline', deadline=120),
+                                 _create_task('Start and deadline', start=40, deadline=500)])
+        plan = Plan()
+        plan.tid = 7
+        plan.shift = 10
+        plan.exclude = [2, 4, 6]
+        plan_id = storage_plan.save_plan(plan)
+        storage_plan.edit_plan_repeat(plan_id, 3, 8)
+        storage_plan.edit_plan({Plan.Field.plan_id: plan_id, Plan.Field.shift: 20})
+        storage_task.remove_task(5)
+        storage_project.remove_admin_from_project(1, 2)
+        storage_project.edit_project({Project.Field.pid: 1, Project.Field.name: 'Renamed'})
+
+        results = []
+        for configure in (lambda filter: filter.filter_range(100, 150),
+                          lambda filter: filter.filter_range(0, 50),
+                          lambda filter: filter.filter_range(700, 800),
+                          lambda filter: filter.filter_range(450, 550),
+                          lambda filter: filter.overdue_by_time(200),
+                          lambda filter: filter.overdue_by_time(400),
+                          lambda filter: filter.to_time(100),
+                          lambda filter: filter.timeless(),
+                          lambda filter: filter.uid(2),
+                          lambda filter: filter.parent_tid([2, 3]),
+                          lambda filter: filter.text_search('"task 1"* report')):
+            filter = module.TaskStorageAdapter.Filter()
+            configure(filter)
+            results.append([task.__dict__ for task in storage_task.get_tasks(filter)])
+        results.append([task.__dict__ for task in storage_task.get_tasks(limit=5, after_tid=20,
+                                                                          newest_first=True)])
+        results.append([plan.__dict__ for plan in storage_plan.get_plans(common_tid=7)])
+        results.append([project.__dict__ for project in storage_project.get_projects(1)])
+        results.append([project.__dict__ for project in storage_project.get_projects(2)])
+        # rows of one edit of plan can be changed in other order
+        results.append([change.revision for change in storage_task.get_changes()])
+        for changes in (storage_task.get_changes(), storage_task.get_changes(40, uid=2)):
+            results.append(sorted((change.entity, change.entity_id, change.kind, change.uid, change.pid,
+                                   change.fields) for change in changes))
+        results.append(storage_task.count_tasks(overdue_time=200))
+        results.append(storage_task.count_completed_tasks(0, 500, 100))
+        results.append(storage_plan.count_repeats(0, 1000, uid=1))
+        results.append(storage_plan.count_repeats(50, 300, uid=2, pids=[1]))
+        results.append([task.tid for task in storage_task.get_subtasks(1, skip_plan_tasks=True)])
+        results.append(storage_task.edit_subtasks(1, {Task.Field.status: Status.ACTIVE}, skip_plan_tasks=True))
+        results.append(storage_user.remove_user(2))
+        results.append(storage_project.remove_projects([1]))
+        results.append([task.tid for task in storage_task.get_tasks()])
+        return results
+
+    def test_same_results(self):
+        self.assertEqual(self._run_scenario(serial_task_adapter), self._run_scenario(sqlite_adapters))
+
+class TestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.folder, 'tasktracker.jsonl')
+
+    def tearDown(self):
+        close_databases()
+        shutil.rmtree(self.folder)
+
+    def test_changes_after_replay_and_compaction(self):
+        storage_task = TaskStorageAdapter(self.journal_file)
+        storage_task.save_tasks([_create_task(), _create_task()])
+        storage_task.db.compact()
+        storage_task.edit_task({Task.Field.tid: 2, Task.Field.title: 'Edited'})
+        changes = [change.__dict__ for change in storage_task.get_changes()]
+        close_databases()
+
+        storage_task = TaskStorageAdapter(self.journal_file)
+        self.assertEqual([change.__dict__ for change in storage_task.get_changes()], changes)
+        self.assertEqual(storage_task.current_revision(), 3)
+        storage_task.remove_task(1)
+        self.assertEqual(storage_task.current_revision(), 4)
+
+class TestControllerWithJournalAdapters(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.folder, 'tasktracker.jsonl')
+
+    def tearDown(self):
+        close_databases()
+        shutil.rmtree(self.folder)
+
+    def _create_controller(self):
+        controller = Controller()
+        controller.init_storage_adapters(PlanStorageAdapter, TaskStorageAdapter,
+                                         UserStorageAdapter, ProjectStorageAdapter, db_file=self.journal_file)
+        return controller
+
+    def test_controllers_use_adapters(self):
+        controller = self._create_controller()
+        self.assertIs(controller._task_storage.db, get_database(self.journal_file))
+
+        uid = test_sqlite_adapters._save_controller_tasks(controller)
+        close_databases()
+
+        controller = self._create_controller()
+        controller.authentication(uid)
+        test_sqlite_adapters._check_controller_tasks(self, controller)
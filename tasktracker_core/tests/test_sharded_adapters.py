@@ -0,0 +1,332 @@
+import unittest
+import os
+import tempfile
+
+from tasktracker_core.storage.sharded_adapters import TaskStorageAdapter, UserStorageAdapter, PlanStorageAdapter, ProjectStorageAdapter
+from tasktracker_core.storage.sharded_adapters import ShardRouter, HashShardMapping, TableShardMapping
+from tasktracker_core.storage.sharded_adapters import get_router, set_shard_mapping, close_routers
+from tasktracker_core.storage import sharded_adapters
+from tasktracker_core.storage import sqlite_adapters
+from tasktracker_core.requests.controllers import (Controller, TaskController, UserController, ProjectController,
+                                                   ChangeController, InvalidParentIdError)
+from tasktracker_core.model.task import Task, Status
+from tasktracker_core.model.user import User
+from tasktracker_core.model.plan import Plan
+from tasktracker_core.model.project import Project
+from tasktracker_core.model.change import Change
+
+_TEST_DB = ':memory:'
+
+def _create_task(uid, title='Title', parent_tid=None):
+    task = Task()
+    task.pid = 1
+    task.uid = uid
+    task.title = title
+    task.parent_tid = parent_tid
+    task.status = Status.PENDING
+    return task
+
+def _shard_of(tid):
+    return tid % sharded_adapters._MAX_SHARDS
+
+class TestShardedAdapters(unittest.TestCase):
+
+    def setUp(self):
+        self.router = ShardRouter(_TEST_DB, HashShardMapping(2))
+        self.storage_task = TaskStorageAdapter(_TEST_DB, self.router)
+        self.storage_plan = PlanStorageAdapter(_TEST_DB, self.router)
+        self.storage_user = UserStorageAdapter(_TEST_DB, self.router)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB, self.router)
+        for _ in range(2):
+            self.storage_user.save_user(User())
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+    def _shard_titles(self, shard_number):
+        return [task.title for task in self.router.shard(shard_number).task.get_tasks()]
+
+    def test_tasks_stored_in_shards_of_owners(self):
+        tids = self.storage_task.save_tasks([_create_task(1, 'First'), _create_task(2, 'Second'),
+                                             _create_task(1, 'Third')])
+        self.assertEqual([_shard_of(tid) for tid in tids], [1, 0, 1])
+        self.assertEqual(self._shard_titles(1), ['First', 'Third'])
+        self.assertEqual(self._shard_titles(0), ['Second'])
+        self.assertEqual(self.router.catalogue.execute('SELECT COUNT(*) FROM task').fetchone()[0], 0)
+
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(1)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter)], [tids[0], tids[2]])
+        filter = TaskStorageAdapter.Filter()
+        filter.tid([tids[1], tids[2]])
+        self.assertEqual(sorted(task.title for task in self.storage_task.get_tasks(filter)), ['Second', 'Third'])
+
+    def test_tasks_of_shards_merged_by_tid(self):
+        tids = self.storage_task.save_tasks([_create_task(uid % 2 + 1, 'Task {}'.format(uid))
+                                             for uid in range(10)])
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks()], sorted(tids))
+        self.assertEqual([task.tid for task in self.storage_task.iterate_tasks(newest_first=True)],
+                         sorted(tids, reverse=True))
+
+        pages = []
+        after_tid = None
+        while True:
+            page = self.storage_task.get_tasks(limit=3, after_tid=after_tid)
+            if len(page) == 0:
+                break
+            pages.append([task.tid for task in page])
+            after_tid = page[-1].tid
+        self.assertEqual(sum(pages, []), sorted(tids))
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(
+            limit=4, after_tid=sorted(tids)[6], newest_first=True)], sorted(tids)[2:6][::-1])
+        self.assertEqual(self.storage_task.get_last_saved_task().tid, max(tids))
+
+    def test_subtask_stored_with_parent(self):
+        parent_tid = self.storage_task.save_task(_create_task(1, 'Parent'))
+        subtask_tid = self.storage_task.save_task(_create_task(2, 'Subtask', parent_tid))
+        self.assertEqual(_shard_of(subtask_tid), _shard_of(parent_tid))
+        self.assertEqual(self.router.shards_of_user(2), {0, 1})
+
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(2)
+        tasks = self.storage_task.get_tasks(filter)
+        self.assertEqual([(task.tid, task.parent_tid) for task in tasks], [(subtask_tid, parent_tid)])
+        filter = TaskStorageAdapter.Filter()
+        filter.parent_tid(parent_tid)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter)], [subtask_tid])
+        self.assertEqual([task.tid for task in self.storage_task.get_subtasks(parent_tid)], [subtask_tid])
+
+        self.assertEqual(self.storage_task.edit_subtasks(parent_tid, {Task.Field.status: Status.ACTIVE}), 1)
+        self.assertTrue(self.storage_task.edit_task({Task.Field.tid: subtask_tid, Task.Field.title: 'Edited'}))
+        other_tid = self.storage_task.save_task(_create_task(2, 'Other'))
+        with self.assertRaises(ValueError):
+            self.storage_task.edit_task({Task.Field.tid: subtask_tid, Task.Field.parent_tid: other_tid})
+
+        self.assertEqual(self.storage_task.remove_task(parent_tid), 2)
+        counts = self.storage_user.remove_user(2)
+        self.assertEqual(counts[Change.Entity.task], 1)
+        self.assertEqual(counts[Change.Entity.user], 1)
+        self.assertEqual(self.router.shards_of_user(2), {0})
+
+    def test_new_owner_becomes_guest_of_shard(self):
+        router = ShardRouter(_TEST_DB, TableShardMapping({1: 0, 2: 1}))
+        storage_task = TaskStorageAdapter(_TEST_DB, router)
+        first_tid = storage_task.save_task(_create_task(1, 'First'))
+        second_tid = storage_task.save_task(_create_task(1, 'Second'))
+
+        self.assertTrue(storage_task.edit_task({Task.Field.tid: first_tid, Task.Field.uid: 2}))
+        task = storage_task.get_tasks()[1]
+        task.uid = 2
+        self.assertTrue(storage_task.edit_task_from_model(task))
+
+        self.assertEqual(router.shards_of_user(2), {0, 1})
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(2)
+        self.assertEqual([task.tid for task in storage_task.get_tasks(filter)], [first_tid, second_tid])
+
+    def test_plans_stored_with_common_task(self):
+        tid = self.storage_task.save_task(_create_task(1))
+        plan = Plan()
+        plan.tid = tid
+        plan.shift = 10
+        plan.exclude = [2]
+        plan_id = self.storage_plan.save_plan(plan)
+        self.assertEqual(_shard_of(plan_id), _shard_of(tid))
+
+        edited_tid = self.storage_task.save_task(_create_task(1, 'Edited repeat'))
+        self.assertTrue(self.storage_plan.edit_plan_repeat(plan_id, 3, edited_tid))
+        self.assertEqual(self.storage_plan.get_tid_for_edit_repeat(plan_id, 3), edited_tid)
+        self.assertEqual(self.storage_plan.get_exclude_type(plan_id, 2), Plan.PlanExcludeKind.DELETED)
+        self.assertEqual([plan.plan_id for plan in self.storage_plan.get_plans(edit_repeat_tid=edited_tid)],
+                         [plan_id])
+
+        plans = self.storage_plan.get_plans(common_tid=tid)
+        self.assertEqual([(plan.plan_id, plan.tid, plan.exclude) for plan in plans], [(plan_id, tid, [2, 3])])
+        self.assertEqual([plan.plan_id for plan in self.storage_plan.get_plans()], [plan_id])
+        self.assertEqual(self.storage_plan.get_plans(plan_id=plan_id + sharded_adapters._MAX_SHARDS), [])
+
+        other_tid = self.storage_task.save_task(_create_task(2))
+        with self.assertRaises(ValueError):
+            self.storage_plan.edit_plan_repeat(plan_id, 4, other_tid)
+        self.assertTrue(self.storage_plan.remove_plan(plan_id))
+        self.assertEqual(self.storage_plan.get_plans(), [])
+
+    def test_statistics_summed_over_shards(self):
+        tasks = [_create_task(1), _create_task(2), _create_task(2)]
+        tasks[2].status = Status.COMPLETED
+        tasks[2].supposed_end_time = 150
+        tids = self.storage_task.save_tasks(tasks)
+        self.assertEqual(self.storage_task.count_tasks(), {(1, Status.PENDING, None): (2, 0),
+                                                           (1, Status.COMPLETED, None): (1, 0)})
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(1)
+        self.assertEqual(self.storage_task.count_tasks(filter), {(1, Status.PENDING, None): (1, 0)})
+        self.assertEqual(self.storage_task.count_completed_tasks(0, 200, 100), {100: 1})
+
+        self.assertTrue(self.storage_task.edit_task({Task.Field.tid: tids[0], Task.Field.supposed_start_time: 10,
+                                                     Task.Field.supposed_end_time: 15}))
+        plan = Plan()
+        plan.tid = tids[0]
+        plan.shift = 10
+        plan_id = self.storage_plan.save_plan(plan)
+        self.assertEqual(self.storage_plan.count_repeats(0, 95), {plan_id: 9})
+        self.assertEqual(self.storage_plan.count_repeats(0, 95, uid=2), {})
+
+    def test_transaction_covers_shards(self):
+        with self.assertRaises(ValueError):
+            with self.storage_task.transaction():
+                self.storage_task.save_task(_create_task(1, 'Rolled back'))
+                with self.storage_task.transaction():
+                    self.storage_task.save_task(_create_task(2, 'Rolled back'))
+                raise ValueError()
+
+        with self.storage_task.transaction():
+            self.storage_task.save_task(_create_task(1, 'Outer'))
+            with self.assertRaises(ValueError):
+                with self.storage_plan.transaction():
+                    self.storage_task.save_task(_create_task(2, 'Inner'))
+                    self.storage_task.save_task(_create_task(1, 'Inner'))
+                    raise ValueError()
+        self.assertEqual([task.title for task in self.storage_task.get_tasks()], ['Outer'])
+
+    def test_pool_closes_least_recently_used_shard(self):
+        router = ShardRouter(_TEST_DB, HashShardMapping(3), pool_size=1)
+        storage_task = TaskStorageAdapter(_TEST_DB, router)
+        tids = storage_task.save_tasks([_create_task(uid) for uid in range(3)])
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(2)
+        self.assertEqual(len(storage_task.get_tasks(filter)), 1)
+        self.assertEqual(list(router._pool()), [2])
+
+        tasks = storage_task.iterate_tasks()
+        next(tasks)
+        storage_task.get_tasks()
+        # shards read by unfinished iteration stay open
+        self.assertEqual(sorted(router._pool()), [0, 1, 2])
+        self.assertEqual(len(list(tasks)), 2)
+        storage_task.remove_task(tids[0])
+        self.assertEqual(list(router._pool()), [0])
+        self.assertIsNone(router._shards[1].db._local.connection)
+        self.assertEqual(len(storage_task.get_tasks()), 2)
+
+    def test_table_mapping(self):
+        mapping = TableShardMapping({1: 5, 2: 5}, HashShardMapping(2))
+        self.assertEqual([mapping(uid) for uid in (1, 2, 3, 4)], [5, 5, 1, 0])
+        self.assertEqual(mapping.shards(), [0, 1, 5])
+        router = ShardRouter(_TEST_DB, mapping)
+        tid = TaskStorageAdapter(_TEST_DB, router).save_task(_create_task(2))
+        self.assertEqual(_shard_of(tid), 5)
+        with self.assertRaises(ValueError):
+            ShardRouter(_TEST_DB, TableShardMapping({1: sharded_adapters._MAX_SHARDS}))
+
+class TestShardFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.directory.name, 'tasks.db')
+        self.mapping = sharded_adapters._shard_mapping
+
+    def test_shards_next_to_catalogue(self):
+        set_shard_mapping(HashShardMapping(2))
+        router = get_router(self.db_file)
+        self.assertIs(get_router(self.db_file), router)
+        TaskStorageAdapter(self.db_file).save_task(_create_task(1))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['tasks.db', 'tasks.shard1.db'])
+
+    def tearDown(self):
+        set_shard_mapping(self.mapping)
+        close_routers()
+        sqlite_adapters.close_databases()
+        self.directory.cleanup()
+
+class TestControllerWithShardedAdapters(unittest.TestCase):
+
+    def test_controllers_use_adapters(self):
+        controller = Controller()
+        controller.init_storage_adapters(PlanStorageAdapter, TaskStorageAdapter,
+                                         UserStorageAdapter, ProjectStorageAdapter, db_file=_TEST_DB)
+        self.assertIsInstance(controller._task_storage.db, ShardRouter)
+        self.assertIs(controller._task_storage.db, controller._user_storage.router)
+
+        first_uid = UserController(controller).save_user('first')
+        second_uid = UserController(controller).save_user('second')
+        controller.authentication(first_uid)
+        pid = ProjectController(controller).save_project('Shared')
+        ProjectController(controller).invite_user_to_project(pid, second_uid, admin=True)
+        parent_tid = TaskController(controller).save_task(pid=pid, title='Parent')
+
+        controller.authentication(second_uid)
+        TaskController(controller).save_task(pid=pid, title='Own')
+        TaskController(controller).save_task(pid=pid, title='Child', parent_tid=parent_tid)
+        self.assertEqual(sorted(task.title for task in TaskController(controller).fetch_tasks()),
+                         ['Child', 'Own'])
+        self.assertEqual(sorted(task.title for task in TaskController(controller).fetch_tasks(pid=pid)),
+                         ['Child', 'Own', 'Parent'])
+
+        own_tid = TaskController(controller).fetch_tasks(title='Own')[0].tid
+        self.assertNotEqual(_shard_of(own_tid), _shard_of(parent_tid))
+        with self.assertRaises(InvalidParentIdError):
+            TaskController(controller).edit_task(own_tid, parent_tid=parent_tid, title='Moved')
+        tasks = TaskController(controller).fetch_tasks(tid=own_tid)
+        self.assertEqual([(task.title, task.parent_tid) for task in tasks], [('Own', None)])
+
+        TaskController(controller).edit_task(parent_tid, status=Status.ACTIVE)
+        self.assertEqual([task.status for task in TaskController(controller).fetch_tasks(pid=pid, tid=parent_tid)],
+                         [Status.ACTIVE])
+        self.assertTrue(TaskController(controller).remove_task(parent_tid))
+        self.assertEqual([task.title for task in TaskController(controller).fetch_tasks(pid=pid)], ['Own'])
+
+class TestChangesWithShardedAdapters(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.controller.init_storage_adapters(PlanStorageAdapter, TaskStorageAdapter,
+                                              UserStorageAdapter, ProjectStorageAdapter, db_file=_TEST_DB)
+        self.first_uid = UserController(self.controller).save_user('first')
+        self.second_uid = UserController(self.controller).save_user('second')
+        self.controller.authentication(self.first_uid)
+        self.pid = ProjectController(self.controller).save_project('Shared')
+        ProjectController(self.controller).invite_user_to_project(self.pid, self.second_uid, admin=True)
+
+    def _save_task(self, uid, title):
+        self.controller.authentication(uid)
+        return TaskController(self.controller).save_task(pid=self.pid, title=title)
+
+    def test_changes_of_all_shards_have_one_revision(self):
+        first_tid = self._save_task(self.first_uid, 'First')
+        second_tid = self._save_task(self.second_uid, 'Second')
+        self.assertNotEqual(_shard_of(first_tid), _shard_of(second_tid))
+
+        changes = ChangeController(self.controller).fetch_changes()
+        task_changes = [(change.entity_id, change.kind) for change in changes if change.entity == Change.Entity.task]
+        self.assertEqual(task_changes, [(first_tid, Change.Kind.INSERT), (second_tid, Change.Kind.INSERT)])
+        revisions = [change.revision for change in changes]
+        self.assertEqual(revisions, sorted(set(revisions)))
+        self.assertEqual(ChangeController(self.controller).get_current_revision(), revisions[-1])
+
+    def test_change_of_any_shard_is_after_read_revision(self):
+        first_tid = self._save_task(self.first_uid, 'First')
+        self._save_task(self.second_uid, 'Second')
+        revision = ChangeController(self.controller).get_current_revision()
+
+        self.controller.authentication(self.first_uid)
+        TaskController(self.controller).edit_task(first_tid, title='Edited')
+        changes = ChangeController(self.controller).fetch_changes(revision)
+        self.assertEqual([(change.entity, change.entity_id, change.kind, change.fields) for change in changes],
+                         [(Change.Entity.task, first_tid, Change.Kind.UPDATE, [Task.Field.title])])
+        self.assertGreater(changes[0].revision, revision)
+        self.assertEqual(ChangeController(self.controller).fetch_changes(changes[0].revision), [])
+
+    def test_changes_of_other_users_are_not_fetched(self):
+        self.controller.authentication(self.second_uid)
+        own_tid = TaskController(self.controller).save_task(title='Own')
+        self._save_task(self.first_uid, 'Shared')
+
+        changes = ChangeController(self.controller).fetch_changes()
+        self.assertNotIn(own_tid, [change.entity_id for change in changes if change.entity == Change.Entity.task])
+        self.controller.authentication(self.second_uid)
+        changes = ChangeController(self.controller).fetch_changes(limit=100)
+        self.assertIn(own_tid, [change.entity_id for change in changes if change.entity == Change.Entity.task])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,161 +1,396 @@
-# import unittest
-# from tasktracker_server.storage.sqlite_adapters import TaskStorageAdapter
-# from tasktracker_server.model.task import Task
-# import os
-# import sqlite3
-
-# _TEST_DB = 'test_tasktracker.db'
-
-# class TestTask(unittest.TestCase):
-
-#     def setUp(self):
-#         self.storage = TaskStorageAdapter(_TEST_DB)
-#         self.storage.connect()
-
-#     def test_save_get_tasks(self):
-#         test_task = Task()
-#         test_task.title = 'vfdmk'
-#         test_task.description = 'vvkjndk'
-#         test_task.deadline_time = 23233
-        
-#         self.storage.save_task(test_task)
-#         self.storage.save_task(test_task)
-
-#         tasks_in_sqlite = self.storage.get_tasks()
-#         self.assertEqual(len(tasks_in_sqlite), 2)
-
-#         test_task.tid = 1
-#         self.assertEqual(tasks_in_sqlite[0], test_task)
-#         test_task.tid = 2
-#         self.assertEqual(tasks_in_sqlite[1], test_task)
-
-#     def test_save_get_title_filtered_tasks(self):
-#         test_task_1 = Task()
-#         test_task_1.title = 'vfdmk'
-#         test_task_1.description = 'vvkjndk'
-#         test_task_1.deadline_time = 23233
-
-#         test_task_2 = Task()
-#         test_task_2.title = 'lmlkmlkml'
-#         test_task_2.description = 'vvkjndk'
-#         test_task_2.deadline_time = 23233
-        
-#         self.storage.save_task(test_task_1)
-#         self.storage.save_task(test_task_2)
-#         self.storage.save_task(test_task_1)
-
-#         tasks_in_sqlite = self.storage.get_tasks({'title': 'vfdmk'})
-#         self.assertEqual(len(tasks_in_sqlite), 2)
-
-#         test_task_1.tid = 1
-#         self.assertEqual(tasks_in_sqlite[0], test_task_1)
-
-#         test_task_1.tid = 3
-#         self.assertEqual(tasks_in_sqlite[1], test_task_1)
-
-#     def test_save_get_title_tid_descr_filtered_tasks(self):
-#         test_task_1 = Task()
-#         test_task_1.title = 'vfdmk'
-#         test_task_1.description = 'vvkjndk'
-#         test_task_1.deadline_time = 23233
-
-#         test_task_2 = Task()
-#         test_task_2.title = 'lmlkmlkml'
-#         test_task_2.description = 'vvkjndk'
-#         test_task_2.deadline_time = 23233
-        
-#         self.storage.save_task(test_task_1)
-#         self.storage.save_task(test_task_2)
-#         self.storage.save_task(test_task_1)
-
-#         tasks_in_sqlite = self.storage.get_tasks({'title': 'vfdmk'})
-#         self.assertEqual(len(tasks_in_sqlite), 2)
-
-#         test_task_1.tid = 1
-#         self.assertEqual(tasks_in_sqlite[0], test_task_1)
-
-#         test_task_1.tid = 3
-#         self.assertEqual(tasks_in_sqlite[1], test_task_1)
-    
-#     def test_save_remove_get_tasks(self):
-#         test_task = Task()
-#         test_task.title = 'flkmerfkl'
-#         test_task.description = 'lkfmelkf'
-#         test_task.supposed_start_time = 232332
-#         test_task.supposed_end_time = 3423
-#         test_task.deadline_time = 2442324
-#         test_task.notificate_deadline = True
-
-#         self.storage.save_task(test_task)
-#         self.storage.save_task(test_task)
-
-#         tasks_in_db = self.storage.get_tasks()
-
-#         self.storage.remove_task(tasks_in_db[0].tid)
-
-#         tasks_in_db_after_delete = self.storage.get_tasks()
-
-#         self.assertEqual(len(tasks_in_db_after_delete), 1)
-#         self.assertEqual(tasks_in_db_after_delete[0], tasks_in_db[1])
-
-#     def test_save_edit_get_tasks(self):
-#         test_task = Task()
-#         test_task.title = 'flkmerfkl'
-#         test_task.description = 'lkfmelkf'
-#         test_task.supposed_start_time = 232332
-#         test_task.supposed_end_time = 3423
-#         test_task.deadline_time = 2442324
-#         test_task.notificate_deadline = True
-
-#         edited_test_task = Task()
-#         edited_test_task.title = 'efnkrjf'
-#         edited_test_task.description = '23323223'
-#         edited_test_task.supposed_start_time = 232332
-#         edited_test_task.supposed_end_time = 23443
-#         edited_test_task.deadline_time = 2442324
-#         edited_test_task.notificate_deadline = False
-
-#         self.storage.save_task(test_task)
-#         self.storage.save_task(test_task)
-
-#         tasks_in_db = self.storage.get_tasks()
-
-#         edited_test_task.tid = tasks_in_db[0].tid
-#         self.storage.edit_task(edited_test_task)
-
-#         tasks_in_db_after_edit = self.storage.get_tasks()
-
-#         self.assertEqual(len(tasks_in_db_after_edit), 2)
-#         self.assertEqual(tasks_in_db_after_edit[0], edited_test_task)
-#         self.assertEqual(tasks_in_db_after_edit[1], tasks_in_db[1])
-
-#     def test_delete_not_existing_task(self):
-#         pass
-
-#     def test_use_without_connection(self):
-#         self.storage.disconnect()
-
-#         connected = self.storage.is_connected()
-#         self.assertEqual(connected, False)
-
-#         with self.assertRaises(ValueError):
-#             self.storage.disconnect()
-
-#         with self.assertRaises(ValueError):
-#             self.storage.get_tasks()
-
-#         with self.assertRaises(ValueError):
-#             task = Task()
-#             self.storage.save_task(task)
-
-#         with self.assertRaises(ValueError):
-#             self.storage.remove_task(0)
-
-#         with self.assertRaises(ValueError):
-#             task = Task()
-#             self.storage.edit_task(task)
-
-#     def tearDown(self):
-#         if self.storage.is_connected():
-#             self.storage.disconnect()
-#         os.remove(_TEST_DB)
\ No newline at end of file
+import unittest
+import os
+import sqlite3
+import tempfile
+
+from tasktracker_core.storage.sqlite_adapters import TaskStorageAdapter, UserStorageAdapter, PlanStorageAdapter, ProjectStorageAdapter
+from tasktracker_core.storage import sqlite_adapters
+from tasktracker_core.storage import sqlite_peewee_adapters
+from tasktracker_core.requests.controllers import Controller, TaskController, UserController
+from tasktracker_core.model.task import Task, Status
+from tasktracker_core.model.user import User
+from tasktracker_core.model.plan import Plan
+from tasktracker_core.model.project import Project
+from tasktracker_core.model.change import Change
+
+_TEST_DB = ':memory:'
+
+def _create_adapters(module):
+    plan_storage = module.PlanStorageAdapter(_TEST_DB)
+    db = plan_storage.db
+    return (module.TaskStorageAdapter(_TEST_DB, db), module.UserStorageAdapter(_TEST_DB, db),
+            plan_storage, module.ProjectStorageAdapter(_TEST_DB, db))
+
+def _create_task(title='Title', parent_tid=None, start=None, end=None, deadline=None):
+    task = Task()
+    task.pid = 1
+    task.uid = 1
+    task.title = title
+    task.parent_tid = parent_tid
+    task.supposed_start_time = start
+    task.supposed_end_time = end
+    task.deadline_time = deadline
+    task.status = Status.PENDING
+    return task
+
+class TestAdapters(unittest.TestCase):
+
+    def setUp(self):
+        (self.storage_task, self.storage_user,
+         self.storage_plan, self.storage_project) = _create_adapters(sqlite_adapters)
+        self.storage_user.save_user(User())
+        project = Project()
+        project.creator = 1
+        project.name = 'Project'
+        self.storage_project.save_project(project)
+
+    def test_save_get_tasks(self):
+        task = _create_task(start=1, end=2)
+        task.notificate_deadline = True
+        self.assertEqual(self.storage_task.save_task(task), 1)
+        self.assertEqual(self.storage_task.save_tasks([_create_task(), _create_task()]), [2, 3])
+
+        tasks = self.storage_task.get_tasks()
+        self.assertEqual([saved_task.tid for saved_task in tasks], [1, 2, 3])
+        task.tid = 1
+        self.assertEqual(tasks[0].__dict__, task.__dict__)
+
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(limit=1, after_tid=1)], [2])
+        self.assertEqual([task.tid for task in self.storage_task.iterate_tasks(newest_first=True)], [3, 2, 1])
+
+    def test_filters(self):
+        self.storage_task.save_tasks([_create_task('Buy milk', start=0, end=4),
+                                      _create_task('Write report', deadline=10),
+                                      _create_task('Reply letters', start=20)])
+        filter = TaskStorageAdapter.Filter()
+        filter.filter_range(3, 12)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter)], [1, 2])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.overdue_by_time(11)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter)], [1, 2])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.text_search('rep*', [Task.Field.title])
+        filter.tid([1, 2, 3])
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter)], [2, 3])
+
+    def test_edit_task(self):
+        tid = self.storage_task.save_task(_create_task(start=0, end=4))
+        self.assertEqual(self.storage_task.edit_task({Task.Field.tid: tid, Task.Field.title: 'Edited',
+                                                      Task.Field.supposed_start_time: 10,
+                                                      Task.Field.supposed_end_time: 14}), True)
+        filter = TaskStorageAdapter.Filter()
+        filter.filter_range(12, 13)
+        tasks = self.storage_task.get_tasks(filter)
+        self.assertEqual([task.title for task in tasks], ['Edited'])
+        self.assertEqual(self.storage_task.edit_task({Task.Field.tid: 10}), False)
+
+    def test_remove_task_with_subtasks_and_plan(self):
+        self.storage_task.save_tasks([_create_task(), _create_task(parent_tid=1),
+                                      _create_task(parent_tid=2), _create_task(), _create_task()])
+        plan = Plan()
+        plan.tid = 2
+        plan.shift = 10
+        plan.exclude = [1]
+        plan_id = self.storage_plan.save_plan(plan)
+        self.storage_plan.edit_plan_repeat(plan_id, 3, 4)
+
+        self.assertEqual(self.storage_task.remove_task(1), 4)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks()], [5])
+        self.assertEqual(self.storage_plan.get_plans(), [])
+
+    def test_edit_subtasks(self):
+        self.storage_task.save_tasks([_create_task(), _create_task(parent_tid=1),
+                                      _create_task(parent_tid=2), _create_task(parent_tid=1)])
+        plan = Plan()
+        plan.tid = 4
+        plan.shift = 10
+        self.storage_plan.save_plan(plan)
+
+        self.assertEqual([task.tid for task in self.storage_task.get_subtasks(1, skip_plan_tasks=True)], [2, 3])
+        self.assertEqual(self.storage_task.edit_subtasks(1, {Task.Field.status: Status.ACTIVE, Task.Field.uid: 2},
+                                                         skip_plan_tasks=True), 2)
+        self.assertEqual([(task.status, task.uid) for task in self.storage_task.get_subtasks(1)],
+                         [(Status.ACTIVE, 2), (Status.ACTIVE, 2), (Status.PENDING, 1)])
+
+    def test_edit_subtasks_skips_common_task_subtree(self):
+        self.storage_task.save_tasks([_create_task(), _create_task(parent_tid=1), _create_task(parent_tid=2),
+                                      _create_task(parent_tid=1)])
+        plan = Plan()
+        plan.tid = 2
+        plan.shift = 10
+        self.storage_plan.save_plan(plan)
+        self.storage_plan.edit_plan_repeat(1, 1, 4)
+
+        self.assertEqual([task.tid for task in self.storage_task.get_subtasks(1, skip_plan_tasks=True)], [4])
+        self.assertEqual(self.storage_task.edit_subtasks(1, {Task.Field.status: Status.ACTIVE},
+                                                         skip_plan_tasks=True), 1)
+        self.assertEqual([task.status for task in self.storage_task.get_subtasks(1)],
+                         [Status.PENDING, Status.PENDING, Status.ACTIVE])
+
+    def test_plan_excludes(self):
+        self.storage_task.save_tasks([_create_task(), _create_task()])
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 10
+        plan.exclude = [2, 3, 4]
+        plan_id = self.storage_plan.save_plan(plan)
+        self.storage_plan.edit_plan_repeat(plan_id, 6, 2)
+
+        self.assertEqual(self.storage_plan.get_exclude_type(plan_id, 2), Plan.PlanExcludeKind.DELETED)
+        self.assertEqual(self.storage_plan.get_tid_for_edit_repeat(plan_id, 6), 2)
+        self.assertEqual(self.storage_plan.get_number_for_edit_repeat_by_tid(plan_id, 2), 6)
+        self.assertEqual(self.storage_plan.get_plans(edit_repeat_tid=2)[0].plan_id, plan_id)
+
+        self.storage_plan.edit_plan({Plan.Field.plan_id: plan_id, Plan.Field.shift: 20})
+        self.assertEqual(self.storage_plan.get_plans(common_tid=1)[0].exclude, [1, 2, 3])
+
+        self.storage_plan.recalculate_exclude_when_start_time_shifted(plan_id, 40)
+        self.assertEqual(self.storage_plan.get_plans(plan_id=plan_id)[0].exclude, [0, 1])
+
+    def test_users(self):
+        user = User()
+        user.login = 'login'
+        self.assertEqual(self.storage_user.save_user(user), 2)
+        self.assertEqual(self.storage_user.check_user_existence('login'), True)
+        self.assertEqual(self.storage_user.edit_user({User.Field.uid: 2, User.Field.online: True}), True)
+
+        filter = UserStorageAdapter.Filter()
+        filter.online(True)
+        users = self.storage_user.get_users(filter)
+        self.assertEqual([(user.uid, user.login, user.online) for user in users], [(2, 'login', True)])
+
+        self.storage_task.save_tasks([_create_task(), _create_task(parent_tid=1)])
+        self.assertEqual(self.storage_user.delete_user(1), True)
+        self.assertEqual(self.storage_task.get_tasks(), [])
+
+    def test_projects(self):
+        self.storage_user.save_user(User())
+        self.storage_user.save_user(User())
+        project = Project()
+        project.creator = 2
+        project.name = 'Own'
+        self.storage_project.save_project(project)
+        self.storage_project.add_guest_to_project(1, 2)
+        self.storage_project.add_admin_to_project(1, 3)
+
+        projects = self.storage_project.get_projects(2)
+        self.assertEqual([(project.pid, project.admins, project.guests) for project in projects],
+                         [(2, None, None), (1, [3], [2])])
+        self.assertEqual(self.storage_project.get_user_kind(1, 2), Project.UserKind.GUEST)
+
+        task = _create_task()
+        task.uid = 3
+        self.storage_task.save_task(task)
+        self.assertEqual(self.storage_project.remove_admin_from_project(1, 3), True)
+        self.assertEqual(self.storage_task.get_tasks()[0].uid, 1)
+        self.assertEqual(self.storage_project.remove_guest_from_project(1, 2), True)
+        self.assertEqual(self.storage_project.get_projects(2, name='Project'), [])
+
+    def test_remove_user_and_projects(self):
+        self.storage_user.save_user(User())
+        project = Project()
+        project.creator = 2
+        self.storage_project.save_project(project)
+        self.storage_project.add_guest_to_project(1, 2)
+
+        task = _create_task()
+        task.uid = 2
+        task.pid = 2
+        self.storage_task.save_tasks([_create_task(), _create_task(parent_tid=1), task])
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 10
+        plan.exclude = [1]
+        self.storage_plan.save_plan(plan)
+
+        self.assertEqual(self.storage_project.remove_projects([2]),
+                         {Change.Entity.task: 1, Change.Entity.plan: 0, Change.Entity.plan_relations: 0,
+                          Change.Entity.project_relations: 0, Change.Entity.project: 1})
+        self.assertEqual(self.storage_user.remove_user(2),
+                         {Change.Entity.task: 0, Change.Entity.plan: 0, Change.Entity.plan_relations: 0,
+                          Change.Entity.project_relations: 1, Change.Entity.user: 1})
+        self.assertEqual(self.storage_task.remove_tasks(uid=1),
+                         {Change.Entity.task: 2, Change.Entity.plan: 1, Change.Entity.plan_relations: 2})
+        self.assertEqual(self.storage_task.get_tasks(), [])
+        self.assertEqual([user.uid for user in self.storage_user.get_users()], [1])
+
+    def test_archive_tasks_and_plans(self):
+        tasks = [_create_task('Done', end=100), _create_task(parent_tid=1), _create_task('Planned', end=100),
+                 _create_task('Later', end=5000)]
+        for task in tasks:
+            task.status = Status.COMPLETED
+        self.storage_task.save_tasks(tasks)
+        plan = Plan()
+        plan.tid = 3
+        plan.shift = 10
+        plan.end = 200
+        plan.exclude = [1]
+        self.storage_plan.save_plan(plan)
+
+        self.assertEqual(self.storage_plan.archive_plans(1000),
+                         {Change.Entity.task: 1, Change.Entity.plan: 1, Change.Entity.plan_relations: 2})
+        self.assertEqual(self.storage_task.archive_tasks(1000), 2)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks()], [4])
+        self.assertEqual([(task.tid, task.title, task.parent_tid, task.supposed_end_time)
+                          for task in self.storage_task.get_tasks(include_archived=True)],
+                         [(1, 'Done', None, 100), (2, 'Title', 1, None), (3, 'Planned', None, 100),
+                          (4, 'Later', None, 5000)])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.filter_range(50, 150)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter, include_archived=True)],
+                         [1, 3, 4])
+        filter = TaskStorageAdapter.Filter()
+        filter.text_search('done')
+        self.assertEqual(self.storage_task.get_tasks(filter, include_archived=True), [])
+
+        self.assertEqual(self.storage_task.save_task(_create_task()), 5)
+        self.assertEqual(self.storage_task.remove_tasks(uid=1)[Change.Entity.task], 5)
+
+    def test_snapshot_and_read_only_database(self):
+        self.storage_task.save_tasks([_create_task('Task {}'.format(i)) for i in range(100)])
+        descriptor, snapshot_file = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+        profile = sqlite_peewee_adapters.get_engine_profile()
+        try:
+            self.assertGreater(self.storage_task.snapshot(snapshot_file, pages=2), 1)
+            sqlite_peewee_adapters.set_engine_profile('read_only')
+            storage_task = TaskStorageAdapter(snapshot_file)
+            self.assertEqual(len(storage_task.get_tasks()), 100)
+            with self.assertRaises(sqlite3.OperationalError):
+                storage_task.save_task(_create_task())
+        finally:
+            sqlite_peewee_adapters.set_engine_profile(profile)
+            sqlite_adapters.close_databases()
+            os.remove(snapshot_file)
+
+    def test_change_log(self):
+        self.assertEqual(self.storage_task.current_revision(), 2)
+        self.storage_user.save_user(User())
+        self.storage_task.save_tasks([_create_task(), _create_task()])
+        self.storage_task.edit_task({Task.Field.tid: 1, Task.Field.title: 'Edited'})
+        self.storage_task.edit_task({Task.Field.tid: 2, Task.Field.title: 'Title'})
+        self.storage_task.remove_task(2)
+
+        changes = self.storage_task.get_changes(2)
+        self.assertEqual([(change.revision, change.entity, change.entity_id, change.kind, change.uid, change.pid)
+                          for change in changes],
+                         [(3, Change.Entity.user, 2, Change.Kind.INSERT, 2, None),
+                          (4, Change.Entity.task, 1, Change.Kind.INSERT, 1, 1),
+                          (5, Change.Entity.task, 2, Change.Kind.INSERT, 1, 1),
+                          (6, Change.Entity.task, 1, Change.Kind.UPDATE, 1, 1),
+                          (7, Change.Entity.task, 2, Change.Kind.DELETE, 1, 1)])
+        self.assertEqual(changes[3].fields, [Task.Field.title])
+        self.assertEqual(changes[4].fields, [])
+        self.assertEqual(self.storage_task.current_revision(), 7)
+        self.assertEqual([change.revision for change in self.storage_task.get_changes(3, limit=2)], [4, 5])
+
+        self.assertEqual([change.revision for change in self.storage_task.get_changes(uid=2)], [3])
+        self.storage_project.add_guest_to_project(1, 2)
+        self.assertEqual([change.revision for change in self.storage_task.get_changes(uid=2)],
+                         [2, 3, 4, 5, 6, 7, 8])
+
+    def test_rolled_back_changes_are_not_logged(self):
+        revision = self.storage_task.current_revision()
+        with self.assertRaises(ValueError):
+            with self.storage_task.transaction():
+                self.storage_task.save_task(_create_task())
+                raise ValueError()
+        self.assertEqual(self.storage_task.get_changes(revision), [])
+
+    def test_transaction(self):
+        with self.storage_task.transaction():
+            self.storage_task.save_task(_create_task('Outer'))
+            with self.assertRaises(ValueError):
+                with self.storage_plan.transaction():
+                    self.storage_task.save_task(_create_task('Inner'))
+                    raise ValueError()
+        with self.assertRaises(ValueError):
+            with self.storage_task.transaction():
+                self.storage_task.save_task(_create_task('Rolled back'))
+                raise ValueError()
+        self.assertEqual([task.title for task in self.storage_task.get_tasks()], ['Outer'])
+
+class TestAdaptersMatchPeeweeAdapters(unittest.TestCase):
+
+    def _run_scenario(self, module):
+        storage_task, storage_user, storage_plan, storage_project = _create_adapters(module)
+        storage_user.save_user(User())
+        project = Project()
+        project.creator = 1
+        storage_project.save_project(project)
+
+        storage_task.save_tasks([_create_task('Task {}'.format(number), parent_tid=number // 3 or None,
+                                              start=number * 10, end=number * 10 + 25)
+                                 for number in range(30)])
+        storage_task.save_task(_create_task('Timeless task'))
+        storage_task.remove_task(5)
+        plan = Plan()
+        plan.tid = 7
+        plan.shift = 10
+        plan.exclude = [2, 4, 6, 9]
+        plan_id = storage_plan.save_plan(plan)
+        storage_plan.edit_plan_repeat(plan_id, 3, 8)
+        storage_plan.edit_plan({Plan.Field.plan_id: plan_id, Plan.Field.shift: 20})
+        storage_plan.recalculate_exclude_when_start_time_shifted(plan_id, 40)
+
+        results = []
+        for configure in (lambda filter: filter.filter_range(100, 150),
+                          lambda filter: filter.overdue_by_time(200),
+                          lambda filter: filter.to_time(120),
+                          lambda filter: filter.timeless(),
+                          lambda filter: filter.parent_tid(2),
+                          lambda filter: filter.text_search('task')):
+            filter = module.TaskStorageAdapter.Filter()
+            configure(filter)
+            results.append([task.__dict__ for task in storage_task.get_tasks(filter)])
+        results.append([task.__dict__ for task in storage_task.get_tasks(limit=5, after_tid=20,
+                                                                          newest_first=True)])
+        results.append([plan.__dict__ for plan in storage_plan.get_plans(common_tid=7)])
+        results.append([project.__dict__ for project in storage_project.get_projects(1)])
+        results.append([change.__dict__ for change in storage_task.get_changes()])
+
+        for tid in (3, 4, 12):
+            storage_task.edit_task({Task.Field.tid: tid, Task.Field.status: Status.COMPLETED})
+        storage_task.archive_tasks(100)
+        filter = module.TaskStorageAdapter.Filter()
+        filter.text_search('task')
+        results.append(storage_task.count_tasks(overdue_time=200))
+        results.append(storage_task.count_tasks(filter, include_archived=True))
+        results.append(storage_task.count_completed_tasks(0, 200, 30))
+        for start_time, end_time in ((0, 1000), (95, 180), (-50, 10), (130, 131)):
+            results.append(storage_plan.count_repeats(start_time, end_time))
+        return results
+
+    def test_same_results(self):
+        self.assertEqual(self._run_scenario(sqlite_adapters), self._run_scenario(sqlite_peewee_adapters))
+
+def _save_controller_tasks(controller):
+    '''Saves user with parent and child tasks through controllers, returns uid'''
+    uid = UserController(controller).save_user('user')
+    controller.authentication(uid)
+    start = 4102444800000
+    tid = TaskController(controller).save_task(title='Parent', supposed_start=start,
+                                               supposed_end=start + 10)
+    TaskController(controller).save_task(title='Child', parent_tid=tid)
+    TaskController(controller).edit_task(tid, status=Status.ACTIVE)
+    return uid
+
+def _check_controller_tasks(test, controller):
+    tasks = TaskController(controller).fetch_tasks(title='child')
+    test.assertEqual([(task.title, task.status) for task in tasks], [('Child', Status.ACTIVE)])
+
+class TestControllerWithAdapters(unittest.TestCase):
+
+    def test_controllers_use_adapters(self):
+        controller = Controller()
+        controller.init_storage_adapters(PlanStorageAdapter, TaskStorageAdapter,
+                                         UserStorageAdapter, ProjectStorageAdapter, db_file=_TEST_DB)
+        self.assertIsInstance(controller._task_storage, TaskStorageAdapter)
+        self.assertIs(controller._task_storage.db, controller._user_storage.db)
+        self.assertIs(controller._task_storage.db, controller._project_storage.db)
+
+        _save_controller_tasks(controller)
+        _check_controller_tasks(self, controller)
@@ -1,9 +1,23 @@
 import unittest
 import os
 import datetime
+import sqlite3
+import logging
+import multiprocessing
+import tempfile
+import threading
+from unittest import mock
+
+from peewee import OperationalError
 
 from tasktracker_core.storage.sqlite_peewee_adapters import TaskStorageAdapter, UserStorageAdapter, PlanStorageAdapter, ProjectStorageAdapter
-from tasktracker_core.model.task import Task
+from tasktracker_core.storage.sqlite_peewee_adapters import SCHEMA_VERSION, get_schema_version
+from tasktracker_core.storage.sqlite_peewee_adapters import get_database, close_databases
+from tasktracker_core.storage.sqlite_peewee_adapters import EngineProfile, set_engine_profile, get_engine_profile
+from tasktracker_core.storage.sqlite_peewee_adapters import open_connection, close_connections
+from tasktracker_core.storage.sqlite_peewee_adapters import TaskTableModel, PlanRelationsTableModel
+from tasktracker_core.storage import sqlite_peewee_adapters
+from tasktracker_core.model.task import Task, Status, Priority
 from tasktracker_core.model.user import User
 from tasktracker_core.model.plan import Plan
 from tasktracker_core.model.project import Project
@@ -33,10 +47,10 @@ class TestTask(unittest.TestCase):
         test_task.description = 'vvkjndk'
         test_task.deadline_time = 23233
         
-        success = self.storage.save_task(test_task)
-        self.assertEqual(success, True)
-        success = self.storage.save_task(test_task)
-        self.assertEqual(success, True)
+        tid = self.storage.save_task(test_task)
+        self.assertEqual(tid, 1)
+        tid = self.storage.save_task(test_task)
+        self.assertEqual(tid, 2)
 
         tasks_in_sqlite = self.storage.get_tasks()
         self.assertEqual(len(tasks_in_sqlite), 2)
@@ -59,12 +73,12 @@ class TestTask(unittest.TestCase):
         test_task_2.description = 'vvkjndk'
         test_task_2.deadline_time = 23233
         
-        success = self.storage.save_task(test_task_1)
-        self.assertEqual(success, True)
-        success = self.storage.save_task(test_task_2)
-        self.assertEqual(success, True)
-        success = self.storage.save_task(test_task_1)
-        self.assertEqual(success, True)
+        tid = self.storage.save_task(test_task_1)
+        self.assertEqual(tid, 1)
+        tid = self.storage.save_task(test_task_2)
+        self.assertEqual(tid, 2)
+        tid = self.storage.save_task(test_task_1)
+        self.assertEqual(tid, 3)
 
         filter = TaskStorageAdapter.Filter()
         filter.title('vfdmk')
@@ -96,12 +110,12 @@ class TestTask(unittest.TestCase):
         test_task_3.description = 'vvkjndk232332'
         test_task_3.deadline_time = 23233
         
-        success = self.storage.save_task(test_task_1)
-        self.assertEqual(success, True)
-        success = self.storage.save_task(test_task_2)
-        self.assertEqual(success, True)
-        success = self.storage.save_task(test_task_3)
-        self.assertEqual(success, True)
+        tid = self.storage.save_task(test_task_1)
+        self.assertEqual(tid, 1)
+        tid = self.storage.save_task(test_task_2)
+        self.assertEqual(tid, 2)
+        tid = self.storage.save_task(test_task_3)
+        self.assertEqual(tid, 3)
 
         filter = TaskStorageAdapter.Filter()
         filter.title('vfdmk')
@@ -119,10 +133,10 @@ class TestTask(unittest.TestCase):
         test_task_1.description = 'vvkjndk'
         test_task_1.deadline_time = 23233
 
-        success = self.storage.save_task(test_task_1)
-        self.assertEqual(success, True)
-        success = self.storage.save_task(test_task_1)
-        self.assertEqual(success, True)
+        tid = self.storage.save_task(test_task_1)
+        self.assertEqual(tid, 1)
+        tid = self.storage.save_task(test_task_1)
+        self.assertEqual(tid, 2)
 
         filter = TaskStorageAdapter.Filter()
         filter.title('2344243')
@@ -171,10 +185,10 @@ class TestTask(unittest.TestCase):
         edited_test_task.deadline_time = 2442324
         edited_test_task.notificate_deadline = False
 
-        success = self.storage.save_task(test_task)
-        self.assertEqual(success, True)
-        success = self.storage.save_task(test_task)
-        self.assertEqual(success, True)
+        tid = self.storage.save_task(test_task)
+        self.assertEqual(tid, 1)
+        tid = self.storage.save_task(test_task)
+        self.assertEqual(tid, 2)
 
         tasks_in_db = self.storage.get_tasks()
 
@@ -284,8 +298,8 @@ class TestTaskParentTid(unittest.TestCase):
         self.storage.save_task(test_task_3)
         self.storage.save_task(test_task_4)
 
-        success = self.storage.remove_task(1)
-        self.assertEqual(success, True)
+        removed_count = self.storage.remove_task(1)
+        self.assertEqual(removed_count, 3)
 
         tasks_in_db = self.storage.get_tasks()
         self.assertEqual(len(tasks_in_db), 1)
@@ -326,8 +340,8 @@ class TestTaskParentTid(unittest.TestCase):
         self.storage.save_task(test_task_3)
         self.storage.save_task(test_task_4)
 
-        success = self.storage.remove_task(1)
-        self.assertEqual(success, True)
+        removed_count = self.storage.remove_task(1)
+        self.assertEqual(removed_count, 4)
 
         tasks_in_db = self.storage.get_tasks()
         self.assertEqual(len(tasks_in_db), 0)
@@ -346,10 +360,10 @@ class TestUser(unittest.TestCase):
         test_user.login = 'new login'
         test_user.password = '12345667'
         
-        success = self.storage.save_user(test_user)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user)
-        self.assertEqual(success, True)
+        uid = self.storage.save_user(test_user)
+        self.assertEqual(uid, 1)
+        uid = self.storage.save_user(test_user)
+        self.assertEqual(uid, 2)
 
         users_in_db = self.storage.get_users()
         self.assertEqual(len(users_in_db), 2)
@@ -368,12 +382,12 @@ class TestUser(unittest.TestCase):
         test_user_2.login = 'second login'
         test_user_2.password = '12345667'
         
-        success = self.storage.save_user(test_user_1)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user_2)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user_1)
-        self.assertEqual(success, True)
+        uid = self.storage.save_user(test_user_1)
+        self.assertEqual(uid, 1)
+        uid = self.storage.save_user(test_user_2)
+        self.assertEqual(uid, 2)
+        uid = self.storage.save_user(test_user_1)
+        self.assertEqual(uid, 3)
 
         filter = UserStorageAdapter.Filter()
         filter.login('first login')
@@ -402,12 +416,12 @@ class TestUser(unittest.TestCase):
         test_user_3.password = '12345667'
         test_user_3.online = True
 
-        success = self.storage.save_user(test_user_1)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user_2)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user_3)
-        self.assertEqual(success, True)
+        uid = self.storage.save_user(test_user_1)
+        self.assertEqual(uid, 1)
+        uid = self.storage.save_user(test_user_2)
+        self.assertEqual(uid, 2)
+        uid = self.storage.save_user(test_user_3)
+        self.assertEqual(uid, 3)
 
         filter = UserStorageAdapter.Filter()
         filter.login('second login')
@@ -424,10 +438,10 @@ class TestUser(unittest.TestCase):
         test_user_1.password = '12345667'
         test_user_1.online = True
 
-        success = self.storage.save_user(test_user_1)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user_1)
-        self.assertEqual(success, True)
+        uid = self.storage.save_user(test_user_1)
+        self.assertEqual(uid, 1)
+        uid = self.storage.save_user(test_user_1)
+        self.assertEqual(uid, 2)
 
         filter = UserStorageAdapter.Filter()
         filter.login('first login')
@@ -441,10 +455,10 @@ class TestUser(unittest.TestCase):
         test_user.password = '12345667'
         test_user.online = True
 
-        success = self.storage.save_user(test_user)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user)
-        self.assertEqual(success, True)
+        uid = self.storage.save_user(test_user)
+        self.assertEqual(uid, 1)
+        uid = self.storage.save_user(test_user)
+        self.assertEqual(uid, 2)
 
         users_in_db = self.storage.get_users()
 
@@ -468,10 +482,10 @@ class TestUser(unittest.TestCase):
         edited_test_user.password = '12345667'
         edited_test_user.online = False
 
-        success = self.storage.save_user(test_user)
-        self.assertEqual(success, True)
-        success = self.storage.save_user(test_user)
-        self.assertEqual(success, True)
+        uid = self.storage.save_user(test_user)
+        self.assertEqual(uid, 1)
+        uid = self.storage.save_user(test_user)
+        self.assertEqual(uid, 2)
 
         users_in_db = self.storage.get_users()
 
@@ -933,3 +947,1236 @@ class TestPlan(unittest.TestCase):
 
     # def tearDown(self):
     #     os.remove(_TEST_DB)
+
+
+class _QueryCounter(logging.Handler):
+    '''Counts sql queries which peewee logs on debug level'''
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+    def __enter__(self):
+        self._logger = logging.getLogger('peewee')
+        self._level = self._logger.level
+        self._logger.setLevel(logging.DEBUG)
+        self._logger.addHandler(self)
+        return self
+
+    def __exit__(self, *args):
+        self._logger.removeHandler(self)
+        self._logger.setLevel(self._level)
+
+class TestQueryCount(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+    def test_get_tasks_query_count_is_constant(self):
+        for i in range(20):
+            task = Task()
+            task.pid = 1
+            task.uid = 1
+            task.title = 'Title {}'.format(i)
+            self.storage_task.save_task(task)
+
+        with _QueryCounter() as counter:
+            tasks = self.storage_task.get_tasks()
+        self.assertEqual(len(tasks), 20)
+        self.assertEqual(tasks[0].pid, 1)
+        self.assertEqual(tasks[0].uid, 1)
+        self.assertEqual(counter.count, 1)
+
+    def test_statistics_query_count_is_constant(self):
+        storage_plan = PlanStorageAdapter(_TEST_DB)
+        for i in range(20):
+            task = Task()
+            task.pid = 1
+            task.uid = 1
+            task.status = i % 3
+            task.supposed_end_time = i * 10
+            self.storage_task.save_task(task)
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 10
+        storage_plan.save_plan(plan)
+
+        with _QueryCounter() as counter:
+            counts = self.storage_task.count_tasks(overdue_time=100)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(sum(count for count, _ in counts.values()), 20)
+        with _QueryCounter() as counter:
+            self.storage_task.count_completed_tasks(0, 200, 50)
+        self.assertEqual(counter.count, 2)
+        with _QueryCounter() as counter:
+            self.assertEqual(storage_plan.count_repeats(0, 95), {1: 10})
+        self.assertEqual(counter.count, 1)
+
+    def test_get_projects_reads_raw_user_ids(self):
+        self.storage_project.add_admin_to_project(1, 1)
+
+        projects = self.storage_project.get_projects(1)
+        self.assertEqual(projects[0].creator, 1)
+        self.assertEqual(projects[0].admins, [1])
+
+    def test_get_projects_query_count_is_constant(self):
+        for login in ['second', 'third']:
+            user = User()
+            user.login = login
+            self.storage_user.save_user(user)
+
+        for i in range(10):
+            project = Project()
+            project.creator = 2
+            project.name = 'Project {}'.format(i)
+            pid = self.storage_project.save_project(project)
+            self.storage_project.add_admin_to_project(pid, 3)
+            if i % 2 == 0:
+                self.storage_project.add_guest_to_project(pid, 1)
+        self.storage_project.add_guest_to_project(2, 3)
+
+        with _QueryCounter() as counter:
+            projects = self.storage_project.get_projects(1)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual([project.pid for project in projects], [1, 2, 4, 6, 8, 10])
+        self.assertEqual(projects[0].admins, None)
+        self.assertEqual(projects[1].admins, [3])
+        self.assertEqual(projects[1].guests, [1, 3])
+
+        with _QueryCounter() as counter:
+            projects = self.storage_project.get_projects(3, name='Project 3')
+        self.assertEqual(counter.count, 1)
+        self.assertEqual([project.pid for project in projects], [5])
+
+def _open_and_get_schema_version(db_file):
+    return get_schema_version(TaskStorageAdapter(db_file).db)
+
+class TestSchemaMigration(unittest.TestCase):
+
+    _LEGACY_SCHEMA = [
+        'CREATE TABLE "user" ("uid" INTEGER NOT NULL PRIMARY KEY, "login" TEXT, "password" TEXT, "online" INTEGER)',
+        'CREATE TABLE "project" ("pid" INTEGER NOT NULL PRIMARY KEY, "creator_id" INTEGER NOT NULL, "name" TEXT)',
+        'CREATE TABLE "project_relations" ("relation_id" INTEGER NOT NULL PRIMARY KEY, "pid_id" INTEGER NOT NULL, "uid_id" INTEGER NOT NULL, "kind" INTEGER NOT NULL)',
+        ('CREATE TABLE "task" ("tid" INTEGER NOT NULL PRIMARY KEY, "pid_id" INTEGER NOT NULL, "uid_id" INTEGER, '
+            '"title" TEXT, "description" TEXT, "supposed_start_time" INTEGER, "supposed_end_time" INTEGER, '
+            '"deadline_time" INTEGER, "parent_tid" INTEGER, "priority" INTEGER, "status" INTEGER, '
+            '"notificate_supposed_start" INTEGER NOT NULL, "notificate_supposed_end" INTEGER NOT NULL, '
+            '"notificate_deadline" INTEGER NOT NULL, "is_plan" INTEGER)'),
+        'CREATE TABLE "plan" ("plan_id" INTEGER NOT NULL PRIMARY KEY, "end" INTEGER, "shift" INTEGER NOT NULL)',
+        'CREATE TABLE "plan_relations" ("relation_id" INTEGER NOT NULL PRIMARY KEY, "plan_id" INTEGER NOT NULL, "tid_id" INTEGER, "number" INTEGER, "kind" INTEGER)',
+        'INSERT INTO "user" ("uid", "login") VALUES (1, \'legacy\')',
+        'INSERT INTO "project" ("pid", "creator_id", "name") VALUES (1, 1, \'Default\')',
+        ('INSERT INTO "task" ("tid", "pid_id", "uid_id", "title", "notificate_supposed_start", '
+            '"notificate_supposed_end", "notificate_deadline") VALUES (1, 1, 1, \'legacy task\', 0, 0, 0)'),
+    ]
+
+    def setUp(self):
+        descriptor, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+        connection = sqlite3.connect(self.db_file)
+        for statement in self._LEGACY_SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+
+    def test_legacy_database_migrated(self):
+        storage = TaskStorageAdapter(self.db_file)
+        self.assertEqual(get_schema_version(storage.db), SCHEMA_VERSION)
+
+        task_indexes = [index.columns for index in storage.db.get_indexes('task')]
+        self.assertIn(['parent_tid'], task_indexes)
+        self.assertIn(['uid_id', 'status'], task_indexes)
+        plan_relations_indexes = [index.columns for index in storage.db.get_indexes('plan_relations')]
+        self.assertIn(['plan_id', 'kind'], plan_relations_indexes)
+        self.assertIn(['tid_id', 'kind'], plan_relations_indexes)
+        project_relations_indexes = [index.columns for index in storage.db.get_indexes('project_relations')]
+        self.assertIn(['uid_id', 'kind'], project_relations_indexes)
+        self.assertNotIn(['uid_id', 'right_border'], task_indexes)
+        self.assertIn(['pid_id', 'left_border'], task_indexes)
+
+        tasks = storage.get_tasks()
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].title, 'legacy task')
+
+    def test_legacy_tasks_indexed(self):
+        connection = sqlite3.connect(self.db_file)
+        connection.execute('INSERT INTO "task" ("tid", "pid_id", "uid_id", "title", "supposed_end_time", '
+            '"deadline_time", "notificate_supposed_start", "notificate_supposed_end", "notificate_deadline") '
+            'VALUES (2, 1, 1, \'timed task\', 20, 30, 0, 0, 0)')
+        connection.commit()
+        connection.close()
+
+        storage = TaskStorageAdapter(self.db_file)
+        cursor = storage.db.execute_sql('SELECT tid, left_border, right_border FROM task ORDER BY tid')
+        self.assertEqual(cursor.fetchall(), [(1, None, None), (2, 20, 30)])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.text_search('timed')
+        self.assertEqual([task.tid for task in storage.get_tasks(filter)], [2])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.filter_range(25, 40)
+        self.assertEqual([task.tid for task in storage.get_tasks(filter)], [2])
+
+    def test_legacy_rows_are_not_logged(self):
+        storage = TaskStorageAdapter(self.db_file)
+        self.assertEqual(storage.current_revision(), 0)
+
+        storage.edit_task({Task.Field.tid: 1, Task.Field.title: 'edited task'})
+        changes = storage.get_changes(uid=1)
+        self.assertEqual([(change.revision, change.entity, change.entity_id, change.fields) for change in changes],
+                         [(1, 'task', 1, [Task.Field.title])])
+
+    def test_migrated_database_not_migrated_twice(self):
+        TaskStorageAdapter(self.db_file)
+        close_databases()
+        storage = TaskStorageAdapter(self.db_file)
+        self.assertEqual(get_schema_version(storage.db), SCHEMA_VERSION)
+        cursor = storage.db.execute_sql('SELECT version FROM schema_version ORDER BY version')
+        self.assertEqual(cursor.fetchall(), [(version, ) for version in range(1, SCHEMA_VERSION + 1)])
+
+    def test_concurrent_opening_migrates_once(self):
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(2) as pool:
+            versions = pool.map(_open_and_get_schema_version, [self.db_file] * 2)
+        self.assertEqual(versions, [SCHEMA_VERSION] * 2)
+
+        connection = sqlite3.connect(self.db_file)
+        try:
+            rows = connection.execute('SELECT version FROM schema_version ORDER BY version').fetchall()
+        finally:
+            connection.close()
+        self.assertEqual(rows, [(version, ) for version in range(1, SCHEMA_VERSION + 1)])
+
+    def tearDown(self):
+        close_databases()
+        os.remove(self.db_file)
+
+class TestDatabaseRegistry(unittest.TestCase):
+
+    def setUp(self):
+        descriptor, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+
+    def test_adapters_share_database(self):
+        task_storage = TaskStorageAdapter(self.db_file)
+        user_storage = UserStorageAdapter(self.db_file)
+        self.assertIs(task_storage.db, user_storage.db)
+        self.assertIs(get_database(self.db_file), task_storage.db)
+
+    def test_schema_checked_once(self):
+        TaskStorageAdapter(self.db_file)
+        with _QueryCounter() as counter:
+            PlanStorageAdapter(self.db_file)
+            ProjectStorageAdapter(self.db_file)
+        self.assertEqual(counter.count, 0)
+
+    def test_memory_database_not_shared(self):
+        self.assertIsNot(get_database(':memory:'), get_database(':memory:'))
+
+    def tearDown(self):
+        close_databases()
+        os.remove(self.db_file)
+
+class TestThreadConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.db_files = []
+        for _ in range(2):
+            descriptor, db_file = tempfile.mkstemp(suffix='.db')
+            os.close(descriptor)
+            self.db_files.append(db_file)
+
+    def _save_users(self, db_file, count, barrier, results):
+        user_storage = UserStorageAdapter(db_file)
+        barrier.wait()
+        for _ in range(count):
+            user_storage.save_user(User())
+            barrier.wait()
+        results[db_file] = len(user_storage.get_users())
+
+    def test_threads_use_own_databases(self):
+        barrier = threading.Barrier(2)
+        results = {}
+        threads = [threading.Thread(target=self._save_users, args=(db_file, count, barrier, results))
+                   for db_file, count in zip(self.db_files, (3, 3))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {self.db_files[0]: 3, self.db_files[1]: 3})
+
+    def test_open_and_close_connections(self):
+        db = UserStorageAdapter(self.db_files[0]).db
+        opened = []
+
+        def serve_request():
+            open_connection()
+            opened.append(not db.is_closed())
+            close_connections()
+            opened.append(not db.is_closed())
+
+        thread = threading.Thread(target=serve_request)
+        thread.start()
+        thread.join()
+        self.assertEqual(opened, [True, False])
+
+    def tearDown(self):
+        close_databases()
+        for db_file in self.db_files:
+            os.remove(db_file)
+
+class TestEngineProfile(unittest.TestCase):
+
+    def setUp(self):
+        descriptor, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+        self.profile = get_engine_profile()
+
+    def test_profile_from_options(self):
+        profile = EngineProfile.from_options({'profile': 'concurrent', 'synchronous': 'off',
+                                              'cache_size': '-2000', 'busy_retry_delay': '0.5'})
+        self.assertEqual(profile.journal_mode, 'wal')
+        self.assertEqual(profile.synchronous, 'off')
+        self.assertEqual(profile.cache_size, -2000)
+        self.assertEqual(profile.busy_retry_delay, 0.5)
+
+        with self.assertRaises(ValueError):
+            EngineProfile.from_options({'profile': 'unknown'})
+        with self.assertRaises(ValueError):
+            EngineProfile.from_options({'page_size': '4096'})
+
+    def test_pragmas_applied(self):
+        set_engine_profile({'profile': 'concurrent', 'busy_timeout': '1234'})
+        db = TaskStorageAdapter(self.db_file).db
+        self.assertEqual(db.execute_sql('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(db.execute_sql('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(db.execute_sql('PRAGMA busy_timeout').fetchone()[0], 1234)
+
+    def _lock_database(self):
+        TaskStorageAdapter(self.db_file)
+        connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        connection.isolation_level = None
+        connection.execute('BEGIN EXCLUSIVE')
+        return connection
+
+    def test_busy_database_retried(self):
+        set_engine_profile(EngineProfile(busy_timeout=1, busy_retries=10, busy_retry_delay=0.01))
+        connection = self._lock_database()
+        timer = threading.Timer(0.1, connection.commit)
+        timer.start()
+        try:
+            user = User()
+            self.assertEqual(UserStorageAdapter(self.db_file).save_user(user), 1)
+        finally:
+            timer.join()
+            connection.close()
+
+    def test_busy_database_fails_without_retries(self):
+        set_engine_profile(EngineProfile(busy_timeout=1))
+        connection = self._lock_database()
+        try:
+            with self.assertRaises(OperationalError):
+                UserStorageAdapter(self.db_file).save_user(User())
+        finally:
+            connection.close()
+
+    def tearDown(self):
+        set_engine_profile(self.profile)
+        close_databases()
+        for path in (self.db_file, self.db_file + '-wal', self.db_file + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = get_engine_profile()
+        self.db_file = self._temp_file()
+        self.snapshot_file = self._temp_file()
+        self.storage_task = TaskStorageAdapter(self.db_file)
+        self.storage_task.save_tasks([self._create_task('task {}'.format(i)) for i in range(200)])
+
+    def _create_task(self, title=None):
+        task = Task()
+        task.pid = 1
+        task.title = title
+        return task
+
+    def _temp_file(self):
+        descriptor, db_file = tempfile.mkstemp(suffix='.db')
+        os.close(descriptor)
+        return db_file
+
+    def _snapshot_titles(self):
+        set_engine_profile('read_only')
+        return sorted(task.title for task in TaskStorageAdapter(self.snapshot_file).get_tasks())
+
+    def test_snapshot_copies_database(self):
+        steps = []
+        total_pages = self.storage_task.snapshot(self.snapshot_file, pages=1,
+                                                 progress=lambda status, remaining, total: steps.append(remaining))
+        self.assertGreater(total_pages, 1)
+        self.assertEqual(len(steps), total_pages)
+        self.assertEqual(steps[-1], 0)
+        self.assertEqual(self._snapshot_titles(), sorted('task {}'.format(i) for i in range(200)))
+
+    def test_writer_not_blocked_between_steps(self):
+        writer = sqlite3.connect(self.db_file, timeout=0, isolation_level=None)
+        written = []
+
+        def write_once(status, remaining, total):
+            if len(written) == 0 and remaining > 0:
+                writer.execute("UPDATE task SET title = 'changed' WHERE tid = 1")
+                written.append(remaining)
+
+        try:
+            self.storage_task.snapshot(self.snapshot_file, pages=1, pause=0, progress=write_once)
+        finally:
+            writer.close()
+        self.assertEqual(len(written), 1)
+        # backup restarts after change by another connection, so snapshot has it
+        self.assertIn('changed', self._snapshot_titles())
+
+    def test_read_only_database_rejects_writes(self):
+        self.storage_task.snapshot(self.snapshot_file)
+        set_engine_profile({'profile': 'default', 'read_only': 'yes'})
+        storage_task = TaskStorageAdapter(self.snapshot_file)
+        self.assertEqual(len(storage_task.get_tasks()), 200)
+        self.assertEqual(storage_task.db.execute_sql('PRAGMA query_only').fetchone()[0], 1)
+        with self.assertRaises(OperationalError):
+            storage_task.save_task(self._create_task())
+        with self.assertRaises(OperationalError):
+            storage_task.db.execute_sql('PRAGMA query_only = 0')
+            storage_task.db.execute_sql('DELETE FROM task')
+
+    def test_read_only_database_is_never_migrated(self):
+        set_engine_profile('read_only')
+        with self.assertRaises(ValueError):
+            get_database(':memory:')
+        empty_file = self._temp_file()
+        try:
+            with self.assertRaises(ValueError):
+                get_database(empty_file)
+        finally:
+            os.remove(empty_file)
+        with self.assertRaises(ValueError):
+            EngineProfile.from_options({'read_only': 'maybe'})
+
+    def tearDown(self):
+        set_engine_profile(self.profile)
+        close_databases()
+        for path in (self.db_file, self.snapshot_file):
+            os.remove(path)
+
+class TestBulkInsert(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_plan = PlanStorageAdapter(_TEST_DB)
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+    def _create_tasks(self, count):
+        tasks = []
+        for i in range(count):
+            task = Task()
+            task.pid = 1
+            task.title = 'Title {}'.format(i)
+            tasks.append(task)
+        return tasks
+
+    def test_save_tasks_returns_tids_in_order(self):
+        self.storage_task.save_task(self._create_tasks(1)[0])
+
+        tasks = self._create_tasks(500)
+        tids = self.storage_task.save_tasks(tasks)
+        self.assertEqual(tids, list(range(2, 502)))
+
+        for tid, task in zip(tids, tasks):
+            task.tid = tid
+        saved_tasks = self.storage_task.get_tasks()
+        self.assertEqual(saved_tasks[1:], tasks)
+
+    def test_save_tasks_empty(self):
+        self.assertEqual(self.storage_task.save_tasks([]), [])
+
+    def test_save_plans_with_excludes(self):
+        self.storage_task.save_tasks(self._create_tasks(2))
+
+        plans = []
+        for tid, exclude in [(1, [3, 5]), (2, [])]:
+            plan = Plan()
+            plan.tid = tid
+            plan.shift = 1000
+            plan.exclude = exclude
+            plans.append(plan)
+
+        plan_ids = self.storage_plan.save_plans(plans)
+        self.assertEqual(plan_ids, [1, 2])
+
+        for plan_id, plan in zip(plan_ids, plans):
+            plan.plan_id = plan_id
+            self.assertEqual(self.storage_plan.get_plans(plan_id=plan_id), [plan])
+
+    def test_save_plan_is_atomic(self):
+        self.storage_task.save_tasks(self._create_tasks(1))
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 1000
+        plan.exclude = [3]
+
+        insert_many = sqlite_peewee_adapters._insert_many
+        def insert_many_and_fail(db, model, rows):
+            if model is PlanRelationsTableModel:
+                raise OperationalError()
+            return insert_many(db, model, rows)
+
+        with mock.patch.object(sqlite_peewee_adapters, '_insert_many', insert_many_and_fail):
+            with self.assertRaises(OperationalError):
+                self.storage_plan.save_plan(plan)
+        self.assertEqual(self.storage_plan.get_plans(), [])
+        self.assertEqual(self.storage_plan.save_plan(plan), 1)
+
+    def test_add_plan_excludes(self):
+        self.storage_task.save_tasks(self._create_tasks(1))
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 1000
+        self.storage_plan.save_plan(plan)
+
+        self.storage_plan.add_plan_excludes(1, [4, 2, 7])
+        self.assertEqual(self.storage_plan.get_plans(plan_id=1)[0].exclude, [4, 2, 7])
+
+class TestRemoveSubtree(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_plan = PlanStorageAdapter(_TEST_DB)
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+    def _create_task(self, parent_tid=None):
+        task = Task()
+        task.pid = 1
+        task.parent_tid = parent_tid
+        task.title = 'Title'
+        return task
+
+    def test_remove_deep_subtree_query_count_is_constant(self):
+        tid = self.storage_task.save_tasks([self._create_task()])[0]
+        root_tid = tid
+        for _ in range(200):
+            tid = self.storage_task.save_tasks([self._create_task(tid)])[0]
+        self.storage_task.save_task(self._create_task())
+
+        with _QueryCounter() as counter:
+            removed_count = self.storage_task.remove_task(root_tid)
+        self.assertEqual(removed_count, 201)
+        self.assertLessEqual(counter.count, 8)
+        self.assertEqual(len(self.storage_task.get_tasks()), 1)
+
+    def test_remove_subtask_common_for_plan(self):
+        self.storage_task.save_tasks([self._create_task(), self._create_task(1), self._create_task()])
+
+        plan = Plan()
+        plan.tid = 2
+        plan.shift = 1000
+        self.storage_plan.save_plan(plan)
+        self.storage_plan.edit_plan_repeat(1, 2, 3)
+
+        removed_count = self.storage_task.remove_task(1)
+        self.assertEqual(removed_count, 3)
+        self.assertEqual(self.storage_task.get_tasks(), [])
+        self.assertEqual(self.storage_plan.get_plans(), [])
+
+    def test_remove_edited_repeat_restores_it(self):
+        self.storage_task.save_tasks([self._create_task(), self._create_task()])
+
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 1000
+        plan.exclude = [3]
+        self.storage_plan.save_plan(plan)
+        self.storage_plan.edit_plan_repeat(1, 2, 2)
+
+        removed_count = self.storage_task.remove_task(2)
+        self.assertEqual(removed_count, 1)
+        self.assertEqual(self.storage_plan.get_plans(plan_id=1)[0].exclude, [3])
+
+class TestEditSubtasks(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_plan = PlanStorageAdapter(_TEST_DB)
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+        tasks = []
+        for parent_tid in (None, 1, 2, 2, None, 1):
+            task = Task()
+            task.pid = 1
+            task.parent_tid = parent_tid
+            task.status = Status.PENDING
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+        plan = Plan()
+        plan.tid = 4
+        plan.shift = 1000
+        self.storage_plan.save_plan(plan)
+
+    def test_get_subtasks(self):
+        self.assertEqual([task.tid for task in self.storage_task.get_subtasks(1)], [2, 3, 4, 6])
+        self.assertEqual([task.tid for task in self.storage_task.get_subtasks(1, skip_plan_tasks=True)],
+                         [2, 3, 6])
+        self.assertEqual(self.storage_task.get_subtasks(5), [])
+
+    def test_edit_subtasks(self):
+        self.assertEqual(self.storage_task.edit_subtasks(1, {Task.Field.status: Status.ACTIVE},
+                                                         skip_plan_tasks=True), 3)
+        self.assertEqual(self.storage_task.edit_subtasks(2, {Task.Field.priority: 2}), 2)
+
+        tasks = self.storage_task.get_tasks()
+        self.assertEqual([(task.tid, task.status, task.priority) for task in tasks],
+                         [(1, Status.PENDING, None), (2, Status.ACTIVE, None), (3, Status.ACTIVE, 2),
+                          (4, Status.PENDING, 2), (5, Status.PENDING, None), (6, Status.ACTIVE, None)])
+
+    def test_skip_plan_tasks_prunes_common_task_subtree(self):
+        self.storage_task.save_tasks([self._create_task(4), self._create_task(2)])
+        self.storage_plan.edit_plan_repeat(1, 2, 8)
+
+        self.assertEqual([task.tid for task in self.storage_task.get_subtasks(1)], [2, 3, 4, 6, 7, 8])
+        self.assertEqual([task.tid for task in self.storage_task.get_subtasks(1, skip_plan_tasks=True)],
+                         [2, 3, 6, 8])
+        self.assertEqual(self.storage_task.edit_subtasks(1, {Task.Field.status: Status.ACTIVE},
+                                                         skip_plan_tasks=True), 4)
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks()
+                          if task.status == Status.ACTIVE], [2, 3, 6, 8])
+
+    def test_edit_deep_subtree_query_count_is_constant(self):
+        tid = 1
+        for _ in range(100):
+            tid = self.storage_task.save_task(self._create_task(tid))
+
+        with _QueryCounter() as counter:
+            edited_count = self.storage_task.edit_subtasks(1, {Task.Field.priority: 2})
+        self.assertEqual(edited_count, 104)
+        self.assertLessEqual(counter.count, 1)
+
+    def _create_task(self, parent_tid):
+        task = Task()
+        task.pid = 1
+        task.parent_tid = parent_tid
+        return task
+
+class TestPlanExcludeRenumbering(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_plan = PlanStorageAdapter(_TEST_DB)
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+        task = Task()
+        task.pid = 1
+        self.storage_task.save_task(task)
+
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 2
+        plan.exclude = list(range(300))
+        self.storage_plan.save_plan(plan)
+
+    def _get_excludes(self):
+        return sorted(self.storage_plan.get_plans(plan_id=1)[0].exclude)
+
+    def test_edit_shift_query_count_is_constant(self):
+        with _QueryCounter() as counter:
+            success = self.storage_plan.edit_plan({Plan.Field.plan_id: 1, Plan.Field.shift: 4})
+        self.assertTrue(success)
+        self.assertLessEqual(counter.count, 6)
+
+        excludes = self._get_excludes()
+        self.assertEqual(excludes, list(range(150)))
+        self.assertTrue(all(type(number) is int for number in excludes))
+
+    def test_shift_start_query_count_is_constant(self):
+        with _QueryCounter() as counter:
+            success = self.storage_plan.recalculate_exclude_when_start_time_shifted(1, 20)
+        self.assertTrue(success)
+        self.assertLessEqual(counter.count, 6)
+
+        excludes = self._get_excludes()
+        self.assertEqual(excludes, list(range(290)))
+        self.assertTrue(all(type(number) is int for number in excludes))
+
+    def test_edit_shift_keeps_excludes_of_other_plans(self):
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 3
+        plan.exclude = [1, 2]
+        plan_id = self.storage_plan.save_plan(plan)
+
+        self.storage_plan.edit_plan({Plan.Field.plan_id: 1, Plan.Field.shift: 6})
+        self.storage_plan.recalculate_exclude_when_start_time_shifted(1, 100)
+        self.assertEqual(sorted(self.storage_plan.get_plans(plan_id=plan_id)[0].exclude), [1, 2])
+
+class TestBulkRemove(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_plan = PlanStorageAdapter(_TEST_DB)
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        for _ in range(2):
+            self.storage_user.save_user(User())
+        for creator in (1, 2):
+            project = Project()
+            project.creator = creator
+            self.storage_project.save_project(project)
+        self.storage_project.add_guest_to_project(1, 2)
+        self.storage_project.add_admin_to_project(2, 1)
+
+        # tasks 1-3 of user 1 in project 1, tasks 4-5 of user 2 in projects 1 and 2,
+        # task 6 of user 2 is edited repeat of plan of task 1
+        tasks = []
+        for uid, pid, parent_tid in ((1, 1, None), (1, 1, 1), (1, 1, 2), (2, 1, None), (2, 2, None), (2, 2, None)):
+            task = Task()
+            task.uid = uid
+            task.pid = pid
+            task.parent_tid = parent_tid
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+        plan = Plan()
+        plan.tid = 1
+        plan.shift = 1000
+        plan.exclude = [1]
+        self.storage_plan.save_plan(plan)
+        self.storage_plan.edit_plan_repeat(1, 2, 6)
+
+    def _tids(self):
+        return [task.tid for task in self.storage_task.get_tasks()]
+
+    def test_remove_tasks_of_user(self):
+        counts = self.storage_task.remove_tasks(uid=1)
+        self.assertEqual(counts, {'task': 4, 'plan': 1, 'plan_relations': 3})
+        self.assertEqual(self._tids(), [4, 5])
+        self.assertEqual(self.storage_plan.get_plans(), [])
+
+    def test_remove_tasks_of_projects(self):
+        counts = self.storage_task.remove_tasks(pids=[2])
+        self.assertEqual(counts, {'task': 2, 'plan': 0, 'plan_relations': 1})
+        self.assertEqual(self._tids(), [1, 2, 3, 4])
+        self.assertEqual(self.storage_plan.get_plans(plan_id=1)[0].exclude, [1])
+
+    def test_remove_user(self):
+        counts = self.storage_user.remove_user(2)
+        self.assertEqual(counts, {'task': 3, 'plan': 0, 'plan_relations': 1,
+                                  'project_relations': 1, 'user': 1})
+        self.assertEqual(self._tids(), [1, 2, 3])
+        self.assertEqual([user.uid for user in self.storage_user.get_users()], [1])
+        self.assertEqual(self.storage_project.get_projects(1)[0].admins, None)
+
+    def test_remove_projects(self):
+        counts = self.storage_project.remove_projects([1])
+        self.assertEqual(counts, {'task': 5, 'plan': 1, 'plan_relations': 3,
+                                  'project_relations': 1, 'project': 1})
+        self.assertEqual(self._tids(), [5])
+        self.assertEqual([project.pid for project in self.storage_project.get_projects(2)], [2])
+
+    def test_remove_user_query_count_is_constant(self):
+        tasks = []
+        for _ in range(200):
+            task = Task()
+            task.uid = 1
+            task.pid = 2
+            task.parent_tid = 2
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+        with _QueryCounter() as counter:
+            counts = self.storage_user.remove_user(1)
+        self.assertEqual(counts['task'], 204)
+        self.assertLessEqual(counter.count, 12)
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_plan = PlanStorageAdapter(_TEST_DB)
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        self.storage_user.save_user(User())
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+        # trees of tasks 1 and 3 are completed, but task 4 is active, task 5
+        # ended too late, task 6 is common task of plan, task 7 is pending
+        tasks = []
+        for parent_tid, status, end in ((None, Status.COMPLETED, 100), (1, Status.COMPLETED, None),
+                                        (None, Status.COMPLETED, 100), (3, Status.ACTIVE, None),
+                                        (None, Status.COMPLETED, 5000), (None, Status.COMPLETED, 100),
+                                        (None, Status.PENDING, None)):
+            task = Task()
+            task.uid = 1
+            task.pid = 1
+            task.title = 'report'
+            task.parent_tid = parent_tid
+            task.status = status
+            task.supposed_end_time = end
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+        plan = Plan()
+        plan.tid = 6
+        plan.shift = 10
+        plan.end = 200
+        plan.exclude = [1]
+        self.storage_plan.save_plan(plan)
+
+    def _tids(self, filter=None, **options):
+        return [task.tid for task in self.storage_task.get_tasks(filter, **options)]
+
+    def test_archive_tasks_moves_completed_trees(self):
+        self.assertEqual(self.storage_task.archive_tasks(1000, batch_size=1), 2)
+        self.assertEqual(self._tids(), [3, 4, 5, 6, 7])
+        self.assertEqual(self._tids(include_archived=True), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(self.storage_task.archive_tasks(1000), 0)
+
+    def test_archive_plans_moves_plan_tasks(self):
+        counts = self.storage_plan.archive_plans(1000)
+        self.assertEqual(counts, {'task': 1, 'plan': 1, 'plan_relations': 2})
+        self.assertEqual(self.storage_plan.get_plans(), [])
+        self.assertEqual(self._tids(), [1, 2, 3, 4, 5, 7])
+        self.assertEqual(self.storage_plan.archive_plans(100), {'task': 0, 'plan': 0, 'plan_relations': 0})
+
+    def test_archived_tasks_are_filtered(self):
+        self.storage_plan.archive_plans(1000)
+        self.storage_task.archive_tasks(1000)
+
+        filter = TaskStorageAdapter.Filter()
+        filter.status(Status.COMPLETED)
+        self.assertEqual(self._tids(filter, include_archived=True, newest_first=True, limit=2), [6, 5])
+        self.assertEqual(self._tids(filter, include_archived=True, after_tid=2), [3, 5, 6])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.filter_range(0, 50)
+        self.assertEqual(self._tids(filter, include_archived=True), [1, 3, 5, 6])
+        filter = TaskStorageAdapter.Filter()
+        filter.filter_range(150, 300)
+        self.assertEqual(self._tids(filter, include_archived=True), [5])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.text_search('report')
+        self.assertEqual(self._tids(filter, include_archived=True), [3, 4, 5, 7])
+
+    def test_archived_tids_are_not_given_again(self):
+        self.storage_task.remove_task(7)
+        self.storage_plan.archive_plans(1000)
+        task = Task()
+        task.pid = 1
+        tids = [self.storage_task.save_task(task)] + self.storage_task.save_tasks([task, task])
+        # sqlite gives tid 6 of archived task again unless adapter prevents it
+        self.assertGreater(tids[0], 6)
+        self.assertEqual(tids[1:], [tids[0] + 1, tids[0] + 2])
+        self.assertEqual(self._tids(include_archived=True), [1, 2, 3, 4, 5, 6] + tids)
+
+    def test_remove_tasks_removes_archived(self):
+        self.storage_plan.archive_plans(1000)
+        self.storage_task.archive_tasks(1000)
+        counts = self.storage_task.remove_tasks(uid=1)
+        self.assertEqual(counts['task'], 7)
+        self.assertEqual(self._tids(include_archived=True), [])
+
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_plan = PlanStorageAdapter(_TEST_DB)
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        for _ in range(2):
+            self.storage_user.save_user(User())
+        for creator in (1, 2):
+            project = Project()
+            project.creator = creator
+            self.storage_project.save_project(project)
+
+        # tasks 1 and 6 are overdue by time 100, task 2 has start only,
+        # task 5 is overdue by status, task 7 is common task of plan
+        tasks = []
+        for uid, status, priority, start, end, deadline in (
+                (1, Status.PENDING, Priority.NORMAL, None, 50, None),
+                (1, Status.ACTIVE, Priority.HIGH, 10, None, None),
+                (1, Status.COMPLETED, Priority.NORMAL, None, 30, None),
+                (1, Status.COMPLETED, Priority.NORMAL, None, 250, None),
+                (2, Status.OVERDUE, Priority.LOW, None, None, None),
+                (1, Status.PENDING, Priority.NORMAL, 10, 1000, 20),
+                (1, Status.ACTIVE, Priority.NORMAL, 10, 15, None)):
+            task = Task()
+            task.uid = uid
+            task.pid = uid
+            task.status = status
+            task.priority = priority
+            task.supposed_start_time = start
+            task.supposed_end_time = end
+            task.deadline_time = deadline
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+        plan = Plan()
+        plan.tid = 7
+        plan.shift = 10
+        plan.end = 100
+        plan.exclude = [3]
+        self.plan_id = self.storage_plan.save_plan(plan)
+
+    def test_count_tasks_by_groups(self):
+        counts = self.storage_task.count_tasks(overdue_time=100)
+        self.assertEqual(counts, {(1, Status.PENDING, Priority.NORMAL): (2, 2),
+                                  (1, Status.ACTIVE, Priority.HIGH): (1, 0),
+                                  (1, Status.ACTIVE, Priority.NORMAL): (1, 1),
+                                  (1, Status.COMPLETED, Priority.NORMAL): (2, 0),
+                                  (2, Status.OVERDUE, Priority.LOW): (1, 1)})
+
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(1)
+        filter.status([Status.PENDING, Status.ACTIVE])
+        self.assertEqual(self.storage_task.count_tasks(filter), {(1, Status.PENDING, Priority.NORMAL): (2, 0),
+                                                                 (1, Status.ACTIVE, Priority.HIGH): (1, 0),
+                                                                 (1, Status.ACTIVE, Priority.NORMAL): (1, 0)})
+
+    def test_archived_tasks_are_counted_when_asked(self):
+        self.storage_task.archive_tasks(100)
+        key = (1, Status.COMPLETED, Priority.NORMAL)
+        self.assertEqual(self.storage_task.count_tasks()[key], (1, 0))
+        self.assertEqual(self.storage_task.count_tasks(include_archived=True)[key], (2, 0))
+
+    def test_count_completed_tasks_by_buckets(self):
+        self.assertEqual(self.storage_task.count_completed_tasks(0, 300, 100), {0: 1, 200: 1})
+        self.storage_task.archive_tasks(100)
+        self.assertEqual(self.storage_task.count_completed_tasks(20, 250, 50), {20: 1})
+
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(2)
+        self.assertEqual(self.storage_task.count_completed_tasks(0, 300, 100, filter), {})
+
+    def test_count_repeats_without_expanding(self):
+        # repeats are 10-15, 20-25, ..., 100-105, repeat 3 is excluded
+        self.assertEqual(self.storage_plan.count_repeats(0, 1000), {self.plan_id: 9})
+        self.assertEqual(self.storage_plan.count_repeats(26, 44), {self.plan_id: 1})
+        self.assertEqual(self.storage_plan.count_repeats(25, 50), {self.plan_id: 3})
+        self.assertEqual(self.storage_plan.count_repeats(16, 19), {})
+        self.assertEqual(self.storage_plan.count_repeats(-100, 5), {})
+
+        self.assertEqual(self.storage_plan.count_repeats(0, 1000, uid=1), {self.plan_id: 9})
+        self.assertEqual(self.storage_plan.count_repeats(0, 1000, uid=2, pids=[1]), {self.plan_id: 9})
+        self.assertEqual(self.storage_plan.count_repeats(0, 1000, pids=[2]), {})
+
+class TestTaskPagination(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+        tasks = []
+        for i in range(10):
+            task = Task()
+            task.pid = 1
+            task.uid = 1
+            task.title = 'Title {}'.format(i)
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+    def test_get_tasks_by_pages(self):
+        tasks = self.storage_task.get_tasks(limit=4)
+        self.assertEqual([task.tid for task in tasks], [1, 2, 3, 4])
+
+        tasks = self.storage_task.get_tasks(limit=4, after_tid=tasks[-1].tid)
+        self.assertEqual([task.tid for task in tasks], [5, 6, 7, 8])
+
+        tasks = self.storage_task.get_tasks(limit=4, after_tid=tasks[-1].tid)
+        self.assertEqual([task.tid for task in tasks], [9, 10])
+
+    def test_get_tasks_newest_first(self):
+        filter = TaskStorageAdapter.Filter()
+        filter.uid(1)
+        tasks = self.storage_task.get_tasks(filter, limit=3, after_tid=5, newest_first=True)
+        self.assertEqual([task.tid for task in tasks], [4, 3, 2])
+
+    def test_get_tasks_of_projects_newest_first(self):
+        filter = TaskStorageAdapter.Filter()
+        filter.pid([1, 2])
+        tasks = self.storage_task.get_tasks(filter, limit=3, newest_first=True)
+        self.assertEqual([task.tid for task in tasks], [10, 9, 8])
+
+        filter = TaskStorageAdapter.Filter()
+        filter.pid([2])
+        self.assertEqual(self.storage_task.get_tasks(filter), [])
+
+    def test_iterate_tasks(self):
+        tasks = self.storage_task.iterate_tasks(after_tid=7)
+        self.assertNotIsInstance(tasks, list)
+        self.assertEqual([task.tid for task in tasks], [8, 9, 10])
+
+class TestTaskTextSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+        tasks = []
+        for title, description in [('Buy milk', 'Milk and bread from the shop'),
+                                   ('Write report', 'Quarterly report for the shop'),
+                                   ('Reply letters', None)]:
+            task = Task()
+            task.pid = 1
+            task.title = title
+            task.description = description
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+    def _search(self, query, fields=None):
+        filter = TaskStorageAdapter.Filter()
+        filter.text_search(query, fields)
+        return [task.tid for task in self.storage_task.get_tasks(filter)]
+
+    def test_search_words_and_prefix(self):
+        self.assertCountEqual(self._search('shop'), [1, 2])
+        self.assertCountEqual(self._search('rep*'), [2, 3])
+        self.assertEqual(self._search('rep'), [])
+
+    def test_search_phrase(self):
+        self.assertEqual(self._search('"milk and bread"'), [1])
+        self.assertEqual(self._search('"bread and milk"'), [])
+
+    def test_search_by_field(self):
+        self.assertEqual(self._search('milk', [Task.Field.title]), [1])
+        self.assertEqual(self._search('report', [Task.Field.description]), [2])
+
+    def test_search_ranked(self):
+        task = Task()
+        task.pid = 1
+        task.title = 'Call about report'
+        self.storage_task.save_task(task)
+
+        self.assertEqual(self._search('report'), [2, 4])
+
+    def test_search_newest_first_is_ordered_by_tid(self):
+        task = Task()
+        task.pid = 1
+        task.title = 'Call about report'
+        self.storage_task.save_task(task)
+
+        filter = TaskStorageAdapter.Filter()
+        filter.text_search('report')
+        tasks = self.storage_task.get_tasks(filter, limit=1, newest_first=True)
+        self.assertEqual([task.tid for task in tasks], [4])
+        tasks = self.storage_task.get_tasks(filter, limit=1, after_tid=4, newest_first=True)
+        self.assertEqual([task.tid for task in tasks], [2])
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(self._search('milk OR'), [])
+        self.assertEqual(self._search('title: milk - "'), [])
+        self.assertEqual(self._search('"'), [])
+        self.assertEqual(self._search(''), [])
+
+    def test_index_follows_task_changes(self):
+        self.storage_task.edit_task({Task.Field.tid: 1, Task.Field.title: 'Buy tea'})
+        self.assertEqual(self._search('tea'), [1])
+        self.assertEqual(self._search('milk', [Task.Field.title]), [])
+
+        self.storage_task.remove_task(2)
+        self.assertEqual(self._search('shop'), [1])
+
+class TestTaskIntervalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+        self.base_time = utils.datetime_to_milliseconds(datetime.datetime(2030, 1, 1))
+        self.hour = 60 * 60 * 1000
+        tasks = []
+        for start, end, deadline in [(0, 2, 4), (None, 3, None), (None, None, 5), (6, None, None),
+                                     (1, None, 8), (None, None, None), (10, 12, None), (None, 1, 20)]:
+            task = Task()
+            task.pid = 1
+            task.supposed_start_time = self._time(start)
+            task.supposed_end_time = self._time(end)
+            task.deadline_time = self._time(deadline)
+            tasks.append(task)
+        self.storage_task.save_tasks(tasks)
+
+    def _time(self, hours):
+        if hours is None:
+            return None
+        return self.base_time + hours * self.hour + 1
+
+    def _range(self, start, end):
+        filter = TaskStorageAdapter.Filter()
+        filter.filter_range(self._time(start), self._time(end))
+        return [task.tid for task in self.storage_task.get_tasks(filter)]
+
+    def _overdue(self, time):
+        filter = TaskStorageAdapter.Filter()
+        filter.overdue_by_time(self._time(time))
+        return [task.tid for task in self.storage_task.get_tasks(filter)]
+
+    def test_filter_range(self):
+        self.assertEqual(self._range(-5, -1), [2, 3, 8])
+        self.assertEqual(self._range(4, 5), [1, 3, 5, 8])
+        self.assertEqual(self._range(6, 6), [4, 5, 8])
+        self.assertEqual(self._range(13, 30), [4, 8])
+
+    def test_overdue_by_time(self):
+        self.assertEqual(self._overdue(0), [])
+        self.assertEqual(self._overdue(2.5), [1, 8])
+        self.assertEqual(self._overdue(9), [1, 2, 3, 5, 8])
+
+    def test_index_follows_task_changes(self):
+        self.storage_task.edit_task({Task.Field.tid: 6, Task.Field.supposed_start_time: self._time(30)})
+        self.storage_task.edit_task({Task.Field.tid: 4, Task.Field.supposed_start_time: None})
+        self.storage_task.remove_task(8)
+        self.assertEqual(self._range(13, 30), [6])
+
+    def test_borders_follow_task_changes(self):
+        def borders(tid):
+            task_model = TaskTableModel.get_by_id(tid)
+            return task_model.left_border, task_model.right_border
+
+        self.assertEqual(borders(1), (self._time(0), self._time(4)))
+        self.assertEqual(borders(3), (self._time(5), self._time(5)))
+        self.assertEqual(borders(6), (None, None))
+
+        self.storage_task.edit_task({Task.Field.tid: 6, Task.Field.deadline_time: self._time(7)})
+        self.assertEqual(borders(6), (self._time(7), self._time(7)))
+
+        task = self.storage_task.get_tasks()[0]
+        task.supposed_start_time = None
+        self.storage_task.edit_task_from_model(task)
+        self.assertEqual(borders(1), (self._time(2), self._time(4)))
+
+    def test_to_time(self):
+        filter = TaskStorageAdapter.Filter()
+        filter.to_time(self._time(2))
+        self.assertEqual([task.tid for task in self.storage_task.get_tasks(filter)], [1, 5, 8])
+
+
+class TestTransaction(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_task = TaskStorageAdapter(_TEST_DB)
+        self.storage_user = UserStorageAdapter(_TEST_DB)
+        self.storage_project = ProjectStorageAdapter(_TEST_DB)
+
+        user = User()
+        self.storage_user.save_user(user)
+        project = Project()
+        project.creator = 1
+        self.storage_project.save_project(project)
+
+    def _create_task(self, title='Title'):
+        task = Task()
+        task.pid = 1
+        task.uid = 1
+        task.title = title
+        return task
+
+    def _titles(self):
+        return [task.title for task in self.storage_task.get_tasks()]
+
+    def test_error_rolls_back_transaction(self):
+        with self.assertRaises(ValueError):
+            with self.storage_task.transaction():
+                self.storage_task.save_task(self._create_task())
+                raise ValueError()
+        self.assertEqual(self._titles(), [])
+
+    def test_nested_transaction_is_savepoint(self):
+        with self.storage_task.transaction():
+            self.storage_task.save_task(self._create_task('Outer'))
+            with self.assertRaises(ValueError):
+                with self.storage_project.transaction():
+                    self.storage_task.save_task(self._create_task('Inner'))
+                    raise ValueError()
+        self.assertEqual(self._titles(), ['Outer'])
+
+    def test_delete_user_is_atomic(self):
+        self.storage_task.save_tasks([self._create_task(), self._create_task()])
+
+        remove_tasks = TaskStorageAdapter.remove_tasks
+        def remove_tasks_and_fail(adapter, uid=None, pids=None):
+            remove_tasks(adapter, uid, pids)
+            raise ValueError()
+
+        TaskStorageAdapter.remove_tasks = remove_tasks_and_fail
+        try:
+            with self.assertRaises(ValueError):
+                self.storage_user.delete_user(1)
+        finally:
+            TaskStorageAdapter.remove_tasks = remove_tasks
+        self.assertEqual(len(self._titles()), 2)
+        self.assertEqual(len(self.storage_user.get_users()), 1)
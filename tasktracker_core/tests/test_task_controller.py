@@ -1,11 +1,14 @@
 import unittest
 import datetime
 
-from tasktracker_core.requests.controllers import TaskController, Controller, InvalidParentIdError
+from tasktracker_core.requests.controllers import (TaskController, UserController, PlanController, Controller,
+                                                   ChangeController, StatisticsController,
+                                                   InvalidParentIdError, InvalidStatusError)
 from tasktracker_core.model.task import Task, Status, Priority
 from tasktracker_core.model.plan import Plan
 from tasktracker_core.model.user import User
 from tasktracker_core.model.project import Project
+from tasktracker_core.model.change import Change
 from tasktracker_core import utils
 
 class TestTaskController(unittest.TestCase):
@@ -111,4 +114,249 @@ class TestTaskController(unittest.TestCase):
         task2.supposed_start_time = 12000
         task2.supposed_end_time = 14000
 
-        self.assertEqual(task2, tasks[1])
\ No newline at end of file
+        self.assertEqual(task2, tasks[1])
+
+class TestControllerTransaction(unittest.TestCase):
+
+    class _TransactionalController(TaskController):
+
+        @Controller.transactional
+        def save_task_and_return(self, result):
+            self.save_task(title='Title')
+            return result
+
+        @Controller.transactional
+        def save_task_and_raise(self):
+            self.save_task(title='Title')
+            raise ValueError()
+
+    def setUp(self):
+        controller = Controller()
+        controller.init_storage_adapters(db_file=':memory:')
+        uid = UserController(controller).save_user('user')
+        controller.authentication(uid)
+        self.controller = self._TransactionalController(controller)
+
+    def _task_count(self):
+        return len(self.controller.fetch_tasks())
+
+    def test_commit_on_success(self):
+        self.controller.save_task_and_return(True)
+        self.assertEqual(self._task_count(), 1)
+
+    def test_rollback_on_false(self):
+        self.assertEqual(self.controller.save_task_and_return(False), False)
+        self.assertEqual(self._task_count(), 0)
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(ValueError):
+            self.controller.save_task_and_raise()
+        self.assertEqual(self._task_count(), 0)
+
+    def test_nested_controllers_share_transaction(self):
+        with self.controller.transaction():
+            TaskController(self.controller).save_task(title='Outer')
+            self.controller.save_task_and_return(False)
+        self.assertEqual([task.title for task in self.controller.fetch_tasks()], ['Outer'])
+
+class TestEditTaskCascade(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.controller.init_storage_adapters(db_file=':memory:')
+        uid = UserController(self.controller).save_user('user')
+        self.controller.authentication(uid)
+        self.start = 4102444800000
+        task_controller = TaskController(self.controller)
+        self.root_tid = task_controller.save_task(title='Root', supposed_start=self.start,
+                                                  supposed_end=self.start + 100)
+        self.child_tid = task_controller.save_task(title='Child', parent_tid=self.root_tid)
+        self.grandchild_tid = task_controller.save_task(title='Grandchild', parent_tid=self.child_tid)
+        # plans are attached to tasks without parent only, task becomes subtask later
+        self.planned_tid = task_controller.save_task(title='Planned', supposed_start=self.start + 10,
+                                                     supposed_end=self.start + 20)
+        PlanController(self.controller).attach_plan(self.planned_tid, 1000)
+        task_controller.edit_task(self.planned_tid, parent_tid=self.root_tid)
+
+    def _statuses_and_priorities(self):
+        tasks = self.controller._task_storage.get_tasks()
+        return {task.tid: (task.status, task.priority) for task in tasks}
+
+    def test_status_and_priority_are_set_to_subtree(self):
+        self.assertTrue(TaskController(self.controller).edit_task(self.root_tid, status=Status.ACTIVE,
+                                                                  priority=Priority.HIGH))
+
+        self.assertEqual(self._statuses_and_priorities(),
+                         {self.root_tid: (Status.ACTIVE, Priority.HIGH),
+                          self.child_tid: (Status.ACTIVE, Priority.HIGH),
+                          self.grandchild_tid: (Status.ACTIVE, Priority.HIGH),
+                          self.planned_tid: (Status.PENDING, Priority.HIGH)})
+
+    def test_invalid_status_of_subtask_changes_nothing(self):
+        self.controller._task_storage.edit_task({Task.Field.tid: self.grandchild_tid,
+                                                 Task.Field.supposed_start_time: 0,
+                                                 Task.Field.supposed_end_time: 10})
+        before = self._statuses_and_priorities()
+        with self.assertRaises(InvalidStatusError):
+            TaskController(self.controller).edit_task(self.root_tid, status=Status.ACTIVE)
+        self.assertEqual(self._statuses_and_priorities(), before)
+
+    def test_status_is_not_set_below_common_task_but_set_to_edited_repeat(self):
+        storage_task = self.controller._task_storage
+        planned_child = Task()
+        planned_child.pid = storage_task.get_tasks()[0].pid
+        planned_child.uid = self.controller._user_login_id
+        planned_child.parent_tid = self.planned_tid
+        planned_child.status = Status.PENDING
+        planned_child_tid = storage_task.save_task(planned_child)
+        edited_tid = TaskController(self.controller).save_task(title='Edited', parent_tid=self.child_tid)
+        plan = PlanController(self.controller).get_plan_for_common_task(self.planned_tid)[0]
+        self.controller._plan_storage.edit_plan_repeat(plan.plan_id, 1, edited_tid)
+
+        self.assertTrue(TaskController(self.controller).edit_task(self.root_tid, status=Status.ACTIVE))
+
+        statuses = {tid: status for tid, (status, _) in self._statuses_and_priorities().items()}
+        self.assertEqual(statuses[edited_tid], Status.ACTIVE)
+        self.assertEqual(statuses[self.planned_tid], Status.PENDING)
+        self.assertEqual(statuses[planned_child_tid], Status.PENDING)
+
+class TestArchiveTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.controller.init_storage_adapters(db_file=':memory:')
+        uid = UserController(self.controller).save_user('user')
+        self.controller.authentication(uid)
+        task_controller = TaskController(self.controller)
+        self.old_tid = task_controller.save_task(title='Old')
+        self.recent_tid = task_controller.save_task(title='Recent')
+        self.pending_tid = task_controller.save_task(title='Pending')
+        now = utils.datetime_to_milliseconds(utils.now())
+        for tid, end in ((self.old_tid, 1000), (self.recent_tid, now)):
+            self.controller._task_storage.edit_task({Task.Field.tid: tid, Task.Field.supposed_end_time: end,
+                                                     Task.Field.status: Status.COMPLETED})
+
+    def _fetched_tids(self, **options):
+        return [task.tid for task in TaskController(self.controller).fetch_tasks(**options)]
+
+    def test_archived_tasks_are_fetched_when_asked(self):
+        counts = TaskController(self.controller).archive_tasks()
+        self.assertEqual(counts, {Change.Entity.task: 1, Change.Entity.plan: 0, Change.Entity.plan_relations: 0})
+
+        self.assertEqual(self._fetched_tids(), [self.recent_tid, self.pending_tid])
+        self.assertEqual(self._fetched_tids(status=Status.COMPLETED), [self.old_tid, self.recent_tid])
+        self.assertEqual(self._fetched_tids(status=[Status.PENDING, Status.COMPLETED]),
+                         [self.old_tid, self.recent_tid, self.pending_tid])
+        self.assertEqual(self._fetched_tids(include_archived=True),
+                         [self.old_tid, self.recent_tid, self.pending_tid])
+
+    def test_archive_age(self):
+        self.assertEqual(TaskController(self.controller).archive_tasks(age=10**15)[Change.Entity.task], 0)
+        self.assertEqual(self._fetched_tids(), [self.old_tid, self.recent_tid, self.pending_tid])
+
+class TestFetchTasksCursor(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.controller.init_storage_adapters(db_file=':memory:')
+        uid = UserController(self.controller).save_user('user')
+        self.controller.authentication(uid)
+        start = 4102444800000
+        for number in range(5):
+            TaskController(self.controller).save_task(title='Task {}'.format(number),
+                                                      supposed_start=start + number,
+                                                      supposed_end=start + number + 10)
+        PlanController(self.controller).attach_plan(4, 1000)
+        self.time_range = (start, start + 100)
+
+    def _fetch_pages(self, limit):
+        pages = []
+        after_tid = None
+        while True:
+            tasks, after_tid = TaskController(self.controller).fetch_tasks(time_range=self.time_range,
+                                                                            limit=limit, after_tid=after_tid,
+                                                                            newest_first=True, with_cursor=True)
+            pages.append(([task.tid for task in tasks], after_tid))
+            if after_tid is None:
+                return pages
+
+    def test_page_of_skipped_plan_task_has_cursor(self):
+        self.assertEqual(self._fetch_pages(1), [([5, 4], 5), ([], 4), ([3], 3), ([2], 2), ([1], 1), ([], None)])
+
+    def test_cursor_is_last_stored_tid(self):
+        self.assertEqual(self._fetch_pages(2), [([5, 4], 4), ([3, 2], 2), ([1], None)])
+
+    def test_lazy_with_cursor_is_rejected(self):
+        with self.assertRaises(ValueError):
+            TaskController(self.controller).fetch_tasks(lazy=True, with_cursor=True)
+
+class TestChangeController(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.controller.init_storage_adapters(db_file=':memory:')
+        self.other_uid = UserController(self.controller).save_user('other')
+        uid = UserController(self.controller).save_user('user')
+        self.controller.authentication(uid)
+
+    def test_changes_since_revision(self):
+        revision = ChangeController(self.controller).get_current_revision()
+        tid = TaskController(self.controller).save_task(title='Title')
+        TaskController(self.controller).edit_task(tid, title='Edited')
+
+        changes = ChangeController(self.controller).fetch_changes(revision)
+        self.assertEqual([(change.entity, change.entity_id, change.kind) for change in changes],
+                         [(Change.Entity.task, tid, Change.Kind.INSERT), (Change.Entity.task, tid, Change.Kind.UPDATE)])
+        self.assertEqual(changes[1].fields, [Task.Field.title])
+        self.assertEqual(ChangeController(self.controller).get_current_revision(), changes[-1].revision)
+        self.assertEqual(ChangeController(self.controller).fetch_changes(changes[-1].revision), [])
+
+    def test_changes_of_other_users_are_hidden(self):
+        changes = ChangeController(self.controller).fetch_changes()
+        self.assertNotIn(self.other_uid, [change.uid for change in changes])
+
+class TestStatisticsController(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.controller.init_storage_adapters(db_file=':memory:')
+        self.other_uid = UserController(self.controller).save_user('other')
+        uid = UserController(self.controller).save_user('user')
+        self.controller.authentication(uid)
+        task_controller = TaskController(self.controller)
+        self.start = 4102444800000
+        task_controller.save_task(title='Timeless', priority=Priority.HIGH)
+        self.planned_tid = task_controller.save_task(title='Planned', supposed_start=self.start,
+                                                     supposed_end=self.start + 10)
+        completed_tid = task_controller.save_task(title='Completed')
+        self.controller._task_storage.edit_task({Task.Field.tid: completed_tid, Task.Field.status: Status.COMPLETED,
+                                                 Task.Field.supposed_end_time: self.start + StatisticsController.DAY})
+
+    def test_task_statistics(self):
+        statistics = StatisticsController(self.controller).get_task_statistics(time=self.start + 100)
+        self.assertEqual(statistics.total, 3)
+        self.assertEqual(statistics.overdue, 1)
+        self.assertEqual(statistics.by_status, {Status.PENDING: 2, Status.COMPLETED: 1})
+        self.assertEqual(statistics.by_priority[Priority.HIGH], 1)
+        self.assertEqual(list(statistics.by_project.values()), [3])
+        self.assertEqual(StatisticsController(self.controller).get_task_statistics(time=self.start).overdue, 0)
+
+        pid = list(statistics.by_project)[0]
+        self.assertEqual(StatisticsController(self.controller).get_task_statistics(pid=[pid]).total, 3)
+        self.controller.authentication(self.other_uid)
+        self.assertEqual(StatisticsController(self.controller).get_task_statistics().total, 0)
+
+    def test_completed_histogram(self):
+        day = StatisticsController.DAY
+        histogram = StatisticsController(self.controller).get_completed_histogram((self.start, self.start + 3*day - 1))
+        self.assertEqual(histogram, [(self.start, 0), (self.start + day, 1), (self.start + 2*day, 0)])
+
+    def test_plan_repeat_counts_match_expanded_repeats(self):
+        plan_controller = PlanController(self.controller)
+        plan_id = plan_controller.attach_plan(self.planned_tid, 1000, end=self.start + 8000)
+        plan_controller.delete_repeats_from_plan_by_number(plan_id, 2)
+        for time_range in ((self.start, self.start + 20000), (self.start + 1005, self.start + 4000),
+                           (self.start + 11, self.start + 999), (self.start - 100, self.start)):
+            counts = StatisticsController(self.controller).get_plan_repeat_counts(time_range)
+            self.assertEqual(counts.get(plan_id, 0),
+                             len(plan_controller.get_repeats_by_time_range(plan_id, time_range)))
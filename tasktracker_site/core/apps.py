@@ -1,5 +1,27 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started, request_finished
+
+from tasktracker_core.storage.sqlite_peewee_adapters import (set_engine_profile,
+                                                             open_connection,
+                                                             close_connections)
+
+
+def open_database_connection(sender, **kwargs):
+    open_connection()
+
+def close_database_connections(sender, **kwargs):
+    close_connections()
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        engine_options = getattr(settings, 'TASKTRACKER_DATABASE_ENGINE', None)
+        if engine_options:
+            set_engine_profile(engine_options)
+
+        # every thread of server has own connection, it lives while request
+        request_started.connect(open_database_connection)
+        request_finished.connect(close_database_connections)
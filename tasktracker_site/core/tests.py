@@ -0,0 +1,37 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.http import QueryDict
+from django.test import SimpleTestCase, RequestFactory
+
+from . import views
+
+
+class TestGetAfterTid(SimpleTestCase):
+
+    def test_empty_cursor(self):
+        self.assertIsNone(views._get_after_tid(QueryDict('')))
+        self.assertIsNone(views._get_after_tid(QueryDict('after=')))
+
+    def test_valid_cursor(self):
+        self.assertEqual(views._get_after_tid(QueryDict('after=42')), 42)
+
+    def test_invalid_cursor_is_first_page(self):
+        self.assertIsNone(views._get_after_tid(QueryDict('after=abc')))
+        self.assertIsNone(views._get_after_tid(QueryDict('after=1.5')))
+
+
+class TestProjectTasksView(SimpleTestCase):
+
+    def test_invalid_cursor_is_first_page(self):
+        request = RequestFactory().get('/projects/1/tasks', {'after': 'abc'})
+        request.user = User(username='user')
+        request.session = {}
+        with mock.patch.object(views, 'Controller'), \
+             mock.patch.object(views, 'ProjectController'), \
+             mock.patch.object(views, 'TaskController') as task_controller, \
+             mock.patch.object(views, 'render') as render:
+            task_controller.return_value.fetch_tasks.return_value = ([], None)
+            views.project_tasks(request, 1)
+        self.assertIsNone(task_controller.return_value.fetch_tasks.call_args[1]['after_tid'])
+        self.assertTrue(render.called)
@@ -30,6 +30,17 @@ from tasktracker_core.model.task import Priority, Status
 from tasktracker_core.model.project import Project
 from tasktracker_core.model.plan import Plan
 
+TASKS_PAGE_SIZE = 50
+
+def _get_after_tid(query_dict):
+    after = query_dict.get('after')
+    if after is None or len(after) == 0:
+        return None
+    try:
+        return int(after)
+    except ValueError:
+        return None
+
 class VisualTaskData():
 
     def __init__(self):
@@ -184,8 +195,6 @@ class VisualPlanData():
                 exclude_obj.kind = PlanController(controller).get_exclude_type(lib_plan.plan_id, exclude)
                 if exclude_obj.kind == Plan.PlanExcludeKind.EDITED:
                     exclude_obj.tid = PlanController(controller).get_tid_for_edit_repeat(lib_plan.plan_id, exclude)
-                    if exclude_obj.tid is not None:
-                        exclude_obj.tid = exclude_obj.tid.tid
                 time_range = PlanController(controller).get_time_for_repeat(lib_plan.plan_id, exclude)
                 if len(time_range) == 2:
                     exclude_obj.time = (VisualTaskData.timestamp_to_display(time_range[0]), VisualTaskData.timestamp_to_display(time_range[1]))
@@ -268,11 +277,14 @@ class VisualProjectData():
 
 def require_lib(method):
     def check(request, *args, **kwargs):
+        # controller holds authenticated user, so it is never shared
+        # between requests
         controller = Controller()
         controller.authentication_by_login(request.user.username)
-        result = method(controller, request, *args, **kwargs)
-        controller.logout()
-        return result
+        try:
+            return method(controller, request, *args, **kwargs)
+        finally:
+            controller.logout()
     return check
 
 def log_in_user(request, username, password):
@@ -544,10 +556,12 @@ def project_tasks(controller, request, project_id):
     if projects is not None and len(projects) != 0:
         back_text = projects[0].name
 
-    tasks = TaskController(controller).fetch_tasks(pid=project_id)
-    tasks = list(reversed(tasks))
+    tasks, next_after = TaskController(controller).fetch_tasks(pid=project_id, limit=TASKS_PAGE_SIZE,
+                                                   after_tid=_get_after_tid(request.GET), newest_first=True,
+                                                   with_cursor=True)
     visual_tasks = [VisualTaskData.from_lib_task(controller, task) for task in tasks]
-    return render(request, 'core/projects_task_list.html', {'tasks':visual_tasks, 'back_text': back_text})
+    return render(request, 'core/projects_task_list.html', {'tasks':visual_tasks, 'back_text': back_text,
+                                                            'next_after': next_after})
 
 @login_required
 @require_lib
@@ -612,7 +626,7 @@ def search(controller, request):
             description = form.cleaned_data.get('description')
             if len(description) == 0:
                 description = None
-            
+
             priority_list = form.cleaned_data.get('priority')
             if len(priority_list) == 0:
                 priority_list = None
@@ -651,27 +665,28 @@ def search(controller, request):
                 timeless = None
 
             if project_pid is None or len(project_pid) == 0:
-            
-                tasks = TaskController(controller).fetch_tasks(title=title, description=description,
-                                               priority=priority_list, status=status_list,
-                                               time_range=time_range, timeless=timeless)
+                project_pid = None
             else:
                 project_pid = [int(p) for p in project_pid]
-                tasks = []
-                for p in project_pid:
-                    tasks += TaskController(controller).fetch_tasks(pid=p, title=title, description=description,
-                                               priority=priority_list, status=status_list,
-                                               time_range=time_range, timeless=timeless)   
+
+            # tasks found by text search are paged by tid too
+            tasks, next_after = TaskController(controller).fetch_tasks(pid=project_pid, title=title,
+                                               description=description, priority=priority_list,
+                                               status=status_list, time_range=time_range, timeless=timeless,
+                                               limit=TASKS_PAGE_SIZE, after_tid=_get_after_tid(request.POST),
+                                               newest_first=True, with_cursor=True)
         else:
-            tasks = TaskController(controller).fetch_tasks()   
+            tasks, next_after = TaskController(controller).fetch_tasks(limit=TASKS_PAGE_SIZE, newest_first=True,
+                                                                       with_cursor=True)
     else:
         form = TaskSearchForm()
-        tasks = TaskController(controller).fetch_tasks()
+        tasks, next_after = TaskController(controller).fetch_tasks(limit=TASKS_PAGE_SIZE,
+                                                       after_tid=_get_after_tid(request.GET), newest_first=True,
+                                                       with_cursor=True)
 
-    tasks = list(reversed(tasks))
     visual_tasks = [VisualTaskData.from_lib_task(controller, task) for task in tasks]
-    
-    return render(request, 'core/search.html', {'form':form, 'tasks':visual_tasks, 'projects': visual_projects})
+    return render(request, 'core/search.html', {'form':form, 'tasks':visual_tasks, 'projects': visual_projects,
+                                                'next_after': next_after})
 
 def _task_change_common(controller, request, on_task_changed, plan_id=None, repeat=None, initial_task=None):
     def to_utc(datetime_object):
@@ -801,13 +816,12 @@ def add_task(controller, request, project_id=None):
     def on_task_created(title, description, priority, supposed_start,
                         supposed_end, deadline, project_pid, shift_milliseconds):
         parent_task = request.session.get('parent_task')
-        TaskController(controller).save_task(pid=project_pid, parent_tid=parent_task, title=title, 
+        tid = TaskController(controller).save_task(pid=project_pid, parent_tid=parent_task, title=title, 
                                     description=description,
                                      priority=priority, supposed_start=supposed_start,
                                      supposed_end=supposed_end, deadline_time=deadline)
 
         if shift_milliseconds is not None and shift_milliseconds != 0:
-            tid = TaskController(controller).get_last_saved_task_tid()
             PlanController(controller).attach_plan(tid, shift_milliseconds)
 
     return _task_change_common(controller, request, on_task_created)
@@ -845,8 +859,7 @@ def edit_task(controller, request, task_id):
             if shift_milliseconds is not None and shift_milliseconds != 0:
                 plans = PlanController(controller).get_plan_for_common_task(task_id)
                 if plans is None or len(plans) == 0:
-                    tid = TaskController(controller).get_last_saved_task_tid()
-                    PlanController(controller).attach_plan(tid, shift_milliseconds)
+                    PlanController(controller).attach_plan(task_id, shift_milliseconds)
                 else:
                     plan = plans[0]
                     PlanController(controller).edit_plan(plan.plan_id, shift=shift_milliseconds)
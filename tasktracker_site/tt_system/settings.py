@@ -83,6 +83,15 @@ DATABASES = {
     }
 }
 
+# Engine of task tracker database, see EngineProfile in
+# tasktracker_core.storage.sqlite_peewee_adapters for options.
+# Site and console jobs share database file, so writers should wait
+# for lock and not block readers
+
+TASKTRACKER_DATABASE_ENGINE = {
+    'profile': 'concurrent',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators